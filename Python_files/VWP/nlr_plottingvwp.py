@@ -20,6 +20,7 @@ import nlr_functions as ft
 from VWP.vvp import VVP
 from VWP import sfc_obs
 from VWP import vwp_functions as f
+from VWP import vwp_archive
 
 
 
@@ -770,4 +771,17 @@ class PlottingVWP(QObject):
         self.updating_vwp = False
         self.data_name = self.get_current_data_name()
         self.data_radar = self.crd.radar
-        self.data_datetime = self.crd.date+self.crd.time
\ No newline at end of file
+        self.data_datetime = self.crd.date+self.crd.time
+        
+    def get_time_height_data(self, startdatetime=None, enddatetime=None):
+        """Returns VVP profiles for the current radar and dataset from the time-height store (see vwp_archive.py), for the current VVP
+        settings and for datetimes between startdatetime and enddatetime (YYYYMMDDHHMM). Returns None when no profiles are available.
+        Profiles are added to the store by vwp_archive.VWPArchiveGenerator, with the same keys (see vwp_archive.get_store_and_keys).
+        """
+        try:
+            vvp = VVP(None, **vwp_archive.get_settings(self.gui))
+            store, group_name, vvp_version = vwp_archive.get_store_and_keys(self.gui, vvp)
+            return store.read(group_name, startdatetime, enddatetime, vvp_version)
+        except Exception as e:
+            print(e, 'get_time_height_data')
+            return None
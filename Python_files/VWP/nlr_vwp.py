@@ -9,6 +9,7 @@ from PyQt5.QtWidgets import *
 
 import nlr_globalvars as gv
 import nlr_functions as ft
+from VWP import vwp_archive
 
 
 
@@ -89,6 +90,12 @@ class GUI_VWP():
         self.change_display_settings_action = QAction('Change display settings')
         menu.addAction(self.change_display_settings_action)
         self.change_display_settings_action.triggered.connect(self.show_display_settings_window)        
+        
+        menu.addSeparator()
+        
+        self.generate_vwp_archive_action = QAction('Generate VWPs for date and time range')
+        menu.addAction(self.generate_vwp_archive_action)
+        self.generate_vwp_archive_action.triggered.connect(self.show_vwp_archive_window)
             
         menu.popup(self.gui.mapToGlobal(pos))
         
@@ -377,4 +384,80 @@ class GUI_VWP():
             
     def change_vwp_sm_display(self, sm):
         self.gui.vwp_sm_display[sm] = True if self.vwp_sm_displayw[sm].checkState() == 2 else False
-        self.update_vwp()
\ No newline at end of file
+        self.update_vwp()
+        
+        
+    def show_vwp_archive_window(self):
+        self.vwp_archive_window=QWidget()
+        self.vwp_archive_window.setWindowTitle('Generate VWPs for date and time range')
+        
+        hbox_datetimes=QHBoxLayout()
+        self.vwp_archive_startdatew=QLineEdit(self.gui.crd.selected_date)
+        self.vwp_archive_startdatew.setToolTip('Start date (YYYYMMDD)')
+        self.vwp_archive_starttimew=QLineEdit('0000')
+        self.vwp_archive_starttimew.setToolTip('Start time (HHMM)')
+        self.vwp_archive_enddatew=QLineEdit(self.gui.crd.selected_date)
+        self.vwp_archive_enddatew.setToolTip('End date (YYYYMMDD)')
+        self.vwp_archive_endtimew=QLineEdit('2359')
+        self.vwp_archive_endtimew.setToolTip('End time (HHMM)')
+        hbox_datetimes.addWidget(self.vwp_archive_startdatew); hbox_datetimes.addWidget(self.vwp_archive_starttimew)
+        hbox_datetimes.addWidget(self.vwp_archive_enddatew); hbox_datetimes.addWidget(self.vwp_archive_endtimew)
+        
+        hbox_buttons=QHBoxLayout()
+        self.vwp_archive_startw=QPushButton('Start', autoDefault=True)
+        self.vwp_archive_stopw=QPushButton('Stop')
+        hbox_buttons.addWidget(self.vwp_archive_startw); hbox_buttons.addWidget(self.vwp_archive_stopw)
+        self.vwp_archive_infow=QLineEdit(); self.vwp_archive_infow.setReadOnly(True)
+        
+        layout=QVBoxLayout()
+        layout.addWidget(QLabel('Calculate VWPs for all radar volumes of the current radar and dataset in the selected date and time range, with the current VVP settings.'))
+        layout.addWidget(QLabel('Profiles are written to the time-height store in the derived products directory (VWP/radar_dataset/subdataset/time_height.h5).'))
+        layout.addWidget(QLabel('Volumes for which a profile is already present in the store are skipped. The main window is disabled during generation.'))
+        layout.addLayout(hbox_datetimes)
+        layout.addLayout(hbox_buttons)
+        layout.addWidget(self.vwp_archive_infow)
+        
+        self.vwp_archive_startdatew.editingFinished.connect(self.update_vwp_archive_enddate)
+        self.vwp_archive_startw.clicked.connect(self.generate_vwp_archive)
+        self.vwp_archive_stopw.clicked.connect(self.stop_vwp_archive_generation)
+        
+        self.vwp_archive_window.setLayout(layout)
+        self.vwp_archive_window.resize(self.vwp_archive_window.sizeHint())
+        self.vwp_archive_window.show()
+        
+    def update_vwp_archive_enddate(self):
+        self.vwp_archive_enddatew.setText(self.vwp_archive_startdatew.text())
+        
+    def update_vwp_archive_infow(self, text, color):
+        self.vwp_archive_infow.setStyleSheet('QLineEdit {color:'+color+'}')
+        self.vwp_archive_infow.setText(text); self.vwp_archive_infow.repaint()
+        
+    def update_vwp_archive_progress(self, n_done, n_total):
+        self.update_vwp_archive_infow(f'{n_done}/{n_total} radar volumes', 'black')
+        # Handles clicks at the stop button. Other user input is not handled, since the main window is disabled.
+        QApplication.processEvents()
+        
+    def generate_vwp_archive(self):
+        self.update_vwp_archive_infow('', 'black')
+        startdate=self.vwp_archive_startdatew.text(); starttime=self.vwp_archive_starttimew.text()
+        enddate=self.vwp_archive_enddatew.text(); endtime=self.vwp_archive_endtimew.text()
+        if not ft.correct_datetimeinput(startdate,starttime) or not ft.correct_datetimeinput(enddate,endtime) or startdate+starttime > enddate+endtime:
+            self.update_vwp_archive_infow('Incorrect dates and/or times', 'red')
+            return
+        
+        # The generator changes the state of crd and dsg while importing a volume, and should therefore not be interrupted by user input
+        # for the main window
+        self.vwp_archive_generator = vwp_archive.VWPArchiveGenerator(self.gui)
+        self.gui.setEnabled(False); self.vwp_archive_startw.setEnabled(False)
+        try:
+            filename = self.vwp_archive_generator(startdate+starttime, enddate+endtime, self.update_vwp_archive_progress)
+            self.update_vwp_archive_infow(('Stopped' if self.vwp_archive_generator.stop_requested else 'Done')+', profiles written to '+filename, 'green')
+        except Exception as e:
+            print(e, 'generate_vwp_archive')
+            self.update_vwp_archive_infow(str(e), 'red')
+        finally:
+            self.gui.setEnabled(True); self.vwp_archive_startw.setEnabled(True)
+            
+    def stop_vwp_archive_generation(self):
+        if hasattr(self, 'vwp_archive_generator'):
+            self.vwp_archive_generator.stop_requested = True
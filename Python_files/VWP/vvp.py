@@ -1,7 +1,6 @@
 # Copyright (C) 2016-2024 Bram van 't Veen, bramvtveen94@hotmail.com
 # Distributed under the GNU General Public License version 3, see <https://www.gnu.org/licenses/>.
 
-from scipy.optimize import lsq_linear
 import numpy as np
 import os
 import h5py
@@ -16,12 +15,28 @@ import nlr_globalvars as gv
 http://bibliotheek.knmi.nl/knmipubWR/WR2003-02.pdf
 """
 
+def solve_bounded_normal_equations(AtA, Atb, w_bounds=(-10., 0.)):
+    """Solves the least-squares problems with normal equations AtA*x = Atb, for stacks of matrices AtA with shape (n, 3, 3) and Atb with
+    shape (n, 3). The solution x = [u_0,v_0,w] is required to satisfy w_bounds[0] <= w <= w_bounds[1]. Since the minimum of the sum of squares
+    over u_0 and v_0 is a convex function of w, the constrained solution has w equal to the unconstrained solution clipped to w_bounds, after
+    which u_0 and v_0 follow from the normal equations with w fixed. 
+    """
+    x = (np.linalg.pinv(AtA) @ Atb[:, :, None])[:, :, 0]
+    w = np.clip(x[:, 2], *w_bounds)
+    fix = w != x[:, 2]
+    if fix.any():
+        rhs = Atb[fix, :2]-AtA[fix, :2, 2]*w[fix, None]
+        x[fix, :2] = (np.linalg.pinv(AtA[fix, :2, :2]) @ rhs[:, :, None])[:, :, 0]
+        x[fix, 2] = w[fix]
+    return x
+
 class VVP():
     def __init__(self, gui_class, range_limits = [2., 25.], v_min = 2., height_limits = [0.1, 11.9], dh = 0.2, n_sectors = 36, min_sector_pairs_filled = 9, min_area_sector = 7., dv_outliers = 10.):
         """Parameters used within the algorithm"""
         self.gui = gui_class
-        self.crd = self.gui.crd
-        self.dsg = self.gui.dsg
+        # gui_class is None when only self.calculate is used, as is done for the archive-wide VWPs in vwp_worker.py
+        self.crd = self.gui.crd if self.gui else None
+        self.dsg = self.gui.dsg if self.gui else None
         
         self.v_min = v_min #Minimum radial velocity that is taken into account in the VVP retrieval. It should be greater than zero,
         #to prevent contamination by ground clutter.
@@ -67,6 +82,23 @@ class VVP():
         self.antenna_height = gv.radar_towerheights[self.crd.radar]/1e3 #Height of the radar antenna above ground level, in km. The heights at which the velocity is
         #determined are relative to ground level, and this antenna height is used to take into account that the radar antenna is located a bit higher.
         
+        scans = self.get_velocity_scans()
+        if len(scans) == 0: 
+            raise Exception('No data (yet) available')
+            
+        data, _, self.volume_starttime, self.volume_endtime, _ = self.dsg.get_data_multiple_scans('v', scans, apply_dealiasing = True, max_range = self.range_limits[1])
+        data = {j: data[j][0] for j in data} #data[j] contains a list, since some scans might be present twice in the radar volume. But
+        #for making a VVP it doesn't matter much which one is taken, and here it's taken to be the 1st.
+        scanangles = {j: self.dsg.scanangle('v', j, 0) for j in data}
+        nyquist_velocities = {j: self.dsg.nyquist_velocities_all_mps[j] for j in data}
+        self.calculate(data, scanangles, self.dsg.radial_res_all['v'], nyquist_velocities, self.antenna_height, h0, V0)
+        
+        self.write_data_to_file()
+        
+        return self.h_layers, self.V, self.w, self.sigma, self.filled_sectors, self.volume_starttime, self.volume_endtime
+    
+    def get_velocity_scans(self):
+        # Returns the velocity scans of the current radar volume that are used for the VVP
         scans = []; scannumbers = []
         for j in self.dsg.nyquist_velocities_all_mps:
             if not self.dsg.scannumbers_all['v'][j][-1] in scannumbers:
@@ -74,16 +106,17 @@ class VVP():
                 # reflectivity and velocity scans (in this case a nearby scan for the unavailable product is repeated)
                 scans.append(j)
                 scannumbers.append(self.dsg.scannumbers_all['v'][j][-1])            
-        scans = [j for j in scans if self.dsg.nyquist_velocities_all_mps[j]>10. and self.dsg.scanangles_all_m['v'][j] < 90.] #Exclude the mono-PRF and vertical scans
-        if len(scans) == 0: 
-            raise Exception('No data (yet) available')
-            
-        self.data, _, self.volume_starttime, self.volume_endtime, _ = self.dsg.get_data_multiple_scans('v', scans, apply_dealiasing = True, max_range = self.range_limits[1])
-        self.data = {j: self.data[j][0] for j in self.data} #self.data[j] contains a list, since some scans might be present twice in the radar volume. But
-        #for making a VVP it doesn't matter much which one is taken, and here it's taken to be the 1st.
-        self.scanangles = {j: self.dsg.scanangle('v', j, 0) for j in self.data}
+        return [j for j in scans if self.dsg.nyquist_velocities_all_mps[j]>10. and self.dsg.scanangles_all_m['v'][j] < 90.] #Exclude the mono-PRF and vertical scans
+    
+    def calculate(self, data, scanangles, radial_res, nyquist_velocities, antenna_height, h0=0, V0=None):
+        """Calculates the VVP for velocity scans data (a dictionary with scans as keys), without dependence on the current radar volume.
+        scanangles, radial_res and nyquist_velocities are dictionaries with the same keys as data. antenna_height is given in km.
+        Sets self.h_layers, self.V, self.w, self.sigma and self.filled_sectors, and self.h_layer_indices with for each height layer the
+        index of the layer in the grid of height layers from self.height_limits[0] to self.height_limits[1] with spacing self.dh.
+        """
+        self.data, self.scanangles, self.radial_res, self.nyquist_velocities = data, scanangles, radial_res, nyquist_velocities
         self.radial_bins = {j: self.data[j].shape[1] for j in self.data}
-        self.radial_res = self.dsg.radial_res_all['v']
+        self.antenna_height, self.h0, self.V0 = antenna_height, h0, V0
         
         self.h_layers, self.V, self.w, self.sigma = np.array([]), np.array([]), np.array([]), np.array([])
         
@@ -101,11 +134,8 @@ class VVP():
         from the determined velocities. After removal of outliers, repeat the fit."""
         self.remove_outliers_and_repeat_fit()
         
+        self.h_layer_indices = np.array(list(self.h_layers), dtype='int64')
         self.h_layers = np.array(list(self.h_layers.values()))
-        
-        self.write_data_to_file()
-        
-        return self.h_layers, self.V, self.w, self.sigma, self.filled_sectors, self.volume_starttime, self.volume_endtime
     
     
     def get_V_height_layers(self):
@@ -113,67 +143,96 @@ class VVP():
         Next, all available velocities in these layers are listed, as a function of the azimuth phi and the scanangle theta.        
         At last the total number of radar bins available within the height layer is determined (which also includes radar bins for
         which no velocity is available).
+        
+        Velocities are listed in flat arrays with one element per radar bin (self.gate_v etc.), sorted by height layer. self.gate_layers
+        contains the index of the height layer for each radar bin, and self.h_layers the mean height for each height layer index.
+        For each scan the radial bins are assigned to height layers at once with np.digitize, using the range of bins in each layer.
         """
         hlayer_centers = np.arange(self.height_limits[0], self.height_limits[1]+1e-3, self.dh)
         if self.h0 > 0:
             hlayer_centers += self.h0
-            
-        attrs = ('h_layers', 'v_layers', 'vn_layers', 'azi_layers', 'theta_layers')
-        for attr in attrs:
-            self.__dict__[attr] = {h:[] for h in hlayer_centers}
-        self.totalbins_layers_scans = {h: {j:0 for j in self.data} for h in hlayer_centers}
-        h_before = None
-        for h in hlayer_centers:
-            for j in self.data:
-                height_range = np.array([np.max([0, h-self.dh/2.-self.antenna_height]), h+self.dh/2.-self.antenna_height])
-                ground_range = ft.var1_to_var2(height_range, self.scanangles[j], 'h+theta->gr')  
-                ground_range[0] = max([ground_range[0], self.range_limits[0]])
-                ground_range[1] = min([ground_range[1], self.range_limits[1]])
-                if ground_range[1] <= ground_range[0]:
-                    continue #This can occur when both ground_range[0] and ground_range[1] lie outside self.range_limits,
-                    #and is caused by the fact that only one of the values gets corrected.
-                
-                slant_range = ft.var1_to_var2(ground_range, self.scanangles[j], 'gr+theta->sr')
-                #Bins are included when at least half of a bin is inside the height range.
-                bins_range = np.round(slant_range/self.radial_res[j]-np.array([0, 1])).astype('int')
-                bins_range[1] = min([bins_range[1], self.radial_bins[j]-1])
-                if bins_range[0] > bins_range[1]:
-                    continue #This can occur when np.round(slant_range/self.radial_res[j]) gives
-                    #the same result for both elements in slant_range, such that subtracting 1 of the latter leads to this problem.
-                
-                data_bins_range = self.data[j][:,bins_range[0]:bins_range[1]+1]
-                unmasked = ~np.isnan(data_bins_range)
-                #Remove velocities below self.v_min m/s, to reduce contamination by ground clutter.
-                unmasked[unmasked] = (np.abs(data_bins_range[unmasked]) >= self.v_min)
-                data_unmasked = data_bins_range[unmasked]
-
-                if data_unmasked.shape[0]>0:
-                    na, nr = self.data[j].shape
-                    data_heights = self.antenna_height+np.tile(ft.var1_to_var2(self.radial_res[j]*np.arange(0.5+bins_range[0], bins_range[1]+1), self.scanangles[j], 'sr+theta->h'), (na, 1))
-                    self.h_layers[h].append(data_heights[unmasked])
-                    self.v_layers[h].append(data_unmasked)
-                    self.vn_layers[h].append(np.full(data_unmasked.shape[0], self.dsg.nyquist_velocities_all_mps[j], dtype='float32'))
-                    data_azimuths = np.tile(np.arange(0.5, na, 1), (nr, 1)).T*(2*np.pi/na)
-                    self.azi_layers[h].append(data_azimuths[:, bins_range[0]:bins_range[1]+1][unmasked])
-                    self.theta_layers[h].append(np.full(data_unmasked.shape[0], self.scanangles[j]*np.pi/180., dtype='float32'))
-                    self.totalbins_layers_scans[h][j] += np.size(data_bins_range)
-                
-            if len(self.h_layers[h]) == 0:
-                del self.h_layers[h]
+        n_layers = len(hlayer_centers)
+        height_ranges = np.array([np.maximum(0, hlayer_centers-self.dh/2.-self.antenna_height), hlayer_centers+self.dh/2.-self.antenna_height]).T
+        
+        # Scans with the same scanangle are treated as a single scan in self.test_data_availability_height_layers
+        thetas = np.array([self.scanangles[j]*np.pi/180. for j in self.data], dtype='float32')
+        self.scan_groups = np.unique(thetas, return_inverse=True)[1]
+        
+        attrs = ('gate_layers', 'gate_heights', 'gate_v', 'gate_vn', 'gate_azi', 'gate_scans', 'gate_A')
+        gates = {attr:[] for attr in attrs}
+        self.totalbins_layers_scans = np.zeros((n_layers, len(self.data)), dtype='int64')
+        for i, j in enumerate(self.data):
+            ground_range = ft.var1_to_var2(height_ranges, self.scanangles[j], 'h+theta->gr')
+            ground_range[:, 0] = np.maximum(ground_range[:, 0], self.range_limits[0])
+            ground_range[:, 1] = np.minimum(ground_range[:, 1], self.range_limits[1])
+            slant_range = ft.var1_to_var2(ground_range, self.scanangles[j], 'gr+theta->sr')
+            #Bins are included when at least half of a bin is inside the height range.
+            bins_range = np.round(slant_range/self.radial_res[j]-np.array([0, 1])).astype('int')
+            bins_range[:, 1] = np.minimum(bins_range[:, 1], self.radial_bins[j]-1)
+            #The first condition is not satisfied when both ground_range[0] and ground_range[1] lie outside self.range_limits. The second can fail
+            #when np.round(slant_range/self.radial_res[j]) gives the same result for both elements in slant_range.
+            layers = np.nonzero((ground_range[:, 1] > ground_range[:, 0]) & (bins_range[:, 0] <= bins_range[:, 1]))[0]
+            if len(layers) == 0:
                 continue
             
-            for attr in attrs:
-                self.__dict__[attr][h] = np.concatenate(self.__dict__[attr][h])
-            self.h_layers[h] = self.h_layers[h].mean()-self.h0
+            bins = np.arange(self.radial_bins[j])
+            index = np.digitize(bins, bins_range[layers, 0])-1
+            cols = np.nonzero((index >= 0) & (bins <= bins_range[layers, 1][index.clip(0)]))[0]
+            bins_layers = layers[index[cols]]
             
-            if h_before and self.h_layers[h]-self.h_layers[h_before] < 0.1:
-                n1, n2 = len(self.v_layers[h_before]), len(self.v_layers[h])
-                self.h_layers[h] = (n1*self.h_layers[h_before]+n2*self.h_layers[h])/(n1+n2)
-                for attr in attrs:
-                    if not attr == 'h_layers':
-                        self.__dict__[attr][h] = np.concatenate([self.__dict__[attr][h], self.__dict__[attr][h_before]])
-                    del self.__dict__[attr][h_before]
-            h_before = h
+            data = self.data[j][:, cols]
+            unmasked = ~np.isnan(data)
+            #Remove velocities below self.v_min m/s, to reduce contamination by ground clutter.
+            unmasked[unmasked] = (np.abs(data[unmasked]) >= self.v_min)
+            rows, c = np.nonzero(unmasked)
+            if len(rows) == 0:
+                continue
+            
+            na = data.shape[0]
+            azimuths = np.arange(0.5, na, 1)*(2*np.pi/na)
+            heights = self.antenna_height+ft.var1_to_var2(self.radial_res[j]*(cols+0.5), self.scanangles[j], 'sr+theta->h')
+            gates['gate_layers'].append(bins_layers[c])
+            gates['gate_heights'].append(heights[c])
+            gates['gate_v'].append(data[unmasked])
+            gates['gate_vn'].append(np.full(len(rows), self.nyquist_velocities[j], dtype='float32'))
+            gates['gate_azi'].append(azimuths[rows])
+            gates['gate_scans'].append(np.full(len(rows), self.scan_groups[i]))
+            # The design matrix for the fit in self.retrieve_velocities_through_fit
+            cos_theta, sin_theta = np.cos(thetas[i]), np.sin(thetas[i])
+            gates['gate_A'].append(np.column_stack([(cos_theta*np.sin(azimuths))[rows], (cos_theta*np.cos(azimuths))[rows],
+                                                    np.full(len(rows), sin_theta, dtype='float64')]))
+            # The total number of bins is only counted for layers in which velocities are available for this scan
+            has_data = np.bincount(bins_layers[c], minlength=n_layers) > 0
+            self.totalbins_layers_scans[:, i] = na*np.bincount(bins_layers, minlength=n_layers)*has_data
+        
+        for attr in attrs:
+            self.__dict__[attr] = np.concatenate(gates[attr]) if gates[attr] else np.zeros((0, 3) if attr == 'gate_A' else 0)
+        self.gate_layers = self.gate_layers.astype('int64')
+        
+        counts = np.bincount(self.gate_layers, minlength=n_layers)
+        mean_heights = np.bincount(self.gate_layers, self.gate_heights, minlength=n_layers)/np.maximum(counts, 1)
+        # Merge layers whose mean heights differ by less than 100 m with the layer below. merge_into maps each layer index onto the
+        # index of the layer in which its velocities end up.
+        self.h_layers = {}
+        merge_into = np.arange(n_layers)
+        k_before = None
+        for k in np.nonzero(counts)[0]:
+            self.h_layers[k] = mean_heights[k]-self.h0
+            if not k_before is None and self.h_layers[k]-self.h_layers[k_before] < 0.1:
+                n1, n2 = counts[k_before], counts[k]
+                self.h_layers[k] = (n1*self.h_layers[k_before]+n2*self.h_layers[k])/(n1+n2)
+                counts[k] += n1
+                merge_into[merge_into == k_before] = k
+                del self.h_layers[k_before]
+            k_before = k
+        self.gate_layers = merge_into[self.gate_layers]
+        del self.gate_heights
+        self.select_gates(np.argsort(self.gate_layers, kind='stable'))
+        
+    def select_gates(self, select):
+        # Selects radar bins from the flat arrays, by index or boolean mask
+        for attr in ('gate_layers', 'gate_v', 'gate_vn', 'gate_azi', 'gate_scans', 'gate_A'):
+            self.__dict__[attr] = self.__dict__[attr][select]
             
     def test_data_availability_height_layers(self, count_filled_sectors = False): 
         """Divide the azimuthal dimension into self.n_sectors sectors, that each span 360/self.n_sectors degrees. 
@@ -195,83 +254,112 @@ class VVP():
         
         The conditions on data availability used here is different from and probably less strict than the one used by Iwan Holleman, who divides the azimuthal domain in 8
         sectors of 45 degrees, and requires for all sectors (<- especially this is quite a criterion) that at least 5 data points are available.
+        
+        The number of radar bins per height layer, sector and scan is counted for all layers at once with np.bincount. When count_filled_sectors
+        is False, then the number of sector pairs with at least one filled sector is used. Otherwise both sectors in a pair are counted.
+        
+        IMPORTANT: With the current condition on the fractional number of bins (>= 0.33) it seems like the areal condition (>= 7) has no effect anymore,
+        since every sector that satisfies the areal condition also seems to satisfy the fractional condition. It should therefore be considered to remove
+        the areal condition.
         """
+        layers, p = self.get_layer_positions()
+        n_pairs = self.n_sectors//2
+        n_groups = self.scan_groups.max()+1
+        
         sector_width = 2*np.pi/(self.n_sectors)
-        self.filled_sectors = []
-        for h in self.h_layers.copy():
-            theta_layers_scans = {k: self.theta_layers[h] == self.scanangles[k]*np.pi/180. for k in self.data}
-            self.filled_sectors += [0]
-            for j in range(self.n_sectors//2):
-                azirange_sector1 = sector_width*np.array([j, j+1])
-                azirange_sector2 = np.pi + sector_width*np.array([j, j+1])
-                
-                select1 = (self.azi_layers[h]>=azirange_sector1[0]) & (self.azi_layers[h]<azirange_sector1[1])
-                select2 = (self.azi_layers[h]>=azirange_sector2[0]) & (self.azi_layers[h]<azirange_sector2[1])
-                
-                max_fractional_nbins_sector1 = max([np.count_nonzero(select1 & theta_layers_scans[k]) / (self.totalbins_layers_scans[h][k]/self.n_sectors) for k in self.data if not self.totalbins_layers_scans[h][k] == 0])
-                """IMPORTANT: With the current condition on max_fractional_bins_sector (>= 0.33) it seems like the areal condition (>= 7) has no effect anymore,
-                since every sector that satisfies the areal condition also seems to satisfy the fractional condition. It should therefore be considered to remove
-                the areal condition.
-                """
-                if max_fractional_nbins_sector1 >= 0.33:
-                    self.filled_sectors[-1] += 1
-                if not max_fractional_nbins_sector1 >= 0.33 or count_filled_sectors:
-                    max_fractional_nbins_sector2 = max([np.count_nonzero(select2 & theta_layers_scans[k]) / (self.totalbins_layers_scans[h][k]/self.n_sectors) for k in self.data if not self.totalbins_layers_scans[h][k] == 0])
-                    if max_fractional_nbins_sector2 >= 0.33:
-                        self.filled_sectors[-1] += 1
-                        
-                availability_condition_satisfied = self.filled_sectors[-1] >= self.min_sector_pairs_filled
-                if not count_filled_sectors and (availability_condition_satisfied or
-                self.min_sector_pairs_filled-self.filled_sectors[-1] > self.n_sectors//2-(j+1)):
-                    #In the latter case it is impossible to get self.min_sector_pairs_filled sectors filled, despite the remaining iterations.
-                    break
-            
-            if self.filled_sectors[-1] < self.min_sector_pairs_filled:
-                self.filled_sectors.pop()
-                del self.h_layers[h]
-        self.filled_sectors = np.array(self.filled_sectors)
+        edges = sector_width*np.arange(n_pairs+1)
+        totalbins = self.totalbins_layers_scans[layers][:, None, :]
+        max_fractional_nbins = []
+        for sector_edges in (edges, np.pi+edges):
+            sectors = np.searchsorted(sector_edges, self.gate_azi, side='right')-1
+            select = (p >= 0) & (sectors >= 0) & (sectors < n_pairs)
+            keys = (p[select]*n_pairs+sectors[select])*n_groups+self.gate_scans[select]
+            counts = np.bincount(keys, minlength=len(layers)*n_pairs*n_groups).reshape((len(layers), n_pairs, n_groups))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fractional_nbins = np.where(totalbins == 0, -1., counts[:, :, self.scan_groups]/(totalbins/self.n_sectors))
+            max_fractional_nbins.append(fractional_nbins.max(axis=2, initial=-1.))
+        filled1, filled2 = [j >= 0.33 for j in max_fractional_nbins]
+        
+        if count_filled_sectors:
+            self.filled_sectors = filled1.sum(axis=1)+filled2.sum(axis=1)
+        else:
+            self.filled_sectors = (filled1 | filled2).sum(axis=1)
+        keep = self.filled_sectors >= self.min_sector_pairs_filled
+        for k in layers[~keep]:
+            del self.h_layers[k]
+        self.filled_sectors = self.filled_sectors[keep]
                         
+    def get_layer_positions(self):
+        # Returns the indices of the height layers in self.h_layers, and for each radar bin the position of its height layer in these
+        # indices (-1 for layers that have been removed)
+        layers = np.array(list(self.h_layers), dtype='int64')
+        positions = np.full(len(self.totalbins_layers_scans), -1)
+        positions[layers] = np.arange(len(layers))
+        return layers, positions[self.gate_layers]
+    
+    def get_layer_slices(self):
+        # Returns for each height layer in self.h_layers the slice of the flat arrays that contains its radar bins
+        layers = np.array(list(self.h_layers), dtype='int64')
+        starts = np.searchsorted(self.gate_layers, layers, side='left')
+        ends = np.searchsorted(self.gate_layers, layers, side='right')
+        return [slice(i, j) for i, j in zip(starts, ends)]
+    
     def retrieve_velocities_through_fit(self, determine_uncertainty=True):      
         """Fit the formula "Vr = w*sin(theta)+u_0*cos(theta)*sin(phi)+v_0*cos(theta)*cos(phi)" to the self.data, 
         where w = w_0 + W_f, the sum of the vertical velocity and the terminal velocity of hydrometeors.
+        
+        When not determining the uncertainty, the velocities for each height layer are dealiased using the retrieved velocity for the layer
+        below it, which requires fitting the layers one after the other. Otherwise the fits for all layers are performed at once, with the
+        normal equations of all layers obtained with np.bincount.
         """    
-        self.V = []; self.w = []; self.sigma = []
-        for i, h in enumerate(self.h_layers):
-            if not determine_uncertainty and i < len(self.h_layers):
+        slices = self.get_layer_slices()
+        if not determine_uncertainty:
+            self.V = []; self.w = []
+            for i, s in enumerate(slices):
                 # Attempt extended dealiasing of the velocity for the next height using the retrieved velocity for the current height
                 V_below = self.V0 if i == 0 else self.V[i-1]
                 if not V_below is None:
+                    v, vn = self.gate_v[s], self.gate_vn[s]
                     V, a = np.linalg.norm(V_below), np.arctan2(V_below[0], V_below[1])
-                    V_diff = self.v_layers[h]-V*np.cos(self.azi_layers[h]-a)
-                    select = np.abs(V_diff) > self.vn_layers[h]
-                    self.v_layers[h][select] += -np.sign(V_diff[select])*2*self.vn_layers[h][select]
+                    V_diff = v-V*np.cos(self.gate_azi[s]-a)
+                    select = np.abs(V_diff) > vn
+                    v[select] += -np.sign(V_diff[select])*2*vn[select]
                 
-            A = np.transpose([np.cos(self.theta_layers[h])*np.sin(self.azi_layers[h]),np.cos(self.theta_layers[h])*np.cos(self.azi_layers[h]), np.sin(self.theta_layers[h])])
-            #x = [u_0,v_0,w]
-            b = self.v_layers[h]
-            #Require that -10<=w<=0 m/s, otherwise unrealistic estimates for w might be obtained
-            output = lsq_linear(A, b, bounds = ([-np.inf, -np.inf, -10.], [np.inf, np.inf, 0.]))
-            params = output.x
-            self.V += [params[:2]]
-            self.w += [params[2]]
-            
-            if determine_uncertainty:
-                Vr_fit = np.linalg.norm(self.V[i])*np.cos(self.theta_layers[h])*np.cos(self.azi_layers[h]-np.arctan2(self.V[i][0],self.V[i][1]))+self.w[i]*np.sin(self.theta_layers[h])
-                self.sigma += [np.sqrt(np.sum(np.power(self.v_layers[h]-Vr_fit,2.))/(self.v_layers[h].shape[0]-3))]
-                #Formula (3.21) from Iwan Holleman is used to calculate the standard deviation self.sigma of the radial velocity
-            
-        self.V, self.w, self.sigma = np.array(self.V), np.array(self.w), np.array(self.sigma)
+                A = self.gate_A[s]
+                #x = [u_0,v_0,w]
+                params = solve_bounded_normal_equations((A.T @ A)[None], (A.T @ self.gate_v[s])[None])[0]
+                self.V += [params[:2]]
+                self.w += [params[2]]
+            self.V, self.w, self.sigma = np.array(self.V), np.array(self.w), np.array([])
+            return
+        
+        layers, p = self.get_layer_positions()
+        # Radar bins in removed layers (p = -1) are counted in the first element of the bincounts, which is discarded
+        layer_sum = lambda weights: np.bincount(p+1, weights, minlength=len(layers)+1)[1:]
+        
+        A, b = self.gate_A, self.gate_v
+        AtA = np.empty((len(layers), 3, 3))
+        for i in range(3):
+            for j in range(i, 3):
+                AtA[:, i, j] = AtA[:, j, i] = layer_sum(A[:, i]*A[:, j])
+        Atb = np.transpose([layer_sum(A[:, i]*b) for i in range(3)]).reshape((len(layers), 3))
+        params = solve_bounded_normal_equations(AtA, Atb)
+        self.V, self.w = params[:, :2], params[:, 2]
+        
+        #Formula (3.21) from Iwan Holleman is used to calculate the standard deviation self.sigma of the radial velocity
+        Vr_fit = np.sum(A*np.vstack([params, np.zeros((1, 3))])[p], axis=1)
+        n = layer_sum(None)
+        self.sigma = np.sqrt(layer_sum((b-Vr_fit)**2)/(n-3))
                 
     def remove_outliers_and_repeat_fit(self):
         """Remove outliers, by requiring that the radial velocities deviate by less than self.dv_outliers from the value that follows
         from the determined velocities. After removal of outliers, repeat the fit.
         """
-        for i, h in enumerate(self.h_layers):
-            Vr_fit = np.linalg.norm(self.V[i])*np.cos(self.theta_layers[h])*np.cos(self.azi_layers[h]-np.arctan2(self.V[i][0],self.V[i][1]))+self.w[i]*np.sin(self.theta_layers[h])
-            non_outliers = np.abs(self.v_layers[h]-Vr_fit)<self.dv_outliers
-            self.v_layers[h] = self.v_layers[h][non_outliers]
-            self.theta_layers[h] = self.theta_layers[h][non_outliers]
-            self.azi_layers[h] = self.azi_layers[h][non_outliers]
+        layers, p = self.get_layer_positions()
+        # Radar bins in removed layers are also removed here
+        params = np.vstack([np.column_stack([self.V, self.w]), np.zeros((1, 3))])
+        Vr_fit = np.sum(self.gate_A*params[p], axis=1)
+        self.select_gates((p >= 0) & (np.abs(self.gate_v-Vr_fit) < self.dv_outliers))
             
         self.test_data_availability_height_layers(count_filled_sectors = True)
         self.retrieve_velocities_through_fit()
@@ -0,0 +1,307 @@
+# Copyright (C) 2016-2024 Bram van 't Veen, bramvtveen94@hotmail.com
+# Distributed under the GNU General Public License version 3, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+import os
+import h5py
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import nlr_globalvars as gv
+import nlr_directoryindex as di
+from VWP.vvp import VVP
+from VWP.vwp_worker import calculate_profile, as_main_module
+
+
+
+"""Calculation of VVP wind profiles for all radar volumes of the current radar and dataset between two datetimes, without displaying them.
+Profiles are written to a time-height store (one HDF5 file per radar_dataset and subdataset, see VWPTimeHeightStore), from which
+PlottingVWP.get_time_height_data reads them. Generation is started from the VWP right-click menu (GUI_VWP.show_vwp_archive_window).
+
+Radar volumes are imported in the calling thread with the usual data source classes (nlr_datasourcespecific.py and nlr_importdata.py),
+which requires the state of DataSource_General. The VVP calculation itself only needs the velocity arrays, and is done in a process pool
+(with functions from vwp_worker.py), while the next volumes are being imported.
+
+Generation can be interrupted at any time. Profiles are written to the store in batches, and the number of valid rows in the store is
+only updated after all datasets for a batch have been written. Datetimes that are present in the store are skipped when generation is
+started again, unless the total size of the volume's files has changed since (e.g. because the volume was still being downloaded).
+"""
+
+# Number of profiles after which the results are written to the store
+write_interval = 25
+
+
+def get_store_filename(derivedproducts_dir, radar_dataset, subdataset):
+    return derivedproducts_dir+'/VWP/'+radar_dataset+'/'+subdataset+'/time_height.h5'
+
+def get_group_name(range_limits, height_limits, dh, v_min):
+    return f'range_lim={range_limits}, height_lim={height_limits}, dh={dh}, v_min={v_min}'
+
+def get_settings(gui):
+    # Uses the same VVP settings as the VWP that is displayed, see nlr_plottingvwp.py
+    return {'range_limits': gui.vvp_range_limits, 'height_limits': gui.vvp_height_limits, 'v_min': gui.vvp_vmin_mps}
+
+def get_store_and_keys(gui, vvp):
+    """Returns the time-height store for the current radar and dataset, the group name for the settings of vvp, and the VVP version for the
+    current data source. Is used both by VWPArchiveGenerator and PlottingVWP.get_time_height_data, such that they use the same keys.
+    """
+    dsg = gui.dsg
+    store = VWPTimeHeightStore(get_store_filename(gui.derivedproducts_dir, dsg.get_radar_dataset(no_special_char=True), dsg.get_subdataset(product='v')))
+    group_name = get_group_name(vvp.range_limits, vvp.height_limits, vvp.dh, vvp.v_min)
+    vvp_version = f'{vvp.file_content_version}_{vvp.file_content_version_sources.get(dsg.data_source(), 0)}'
+    return store, group_name, vvp_version
+
+
+
+class VWPTimeHeightStore():
+    """Time-height store of VVP profiles. Each group in the file contains profiles for one combination of VVP settings (see get_group_name),
+    on a grid of height layers that is given by the dataset 'heights' (centers of the height layers of the VVP). Profiles are stored
+    in the order in which they have been calculated, with datasets:
+    - datetimes: YYYYMMDDHHMM as int64
+    - producttime: start and end time of the radar volume
+    - total_volume_files_size: used to determine whether a profile needs to be calculated again
+    - status: 1 when a profile is available, 0 when no profile could be calculated
+    - h, u, v, w, sigma, filled_sectors: per height layer, NaN for height layers without data. h contains the mean height of the
+      radar bins that were used for the height layer.
+    Only the first attrs['n_rows'] rows are valid.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file_content_version = 1
+        self.profile_datasets = ('h', 'u', 'v', 'w', 'sigma', 'filled_sectors')
+
+    def get_group(self, f, group_name, heights=None, vvp_version=None):
+        # Returns the group, or None when it is not present or outdated. When heights is given, then the group is (re)created when needed.
+        if group_name in f:
+            group = f[group_name]
+            outdated = group.attrs['version'] != self.file_content_version or (not vvp_version is None and group.attrs['vvp_version'] != vvp_version)
+            if not outdated and (heights is None or np.array_equal(group['heights'][:], heights)):
+                return group
+            elif heights is None:
+                return None
+            del f[group_name]
+        elif heights is None:
+            return None
+
+        group = f.create_group(group_name)
+        group.attrs['version'] = self.file_content_version
+        group.attrs['vvp_version'] = vvp_version
+        group.attrs['n_rows'] = 0
+        group.create_dataset('heights', data=heights, track_times=False)
+        n_h = len(heights)
+        chunks = (max(1, min(256, 2**20//(4*n_h))), n_h)
+        group.create_dataset('datetimes', (0,), maxshape=(None,), dtype='int64', chunks=chunks[:1], track_times=False)
+        group.create_dataset('producttime', (0,), maxshape=(None,), dtype='S17', chunks=chunks[:1], track_times=False)
+        group.create_dataset('total_volume_files_size', (0,), maxshape=(None,), dtype='int64', chunks=chunks[:1], track_times=False)
+        group.create_dataset('status', (0,), maxshape=(None,), dtype='int8', chunks=chunks[:1], track_times=False)
+        for name in self.profile_datasets:
+            group.create_dataset(name, (0, n_h), maxshape=(None, n_h), dtype='float32', chunks=chunks, compression='gzip',
+                                 fillvalue=np.nan, track_times=False)
+        return group
+
+    def get_completed(self, group_name, vvp_version=None):
+        # Returns a dictionary with as keys the datetimes present in the store, and as values the total volume files size.
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with h5py.File(self.filename, 'r') as f:
+                group = self.get_group(f, group_name, vvp_version=vvp_version)
+                if group is None:
+                    return {}
+                n = group.attrs['n_rows']
+                return dict(zip(group['datetimes'][:n].tolist(), group['total_volume_files_size'][:n].tolist()))
+        except Exception as e:
+            print(e, 'VWPTimeHeightStore.get_completed')
+            return {}
+
+    def write(self, group_name, heights, vvp_version, records):
+        """records is a list of dictionaries with keys datetime, producttime, total_volume_files_size and profile, where profile is either
+        None or the output of calculate_profile. Records for datetimes that are already present in the store replace the existing rows.
+        """
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with h5py.File(self.filename, 'a') as f:
+            group = self.get_group(f, group_name, heights, vvp_version)
+            n = group.attrs['n_rows']
+            existing = {j:i for i,j in enumerate(group['datetimes'][:n].tolist())}
+
+            rows = np.empty(len(records), dtype='int64')
+            n_new = 0
+            for i, record in enumerate(records):
+                if record['datetime'] in existing:
+                    rows[i] = existing[record['datetime']]
+                else:
+                    rows[i] = n+n_new
+                    existing[record['datetime']] = rows[i]
+                    n_new += 1
+
+            values = {name: np.full((len(records), len(heights)), np.nan, dtype='float32') for name in self.profile_datasets}
+            status = np.zeros(len(records), dtype='int8')
+            for i, record in enumerate(records):
+                if record['profile'] is None:
+                    continue
+                indices, h, V, w, sigma, filled_sectors = record['profile']
+                status[i] = 1
+                for name, data in zip(self.profile_datasets, (h, V[:, 0], V[:, 1], w, sigma, filled_sectors)):
+                    values[name][i, indices] = data
+
+            for name in ('datetimes', 'producttime', 'total_volume_files_size', 'status')+self.profile_datasets:
+                if len(group[name]) < n+n_new:
+                    group[name].resize(n+n_new, axis=0)
+            # Rows are written in ascending order, as required by h5py for fancy indexing
+            order = np.argsort(rows)
+            group['datetimes'][rows[order]] = np.array([j['datetime'] for j in records], dtype='int64')[order]
+            group['producttime'][rows[order]] = np.array([j['producttime'] for j in records], dtype='S17')[order]
+            group['total_volume_files_size'][rows[order]] = np.array([j['total_volume_files_size'] for j in records], dtype='int64')[order]
+            group['status'][rows[order]] = status[order]
+            for name in self.profile_datasets:
+                group[name][rows[order]] = values[name][order]
+            # Is updated at last, such that rows of an interrupted write are not used
+            group.attrs['n_rows'] = n+n_new
+
+    def read(self, group_name, startdatetime=None, enddatetime=None, vvp_version=None):
+        """Returns a dictionary with the datasets listed in the class description (excluding status), sorted by datetime and limited to
+        datetimes between startdatetime and enddatetime (YYYYMMDDHHMM). Only rows with status 1 are included. Returns None when no profiles
+        are available for group_name, or when they are outdated for vvp_version (when given).
+        """
+        if not os.path.exists(self.filename):
+            return None
+        with h5py.File(self.filename, 'r') as f:
+            group = self.get_group(f, group_name, vvp_version=vvp_version)
+            if group is None:
+                return None
+            n = group.attrs['n_rows']
+            datetimes = group['datetimes'][:n]
+            select = group['status'][:n] == 1
+            if not startdatetime is None:
+                select &= datetimes >= int(startdatetime)
+            if not enddatetime is None:
+                select &= datetimes <= int(enddatetime)
+            rows = np.nonzero(select)[0]
+            rows = rows[np.argsort(datetimes[rows], kind='stable')]
+            # Reading a contiguous block and selecting rows afterwards is much faster than fancy indexing with h5py
+            s = np.s_[rows.min():rows.max()+1] if len(rows) else np.s_[0:0]
+            rows -= rows.min() if len(rows) else 0
+
+            data = {'heights': group['heights'][:]}
+            for name in ('datetimes', 'producttime', 'total_volume_files_size')+self.profile_datasets:
+                data[name] = group[name][s][rows]
+            data['producttime'] = data['producttime'].astype(str)
+        return data
+
+
+
+class VWPArchiveGenerator():
+    def __init__(self, gui_class, n_workers=None):
+        self.gui = gui_class
+        self.crd = self.gui.crd
+        self.dsg = self.crd.dsg
+        self.n_workers = n_workers if n_workers else max(1, os.cpu_count()-1)
+
+        # Can be set to True from another thread, in order to stop the generation after the volume that is currently being imported
+        self.stop_requested = False
+
+    def get_total_volume_files_size(self, filepaths):
+        # Should give the same result as DataSource_General.get_total_volume_files_size, without changing its state
+        try:
+            return int(sum(sum(di.directory_index.get_file_sizes(j, [os.path.basename(i) for i in filepaths if os.path.dirname(i) == j]))
+                           for j in set(map(os.path.dirname, filepaths))))
+        except Exception:
+            return -1
+
+    def import_volume(self, date, time):
+        """Imports the velocity scans that are used for the VVP, for the radar volume at date and time of the current radar and dataset.
+        Volume attributes and the datetime of the displayed volume are restored afterwards.
+        """
+        crd_before = {j: self.crd.__dict__[j] for j in ('date', 'time', 'directory')}
+        dsg_before = {j: self.dsg.__dict__.get(j, None) for j in ('files_datetimesdict', 'files_datetime', 'total_files_size', 'product_versions_datetimesdict',
+                      'product_versions_datetime', 'product_versions_directory')}
+        updating_vwp_before = self.gui.vwp.updating_vwp
+        try:
+            self.crd.date, self.crd.time = date, time
+            self.crd.directory = self.dsg.get_directory(date, time, self.crd.radar, self.crd.dataset)
+            self.dsg.get_files(self.crd.radar, self.crd.directory)
+            self.dsg.select_files_datetime()
+            self.dsg.total_files_size = self.dsg.get_total_volume_files_size()
+            self.dsg.get_scans_information(set_data=False)
+            try:
+                scans = self.vvp.get_velocity_scans()
+                if len(scans) == 0:
+                    raise Exception('No velocity scans available')
+                # Use the same dealiasing settings as for the displayed VWP
+                self.gui.vwp.updating_vwp = True
+                data, _, volume_starttime, volume_endtime, _ = self.dsg.get_data_multiple_scans('v', scans, apply_dealiasing=True, max_range=self.vvp.range_limits[1])
+                data = {j: data[j][0] for j in data}
+                scanangles = {j: self.dsg.scanangle('v', j, 0) for j in data}
+                nyquist_velocities = {j: self.dsg.nyquist_velocities_all_mps[j] for j in data}
+                radial_res = self.dsg.radial_res_all['v'].copy()
+                return (data, scanangles, radial_res, nyquist_velocities), volume_starttime+'-'+volume_endtime, self.dsg.total_files_size
+            finally:
+                self.dsg.restore_previous_attributes()
+        finally:
+            self.gui.vwp.updating_vwp = updating_vwp_before
+            self.crd.__dict__.update(crd_before)
+            self.dsg.__dict__.update(dsg_before)
+
+    def __call__(self, startdatetime, enddatetime, progress_callback=None):
+        """Calculates VVP profiles for all radar volumes of the current radar and dataset between startdatetime and enddatetime (YYYYMMDDHHMM),
+        and writes them to the time-height store. Should be called from the main thread, since the state of crd and dsg is temporarily
+        changed while importing a volume. progress_callback(n_done, n_total) is called after each finished profile.
+        Returns the filename of the store.
+        """
+        self.stop_requested = False
+        settings = get_settings(self.gui)
+        self.vvp = VVP(self.gui, **settings)
+        store, group_name, vvp_version = get_store_and_keys(self.gui, self.vvp)
+        heights = np.arange(self.vvp.height_limits[0], self.vvp.height_limits[1]+1e-3, self.vvp.dh)
+        antenna_height = gv.radar_towerheights[self.crd.radar]/1e3
+        completed = store.get_completed(group_name, vvp_version)
+
+        filepaths, datetimes = self.dsg.get_filenames_and_datetimes_in_datetime_range(self.crd.radar, self.crd.dataset, startdatetime=startdatetime,
+                                                                                       enddatetime=enddatetime, return_abspaths=True)
+        datetimes, indices = np.unique(datetimes, return_inverse=True)
+        datetimes = datetimes.tolist()
+        n_total, n_done = len(datetimes), 0
+
+        records, pending = [], {}
+        def process_finished(futures):
+            nonlocal n_done
+            for future in futures:
+                record = pending.pop(future)
+                record['profile'] = future.result()
+                records.append(record)
+                n_done += 1
+                if progress_callback:
+                    progress_callback(n_done, n_total)
+            if len(records) >= write_interval:
+                store.write(group_name, heights, vvp_version, records)
+                records.clear()
+
+        with ProcessPoolExecutor(self.n_workers) as executor:
+            for i, datetime in enumerate(datetimes):
+                if self.stop_requested:
+                    break
+                date, time = str(datetime)[:8], str(datetime)[-4:]
+                total_files_size = self.get_total_volume_files_size(filepaths[indices == i])
+                if total_files_size != -1 and completed.get(datetime, None) == total_files_size:
+                    n_done += 1
+                    continue
+
+                try:
+                    args, producttime, total_files_size = self.import_volume(date, time)
+                except Exception as e:
+                    traceback.print_exception(type(e), e, e.__traceback__)
+                    records.append({'datetime': datetime, 'producttime': '', 'total_volume_files_size': total_files_size, 'profile': None})
+                    n_done += 1
+                    continue
+                with as_main_module():
+                    future = executor.submit(calculate_profile, (settings,)+args+(antenna_height,))
+                pending[future] = {'datetime': datetime, 'producttime': producttime, 'total_volume_files_size': total_files_size}
+
+                # Limit the number of imported volumes that wait for a worker, to limit memory usage
+                if len(pending) >= 2*self.n_workers:
+                    process_finished(wait(pending, return_when=FIRST_COMPLETED).done)
+            process_finished(wait(pending).done)
+
+        if records:
+            store.write(group_name, heights, vvp_version, records)
+        return store.filename
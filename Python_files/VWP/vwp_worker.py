@@ -0,0 +1,40 @@
+# Copyright (C) 2016-2024 Bram van 't Veen, bramvtveen94@hotmail.com
+# Distributed under the GNU General Public License version 3, see <https://www.gnu.org/licenses/>.
+
+import sys
+from contextlib import contextmanager
+
+from VWP.vvp import VVP
+
+
+
+"""Functions that are executed in the worker processes of vwp_archive.VWPArchiveGenerator. This module should not import the GUI (PyQt, vispy)
+or modules that import it, since the worker processes import this module instead of nlr.py (see as_main_module).
+"""
+
+def calculate_profile(args):
+    """Calculates the VVP for one radar volume. Is called in a worker process, and therefore only receives the velocity arrays and
+    attributes that are needed for it. Returns None when no profile could be calculated.
+    """
+    settings, data, scanangles, radial_res, nyquist_velocities, antenna_height = args
+    try:
+        vvp = VVP(None, **settings)
+        vvp.calculate(data, scanangles, radial_res, nyquist_velocities, antenna_height)
+        return vvp.h_layer_indices, vvp.h_layers, vvp.V, vvp.w, vvp.sigma, vvp.filled_sectors
+    except Exception as e:
+        print(e, 'calculate_profile')
+        return None
+
+@contextmanager
+def as_main_module():
+    """With the spawn and forkserver start methods, worker processes first import the main module of the parent process (as __mp_main__).
+    For NLradar this is nlr.py, which imports PyQt, vispy and starts the TensorFlow initialisation. Worker processes of a ProcessPoolExecutor
+    are started when tasks are submitted, and tasks should therefore be submitted within this context, in which this module is presented as
+    the main module.
+    """
+    main_module = sys.modules['__main__']
+    sys.modules['__main__'] = sys.modules[__name__]
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main_module
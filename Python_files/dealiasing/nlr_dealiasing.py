@@ -5,7 +5,11 @@ import numpy as np
 import time as pytime
 import matplotlib.pyplot as plt
 
-from nlr_functions import get_window_sum, get_window_indices
+from nlr_functions import get_window_sums_at, get_window_neighbours
+
+
+# When True, statistics for each iteration of the dual PRF dealiasing algorithm are printed (see DualPRFDealiasing.dealias)
+print_iterations = False
 
 
 
@@ -50,9 +54,8 @@ class DualPRFDealiasing():
         - plot_velocity_deviations: By setting this to True, a plot with velocity deviations is created during calling of the function 'determine_vn_even_and_odd_radials'. 
         """
         
-        self.data = v_array
-        # Integer dtype instead of unsigned integer, since in calculations some operations can lead to negative values
-        self.data_indices = np.array(np.meshgrid(np.arange(self.data.shape[0], dtype = 'int16'), np.arange(self.data.shape[1], dtype = 'int16'))).T
+        # Contiguous, since velocities are updated through flattened views of the array
+        self.data = np.ascontiguousarray(v_array)
         
         if (c_array is None and mask_all_nearzero_velocities):
             data_mask = np.logical_or(data_mask, np.abs(v_array) < 1.5) #Also mask bins with wind speeds of less than 1.5 m/s, because these are often associated with clutter.
@@ -103,30 +106,49 @@ class DualPRFDealiasing():
         
     
     def dealias(self):
+        """The iteration keeps track of the radar bins whose velocity has been changed in the previous correction step. In the next detection
+        step only the bins that have one of these changed bins in their window are checked again, since for all other bins the window content
+        hasn't changed, such that they keep their outlier status. The iteration stops when no velocities are changed anymore, when the number
+        of outliers doesn't decrease anymore, or when n_it iterations have been performed.
+        Window sums are calculated only for the bins that are checked or corrected (see get_window_sums_at), which makes the iterations after
+        the first one much cheaper when only few velocities get changed. 
+        For each iteration some statistics are stored in self.iterations, and printed when print_iterations is True.
+        """
         self.n_azi, self.n_rad = self.data.shape
         if self.vn_first_azimuth:
             vn_order = [self.vn_h, self.vn_l] if self.vn_first_azimuth == 'h' else [self.vn_l, self.vn_h]
             self.vn_radials = np.tile(vn_order, (self.n_azi+1)//2)[:self.n_azi].astype(self.data.dtype)
-            self.vn_array = np.transpose(np.tile(self.vn_radials, (self.n_rad, 1))).astype(self.data.dtype)
             
         self.n_outliers_before = 1e8; self.n_outliers = 1e6
-        # t = pytime.time()
+        self.iterations = []
         for self.n in range(self.n_it):
+            t = pytime.time()
             if self.n == 0:                 
                 self.phi = np.pi * self.data / self.vn_e
                 self.sin_phi = np.sin(self.phi); self.cos_phi = np.cos(self.phi)
                 self.sin_phi[self.data_mask] = self.cos_phi[self.data_mask] = 0.
-            else:                
-                self.phi[self.outliers] = np.pi * self.data[self.outliers] / self.vn_e
-                phi_outliers = self.phi[self.outliers]
-                self.sin_phi[self.outliers] = np.sin(phi_outliers); self.cos_phi[self.outliers] = np.cos(phi_outliers)
-                              
+                self.update = np.flatnonzero(self.data_nonmask)
+            else:
+                if len(self.changed) == 0:
+                    break
+                # Restore the phases of the outliers, that were excluded from the reference phase in the correction step
+                phi_outliers = np.pi * self.data.ravel()[self.outliers_indices] / self.vn_e
+                self.phi.ravel()[self.outliers_indices] = phi_outliers
+                self.sin_phi.ravel()[self.outliers_indices] = np.sin(phi_outliers); self.cos_phi.ravel()[self.outliers_indices] = np.cos(phi_outliers)
+                self.update = get_window_neighbours(self.changed, self.window_detection, self.data.shape)
+                self.update = self.update[self.data_nonmask.ravel()[self.update]]
+                
             self.detect_outliers()
-            if self.n_outliers_before <= self.n_outliers:
+            converged = self.n_outliers_before <= self.n_outliers
+            if not converged:
+                self.correct_outliers()
+                
+            self.iterations.append({'n_update':len(self.update), 'n_outliers':self.n_outliers, 
+                                    'n_changed':0 if converged else len(self.changed), 'time':pytime.time()-t})
+            if print_iterations:
+                print(self.n, self.iterations[-1])
+            if converged:
                 break
-            self.correct_outliers()
-            
-            # print(self.n, self.n_outliers, pytime.time() - t)
 
                                                     
     def detect_outliers(self):
@@ -135,81 +157,73 @@ class DualPRFDealiasing():
         Next, for each radar bin the minimum angular difference between the phase at that bin and the circular mean phase is calculated, and
         converted to a velocity difference. If this velocity difference is greater than the high/low Nyquist velocity corresponding to that bin, then
         that velocity is classified as an outlier.
-        The reason for using phases instead of velocities is that it circumvents problems with extended Nyquist velocity aliasing."""
-        if self.n == 0:
-            self.update = self.data_nonmask
-        else:
-            # Keep in mind that the window sum cannot become larger than 1 for a boolean array. But that is not a problem here.
-            self.update = self.data_nonmask & get_window_sum(self.outliers, self.window_detection)
-        self.n_update = np.count_nonzero(self.update)
-        
-        phi_ref = self.calculate_reference_phase(self.update, self.n_update, self.window_detection)
+        The reason for using phases instead of velocities is that it circumvents problems with extended Nyquist velocity aliasing.
+        Only the bins in self.update are checked, for other bins the outlier status from the previous iteration is kept."""
+        phi_ref = self.calculate_reference_phase(self.update, self.window_detection)
         
-        phi_diff = np.abs(self.phi[self.update] - phi_ref)
+        phi_diff = np.abs(self.phi.ravel()[self.update] - phi_ref)
         corr = phi_diff > np.pi
         phi_diff[corr] = 2*np.pi - phi_diff[corr]
         v_diff = phi_diff * self.vn_e/np.pi
                     
         if self.vn_first_azimuth is None:
             self.v_diff_detection = np.zeros((self.n_azi, self.n_rad), dtype = self.data.dtype)
-            self.v_diff_detection[self.update] = v_diff
+            self.v_diff_detection.ravel()[self.update] = v_diff
             
             self.determine_vn_even_and_odd_radials()
         
-        if self.n > 0: 
-            self.outliers[:] = 0
-        else:
+        if self.n == 0:
             self.outliers = np.zeros((self.n_azi, self.n_rad), dtype = 'bool')
-        outliers = (np.abs(v_diff) > self.deviation_factor * self.vn_array[self.update])
-        self.outliers[self.update] = outliers 
+        vn_update = self.vn_radials[self.update // self.n_rad]
+        self.outliers.ravel()[self.update] = np.abs(v_diff) > self.deviation_factor * vn_update
         
         self.n_outliers_before = self.n_outliers
         self.n_outliers = np.count_nonzero(self.outliers)
         
     def correct_outliers(self):
         """Correction step: Add 2n*v_h or 2n*v_l to the velocity of the outliers, with n such that the difference between the resulting phase and 
-        phi_ref is minimised."""
-        self.sin_phi[self.outliers] = self.cos_phi[self.outliers] = 0.
+        phi_ref is minimised. The bins whose velocity changes are stored in self.changed."""
+        outliers = np.flatnonzero(self.outliers)
+        self.sin_phi.ravel()[outliers] = self.cos_phi.ravel()[outliers] = 0.
         
+        dropped = outliers[:0]
         if self.min_gates_correct > 0:
             """Setting self.min_gates_correct to 0 is equal to stating that correction of velocities should always occur.
             If min_gates_correct = 0, then there might be some cases where the reference velocity is set to zero because there is no
             non-outlier velocity. This will likely however only occur in areas with very few velocities, in which case the data
             is usually not reliable/useful. For this reason min_gates_correct is set to zero by default, because this increases
             the speed of the algorithm."""
-            n_nonoutliers = get_window_sum(np.logical_or(self.data_nonmask, ~self.outliers).astype('uint8'), self.window_correction)
-            self.outliers[n_nonoutliers < self.min_gates_correct] = False
+            n_nonoutliers = get_window_sums_at([np.logical_or(self.data_nonmask, ~self.outliers).astype('uint8')], self.window_correction, outliers)[0]
+            # The phases of these bins remain excluded from the reference phase, so they also count as changed
+            dropped = outliers[n_nonoutliers < self.min_gates_correct]
+            outliers = outliers[n_nonoutliers >= self.min_gates_correct]
+            self.outliers.ravel()[dropped] = False
         
         #Calculate again the mean phase, but exclude the outliers from the averaging        
-        phi_ref = self.calculate_reference_phase(self.outliers, self.n_outliers, self.window_correction)
+        phi_ref = self.calculate_reference_phase(outliers, self.window_correction)
         
-        v_diff = (self.phi[self.outliers] - phi_ref)*self.vn_e/np.pi
+        v_diff = (self.phi.ravel()[outliers] - phi_ref)*self.vn_e/np.pi
         select = np.abs(v_diff) > self.vn_e
         v_diff[select] -= np.sign(v_diff[select])*2*self.vn_e
         
-        vn_outliers = self.vn_array[self.outliers]
+        vn_outliers = self.vn_radials[outliers // self.n_rad]
         correction_ints = np.round(v_diff/(2*vn_outliers))
-        data_outliers = self.data[self.outliers] - 2*correction_ints*vn_outliers
+        data_before = self.data.ravel()[outliers]
+        data_outliers = data_before - 2*correction_ints*vn_outliers
         outside_extended_nyquist_interval = np.abs(data_outliers) > self.vn_e
         data_outliers_outside_nyq_int = data_outliers[outside_extended_nyquist_interval]
         data_outliers[outside_extended_nyquist_interval] = -np.sign(data_outliers_outside_nyq_int)*2*self.vn_e\
         + data_outliers_outside_nyq_int
-        self.data[self.outliers] = data_outliers
+        self.data.ravel()[outliers] = data_outliers
         
-    def calculate_reference_phase(self, select, n_select, window):
-        if n_select < 12000 * (self.n_rad * self.n_azi) / (838 * 360):
-            #Around this value of n_select becomes this method faster
-            rows, cols = get_window_indices(self.data_indices[select], window, self.data.shape, periodic = 'rows')
-            window_size = sum([j*2+1 for j in window])
-            sin_phi_sum_update = np.sum(self.sin_phi[rows, cols].reshape((window_size, n_select)), axis = 0)
-            cos_phi_sum_update = np.sum(self.cos_phi[rows, cols].reshape((window_size, n_select)), axis = 0)
-            return np.arctan2(sin_phi_sum_update, cos_phi_sum_update)
-        else:
-            sin_phi_sum_detection, cos_phi_sum_detection = self.calculate_sin_cos_phi_sum(window) 
-            return np.arctan2(sin_phi_sum_detection[select], cos_phi_sum_detection[select])
+        self.outliers_indices = outliers
+        self.changed = outliers[self.data.ravel()[outliers] != data_before]
+        if len(dropped):
+            self.changed = np.union1d(self.changed, dropped)
         
-    def calculate_sin_cos_phi_sum(self, window):
-        return get_window_sum(self.sin_phi, window), get_window_sum(self.cos_phi, window)
+    def calculate_reference_phase(self, indices, window):
+        sin_phi_sum, cos_phi_sum = get_window_sums_at((self.sin_phi, self.cos_phi), window, indices)
+        return np.arctan2(sin_phi_sum, cos_phi_sum)
     
     def determine_vn_even_and_odd_radials(self):
         counts1, v = np.histogram(self.v_diff_detection[0:self.n_azi:2], bins = int(self.vn_e), range = (0, self.vn_e))
@@ -221,7 +235,6 @@ class DualPRFDealiasing():
         self.vn_first_azimuth = 'h' if np.argmax(counts1[select]) > np.argmax(counts2[select]) else 'l'
         vn_order = [self.vn_h, self.vn_l] if self.vn_first_azimuth == 'h' else [self.vn_l, self.vn_h]
         self.vn_radials = np.tile(vn_order, (self.n_azi+1)//2)[:self.n_azi]
-        self.vn_array = np.tile(self.vn_radials, (self.n_rad, 1)).T
         
         f = 1.9426
         v_avg *= f
@@ -241,7 +254,6 @@ class DualPRFDealiasing():
 
 
         
-da = DualPRFDealiasing()
 
 def apply_dual_prf_dealiasing(v_array, data_mask, radial_res, vn_e, vn_l, vn_h, vn_first_azimuth = None, window_detection = None, window_correction = None, deviation_factor = 1.0, n_it = 50, z_array=None, c_array = None, mask_all_nearzero_velocities = False):
     """If window_detection and window_correction are not specified, then they are given below. Those window sizes are based upon the assumption that there can be many outliers,
@@ -263,4 +275,6 @@ def apply_dual_prf_dealiasing(v_array, data_mask, radial_res, vn_e, vn_l, vn_h,
         elif ratio < 5: window_correction = [3,5,3]
         else: window_correction = [4,6,4]
                 
-    return da(v_array, data_mask, azimuthal_res, radial_res, vn_e, vn_l, vn_h, vn_first_azimuth, window_detection, window_correction, deviation_factor, n_it, z_array, c_array, mask_all_nearzero_velocities)
\ No newline at end of file
+    # A new instance for each call, since DualPRFDealiasing stores the arrays for the current call as attributes, and this function can be
+    # called from several threads (see nlr_importdata.read_scans_concurrently)
+    return DualPRFDealiasing()(v_array, data_mask, azimuthal_res, radial_res, vn_e, vn_l, vn_h, vn_first_azimuth, window_detection, window_correction, deviation_factor, n_it, z_array, c_array, mask_all_nearzero_velocities)
\ No newline at end of file
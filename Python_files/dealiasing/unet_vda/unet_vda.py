@@ -1,53 +1,242 @@
 # Copyright (C) 2016-2024 Bram van 't Veen, bramvtveen94@hotmail.com
 # Distributed under the GNU General Public License version 3, see <https://www.gnu.org/licenses/>.
 
-import sys
-sys.path.append('src/')
-
+import os
+import json
+import hashlib
 import numpy as np
 import time as pytime
-import tensorflow as tf
-tf.debugging.disable_traceback_filtering()
-
-# os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
-gpus = tf.config.experimental.list_physical_devices('GPU')
-print('detected GPUs:', gpus)
-if gpus:
-    # for gpu in gpus:
-        # tf.config.experimental.set_memory_growth(gpu, True)
-    # Restrict TensorFlow to only allocate x GB of memory on the first GPU
-    tf.config.experimental.set_virtual_device_configuration(gpus[0],
-        [tf.config.experimental.VirtualDeviceConfiguration(memory_limit=500)])
-
-from dealiasing.unet_vda.src.dealias import VelocityDealiaser
-from dealiasing.unet_vda.src.feature_extraction import create_downsampler, create_upsampler
 
 import nlr_globalvars as gv
 from nlr_functions import angle_diff
 
 
-# tf.config.run_functions_eagerly(True)
+"""Velocity dealiasing with the Unet VDA model (https://arxiv.org/abs/2211.13181). Pre- and postprocessing of the data are done with NumPy,
+while the neural network itself is evaluated by a backend:
+- TensorFlowBackend uses the Keras model from src/, with the weights from models/dealias_sn16_csi9764.SavedModel. Importing TensorFlow and
+  loading the model takes several seconds, and each new input shape requires tracing a new graph.
+- NumpyBackend evaluates the network with NumPy, from the layer configuration and weights that TensorFlowBackend.export_numpy_model exports
+  to models/dealias_sn16_csi9764.npz. TensorFlow is only needed once, for this export.
+When backend is None, then the NumPy backend is used when the exported model is available, and the TensorFlow backend otherwise.
 
+Several scans (e.g. all velocity scans of a volume) can be dealiased at once with Unet_VDA.dealias_scans, in which case the network is
+evaluated for a batch of scans at once.
+"""
 
-class Unet_VDA():
+backend = None
+models_dir = gv.programdir+'/Python_files/dealiasing/unet_vda/models'
+numpy_model_filename = models_dir+'/dealias_sn16_csi9764.npz'
+variables_dir = models_dir+'/dealias_sn16_csi9764.SavedModel/variables'
+
+
+def get_backend_name(name=None):
+    return name or backend or ('numpy' if os.path.exists(numpy_model_filename) else 'tensorflow')
+
+def get_backend(name=None):
+    return NumpyBackend(numpy_model_filename) if get_backend_name(name) == 'numpy' else TensorFlowBackend()
+
+model_ids = {}
+def get_model_id(name=None):
+    """Returns a string that identifies the model weights used by the backend, e.g. for caching dealiased velocities. It doesn't require
+    loading the model.
+    """
+    name = get_backend_name(name)
+    if not name in model_ids:
+        filenames = [numpy_model_filename] if name == 'numpy' else [variables_dir+'/'+j for j in sorted(os.listdir(variables_dir))]
+        h = hashlib.blake2b(digest_size=16)
+        for filename in filenames:
+            with open(filename, 'rb') as f:
+                h.update(f.read())
+        model_ids[name] = name+'_'+h.hexdigest()
+    return model_ids[name]
+
+
+class TensorFlowBackend():
     def __init__(self):
-        self.run_only_once_for_na_gt_1 = True
-        
-    
-    def load_model(self):
+        import tensorflow as tf
+        tf.debugging.disable_traceback_filtering()
+
+        # os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+        gpus = tf.config.experimental.list_physical_devices('GPU')
+        print('detected GPUs:', gpus)
+        if gpus:
+            # Restrict TensorFlow to only allocate x GB of memory on the first GPU
+            tf.config.experimental.set_virtual_device_configuration(gpus[0],
+                [tf.config.experimental.VirtualDeviceConfiguration(memory_limit=500)])
+
+        from dealiasing.unet_vda.src.dealias import VelocityDealiaser
+        from dealiasing.unet_vda.src.feature_extraction import create_downsampler, create_upsampler
+
         start_neurons_az = 16 # sn=16
-        self.data = tf.keras.Input(shape=(None,None,1))
-                
+        inp = tf.keras.Input(shape=(None,None,1))
         # Down portion of unet
-        down = create_downsampler(inp=self.data, start_neurons=start_neurons_az, input_channels=1)
-        # Up portion of unet        
+        down = create_downsampler(inp=inp, start_neurons=start_neurons_az, input_channels=1)
+        # Up portion of unet
         up = create_upsampler(n_inputs=1, start_neurons=start_neurons_az, n_outputs=6)
-        
+
         # Full model
         self.vda = VelocityDealiaser(down, up)
-        
         # Load weights. Append variables/variables to model path, since without it some users report an error that prevents loading the model.
-        self.vda.load_weights(gv.programdir+'/Python_files/dealiasing/unet_vda/models/dealias_sn16_csi9764.SavedModel/variables/variables')
+        self.vda.load_weights(variables_dir+'/variables')
+
+        self.run_vda = tf.function(lambda vel, nyq: self.vda({'vel':vel, 'nyq':nyq})['dealiased_vel'],
+                                   input_signature=(tf.TensorSpec(shape=[None, None, None, None, 1], dtype=tf.float32),
+                                                    tf.TensorSpec(shape=[None, None, None, 1], dtype=tf.float32)))
+
+    def __call__(self, vel, vn):
+        # vel has shape (batch, n_azi, n_rad) and vn (batch, n_azi). Returns dealiased velocities with the shape of vel.
+        return self.run_vda(vel[:, None, :, :, None], vn[:, None, :, None]).numpy()[..., 0]
+
+    def export_numpy_model(self, filename=numpy_model_filename):
+        # Exports the layer configuration and weights of the feature extractor and upsampler, for use by NumpyBackend
+        arrays = {}
+        for name, model in (('extractor', self.vda.extractor), ('upsampler', self.vda.upsampler)):
+            arrays[name+'/config'] = np.array(json.dumps(model.get_config()))
+            for layer in model.layers:
+                for i, w in enumerate(layer.get_weights()):
+                    arrays[f'{name}/{layer.name}/{i}'] = w
+        np.savez(filename, **arrays)
+
+
+class NumpyBackend():
+    """Evaluates the network in the same way as VelocityDealiaser.call in src/dealias.py. The feature extractor and upsampler are
+    evaluated by interpreting their Keras configuration, which requires only the few layer types used by them.
+    Convolutions are performed as matrix multiplications, for blocks of rows to limit memory usage.
+    """
+    def __init__(self, filename):
+        with np.load(filename) as f:
+            arrays = dict(f)
+        self.models = {}
+        for name in ('extractor', 'upsampler'):
+            config = json.loads(str(arrays[name+'/config']))
+            weights = {}
+            for key in arrays:
+                model, _, layer_i = key.partition('/')
+                if model == name and layer_i != 'config':
+                    layer, i = layer_i.rsplit('/', 1)
+                    weights.setdefault(layer, {})[int(i)] = arrays[key]
+            weights = {layer: [w[i] for i in sorted(w)] for layer, w in weights.items()}
+            self.models[name] = (config, weights)
+
+    def __call__(self, vel, vn):
+        nyq = vn[:, :, None]
+        # Normalize velocity by nyquist, and fill empty bins with -3
+        x = vel/nyq
+        x[np.isnan(x)] = -3.
+        features = self.run_model('extractor', [x[..., None]])
+        out = np.clip(self.run_model('upsampler', features)[0], -50., 50.)
+        return self.dealias_vel(vel, out, nyq)
+
+    def dealias_vel(self, vel, alias_onehot, nyq):
+        # As VelocityDealiaser.dealias_vel: categories 1, 2, 4 and 5 correspond with corrections of -4, -2, 2 and 4 times the Nyquist velocity,
+        # while no correction is applied for categories 0 and 3
+        cat = np.argmax(alias_onehot, axis=-1)
+        corrections = np.array([0., -4., -2., 0., 2., 4.], vel.dtype)
+        return vel+corrections[cat]*nyq
+
+    def run_model(self, name, inputs):
+        config, weights = self.models[name]
+        layers = {j['name']:j for j in config['layers']}
+        outputs = {j[0]:x for j,x in zip(config['input_layers'], inputs)}
+        # The number of layers that use each layer's output, used to release outputs that are no longer needed
+        n_uses = {}
+        for layer in config['layers']:
+            for j in self.inbound_layers(layer):
+                n_uses[j] = n_uses.get(j, 0)+1
+        output_names = [j[0] for j in config['output_layers']]
+
+        def evaluate(name):
+            if not name in outputs:
+                layer = layers[name]
+                inputs = [evaluate(j) for j in self.inbound_layers(layer)]
+                for j in self.inbound_layers(layer):
+                    n_uses[j] -= 1
+                    if n_uses[j] == 0 and not j in output_names:
+                        del outputs[j]
+                outputs[name] = self.apply_layer(layer['class_name'], layer['config'], weights.get(name, []), inputs)
+            return outputs[name]
+        return [evaluate(j) for j in output_names]
+
+    def inbound_layers(self, layer):
+        if not layer['inbound_nodes']:
+            return []
+        node = layer['inbound_nodes'][0]
+        if isinstance(node, dict):
+            # Keras 3 format
+            args = node['args'][0] if isinstance(node['args'][0], list) else node['args']
+            return [j['config']['keras_history'][0] for j in args]
+        return [j[0] for j in node]
+
+    def apply_layer(self, class_name, config, weights, inputs):
+        x = inputs[0]
+        if class_name == 'Conv2D':
+            if tuple(config['strides']) != (1, 1) or tuple(config['dilation_rate']) != (1, 1) or config['padding'] != 'same':
+                raise Exception('Conv2D configuration not supported')
+            x = self.conv2d(x, weights[0])
+            if config['use_bias']:
+                x += weights[1]
+            if config['activation'] == 'relu':
+                x = np.maximum(x, 0., out=x)
+            elif config['activation'] != 'linear':
+                raise Exception('Activation not supported')
+            return x
+        elif class_name == 'AveragePooling2D':
+            (ph, pw), strides = config['pool_size'], config['strides']
+            if config['padding'] != 'valid' or not strides in (None, config['pool_size']):
+                raise Exception('AveragePooling2D configuration not supported')
+            b, h, w, c = x.shape
+            return x[:, :h//ph*ph, :w//pw*pw].reshape((b, h//ph, ph, w//pw, pw, c)).mean(axis=(2, 4), dtype=x.dtype)
+        elif class_name == 'UpSampling2D':
+            if config['interpolation'] != 'nearest':
+                raise Exception('UpSampling2D interpolation not supported')
+            return np.repeat(np.repeat(x, config['size'][0], axis=1), config['size'][1], axis=2)
+        elif class_name == 'BatchNormalization':
+            weights = list(weights)
+            gamma = weights.pop(0) if config['scale'] else 1.
+            beta = weights.pop(0) if config['center'] else 0.
+            mean, var = weights
+            scale = (gamma/np.sqrt(var+np.float32(config['epsilon']))).astype(x.dtype)
+            return x*scale+(beta-mean*scale).astype(x.dtype)
+        elif class_name == 'LeakyReLU':
+            alpha = np.float32(config['alpha'] if 'alpha' in config else config['negative_slope'])
+            return np.where(x > 0, x, alpha*x)
+        elif class_name == 'ReLU':
+            return np.maximum(x, 0.)
+        elif class_name == 'Add':
+            return sum(inputs[1:], x)
+        elif class_name == 'Concatenate':
+            return np.concatenate(inputs, axis=config['axis'])
+        raise Exception(f'Layer {class_name} not supported')
+
+    def conv2d(self, x, kernel, max_block_size=2**22):
+        # Convolution with 'same' padding. x has shape (batch, height, width, channels) and kernel (kh, kw, channels, filters).
+        kh, kw, c, f = kernel.shape
+        if kh == kw == 1:
+            return x @ kernel[0, 0]
+        b, h, w, _ = x.shape
+        x = np.pad(x, ((0, 0), ((kh-1)//2, kh//2), ((kw-1)//2, kw//2), (0, 0)))
+        kernel = kernel.transpose((2, 0, 1, 3)).reshape((c*kh*kw, f))
+        windows = np.lib.stride_tricks.sliding_window_view(x, (kh, kw), axis=(1, 2))
+
+        out = np.empty((b, h, w, f), x.dtype)
+        n_rows = max(1, max_block_size//(w*c*kh*kw))
+        for i in range(b):
+            for j in range(0, h, n_rows):
+                block = windows[i, j:j+n_rows]
+                out[i, j:j+n_rows] = (block.reshape((-1, c*kh*kw)) @ kernel).reshape(block.shape[:2]+(f,))
+        return out
+
+
+class Unet_VDA():
+    def __init__(self, backend=None):
+        self.backend_name = backend
+        self.run_only_once_for_na_gt_1 = True
+
+    def load_model(self):
+        t = pytime.time()
+        self.backend = get_backend(self.backend_name)
+        self.model_id = get_model_id(self.backend_name)
+        print(f'Unet VDA {type(self.backend).__name__} loaded in {pytime.time()-t:.1f} s')
 
 
     def __call__(self, data, vn, azis=None, da=None, extra_dealias=True):
@@ -60,7 +249,7 @@ class Unet_VDA():
             Nyquist velocity. Either a single value for the whole scan, or a 1D array with a value for each azimuth. The latter is required when
             different Nyquist velocities are used for different azimuthal sectors of the scan. This is sometimes the case with NEXRAD scans.
         azis : np.ndarray (1D), optional
-            The default assumption is that data spans (approximately) 360 degrees, with any data gap filled with nans. If that's not the case, 
+            The default assumption is that data spans (approximately) 360 degrees, with any data gap filled with nans. If that's not the case,
             then it's possible to provide an array of azimuths corresponding to the data rows. This information will then be used to create a new
             data array, with data gaps filled with nans.
         da : float, optional
@@ -71,59 +260,67 @@ class Unet_VDA():
         np.ndarray (2D)
             Array with dealiased velocity data.
         """
-        if not hasattr(self, 'vda'):
+        return self.dealias_scans([data], [vn], [azis], [da], extra_dealias)[0]
+
+    def dealias_scans(self, datas, vns, azis=None, das=None, extra_dealias=True):
+        """Dealiases the scans in the list datas, with parameters as described for self.__call__, except that they are now given as lists
+        with one element per scan. The network is evaluated once for each group of scans that have the same number of radial bins after
+        padding (see self.run_vda), which is faster than evaluating it for each scan separately. Returns a list with dealiased velocities.
+        """
+        if not hasattr(self, 'backend'):
             self.load_model()
-            
-        n_unmasked = np.count_nonzero(~np.isnan(data))
-        if n_unmasked == 0:
-            # Processing an array with only empty velocity bins leads to errors elsewhere in the code, and is of course completely unnecessary
-            return data
-                    
-        indices = np.s_[:]
-        if not azis is None:
-            #Add rows with nans in case that data doesn't cover the full 360 degrees
-            data, vn, indices = self.expand_data_to_360deg(data, vn, azis, da)
-             
-        vn = (vn if type(vn) is np.ndarray else np.repeat(vn, len(data))).astype('float32')
-        data = self.run_model(data, vn[:, None], list(data.shape), extra_dealias).numpy()
-        # Remove any extra nan rows by using indices
-        return data[indices]
-            
+        azis = azis or [None]*len(datas)
+        das = das or [None]*len(datas)
+
+        results, scans = [None]*len(datas), []
+        for i, data in enumerate(datas):
+            n_unmasked = np.count_nonzero(~np.isnan(data))
+            if n_unmasked == 0:
+                # Processing an array with only empty velocity bins leads to errors elsewhere in the code, and is of course completely unnecessary
+                results[i] = data
+                continue
+
+            vn, indices = vns[i], np.s_[:]
+            if not azis[i] is None:
+                #Add rows with nans in case that data doesn't cover the full 360 degrees
+                data, vn, indices = self.expand_data_to_360deg(data, vn, azis[i], das[i])
+            vn = (vn if type(vn) is np.ndarray else np.repeat(vn, len(data))).astype('float32')
+            scans.append((i, self.prepare_data(data.astype('float32'), vn[:, None]), indices))
+
+        inputs = [j for _, scan, _ in scans for j in scan['vda_inputs']]
+        outputs = self.run_vda(inputs)
+        for i, scan, indices in scans:
+            scan['vda_outputs'], outputs = outputs[:len(scan['vda_inputs'])], outputs[len(scan['vda_inputs']):]
+            # Remove any extra nan rows by using indices
+            results[i] = self.finish_data(scan, extra_dealias)[indices]
+        return results
+
     def expand_data_to_360deg(self, data, vn, azis, da):
         """Add rows of nans in case of data gaps. An array of indices is created that contains for each data row the row in which it appears
         in the expanded data array. These indices are used to obtain back the original data array after dealiasing.
         """
         n_azi, n_rad = data.shape
-        
-        _data, indices = [], []
-        j = 0
-        for i,a in enumerate(azis):
-            n = angle_diff(a, azis[(i+1)%n_azi], between_0_360=True)/da
-            if n > 3:
-                k = sum(map(len, _data))
-                _data += [data[j:i+1], np.full((round(n)-1, n_rad), np.nan, data.dtype)]
-                indices += list(range(k, k+i+1-j))
-                j = i+1
-        k = sum(map(len, _data))
-        n_expected = round(360/da)
-        n_extra = max(0, k-n_expected)
-        _data += [data[j:], np.full((n_extra, n_rad), np.nan, data.dtype)]
-        indices += list(range(k, k+n_azi-j))
-        _data = np.concatenate([j for j in _data if len(j)])
-        
+
+        # Number of nan rows to insert after each row
+        n = angle_diff(azis, np.roll(azis, -1), between_0_360=True)/da
+        n_insert = np.where(n > 3, np.round(n)-1, 0).astype('int64')
+        indices = np.arange(n_azi)+np.concatenate(([0], np.cumsum(n_insert[:-1])))
+        # The number of rows before the last data gap. Nan rows are added at the end when this exceeds the expected number of rows.
+        gaps = np.nonzero(n_insert)[0]
+        k = indices[gaps[-1]]+1+n_insert[gaps[-1]] if len(gaps) else 0
+        n_extra = max(0, k-round(360/da))
+        n_total = n_azi+n_insert.sum()+n_extra
+
         shift = round(azis[0]/da)
-        _data = np.roll(_data, shift, axis=0)
-        indices = (np.array(indices)+shift) % len(_data)
-        
-        _vn = np.full(len(_data), np.nan, data.dtype)
+        indices = (indices+shift) % n_total
+        _data = np.full((n_total, n_rad), np.nan, data.dtype)
+        _data[indices] = data
+        _vn = np.full(n_total, np.nan, data.dtype)
         _vn[indices] = vn
-        
+
         return _data, _vn, indices
-    
-    
-    @tf.function(input_signature=(tf.TensorSpec(shape=[None, None], dtype=tf.float32), tf.TensorSpec(shape=[None, 1], dtype=tf.float32),
-                                  tf.TensorSpec(shape=[2], dtype=tf.int32), tf.TensorSpec(shape=[], dtype=tf.bool)))
-    def run_model(self, data, vn, data_shape, extra_dealias):        
+
+    def prepare_data(self, data, vn):
         """The model has been trained on data with an azimuthal resolution of 1°, implying that input data needs to consist
         of 360 azimuthal bins. First step below ensures that azimuthal dimension is integer multiple of 360. When this
         integer multiple is 2 (or more), then the model can't be applied to the full dataset. In this case one can run it twice on
@@ -131,139 +328,139 @@ class Unet_VDA():
         The latter is more computationally efficient, and is the default (self.run_only_once_for_na_gt_1 = True). In the latter
         case correction factors for the actual data rows are obtained obtained by comparing their potentially aliased velocities
         with the dealiased velocities from the model.
+        Returns a dictionary with the data needed by self.finish_data, including the inputs for the model under the key 'vda_inputs'.
         """
-        remap_data = data_shape[0]%360 != 0
+        scan = {'orig_data':data, 'orig_vn':vn, 'remap_indices':None}
         # Azimuthal dimension should be an integer multiple of 360. If not, then certain rows are either repeated or skipped, in order
         # to arrive at the desired dimension.
-        _data_shape, remap_indices = data_shape, tf.constant(0)
-        if remap_data:
-            remap_indices, data, vn, _data_shape = self.remap_azi_dim(data, vn, data_shape)
-            
-        n_azi, n_rad = _data_shape[0], _data_shape[1]
-        na = tf.cast(tf.round(n_azi/360), 'int32')
-        
+        if len(data) % 360 != 0:
+            scan['remap_indices'], data, vn = self.remap_azi_dim(data, vn)
+        scan['data'], scan['vn'] = data, vn
+
+        n_azi, n_rad = data.shape
+        na = round(n_azi/360)
+        scan['na'] = na
         if self.run_only_once_for_na_gt_1:
             # Reduce azimuthal dimension to 360, by averaging neigbhouring data rows. This is not a normal average, since that leads
             # to problems when averaging over both aliased and non-aliased velocities. The average is calculated by first converting
             # velocities to phases, then calculating a circular mean phase, and then converting this phase back to a velocity.
-            _data = tf.reshape(data/vn, (n_azi//na, na, n_rad))
-            data_mask = tf.math.is_nan(_data)
-            
+            _data = (data/vn).reshape((n_azi//na, na, n_rad))
+            data_mask = np.isnan(_data)
+
             phi = np.pi*_data
-            sin_phi_sum = tf.reduce_sum(tf.where(data_mask, 0., tf.sin(phi)), axis=1)
-            cos_phi_sum = tf.reduce_sum(tf.where(data_mask, 0., tf.cos(phi)), axis=1)
-            phi_mean = tf.atan2(sin_phi_sum, cos_phi_sum)
-            
-            vn_mean = tf.reduce_mean(tf.reshape(vn, (360, na, 1)), axis=1)
-            unmasked = tf.reduce_sum(tf.cast(~data_mask, 'uint8'), axis=1)
-            v_mean = tf.where(unmasked == 0, np.nan, phi_mean*vn_mean/np.pi)
-            
-            dealiased_vel = self.run_vda(v_mean, vn_mean, _data_shape)
-            
-            n = tf.round((tf.repeat(dealiased_vel, na, axis=0)-data)/(2*vn))
-            self.data = data+2*n*vn
+            sin_phi_sum = np.where(data_mask, np.float32(0.), np.sin(phi)).sum(axis=1)
+            cos_phi_sum = np.where(data_mask, np.float32(0.), np.cos(phi)).sum(axis=1)
+            phi_mean = np.arctan2(sin_phi_sum, cos_phi_sum)
+
+            vn_mean = vn.reshape((360, na, 1)).mean(axis=1)
+            unmasked = (~data_mask).sum(axis=1)
+            v_mean = np.where(unmasked == 0, np.float32(np.nan), phi_mean*vn_mean/np.pi)
+            scan['vda_inputs'] = [(v_mean, vn_mean)]
+        else:
+            scan['vda_inputs'] = [(data[i::na], vn[i::na]) for i in range(na)]
+        return scan
+
+    def finish_data(self, scan, extra_dealias):
+        data, vn, na = scan['data'], scan['vn'], scan['na']
+        if self.run_only_once_for_na_gt_1:
+            dealiased_vel = scan['vda_outputs'][0]
+            n = np.round((np.repeat(dealiased_vel, na, axis=0)-data)/(2*vn))
+            data = data+2*n*vn
         else:
-            self.data = [self.run_vda(data[::na], vn[::na], _data_shape),
-                         self.run_vda(data[1::na], vn[1::na], _data_shape)]
-            self.data = tf.reshape(tf.stack(self.data, axis=1), _data_shape)
-            
+            data = np.stack(scan['vda_outputs'], axis=1).reshape(data.shape)
+
         # Restore original azimuthal dimension, now that velocity is dealiased. In the case that the number of rows had to be reduced to
         # arrive at the desired dimension, some data rows will not have been dealiased yet. For these a correction factor is obtained by
         # comparing the potentially aliased velocity with a reference average dealiased velocity over the neighbouring rows.
         # This is done before performing extra dealiasing, since using the reference velocity might not work well in regions of strong azimuthal
         # shear. Resulting errors can then be corrected by the extra dealiasing procedure.
-        if remap_data:
-            self.data, vn = self.restore_azi_dim(remap_indices, data_shape)
-               
+        if not scan['remap_indices'] is None:
+            data, vn = self.restore_azi_dim(data, scan)
+
         if extra_dealias and vn[0,0] > 10:
-            self.data = self.perform_extra_dealiasing(vn, data_shape)
-
-        return self.data
-    
-    def remap_azi_dim(self, data, vn, data_shape):
-        self.orig_data, self.orig_vn, orig_n_azi = data, vn, tf.cast(data_shape[0], 'float32')
-        n_azi = tf.cast(tf.round(data_shape[0]/360)*360, 'float32')
-        remap_indices = tf.cast(tf.range(0.5, n_azi, dtype='float32')*orig_n_azi/n_azi, 'int32')[:, None]
-        data = tf.gather_nd(data, remap_indices)
-        vn = tf.gather_nd(vn, remap_indices)
-        _data_shape = tf.stack((tf.cast(n_azi, 'int32'), data_shape[1]))
-        return remap_indices, data, vn, _data_shape
-    
-    def restore_azi_dim(self, remap_indices, data_shape):
-        data = tf.scatter_nd(remap_indices, self.data, data_shape)
-        if len(remap_indices) > data_shape[0]:
-            indices_counts = tf.cast(tf.unique_with_counts(remap_indices[:,0])[2], 'float32')
+            data = self.perform_extra_dealiasing(data, vn)
+        return data
+
+    def remap_azi_dim(self, data, vn):
+        orig_n_azi = np.float32(len(data))
+        n_azi = np.float32(round(len(data)/360)*360)
+        remap_indices = (np.arange(0.5, n_azi, dtype='float32')*orig_n_azi/n_azi).astype('int32')
+        return remap_indices, data[remap_indices], vn[remap_indices]
+
+    def restore_azi_dim(self, data, scan):
+        remap_indices, vn = scan['remap_indices'], scan['orig_vn']
+        n_azi = len(scan['orig_data'])
+        _data = np.zeros((n_azi, data.shape[1]), data.dtype)
+        np.add.at(_data, remap_indices, data)
+        data = _data
+        if len(remap_indices) > n_azi:
             # Without division by indices_counts, velocity values will be doubled when remap_indices contains a repeated index
-            data /= indices_counts[:,None]
-        vn = self.orig_vn
-        
-        select = tf.concat((remap_indices[1:,0]-remap_indices[:-1,0] == 2, [False]), axis=0)
-        i = tf.boolean_mask(remap_indices, select)+1
-        im1, ip1 = i-1, (i+1) % data_shape[0]
-        
-        v_ref = 0.5*(tf.gather_nd(data, im1)+tf.gather_nd(data, ip1))
-        v_i, vn_i = tf.gather_nd(self.orig_data, i), tf.gather_nd(vn, i)
-        n = tf.round((v_ref-v_i)/(2*vn_i))
-        update = v_i+2*n*vn_i
-        data = tf.tensor_scatter_nd_update(data, i, update)
+            data /= np.bincount(remap_indices, minlength=n_azi)[:,None].astype(data.dtype)
+
+        i = remap_indices[:-1][remap_indices[1:]-remap_indices[:-1] == 2]+1
+        im1, ip1 = i-1, (i+1) % n_azi
+
+        v_ref = 0.5*(data[im1]+data[ip1])
+        v_i, vn_i = scan['orig_data'][i], vn[i]
+        n = np.round((v_ref-v_i)/(2*vn_i))
+        data[i] = v_i+2*n*vn_i
         return data, vn
 
-    def run_vda(self, vel, vn, data_shape):
-        ##  Prep data for UNet
-        n_rad = data_shape[1]
+    def run_vda(self, inputs):
+        """Runs the model for the list inputs with tuples of velocity and Nyquist velocity arrays, with a single backend call for inputs that
+        have the same shape after padding. Returns a list with dealiased velocities.
+        """
         # The number of radial bins needs to be an integer multiple of 64. Here the radial dimension is expanded if needed.
         n = 64
-        n_rad_extra = n-n_rad%n
-        vel = tf.pad(vel, [[0, 0], [0, n_rad_extra]], 'CONSTANT', constant_values=np.nan)
-        
+        shapes = [(len(vel), vel.shape[1]+n-vel.shape[1]%n) for vel, vn in inputs]
         # Pad data 12 degrees on either side with periodic boundary conditions
         pad_deg = 12
-        vel = tf.concat((vel[-pad_deg:,:], vel, vel[:pad_deg,:]), axis=0)
-        vn = tf.concat((vn[-pad_deg:,:], vn, vn[:pad_deg,:]), axis=0)
-        
-        # vel shape (batch, n_frames, Naz, Nrng, 1)
-        vel = vel[None, None, :, :, None]
-        # vn shape (batch, n_frames, Naz, 1)
-        vn = vn[None, None, :, :]
-        
-        # Run UNet
-        inp = {'vel':vel, 'nyq':vn}
-        out = self.vda(inp)
-        return out['dealiased_vel'][0,pad_deg:-pad_deg,:n_rad,0]
-    
-    def perform_extra_dealiasing(self, vn, data_shape):
-        n_azi, n_rad = data_shape[0], data_shape[1]
-        rows = tf.transpose(tf.tile([tf.range(n_azi)], (n_rad, 1)))
-        
-        mask = ~tf.math.is_nan(self.data)
-        mask.set_shape((None, None))
-        mask_indices = tf.cast(tf.where(mask), 'int32')
-        _data = tf.boolean_mask(self.data, mask)
-        _rows = tf.boolean_mask(rows, mask)
-        
-        diff_1d = tf.concat(([0], tf.where(_rows[1:] == _rows[:-1], _data[1:]-_data[:-1], 0.)), axis=0)
-        diff = tf.scatter_nd(mask_indices, diff_1d, data_shape)
+
+        outputs = [None]*len(inputs)
+        for n_azi, n_rad_padded in set(shapes):
+            batch = [i for i in range(len(inputs)) if shapes[i] == (n_azi, n_rad_padded)]
+            vel = np.full((len(batch), n_azi+2*pad_deg, n_rad_padded), np.nan, 'float32')
+            vn = np.empty((len(batch), n_azi+2*pad_deg), 'float32')
+            for j, i in enumerate(batch):
+                _vel, _vn = inputs[i]
+                rows = np.arange(-pad_deg, n_azi+pad_deg) % n_azi
+                vel[j, :, :_vel.shape[1]] = _vel[rows]
+                vn[j] = _vn[rows, 0]
+
+            # Run UNet
+            out = self.backend(vel, vn)
+            for j, i in enumerate(batch):
+                outputs[i] = out[j, pad_deg:-pad_deg, :inputs[i][0].shape[1]]
+        return outputs
+
+    def perform_extra_dealiasing(self, data, vn):
+        mask = ~np.isnan(data)
+        _data = data[mask]
+        _rows = np.nonzero(mask)[0]
+
+        diff_1d = np.concatenate(([0], np.where(_rows[1:] == _rows[:-1], _data[1:]-_data[:-1], 0.))).astype(data.dtype)
+        diff = np.zeros(data.shape, data.dtype)
+        diff[mask] = diff_1d
         corr, valid_data = self.calculate_correction_ints(diff, mask, vn)
-        
-        diff_1d = -tf.roll(diff_1d, -1, axis=0)
-        diff = tf.scatter_nd(mask_indices, diff_1d, data_shape)
+
+        diff[mask] = -np.roll(diff_1d, -1)
         corr2, valid_data2 = self.calculate_correction_ints(diff, mask, vn, -1)
-                    
-        corr = tf.where(valid_data & valid_data2 & (corr != corr2), 0., tf.where(valid_data, corr, corr2))
-        return self.data - 2*vn*corr
-    
+
+        corr = np.where(valid_data & valid_data2 & (corr != corr2), 0., np.where(valid_data, corr, corr2))
+        return data - 2*vn*corr
+
     def calculate_correction_ints(self, diff, mask, vn, direction=1):
         s = np.s_[:] if direction == 1 else np.s_[:,::-1]
         diff, mask = diff[s], mask[s]
-        
-        ratio = tf.round(diff/(2*vn))
-        cs = tf.where(mask, tf.math.cumsum(ratio, axis=1), 0.)
-        ccs = tf.math.cumsum(tf.abs(tf.sign(cs)), axis=1)
+
+        ratio = np.round(diff/(2*vn))
+        cs = np.where(mask, np.cumsum(ratio, axis=1), 0.)
+        ccs = np.cumsum(np.abs(np.sign(cs)), axis=1)
         keep = ccs <= 20
-        ratio = tf.where(keep, ratio, 0.)
-        beyond_last_cs0 = tf.math.cumsum(tf.cast(tf.math.cumsum(ratio, axis=1) == 0., 'uint8')[:,::-1], axis=1)[:,::-1] == 0
+        ratio = np.where(keep, ratio, 0.)
+        beyond_last_cs0 = np.cumsum((np.cumsum(ratio, axis=1) == 0.).astype('uint8')[:,::-1], axis=1, dtype='uint8')[:,::-1] == 0
         valid_data = keep[:,-1,None] | ~beyond_last_cs0
-        ratio = tf.where(valid_data, ratio, 0.)
-        cs = tf.math.cumsum(ratio, axis=1)
-        
-        return cs[s], valid_data[s]
\ No newline at end of file
+        ratio = np.where(valid_data, ratio, 0.)
+        cs = np.cumsum(ratio, axis=1)
+
+        return cs[s], valid_data[s]
@@ -57,6 +57,7 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import bz2
 import gzip
+import mmap
 import re
 import struct
 import warnings
@@ -64,10 +65,31 @@ from datetime import datetime, timedelta
 import os
 import copy
 import time as pytime
+from collections import OrderedDict
+from collections.abc import Sequence
+import threading
+import json
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
 
+# When True, MSG31 records are decoded into columnar arrays (see _Msg31Columns) instead of into a dictionary per record.
+# Can be set to False in order to compare with the dictionary-based decoding.
+bulk_decoding = True
+# Number of threads used for decompressing the independent BZ2 blocks of a file. A value of 1 means that all blocks
+# are decompressed in one call in the current thread.
+bzip2_decompression_workers = min(8, os.cpu_count() or 1)
+# Maximum size (in bytes) of bzip2_block_cache, which is created further down. NLradar changes it with bzip2_block_cache.resize,
+# such that the cache is part of the maximum amount of radar data in memory (see DataSource_General.set_memory_limits)
+bzip2_block_cache_max_bytes = 256*1024**2
+# When True, uncompressed files are memory-mapped and gzipped files are decompressed once into a preallocated bytearray
+# (see _VolumeBuffer), and records are parsed from memoryview slices of these buffers. Can be set to False in order to
+# compare with reading through bytes concatenation.
+zero_copy_reading = True
+
+
 class NEXRADLevel2File:
     """
     Class for accessing data in a NEXRAD (WSR-88D) Level II file.
@@ -85,8 +107,9 @@ class NEXRADLevel2File:
 
     Attributes
     ----------
-    radial_records : list
-        Radial (1 or 31) messages in the file.
+    radial_records : list or _RadialRecords
+        Radial (1 or 31) messages in the file. When the MSG31 records are decoded
+        in bulk, this is a list-like view on the columnar arrays in _columns.
     nscans : int
         Number of scans in the file.
     scan_msgs : list of arrays
@@ -137,10 +160,12 @@ class NEXRADLevel2File:
             if self._fh.closed:
                 if self._bzip2_compression:
                     self._fh = open(self._fh.name, "rb")
-                else:
+                    self._file_key = _get_file_key(self._fh.name)
+                elif not getattr(self._buf, 'complete', False):
                     # If a gzipped file is closed it must be fully decompressed again. So in this case there is no
                     # benefit of passing a file handle, and an exception is raised. This is not the case for
                     # bzip2-compressed files, which consist of separate compressed blocks that can be handled independently. 
+                    # It's also not the case when the content of the file is already fully present in self._buf.
                     raise Exception('Gzipped files should not be closed when using this option')
         else:
             if file_name_or_obj.endswith('.gz'):
@@ -158,7 +183,12 @@ class NEXRADLevel2File:
             compression_or_ctm_info = compression_record[compression_slice]
             self._bzip2_compression = compression_or_ctm_info == b"BZ"
             
-            self._buf = {} if self._bzip2_compression else b''
+            if self._bzip2_compression:
+                self._buf = {}
+            else:
+                self._buf = _VolumeBuffer(self._fh, file_name_or_obj) if zero_copy_reading else b''
+            # Identifies the file in bzip2_block_cache
+            self._file_key = _get_file_key(file_name_or_obj) if self._bzip2_compression else None
 
             
         if self._decode_meta:
@@ -176,7 +206,7 @@ class NEXRADLevel2File:
                 
                 bzip2_read_indices = 'all'
                 if read_mode == 'min-meta':
-                    buf = _decompress_records_meta(self._cbuf, self._bzip2_start_pos, [0])
+                    buf = _decompress_records_meta(self._cbuf, self._bzip2_start_pos, [0], file_key=self._file_key)
                     self._read_records(buf)
                     self._get_vcp()
                     cut_params = self.vcp.get('cut_parameters', [])
@@ -199,7 +229,7 @@ class NEXRADLevel2File:
                         # print('reopen', bzip2_read_indices, len(self._bzip2_start_pos))
                         # self.decode_file(self._fh, read_mode='all-meta')
                         # return
-                buf = _decompress_records_meta(self._cbuf, self._bzip2_start_pos, bzip2_read_indices)
+                buf = _decompress_records_meta(self._cbuf, self._bzip2_start_pos, bzip2_read_indices, file_key=self._file_key)
                 self._bzip2_read_indices = list(range(len(self._bzip2_start_pos))) if bzip2_read_indices == 'all' else\
                                            bzip2_read_indices
             else:
@@ -237,40 +267,55 @@ class NEXRADLevel2File:
             # First sort the indices, to make sure that no issues occur with reaching end-of-file marker halfway through reading the desired scans.
             # This has no effect on handling the resulting data, since scans will be sorted in self.scan_msgs anyway here below.
             read_mode = sorted(read_mode)             
-            buf = b""
-            for startend_pos in read_mode:
-                buf += self._read_bzip2(startend_pos) if self._bzip2_compression else self._read_gzip(startend_pos)
-        
-        self._read_records(buf)
+            if isinstance(self._buf, _VolumeBuffer):
+                # Adjacent parts are merged, such that when all requested scans are adjacent the records can be parsed
+                # directly from a memoryview on self._buf, without copying
+                read_mode = _merge_adjacent_parts(read_mode)
+            bufs = [self._read_bzip2(startend_pos) if self._bzip2_compression else self._read_gzip(startend_pos) for
+                    startend_pos in read_mode]
+            # Join only when needed, and at once instead of through repeated concatenation
+            buf = bufs[0] if len(bufs) == 1 else b''.join(bufs)
+
+        # The columnar MSG31 arrays are only used when decoding full scans, since for the meta read modes only 1 record per
+        # BZ2 block is decoded.
+        self._columns = None
+        if self._decode_meta or not bulk_decoding:
+            self._read_records(buf)
+        else:
+            msg_types_counts = self._read_records_bulk(buf)
+
+        if self._columns is None:
+            # pull out radial records (1 or 31) which contain the moment data.
+            self.radial_records = []
+            radial_records_start_pos = []
+
+            msg_types = [r["header"]["type"] for r in self._records]
+            msg_types_counts = {j:msg_types.count(j) for j in (1,31)}
+            # It has been observed in at least 1 erroneous file that both MSG1 and MSG31 formats are present. In that case include only those
+            # of the type that is present most.
+            self._msg_type = max(msg_types_counts, key=msg_types_counts.get)
+            for i, r in enumerate(self._records):
+                if r["header"]["type"] == self._msg_type:
+                    self.radial_records.append(r)
+                    if self._decode_meta and self._bzip2_compression:
+                        radial_records_start_pos.append(self._bzip2_read_indices[i])
+                    else:
+                        radial_records_start_pos.append(self._records_start_pos[i])
 
-        # pull out radial records (1 or 31) which contain the moment data.
-        self.radial_records = []
-        radial_records_start_pos = []
-        
-        msg_types = [r["header"]["type"] for r in self._records]
-        msg_types_counts = {j:msg_types.count(j) for j in (1,31)}
-        # It has been observed in at least 1 erroneous file that both MSG1 and MSG31 formats are present. In that case include only those 
-        # of the type that is present most.
-        self._msg_type = max(msg_types_counts, key=msg_types_counts.get)
-        for i, r in enumerate(self._records):
-            if r["header"]["type"] == self._msg_type:
-                self.radial_records.append(r)
-                if self._decode_meta and self._bzip2_compression:
-                    radial_records_start_pos.append(self._bzip2_read_indices[i])
-                else:
-                    radial_records_start_pos.append(self._records_start_pos[i])
-                
         if len(self.radial_records) == 0:
             raise ValueError("No MSG31 records found, cannot read file")
-            
-        elev_nums = np.array(
-            [m["msg_header"]["elevation_number"] for m in self.radial_records]
-        )
+
+        if self._columns is None:
+            elev_nums = np.array(
+                [m["msg_header"]["elevation_number"] for m in self.radial_records]
+            )
+        else:
+            elev_nums = self._columns.msg_header["elevation_number"].astype('int64')
         self.scan_msgs = [
             np.where(elev_nums == i)[0] for i in range(elev_nums.min(), elev_nums.max()+1)
         ]
                
-        azi_numbers = [j['msg_header']['azimuth_number'] for j in self.radial_records]
+        azi_numbers = [j['msg_header']['azimuth_number'] for j in self.radial_records] if read_mode == 'min-meta' else []
         wrong_indices_step = read_mode == 'min-meta' and not self._bzip2_compression and\
                              any(azi_i-azi_numbers[i-1] > 0 and azi_i-azi_numbers[i-1] != gzip_indices_step for i,azi_i in enumerate(azi_numbers))
         # For 'min-meta' a few additional checks are needed to ensure that the desired metadata has been obtained correctly.
@@ -331,7 +376,8 @@ class NEXRADLevel2File:
 
     def _read_bzip2(self, startend_pos=[0, None]):
         """Reads (parts of) a bzip2 compressed file, and stores the decompressed data in self._buf. 
-        This is done in order to prevent repeated decompression."""
+        This is done in order to prevent repeated decompression. Decompressed BZ2 blocks are also stored in
+        bzip2_block_cache, which prevents repeated decompression when the file is reopened."""
         key = str(startend_pos)
         if not key in self._buf:
             self._fh.seek(startend_pos[0])
@@ -339,13 +385,16 @@ class NEXRADLevel2File:
                 buf = self._fh.read()
             else:
                 buf = self._fh.read(startend_pos[1]-startend_pos[0])
-            self._buf[key] = _decompress_records(buf)
+            self._buf[key] = _decompress_records(buf, file_key=self._file_key, offset=startend_pos[0])
         return self._buf[key]
 
     def _read_gzip(self, startend_pos=None):
-        """Reads (parts of) a gzipped file, and stores the decompressed data in self._buf. 
-        This is done in order to prevent repeated decompression."""
-        if startend_pos:
+        """Reads (parts of) a gzipped or uncompressed file, and stores the decompressed data in self._buf. 
+        This is done in order to prevent repeated decompression. With zero_copy_reading a memoryview on self._buf
+        is returned."""
+        if isinstance(self._buf, _VolumeBuffer):
+            return self._buf.read(startend_pos)
+        elif startend_pos:
             l = len(self._buf)
             if not startend_pos[1]:
                 self._buf += self._fh.read()
@@ -375,7 +424,8 @@ class NEXRADLevel2File:
                 self._records_start_pos.append(pos)
                 pos, dic = _get_record_from_buf(b, pos, self._moments)
                 if self._bzip2_compression and self._decode_meta and i > 0 and not 'RAD' in dic:
-                    b = _decompress_records_meta(self._cbuf, self._bzip2_start_pos, bzip2_read_indices=[i], max_length=10000)[0]
+                    b = _decompress_records_meta(self._cbuf, self._bzip2_start_pos, bzip2_read_indices=[i], max_length=10000,
+                                                 file_key=self._file_key)[0]
                     buf_length = len(b)
                     pos = COMPRESSION_RECORD_SIZE
                     while pos < buf_length:
@@ -391,7 +441,27 @@ class NEXRADLevel2File:
                 if self._bzip2_compression and self._decode_meta:
                     # Only one record per BZ2 block is needed for metadata
                     break
-                
+
+    def _read_records_bulk(self, buf):
+        """Alternative for self._read_records, that decodes all MSG31 records at once into columnar arrays (self._columns),
+        instead of creating a dictionary per record. self.radial_records then becomes a view on these arrays, that creates
+        dictionaries only for the records that are requested. Returns the number of MSG1 and MSG31 records.
+        Files with MSG1 records are still decoded with self._read_records."""
+        pos = COMPRESSION_RECORD_SIZE if self._bzip2_compression else 0
+        offsets, msg_types = _get_record_offsets(buf, pos)
+        msg_types_counts = {j:int(np.count_nonzero(msg_types == j)) for j in (1,31)}
+        if msg_types_counts[1] >= msg_types_counts[31]:
+            self._read_records(buf)
+            return msg_types_counts
+
+        self._msg_type = 31
+        # Other records (like the VCP in MSG5) are still stored as dictionaries
+        self._records = [_get_record_from_buf(buf, int(i), self._moments)[1] for i in offsets[msg_types != 31]]
+        self._records_start_pos = list(offsets[msg_types != 31])
+        self._columns = _Msg31Columns(buf, offsets[msg_types == 31], self._moments)
+        self.radial_records = _RadialRecords(self._columns)
+        return msg_types_counts
+
     def _get_vcp(self):
         # pull out the vcp record
         msg_5 = [r for r in self._records if r["header"]["type"] == 5]
@@ -487,6 +557,31 @@ class NEXRADLevel2File:
             )
         return info
 
+    def get_scans_meta(self):
+        """
+        Return a summary of the scan metadata that is obtained with read_mode 'min-meta' or 'all-meta', in a JSON-serializable
+        form that can be stored in a NEXRADLevel2MetaIndex. Contains per scan the start and end positions in the file, the
+        target and actual elevation angles, the Nyquist velocity, the unambiguous range and the gate information of the
+        moments that are available in the first radial.
+        """
+        target_angles = self.get_target_angles()
+        elevation_angles = self.get_elevation_angles()
+        unambig_ranges = self.get_unambigous_range()
+        scans = []
+        for i, msgs in enumerate(self.scan_msgs):
+            msg = self.radial_records[msgs[0]]
+            scans.append({
+                "startend_pos": [None if j is None else int(j) for j in self.scan_startend_pos[i]],
+                "target_angle": float(target_angles[i]),
+                "elevation_angle": float(elevation_angles[msgs].mean()),
+                "unambig_range": float(unambig_ranges[msgs].mean()),
+                "nyquist_vel": float(self.get_nyquist_vel(scans=[i])[0]),
+                "moments": {m:{k:int(msg[m][k]) for k in ("ngates", "first_gate", "gate_spacing")}
+                            for m in ["REF", "VEL", "SW", "ZDR", "PHI", "RHO", "CFP"] if m in msg},
+            })
+        bzip2_start_pos = [int(j) for j in self._bzip2_start_pos] if self._bzip2_compression else []
+        return {"bzip2_compression": bool(self._bzip2_compression), "bzip2_start_pos": bzip2_start_pos, "scans": scans}
+
     def get_vcp_pattern(self):
         """
         Return the numerical volume coverage pattern (VCP) or None if unknown.
@@ -506,6 +601,8 @@ class NEXRADLevel2File:
         Return an array of radial header elements for all rays in scans.
         """
         msg_nums = self._msg_nums(scans)
+        if self._columns is not None:
+            return _to_python_precision(self._columns.msg_header[key][msg_nums])
         temp = [self.radial_records[i]["msg_header"][key] for i in msg_nums]
         return np.array(temp)
 
@@ -514,7 +611,9 @@ class NEXRADLevel2File:
         Return an array of RAD or msg_header elements for all rays in scans.
         """
         msg_nums = self._msg_nums(scans)
-        if self._msg_type == 31:
+        if self._columns is not None:
+            return _to_python_precision(self._columns.blocks["RAD"][key][msg_nums])
+        elif self._msg_type == 31:
             tmp = [self.radial_records[i]["RAD"][key] for i in msg_nums]
         else:
             tmp = [self.radial_records[i]["msg_header"][key] for i in msg_nums]
@@ -711,6 +810,8 @@ class NEXRADLevel2File:
 
         # determine the number of rays
         msg_nums = self._msg_nums(scans)
+        if self._columns is not None:
+            return self._get_data_columns(moment, max_ngates, scans, msg_nums, raw_data)
         nrays = len(msg_nums)
         # extract the data
         set_datatype = False
@@ -744,6 +845,26 @@ class NEXRADLevel2File:
         # moment is not present in any scan, mask all values
         return np.ma.masked_less_equal(data, 1)
 
+    def _get_data_columns(self, moment, max_ngates, scans, msg_nums, raw_data):
+        """Version of self.get_data for data that is stored in self._columns."""
+        column = self._columns.moments.get(moment, None)
+        present = column["present"][msg_nums] if column else np.zeros(len(msg_nums), dtype=bool)
+        if not present.any():
+            data = np.ones((len(msg_nums), max_ngates), ">B")
+            return data if raw_data else np.ma.masked_less_equal(data, 1)
+
+        ngates = min(max_ngates, column["data"].shape[1])
+        data = np.ones((len(msg_nums), max_ngates), column["data"].dtype)
+        data[:, :ngates] = column["data"][msg_nums, :ngates]
+        if raw_data:
+            return data
+
+        # As in self.get_data, assume that offset and scale are the same for all scans/gates
+        i = msg_nums[present.argmax()]
+        offset = np.float32(column["header"]["offset"][i])
+        scale = np.float32(column["header"]["scale"][i])
+        return np.ma.array((data - offset) / scale, mask=data <= 1)
+
 
 def _bits_to_code(msg, moment):
     """
@@ -775,22 +896,61 @@ def _bits_to_code(msg, moment):
         raise TypeError("Unsupported msg type %s", msg["header"]["type"])
 
 
-def _decompress_records(cbuf):
+def _decompress_records(cbuf, n_workers=None, file_key=None, offset=0):
     """
     Decompress the records from an BZ2 compressed Archive 2 file.
+    The BZ2 blocks are independent streams, and when n_workers > 1 they are decompressed in parallel by a thread pool
+    (bz2 releases the GIL during decompression). n_workers defaults to bzip2_decompression_workers.
+    When file_key is given, decompressed blocks are obtained from/stored in bzip2_block_cache, with offset the position of
+    cbuf in the file.
     """
+    if n_workers is None:
+        n_workers = bzip2_decompression_workers
     bzip2_start_pos = _get_bzip2_start_indices(cbuf)
     n = len(bzip2_start_pos)
     # Remove the end-of-stream markers at the end of each bzip2 stream in order to enable decompression in one shot
-    cbuf = b''.join([cbuf[s:(bzip2_start_pos[i+1]-4 if i+1 < n else None)] for i,s in enumerate(bzip2_start_pos)])
-    buf = bz2.decompress(cbuf)
+    cbuf_view = memoryview(cbuf)
+    blocks = [cbuf_view[s:(bzip2_start_pos[i+1]-4 if i+1 < n else None)] for i,s in enumerate(bzip2_start_pos)]
+    
+    if file_key is not None or (n_workers > 1 and n > 1):
+        try:
+            if file_key is None:
+                return b''.join(_decompress_blocks(blocks, n_workers))
+            keys = [file_key+(offset+s, None) for s in bzip2_start_pos]
+            bufs = [bzip2_block_cache.get(k) for k in keys]
+            missing = [i for i in range(n) if bufs[i] is None]
+            for i, b in zip(missing, _decompress_blocks([blocks[i] for i in missing], n_workers)):
+                bufs[i] = b
+                bzip2_block_cache.put(keys[i], b)
+            return b''.join(bufs)
+        except Exception as e:
+            # Fall back to decompression in one shot, which gives the same result (or error) for a valid (erroneous) file
+            print(e, '_decompress_records')
+    buf = bz2.decompress(b''.join(blocks))
     return buf
 
+def _decompress_blocks(blocks, n_workers):
+    """Decompress a list of BZ2 blocks, in parallel when n_workers > 1."""
+    if n_workers > 1 and len(blocks) > 1:
+        # executor.map returns the results in order of the blocks
+        return list(_get_bzip2_executor(n_workers).map(bz2.decompress, blocks))
+    return [bz2.decompress(b) for b in blocks]
+
+_bzip2_executor = None
+def _get_bzip2_executor(n_workers):
+    # The thread pool is shared by all files, and is only recreated when the number of workers changes
+    global _bzip2_executor
+    if _bzip2_executor is None or _bzip2_executor._max_workers != n_workers:
+        if _bzip2_executor is not None:
+            _bzip2_executor.shutdown(wait=False)
+        _bzip2_executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix='nexrad_l2_bz2')
+    return _bzip2_executor
+
 def _get_bzip2_start_indices(cbuf):
     bzip2_start_pos = [i.start() for i in re.finditer(b'BZh', cbuf)]
     return [i for i in bzip2_start_pos if cbuf[i+5:i+10] in b'AY&SY']
         
-def _decompress_records_meta(cbuf, bzip2_start_pos, bzip2_read_indices='all', max_length=300):
+def _decompress_records_meta(cbuf, bzip2_start_pos, bzip2_read_indices='all', max_length=300, file_key=None):
     n = len(bzip2_start_pos)
     if bzip2_read_indices == 'all':
         bzip2_read_indices = range(n)
@@ -798,10 +958,21 @@ def _decompress_records_meta(cbuf, bzip2_start_pos, bzip2_read_indices='all', ma
     for i in bzip2_read_indices:
         i1 = bzip2_start_pos[i]
         i2 = bzip2_start_pos[i+1]-4 if i+1 < n else None
-        decompressor = bz2.BZ2Decompressor()
         # Always read the first BZ2 block fully, since it contains important metadata like VCP pattern characteristics
+        length = max_length if i > 0 else -1
+        if file_key is not None:
+            # A fully decompressed block from bzip2_block_cache can be used as well, since partial decompression gives
+            # the first max_length bytes of it
+            key = file_key+(i1, None if length == -1 else length)
+            b = bzip2_block_cache.get(file_key+(i1, None), key)
+            if b is not None:
+                buf.append(b if length == -1 else b[:length])
+                continue
+        decompressor = bz2.BZ2Decompressor()
         try:
-            buf.append(decompressor.decompress(cbuf[i1:i2], max_length if i > 0 else -1))
+            buf.append(decompressor.decompress(cbuf[i1:i2], length))
+            if file_key is not None:
+                bzip2_block_cache.put(key, buf[-1])
         except Exception as e:
             print(e, i, '_decompress_records_meta')
             # In case of an error add an empty string. This can be properly dealt with in the function _read_records
@@ -809,6 +980,380 @@ def _decompress_records_meta(cbuf, bzip2_start_pos, bzip2_read_indices='all', ma
     return buf
 
 
+def decompress_into_cache(filename, startend_pos=None):
+    """Decompress (parts of) a bzip2-compressed file into bzip2_block_cache, without decoding any records. Is used for prefetching
+    files that will likely be requested soon, after which NEXRADLevel2File(filename, read_mode=startend_pos) doesn't need to 
+    decompress anything. startend_pos is a list with [start, end] positions, and by default the whole file is decompressed."""
+    file_key = _get_file_key(filename)
+    with open(filename, 'rb') as f:
+        for start, end in startend_pos or [[0, None]]:
+            f.seek(start)
+            cbuf = f.read() if end is None else f.read(end-start)
+            # Use 1 worker, since prefetching already takes place in a separate thread
+            _decompress_records(cbuf, n_workers=1, file_key=file_key, offset=start)
+
+
+class NEXRADLevel2MetaIndex:
+    """
+    Persistent index of the scan metadata of NEXRAD L2 files (see NEXRADLevel2File.get_scans_meta), stored in an SQLite
+    database. Entries are keyed by directory and filename, and are only used when the size and modification time of
+    the file are unchanged. Opening an already seen file then requires no decompression at all.
+    """
+
+    def __init__(self, db_filename):
+        self.db_filename = db_filename
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.db_filename), exist_ok=True)
+            self._connection = sqlite3.connect(self.db_filename, check_same_thread=False)
+            self._connection.execute("CREATE TABLE IF NOT EXISTS scans_meta (directory TEXT, filename TEXT, size INTEGER, "
+                                     "mtime_ns INTEGER, meta TEXT, PRIMARY KEY (directory, filename))")
+        return self._connection
+
+    def _key(self, filepath):
+        stat = os.stat(filepath)
+        filepath = os.path.abspath(filepath)
+        return (os.path.dirname(filepath), os.path.basename(filepath), stat.st_size, stat.st_mtime_ns)
+
+    def get(self, filepath):
+        """Return the scan metadata for filepath, or None if it is not present in the index (or outdated)."""
+        try:
+            key = self._key(filepath)
+            with self._lock:
+                row = self._connect().execute("SELECT meta FROM scans_meta WHERE directory=? AND filename=? AND size=? "
+                                              "AND mtime_ns=?", key).fetchone()
+            return None if row is None else json.loads(row[0])
+        except (OSError, sqlite3.Error, ValueError) as e:
+            print(e, 'NEXRADLevel2MetaIndex.get')
+            return None
+
+    def put(self, filepath, meta):
+        try:
+            key = self._key(filepath)
+            with self._lock:
+                with self._connect() as connection: # Commits the transaction
+                    connection.execute("INSERT OR REPLACE INTO scans_meta VALUES (?, ?, ?, ?, ?)", key+(json.dumps(meta),))
+        except (OSError, sqlite3.Error) as e:
+            print(e, 'NEXRADLevel2MetaIndex.put')
+
+
+class _VolumeBuffer:
+    """
+    Content of an uncompressed or gzipped file after the volume header and compression record, which is the part that is
+    stored in NEXRADLevel2File._buf. Uncompressed files are memory-mapped, so no copy of the file is made at all.
+    Gzipped files are decompressed incrementally into a single bytearray, that is preallocated with the uncompressed size 
+    given by the ISIZE field at the end of the file. Parts are returned as read-only memoryviews, such that arrays obtained
+    from them with np.frombuffer reference this buffer instead of a copy.
+    """
+    
+    chunk_size = 4*1024**2
+    
+    def __init__(self, fh, filename):
+        self._fh = fh
+        offset = _structure_size['VOLUME_HEADER'] + COMPRESSION_RECORD_SIZE
+        self.complete = False
+        if isinstance(fh, gzip.GzipFile):
+            self._data = bytearray(max(_get_gzip_size(filename) - offset, 0))
+            self.length = 0
+        else:
+            try:
+                # The mapping remains valid after closing fh, and is released when the last memoryview on it is gone
+                self._data = memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))[offset:]
+            except (ValueError, OSError) as e:
+                # Empty files can't be mapped, and neither can some file-like objects
+                print(e, '_VolumeBuffer')
+                fh.seek(offset)
+                self._data = fh.read()
+            self.length = len(self._data)
+            self.complete = True
+        
+    def read(self, startend_pos=None):
+        end = startend_pos[1] if startend_pos else None
+        if not self.complete and (end is None or self.length < end):
+            self._fill(end)
+        view = memoryview(self._data)[:self.length].toreadonly()
+        return view[startend_pos[0]:end] if startend_pos else view
+        
+    def _fill(self, end=None):
+        while end is None or self.length < end:
+            capacity = len(self._data)
+            if self.length == capacity:
+                # ISIZE is only exact for single-member files smaller than 4 GB. If the file turns out to be larger, then 
+                # continue in a larger bytearray. This leaves memoryviews that were handed out earlier intact.
+                chunk = self._fh.read(self.chunk_size)
+                if not chunk:
+                    self.complete = True
+                    break
+                data = bytearray(max(2*capacity, capacity+len(chunk)))
+                data[:self.length] = memoryview(self._data)[:self.length]
+                data[self.length:self.length+len(chunk)] = chunk
+                self._data = data
+                self.length += len(chunk)
+                continue
+            n = min(self.chunk_size, capacity-self.length)
+            n = self._fh.readinto(memoryview(self._data)[self.length:self.length+n])
+            if n == 0:
+                self.complete = True
+                break
+            self.length += n
+            
+def _get_gzip_size(filename):
+    """Returns the uncompressed size of a gzipped file modulo 2**32, as given by the ISIZE field at the end of the file."""
+    try:
+        with open(filename, 'rb') as f:
+            f.seek(-4, os.SEEK_END)
+            return struct.unpack('<I', f.read(4))[0]
+    except Exception as e:
+        print(e, '_get_gzip_size')
+        return 0
+
+def _merge_adjacent_parts(startend_pos):
+    """Merges adjacent [start, end] parts in a sorted list of parts."""
+    merged = []
+    for pos in startend_pos:
+        if merged and merged[-1][1] is not None and merged[-1][1] == pos[0]:
+            merged[-1] = [merged[-1][0], pos[1]]
+        else:
+            merged.append(list(pos))
+    return merged
+
+def _get_file_key(filename):
+    stat = os.stat(filename)
+    return (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+
+
+class _BlockCache:
+    """
+    Process-wide LRU cache of decompressed BZ2 blocks, that is shared by all NEXRADLevel2File instances. This prevents
+    repeated decompression when a file gets reopened, as happens when stepping back and forth through time.
+    Keys are (file path, mtime, file size, block offset, max_length), where max_length is None for fully decompressed
+    blocks, and the number of bytes otherwise (see _decompress_records_meta).
+    The total size of the cached blocks is limited to max_bytes, after which least recently used blocks are evicted.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, *keys):
+        """Returns the block for the first of keys that is present in the cache, or None if none of them is present."""
+        with self._lock:
+            buf = None
+            for key in keys:
+                buf = self._blocks.get(key, None)
+                if buf is not None:
+                    self._blocks.move_to_end(key)
+                    break
+            self.hits += buf is not None
+            self.misses += buf is None
+        return buf
+
+    def put(self, key, buf):
+        if len(buf) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._blocks:
+                self.nbytes -= len(self._blocks.pop(key))
+            self._blocks[key] = buf
+            self.nbytes += len(buf)
+            self._evict()
+
+    def resize(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        # Should be called with self._lock acquired
+        while self.nbytes > self.max_bytes:
+            self.nbytes -= len(self._blocks.popitem(last=False)[1])
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Return hit/miss counters and memory usage, for diagnostics."""
+        with self._lock:
+            n_lookups = self.hits+self.misses
+            return {'hits':self.hits, 'misses':self.misses, 'hit_rate':self.hits/n_lookups if n_lookups else 0.,
+                    'evictions':self.evictions, 'n_blocks':len(self._blocks), 'nbytes':self.nbytes, 'max_bytes':self.max_bytes}
+
+
+def _get_record_offsets(buf, pos):
+    """Scan a decompressed buffer once, and return the start positions and message types of all records in it.
+    Record sizes are determined in the same way as in _get_record_from_buf."""
+    msg_header_size = _structure_size['MSG_HEADER']
+    msg_header_format = _structure_format['MSG_HEADER']
+    buf_length = len(buf)
+    offsets, msg_types = [], []
+    while pos+msg_header_size <= buf_length:
+        msg_size, _, msg_type, _, _, _, segments, seg_num = struct.unpack_from(msg_header_format, buf, pos)
+        offsets.append(pos)
+        msg_types.append(msg_type)
+        if msg_type == 31:
+            pos += msg_header_size + msg_size * 2 - 4
+        elif msg_type == 29:
+            if msg_size == 65535:
+                msg_size = segments << 16 | seg_num
+            pos += msg_header_size + msg_size
+        else:
+            pos += RECORD_SIZE
+    return np.array(offsets, dtype='int64'), np.array(msg_types, dtype='int64')
+
+
+class _Msg31Columns:
+    """
+    Columnar representation of a set of MSG31 records, obtained by viewing the record headers and data blocks
+    of all radials at once through structured dtypes.
+
+    Attributes
+    ----------
+    header, msg_header : structured ndarray
+        MSG_HEADER and MSG_31 structures for all radials.
+    blocks : dict
+        Structured arrays with the VOL, ELV and RAD data blocks for all radials, in which radials without the block
+        are zero-filled. Whether a radial contains the block is given in blocks_present.
+    moments : dict
+        For each decoded moment a dictionary with keys 'header' (GENERIC_DATA_BLOCK structures), 'present' (bool array)
+        and 'data' (2D array with gate values for all radials, with value 1 for gates beyond the number of gates of a radial
+        and for radials in which the moment is absent).
+    """
+
+    def __init__(self, buf, offsets, moments=None):
+        u8 = np.frombuffer(buf, dtype='uint8')
+        self.n = len(offsets)
+        msg_start = offsets + _structure_size['MSG_HEADER']
+
+        self.header = _gather_structures(u8, offsets, 'MSG_HEADER')
+        msg_length = self.header['size'].astype('int64') * 2 - 4
+        self.msg_header = _gather_structures(u8, msg_start, 'MSG_31')
+
+        ptrs = np.stack([self.msg_header[p] for p in block_pointers], axis=1).astype('int64')
+        valid = (ptrs > 0) & (ptrs+4 <= msg_length[:, None])
+        block_start = msg_start[:, None] + ptrs
+        names = u8[np.clip(block_start[:, :, None] + np.arange(1, 4), 0, len(u8)-1)]
+        names = np.ascontiguousarray(names).view('S3')[:, :, 0]
+        names[~valid] = b''
+
+        self.blocks, self.blocks_present = {}, {}
+        for name, structure_name in (('VOL', 'VOLUME_DATA_BLOCK'), ('ELV', 'ELEVATION_DATA_BLOCK'), ('RAD', 'RADIAL_DATA_BLOCK')):
+            start, present = self._block_start(names, block_start, name, _structure_size[structure_name], len(u8))
+            self.blocks[name] = _gather_structures(u8, start, structure_name, present)
+            self.blocks_present[name] = present
+
+        self.moments = {}
+        for moment in ("REF", "VEL", "SW", "ZDR", "PHI", "RHO", "CFP"):
+            if moments and not moment in moments:
+                continue
+            start, present = self._block_start(names, block_start, moment, _structure_size['GENERIC_DATA_BLOCK'], len(u8))
+            if present.any():
+                header = _gather_structures(u8, start, 'GENERIC_DATA_BLOCK', present)
+                data = _gather_gates(u8, start + _structure_size['GENERIC_DATA_BLOCK'], header, present)
+                self.moments[moment] = {"header": header, "present": present, "data": data}
+
+    def _block_start(self, names, block_start, name, size, buf_length):
+        select = names == name.ljust(3).encode('ascii')
+        present = select.any(axis=1)
+        start = block_start[np.arange(self.n), select.argmax(axis=1)]
+        present &= start+size <= buf_length
+        return np.where(present, start, 0), present
+
+
+def _gather_structures(u8, start, structure_name, present=None):
+    """Unpack the structure with name structure_name at positions start in u8 (a uint8 view on the buffer) for
+    all positions at once. Entries for which present is False are zero-filled."""
+    size = _structure_size[structure_name]
+    idx = start[:, None] + np.arange(size)
+    if present is None:
+        s = u8[idx]
+    else:
+        s = np.zeros(idx.shape, dtype='uint8')
+        s[present] = u8[idx[present]]
+    return np.ascontiguousarray(s).view(_structure_dtype[structure_name])[:, 0]
+
+def _gather_gates(u8, start, header, present):
+    """Gather the gate data of a moment for all radials into a 2D array, with value 1 for gates that are not
+    available in a radial (as in NEXRADLevel2File.get_data)."""
+    word_size = header['word_size'].astype('int64')
+    dtype = 'uint16' if np.any(word_size[present] == 16) else 'uint8'
+    gate_bytes = np.where(word_size == 16, 2, 1)
+    # Limit the number of gates to what is actually available in the buffer
+    ngates = np.minimum(header['ngates'].astype('int64'), (len(u8) - start) // gate_bytes)
+    ngates[~present] = 0
+
+    data = np.ones((len(start), max(ngates.max(), 0)), dtype)
+    gates = np.arange(data.shape[1])
+    for ws, nbytes, dt in ((8, 1, '>u1'), (16, 2, '>u2')):
+        rows = np.where(present & (word_size == ws))[0]
+        if len(rows) == 0:
+            continue
+        # Records within a scan usually have a constant size, which means that the gates of consecutive radials are located at
+        # a constant stride in the buffer. Runs of such radials are gathered with a strided view instead of through fancy indexing.
+        strides = np.diff(start[rows])
+        changes = np.flatnonzero(np.diff(strides)) + 1
+        runs, rest = [], []
+        for i1, i2 in zip(np.r_[0, changes], np.r_[changes, len(strides)]):
+            run = rows[i1:i2+1]
+            n = ngates[run].max()
+            if len(run) >= 8 and start[run[-1]] + n * nbytes <= len(u8):
+                runs.append((run, n, np.lib.stride_tricks.as_strided(u8[start[run[0]]:], (len(run), n * nbytes), (strides[i1], 1))))
+            else:
+                rest.append(run)
+        for i in np.unique(np.concatenate(rest)) if rest else []:
+            # Radials in short runs are copied one by one, which is faster than fancy indexing
+            data[i, :ngates[i]] = np.frombuffer(u8, dt, ngates[i], start[i])
+
+        for run, n, values in runs:
+            values = np.ascontiguousarray(values).view(dt)
+            if ngates[run].min() < n:
+                values = np.where(gates[:n] < ngates[run, None], values, 1)
+            data[run, :n] = values
+    return data
+
+def _to_python_precision(arr):
+    # Values obtained with struct.unpack are Python floats/ints, and therefore have 64-bit precision
+    return arr.astype('float64' if arr.dtype.kind == 'f' else 'int64')
+
+
+class _RadialRecords(Sequence):
+    """List-like view on _Msg31Columns, that returns the same dictionaries as created by _get_record_from_buf.
+    These dictionaries are created only for the records that are requested."""
+
+    def __init__(self, columns):
+        self._columns = columns
+
+    def __len__(self):
+        return self._columns.n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        c = self._columns
+        i = range(c.n)[i]
+        dic = {"header": _structure_to_dict(c.header[i]), "msg_header": _structure_to_dict(c.msg_header[i])}
+        for name, block in c.blocks.items():
+            if c.blocks_present[name][i]:
+                dic[name] = _structure_to_dict(block[i])
+        for moment, column in c.moments.items():
+            if column["present"][i]:
+                dic[moment] = _structure_to_dict(column["header"][i])
+                ngates = min(dic[moment]["ngates"], column["data"].shape[1])
+                dic[moment]["data"] = column["data"][i, :ngates]
+        return dic
+
+def _structure_to_dict(s):
+    return dict(zip(s.dtype.names, s.tolist()))
+
+
 def _get_record_from_buf(buf, pos, moments=None):
     """Retrieve and unpack a NEXRAD record from a buffer."""
     dic = {"header": _unpack_from_buf(buf, pos, 'MSG_HEADER')}
@@ -862,7 +1407,7 @@ def _get_msg31_from_buf(buf, pos, dic, moments=None):
 
 def _get_msg31_data_block(buf, ptr, moments=None):
     """Unpack a msg_31 data block into a dictionary."""
-    block_name = buf[ptr + 1 : ptr + 4].decode("ascii").strip()
+    block_name = bytes(buf[ptr + 1 : ptr + 4]).decode("ascii").strip()
 
     if block_name == "VOL":
         dic = _unpack_from_buf(buf, ptr, 'VOLUME_DATA_BLOCK')
@@ -966,26 +1511,22 @@ def _get_msg5_from_buf(buf, pos, dic):
 _structure_names = ('VOLUME_HEADER', 'MSG_HEADER', 'MSG_31', 'MSG_1', 'MSG_5', 'MSG_5_ELEV', 'GENERIC_DATA_BLOCK', 
                    'VOLUME_DATA_BLOCK', 'ELEVATION_DATA_BLOCK', 'RADIAL_DATA_BLOCK')
 
-dic_before = {name:'' for name in _structure_names}
-dic_before['GENERIC_DATA_BLOCK'] = {}
-s_before = copy.deepcopy(dic_before)
+# The last unpacked structure per structure name (and per product for GENERIC_DATA_BLOCK), stored together with its bytes
+# in a single tuple. This keeps the lookup consistent when files are decoded in more than one thread (see nlr_prefetch.py).
+unpacked_before = {}
 def _unpack_from_buf(buf, pos, structure_name, product=None):
-    global dic_before, s_before
     """Unpack a structure from a buffer."""
     size = _structure_size[structure_name]
-    s = buf[pos : pos + size]
-    s_b = s_before[structure_name] if structure_name != 'GENERIC_DATA_BLOCK' else s_before['GENERIC_DATA_BLOCK'].get(product, '')
+    # bytes() is needed when buf is a memoryview. It prevents that unpacked_before keeps a reference to the full buffer
+    s = bytes(buf[pos : pos + size])
+    key = (structure_name, product)
+    s_b, dic = unpacked_before.get(key, (None, None))
     if s != s_b:
         dic = _unpack_structure(s, structure_name)
-        if structure_name == 'GENERIC_DATA_BLOCK':
-            dic_before[structure_name][product], s_before[structure_name][product] = dic.copy(), s
-        else:
-            dic_before[structure_name], s_before[structure_name] = dic, s
-    else:
-        if structure_name == 'GENERIC_DATA_BLOCK':
-            dic = dic_before[structure_name][product].copy()
-        else:
-            dic = dic_before[structure_name]
+        unpacked_before[key] = (s, dic)
+    if structure_name == 'GENERIC_DATA_BLOCK':
+        # A copy is needed, since the data array gets added to the dictionary
+        dic = dic.copy()
     return dic
 
 
@@ -1221,6 +1762,13 @@ _structure_content = {structure:[i[0] for i in globals()[structure]] for structu
 _structure_format = {structure:">" + "".join([i[1] for i in globals()[structure]]) for structure in _structure_names}
 _structure_size = {structure:struct.calcsize(struct_format) for structure,struct_format in _structure_format.items()}
 
+bzip2_block_cache = _BlockCache(bzip2_block_cache_max_bytes)
+
+# Structured dtypes equivalent to the struct formats above, used for decoding many records at once
+_dtype_codes = {"B":">u1", "H":">u2", "I":">u4", "f":">f4", "d":">f8", "b":">i1", "h":">i2", "i":">i4"}
+_structure_dtype = {structure:np.dtype([(i[0], _dtype_codes.get(i[1], "S"+i[1][:-1])) for i in globals()[structure]]) 
+                    for structure in _structure_names}
+
 
 #%%
 if __name__ == "__main__":
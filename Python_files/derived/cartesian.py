@@ -6,10 +6,16 @@ import time as pytime
 
 import nlr_functions as ft
 import nlr_globalvars as gv
+from derived import nlr_mappingcache as mc
 
 
 
 class Cartesian():
+    # Attributes that are determined in self.get_parameters_data_mapping, and that are kept in the bin mapping cache (see nlr_mappingcache.py).
+    # Only the index maps are stored on disk, self.heights_3D_all is calculated from them.
+    mapping_attributes = ('productbins_unique_all_flat', 'radarbins_unique_all_flat', 'heights_3D_all', 'sorted_heights')
+    persisted_attributes = ('productbins_unique_all_flat', 'radarbins_unique_all_flat')
+    
     def __init__(self, dp_class, parent = None):
         self.dp = dp_class
         self.dsg = self.dp.dsg
@@ -164,24 +170,44 @@ class Cartesian():
                                  np.abs(self.translation_vectors_all_before-translation_vectors_all).max()<=0.1)
         if perform_remapping:
             #Is only done when the structure of the radar volume has changed, or when the function has not yet been called before for self.product,
-            #for the given radar volume structure.
-            # t = pytime.time()
-            self.assign_radarbins_to_productbins()
-            # print(pytime.time() - t,'t1')
+            #for the given radar volume structure. In that case the mapping is taken from the cache when it has been calculated before for
+            #this structure.
             self.get_product_coords_and_groundranges()
-            # print(pytime.time() - t,'t2')
-            self.assign_productbins_to_radarbins()
-            # print(pytime.time() - t,'t3')
-            self.get_heights_3D()
-            # print(pytime.time() - t,'t4')
-            
-            # Make sure that sorted heights are recalculated for every product, by emptying self.sorted_heights
-            self.sorted_heights = {}
+            key = self.get_mapping_key()
+            # Mappings with storm motion correction are only kept in memory, since these change with the storm motion and scan times
+            filename = None if translation_vectors_all.any() else\
+                       self.dp.mapping_cache.get_filename(self.gui.derivedproducts_dir, self.dsg.get_radar_dataset(no_special_char=True), key)
+            mapping = self.dp.mapping_cache.get(key, filename)
+            if mapping is None:
+                # New dictionaries, since the ones that are currently assigned might be present in the cache
+                self.productbins_unique_all_flat, self.radarbins_unique_all_flat = {}, {}
+                self.assign_radarbins_to_productbins()
+                self.assign_productbins_to_radarbins()
+            else:
+                for j in mapping:
+                    self.__dict__[j] = mapping[j]
+                    
+            if mapping is None or not 'heights_3D_all' in mapping:
+                # Also when the mapping has been read from disk, in which case it contains only the index maps
+                self.get_heights_3D()
+                # Make sure that sorted heights are recalculated for every product, by emptying self.sorted_heights
+                self.sorted_heights = {}
+                self.dp.mapping_cache.put(key, {j:self.__dict__[j] for j in self.mapping_attributes}, filename if mapping is None else None,
+                                          self.persisted_attributes)
             
             self.radial_bins_all_before = self.radial_bins_all.copy()
             self.azimuthal_bins_all_before = azimuthal_bins_all.copy()
             self.maxheights_all_before = maxheights_all.copy()
             self.translation_vectors_all_before = translation_vectors_all.copy()
+            
+    def get_mapping_key(self):
+        # Hash of everything that determines the mapping. Floats are rounded, such that negligible changes in e.g. scanangles or translation
+        # vectors don't lead to a new mapping
+        scans_params = tuple((j, self.radial_bins_all[j], round(self.radial_res_all[j], 4), round(self.radius_offsets_all[j], 4), 
+                              round(self.scanangles_all[j], 3), round(self.radial_range_all[j], 3), tuple(arr.shape[0] for arr in self.data_all[j]),
+                              tuple(tuple(np.round(v, 2)) for v in self.translation_vectors[j]))
+                             for j in self.scans_all)
+        return mc.get_key(('car', round(self.product_res, 4), self.product_xy_bins_all, scans_params))
 
 
     def get_data_specs(self):
@@ -202,58 +228,20 @@ class Cartesian():
         Z_empty = -30.       
         n = sum([len(self.data_all[j]) for j in self.scans_all])
         self.Zavg_3D_all = np.full((n, length), Z_empty, dtype='float32')        
-        indices_occurrences = np.ones(length, dtype=self.get_int_dtype())
                                                             
         for j in self.scans_all:
             for i in range(0, len(self.data_all[j])):
                 index = self.dp.index_all(j, i)
                 flattened = self.data_all[j][i].ravel()
                 
-                indices = self.productbins_unique_all_flat[j][i]
-                retain = (indices != max_value) & ~np.isnan(flattened)
-                flattened = flattened[retain]
-                indices = indices[retain]
-                #The linear reflectivity is only calculated for a bin in self.Zavg_3D_all[j] if more than one bin in self.data_all[j][i] is mapped onto that bin
-                #in self.Zavg_3D_all[j], because calculating the logartihm to arrive back at the logarithmic reflectivity is an expensive operation.
-                
-                kmax = max(1, int(np.ceil(40*self.product_res**2)))
-                """indices_occurrences gives the number of occurrences for each index in indices. When the while loop is finished and each bin in 
-                self.Zavg_3D_all[j] contains the sum of all reflectivities that are mapped onto that bin, then self.Zavg_3D_all[j] is divided by
-                indices_occurrences, to get the average reflectivity.
-                """
-                indices_occurrences[:] = 1
-                indices_bincount = np.minimum(np.bincount(indices), kmax)
-                indices_occurrences[:len(indices_bincount)] = indices_bincount
+                # Average of all reflectivities that get mapped onto a particular bin, see ft.get_grid_max_and_mean_dBZ. Bins outside the
+                # product domain have index max_value, and are therefore excluded.
+                _, Zavg, counts = ft.get_grid_max_and_mean_dBZ(flattened, self.productbins_unique_all_flat[j][i], length, calculate_max=False)
                 
-                sort_indices = np.argsort(indices)
-                indices = indices[sort_indices]
-                flattened = flattened[sort_indices]
-                
-                indices_unique_orig, flattened_indices_orig, counts = np.unique(indices, return_index=True, return_counts=True)
-                count_max = counts.max()
-
-                k = 0
-                while k < min([kmax, count_max]):
-                    if k == 0:
-                        self.Zavg_3D_all[index, indices_unique_orig] = flattened[flattened_indices_orig]
-                    else:                                   
-                        select = counts > k
-                        indices_unique = indices_unique_orig[select]
-                        flattened_indices = flattened_indices_orig[select] + k
-                        
-                        if k == 1:
-                            # Perform this operation only once, because it is quite expensive
-                            self.Zavg_3D_all[index, indices_unique] = np.power(10., 0.1*self.Zavg_3D_all[index, indices_unique])
-                            
-                        self.Zavg_3D_all[index, indices_unique] += np.power(10., 0.1*flattened[flattened_indices])
-                    k += 1
-                
-                Zavg_islinear = indices_occurrences > 1
-                self.Zavg_3D_all[index, Zavg_islinear] = 10.*np.log10(self.Zavg_3D_all[index, Zavg_islinear]/indices_occurrences[Zavg_islinear])
-
-                flattened = self.data_all[j][i].ravel()
-                Zavg_empty = (self.Zavg_3D_all[index] == Z_empty) & (self.radarbins_unique_all_flat[j][i] != max_value)
-                self.Zavg_3D_all[index, Zavg_empty] = flattened[self.radarbins_unique_all_flat[j][i][Zavg_empty]]
+                # Bins onto which no radar bins are mapped get the reflectivity of the radar bin in which they are located
+                Zavg_empty = (counts == 0) & (self.radarbins_unique_all_flat[j][i] != max_value)
+                Zavg[Zavg_empty] = flattened[self.radarbins_unique_all_flat[j][i][Zavg_empty]]
+                self.Zavg_3D_all[index] = Zavg
                 
         self.Zavg_3D_all[np.isnan(self.Zavg_3D_all)] = Z_empty  
         self.Zavg_3D_all.shape = (n, self.product_xy_bins_all, self.product_xy_bins_all)
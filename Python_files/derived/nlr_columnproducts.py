@@ -0,0 +1,160 @@
+# Copyright (C) 2016-2024 Bram van 't Veen, bramvtveen94@hotmail.com
+# Distributed under the GNU General Public License version 3, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+
+
+"""Calculation of echo tops, PCAPPIs, VIL and Zmax in a single pass over the (height-sorted) scans, for products that use the same scans.
+The product grid is processed in blocks of rows of at most column_chunk_size bins, such that the intermediate arrays remain small.
+Results are equal to those of DerivedPlain.calculate_echotops, calculate_PCAPPI, calculate_VIL and calculate_Zmax, but mask values are not
+yet applied (this is done in DerivedPlain.calculate_column_products).
+"""
+
+column_chunk_size = 2**16
+Z_empty = -30.
+Zlinear_56dBZ = 10**5.6
+
+
+def get_highest_notempty_scan(Zavg_3D, heights_3D):
+    # See DerivedPlain.get_highest_notempty_scan
+    highest_notempty = np.zeros(Zavg_3D.shape[1:], dtype='int8')
+    empty = np.ones(Zavg_3D.shape[1:], dtype=bool)
+    for i in range(len(Zavg_3D)-1, -1, -1):
+        update = empty & (Zavg_3D[i] != Z_empty)
+        highest_notempty[update] = i
+        empty[update] = 0
+        empty[heights_3D[i] == 0.] = 1
+    return highest_notempty
+
+def power_4_7(Z, select):
+    # Z**(4/7) for the selected bins, and 0 elsewhere
+    result = np.zeros(Z.shape, dtype='float32')
+    np.power(Z, 4./7., out=result, where=select)
+    return result
+
+def calculate_column_products(Zmax_3D, Zavg_3D, heights_3D, hdiffs=None, echotops_thresholds=(), PCAPPI_heights=(), VIL_params=(),
+                              Zmax_minheights=(), VIL_params_h=None, chunk_size=None):
+    """Returns dictionaries with as keys the echo tops thresholds, PCAPPI heights, VIL parameters (tuples (cap_dBZ, VIL_minheight)) and Zmax
+    minimum heights, and as values the product arrays. VIL_params_h can be one of the VIL parameters, for which also the ratio of height-weighted
+    and unweighted VIL is returned (that is used for the 'h' products), otherwise None is returned for it. hdiffs is only needed for VIL.
+    """
+    shape = heights_3D.shape[1:]
+    echotops = {j:np.full(shape, -1000., dtype='float32') for j in echotops_thresholds}
+    PCAPPI = {j:np.empty(shape, dtype='float32') for j in PCAPPI_heights}
+    VIL = {j:np.zeros(shape, dtype='float32') for j in VIL_params}
+    Zmax = {j:np.full(shape, -np.inf, dtype='float32') for j in Zmax_minheights}
+    VIL_h = np.zeros(shape, dtype='float32') if VIL_params_h else None
+
+    rows = max(1, (chunk_size or column_chunk_size)//int(np.prod(shape[1:])))
+    # Invalid values that occur outside the bins that are updated are not used
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for r in range(0, shape[0], rows):
+            c = np.s_[:, r:r+rows]
+            _calculate_chunk(Zmax_3D[c], Zavg_3D[c], heights_3D[c], None if hdiffs is None else hdiffs[c],
+                             {j:k[r:r+rows] for j,k in echotops.items()}, {j:k[r:r+rows] for j,k in PCAPPI.items()},
+                             {j:k[r:r+rows] for j,k in VIL.items()}, {j:k[r:r+rows] for j,k in Zmax.items()},
+                             VIL_params_h, None if VIL_h is None else VIL_h[r:r+rows])
+    return echotops, PCAPPI, VIL, Zmax, VIL_h
+
+def _calculate_chunk(Zmax_3D, Zavg_3D, heights_3D, hdiffs, echotops, PCAPPI, VIL, Zmax, VIL_params_h, VIL_h):
+    """Updates the product arrays for one block of rows. These are views of the output arrays, and echotops, VIL and Zmax arrays are updated
+    during the pass over the scans, while for PCAPPI the bottom and top reflectivities and height differences are collected first.
+    The expressions below follow those in the DerivedPlain functions, such that floating point results are equal.
+    """
+    n = len(heights_3D)
+    shape = heights_3D.shape[1:]
+    if PCAPPI or VIL:
+        highest_notempty = get_highest_notempty_scan(Zavg_3D, heights_3D)
+    PCAPPI_data = {j:[np.full(shape, -1000., dtype='float32'), np.full(shape, -1000., dtype='float32'),
+                      np.zeros(shape, dtype='float32'), np.zeros(shape, dtype='float32')] for j in PCAPPI}
+    if VIL_params_h:
+        VIL_l = np.zeros(shape, dtype='float32')
+
+    for i in range(n):
+        Zmax_i, Zavg_i, h_i = Zmax_3D[i], Zavg_3D[i], heights_3D[i]
+
+        if echotops:
+            Zmax_imin1 = Zmax_3D[i-1]
+            not_empty = Zmax_i != Z_empty
+        for threshold, product_array in echotops.items():
+            update = Zmax_i >= threshold
+            if i > 0:
+                # Interpolate between scans when the threshold is exceeded in the previous scan but not in the current one
+                update_before = Zmax_imin1 >= threshold
+                difference = update_before & ~update & not_empty
+                interpolated = product_array+(h_i-product_array)*(Zmax_imin1-threshold)/(Zmax_imin1-Zmax_i)
+                np.copyto(product_array, interpolated, where=difference)
+            np.copyto(product_array, h_i, where=update)
+
+        if PCAPPI:
+            h_positive = h_i > 0.
+        for PCAPPI_height, (Z_bottom, Z_top, hdiff_bottom, hdiff_top) in PCAPPI_data.items():
+            hdiff = np.abs(PCAPPI_height-h_i)
+            Z_bottom_update = (h_i < PCAPPI_height) & h_positive
+            np.copyto(Z_bottom, Zavg_i, where=Z_bottom_update)
+            np.copyto(hdiff_bottom, hdiff, where=Z_bottom_update)
+            Z_top_update = (Z_top == -1000.) & (h_i > PCAPPI_height)
+            np.copyto(Z_top, Zavg_i, where=Z_top_update)
+            np.copyto(hdiff_top, hdiff, where=Z_top_update)
+
+        for Zmax_minheight, product_array in Zmax.items():
+            # The minimum height doesn't apply to the highest scan
+            np.maximum(product_array, Zmax_i if i == n-1 else np.where(h_i < Zmax_minheight, np.float32(Z_empty), Zmax_i), out=product_array)
+
+        if VIL:
+            s2 = Zavg_i != Z_empty
+            Z2 = np.zeros(shape, dtype='float32')
+            Z2[s2] = 10**(0.1*Zavg_i[s2])
+            Z2_cap = np.minimum(Z2, Zlinear_56dBZ)
+            if VIL_params_h:
+                # Calculated once per scan, since it is used for the layers below and above the scan
+                z2_47 = power_4_7(Z2_cap if VIL_params_h[0] else Z2, s2)
+            if i > 0:
+                # Layer between scans i-1 and i
+                ss = (s1 | s2) & (highest_notempty >= i)
+                Z_avg = 0.5*(Z1+Z2)
+                for VIL_params, product_array in VIL.items():
+                    cap_dBZ, VIL_minheight = VIL_params
+                    Z = np.minimum(Z_avg, Zlinear_56dBZ) if cap_dBZ else Z_avg
+                    layer_hdiffs = hdiffs[i]
+                    if VIL_minheight:
+                        layer_hdiffs = np.where(VIL_minheight > heights_3D[i-1], 1e3*np.maximum(0., h_i-VIL_minheight), layer_hdiffs)
+                    Z_47 = power_4_7(Z, ss)
+                    np.add(product_array, (3.44*10**-6)*layer_hdiffs*Z_47, out=product_array, where=ss)
+
+                    if VIL_params == VIL_params_h:
+                        hZ47 = 0.5*(heights_3D[i-1]*z1_47+h_i*z2_47)
+                        np.add(VIL_h, (3.44*10**-6)*layer_hdiffs*hZ47, out=VIL_h, where=ss)
+                        if cap_dBZ:
+                            Z_47 = power_4_7(0.5*(Z1_cap+Z2_cap), ss)
+                        np.add(VIL_l, (3.44*10**-6)*layer_hdiffs*Z_47, out=VIL_l, where=ss)
+
+                    if i == 1:
+                        # Part below the lowest scan, for which the reflectivity of the lowest scan is used
+                        bottom_hdiffs = 1e3*np.maximum(0., heights_3D[0]-VIL_minheight) if VIL_minheight else hdiffs[0]
+                        z1_47_bottom = z1_47 if VIL_params == VIL_params_h else power_4_7(Z1_cap if cap_dBZ else Z1, s1)
+                        delta_l = (3.44*10**-6)*bottom_hdiffs*z1_47_bottom
+                        np.add(product_array, delta_l, out=product_array, where=s1)
+                        if VIL_params == VIL_params_h:
+                            hZ47 = 0.5*heights_3D[0]*z1_47
+                            np.add(VIL_h, (3.44*10**-6)*bottom_hdiffs*hZ47, out=VIL_h, where=s1)
+                            np.add(VIL_l, delta_l, out=VIL_l, where=s1)
+            s1, Z1, Z1_cap = s2, Z2, Z2_cap
+            if VIL_params_h:
+                z1_47 = z2_47
+
+    for PCAPPI_height, (Z_bottom, Z_top, hdiff_bottom, hdiff_top) in PCAPPI_data.items():
+        product_array = PCAPPI[PCAPPI_height]
+        Zb = Z_bottom == -1000.; Zt = Z_top == -1000.
+        hdiff_sum = hdiff_bottom+hdiff_top; hdiff_sum_nonzero = hdiff_sum != 0.
+        product_array[:] = np.where(hdiff_sum_nonzero, (Z_bottom*hdiff_top+Z_top*hdiff_bottom)/hdiff_sum, np.float32(-1000.))
+        height_highest_notempty = np.take_along_axis(heights_3D, highest_notempty[np.newaxis].astype(np.intp), axis=0)[0]
+        product_array[height_highest_notempty < PCAPPI_height] = -1000.
+        # As in DerivedPlain.calculate_PCAPPI, Z_bottom is also used when Z_top is available exactly at the CAPPI height
+        Z_exactly_at_CAPPI_height = ~hdiff_sum_nonzero & (~Zb | ~Zt)
+        product_array[Z_exactly_at_CAPPI_height] = Z_bottom[Z_exactly_at_CAPPI_height]
+        product_array[Zt] = Zavg_3D[-1, Zt]
+        product_array[Zb] = Zavg_3D[0, Zb]
+
+    if VIL_params_h:
+        VIL_h /= VIL_l
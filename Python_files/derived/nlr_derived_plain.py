@@ -14,10 +14,16 @@ import nlr_functions as ft
 import nlr_globalvars as gv
 from derived.polar import Polar
 from derived.cartesian import Cartesian
+from derived.nlr_mappingcache import BinMappingCache
+from derived import nlr_columnproducts as cp
 
 
 
 class DerivedPlain():
+    # When True, products that use the same scans are calculated in a single pass over the scans (see self.calculate_column_products),
+    # instead of with a separate function call per product
+    use_column_engine = True
+    
     def __init__(self, dsg_class, parent = None):
         self.dsg = dsg_class
         self.gui = self.dsg.gui
@@ -50,6 +56,9 @@ class DerivedPlain():
 
         self.meta_PP = {j: {} for j in gv.plain_products}
         
+        # Mappings between radar bins and product bins, for the volume structures of the radars that have been viewed. The maximum size
+        # of the cache is set in DataSource_General.set_memory_limits.
+        self.mapping_cache = BinMappingCache()
         self.mapping_classes = {'pol': Polar(self), 'car': Cartesian(self)}
         self.mapping_parameters = ['Zmax_3D','Zavg_3D','heights_3D','hdiffs']
         
@@ -332,8 +341,13 @@ class DerivedPlain():
                 p_params_projs[p_param_function] = p_params_projs[p_param]
         
             
+        # Products that use the same scans are calculated together, at the first p_param of their group (see self.get_column_groups).
+        # The other p_params of a group are therefore handled after it.
+        column_groups = self.get_column_groups(p_params_functions, p_params_projs) if self.use_column_engine else {}
+        column_arrays = {}
+        
         product_slices = {}
-        for p_param in p_params_functions:
+        for p_param in sorted(p_params_functions, key=lambda j: j in column_groups and column_groups[j][0] != j):
             product, param = self.get_product_and_param(p_param)
             self.product = product
             
@@ -357,7 +371,12 @@ class DerivedPlain():
                 if hasattr(self.mapping_classes[self.proj], parameter):
                     self.__dict__[parameter] = self.mapping_classes[self.proj].__dict__[parameter]
                 
-            self.plain_products_functions['independent'][self.product](param)
+            if p_param in column_groups:
+                if not p_param in column_arrays:
+                    column_arrays.update(self.calculate_column_products(column_groups[p_param]))
+                self.product_array = column_arrays.pop(p_param)
+            else:
+                self.plain_products_functions['independent'][self.product](param)
             self.product_arrays[p_param] = self.product_array # Gets defined in the plain product function
                                    
             volume_starttime, volume_endtime = self.volume_starttime, self.volume_endtime             
@@ -596,6 +615,68 @@ class DerivedPlain():
             empty[height_0] = 1
         
     
+    def get_column_groups(self, p_params, p_params_projs):
+        """Groups p_params for which the products are calculated from the same data, i.e. with the same projection and scans, and returns for
+        each p_param its group. Cartesian data is sorted by height for products in self.products_requiring_heightsorted_data, so these cannot be
+        grouped with other products. Polar data is not sorted, so there only the scans matter.
+        The first p_param in a group is one for which scans are selected by index when present (see self.get_indices_scans), since self.hdiffs
+        is only determined for these.
+        """
+        groups = {}
+        scans_indexed = {}
+        for p_param in p_params:
+            product, param = self.get_product_and_param(p_param)
+            if not product in ('e', 'a', 'l', 'm'):
+                continue
+            proj = p_params_projs[p_param]
+            s = self.get_indices_scans(product, self.scans_products[product])
+            scans_indexed[p_param] = not isinstance(s, slice)
+            if proj == 'pol' and not scans_indexed[p_param]:
+                s = list(range(sum([len(self.data_all[j]) for j in self.scans_all])))
+            groups[(proj, str(s))] = groups.get((proj, str(s)), [])+[p_param]
+        
+        column_groups = {}
+        for group in groups.values():
+            group.sort(key=lambda j: not scans_indexed[j])
+            for p_param in group:
+                column_groups[p_param] = group
+        return column_groups
+        
+    def calculate_column_products(self, p_params):
+        """Calculates the products for a group of p_params (see self.get_column_groups) in a single pass over the scans, and returns a
+        dictionary with the product array for each p_param. Results are equal to those of the functions for the individual products below.
+        As in self.calculate_VIL, arrays for 'h' products are directly added to self.product_arrays.
+        """
+        params = {}
+        for p_param in p_params:
+            product, param = self.get_product_and_param(p_param)
+            params[p_param] = tuple(eval(param)) if product == 'l' else float(param)
+        get_params = lambda product: [params[j] for j in p_params if j.startswith(product+'_')]
+        
+        p_params_h = [p_param for p_param in self.base_p_params if p_param.startswith('h_')]
+        # As in self.calculate_VIL, the 'h' products are obtained together with the last VIL product that is calculated
+        VIL_params_h = get_params('l')[-1] if p_params_h and get_params('l') else None
+        
+        echotops, PCAPPI, VIL, Zmax, VIL_h = cp.calculate_column_products(self.Zmax_3D, self.Zavg_3D, self.heights_3D, 
+            self.hdiffs if get_params('l') else None, get_params('e'), get_params('a'), get_params('l'), get_params('m'), VIL_params_h)
+        
+        for PCAPPI_height in PCAPPI:
+            PCAPPI[PCAPPI_height][np.abs(PCAPPI[PCAPPI_height]+35.)<0.1] = self.pb.mask_values['a']
+        for Zmax_minheight in Zmax:
+            Zmax[Zmax_minheight][Zmax[Zmax_minheight]==-30.] = self.pb.mask_values['m']
+        if VIL_params_h:
+            for p_param in p_params_h:
+                _, param_h = self.get_product_and_param(p_param)
+                VIL_threshold = eval(param_h)[1]
+                select_h = VIL[VIL_params_h] < VIL_threshold
+                self.product_arrays[p_param] = VIL_h.copy()
+                self.product_arrays[p_param][select_h] = self.pb.mask_values['h']
+        for VIL_params in VIL:
+            VIL[VIL_params][VIL[VIL_params] < 1e-5] = self.pb.mask_values['l']
+        
+        products = {'e':echotops, 'a':PCAPPI, 'l':VIL, 'm':Zmax}
+        return {p_param:products[self.get_product_and_param(p_param)[0]][params[p_param]] for p_param in p_params}
+    
     def calculate_echotops(self, param): 
         min_dBZ_value_echotops = float(param)
         self.product_array = np.full(self.product_shape, -1000., dtype='float32')
@@ -0,0 +1,164 @@
+# Copyright (C) 2016-2024 Bram van 't Veen, bramvtveen94@hotmail.com
+# Distributed under the GNU General Public License version 3, see <https://www.gnu.org/licenses/>.
+
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import h5py
+
+
+"""Cache of the mappings between radar bins and the bins of the polar and Cartesian grids of derived products, that are determined in
+Polar.get_parameters_data_mapping and Cartesian.get_parameters_data_mapping. These mappings only depend on the structure of the radar volume
+(ranges, number of radial and azimuthal bins and scanangles of the scans) and on the product grid, and are recalculated whenever this structure
+differs from that of the previous volume. That happens each time that the user switches radar, and also when a radar alternates between
+different volume coverage patterns.
+
+Mappings are kept in memory in an LRU cache with a structure hash as key (see get_key), of which the total size is limited to max_bytes.
+Within NLradar max_bytes is a fraction of the maximum amount of radar data in memory (see DataSource_General.set_memory_limits). Per volume
+structure a mapping takes about 28 bytes per radar bin for polar grids, and about 48 bytes per radar bin for Cartesian grids with a resolution
+of 0.5 km, i.e. about 150 and 260 MB for a volume with 15 scans of 360x1000 bins (see util/benchmark_mappingcache.py).
+Next to this, the index maps can be stored on disk, in one HDF5 file per radar and structure in the derived products directory. Only the
+index maps are stored (uncompressed, since compression takes more time than calculating them), the remaining attributes are derived from these
+when they are read from disk. The number of files per radar is limited to max_files_per_radar, and the least recently used files are removed
+when this limit is reached.
+"""
+
+# Should be updated when the calculation of the mappings in polar.py or cartesian.py changes, such that previously stored mappings are no
+# longer used
+file_content_version = 1
+max_files_per_radar = 10
+
+
+def to_builtin(params):
+    # Converts NumPy scalars into Python numbers, such that the representation of params doesn't depend on their types
+    if isinstance(params, (tuple, list)):
+        return tuple(to_builtin(i) for i in params)
+    return params.item() if isinstance(params, np.generic) else params
+
+def get_key(params):
+    """Returns a hash of params, which should be a (nested) tuple of numbers and strings that describes the structure of the radar volume and
+    the product grid.
+    """
+    return hashlib.blake2b(repr(to_builtin(params)).encode(), digest_size=16).hexdigest()
+
+def get_nbytes(value):
+    # Total size of the arrays in value, which can be a (nested) dictionary or list of arrays
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, dict):
+        return sum(get_nbytes(i) for i in value.values())
+    elif isinstance(value, (list, tuple)):
+        return sum(get_nbytes(i) for i in value)
+    return 0
+
+
+class BinMappingCache():
+    def __init__(self, max_bytes=500e6):
+        self.max_bytes = max_bytes
+        # In order of last use. Values are dictionaries with as keys the attribute names of the mapping class.
+        self._entries = OrderedDict()
+        self.hits = self.disk_hits = self.misses = self.evictions = self.disk_writes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        # Calculated on request, since entries can grow after being added (e.g. Cartesian.sorted_heights, which is filled per product)
+        return sum(get_nbytes(i) for i in self._entries.values())
+
+    def get_filename(self, derivedproducts_dir, radar_dataset, key):
+        return derivedproducts_dir+'/bin_mappings/'+radar_dataset+'/'+key+'.h5'
+
+    def get(self, key, filename=None):
+        """Returns the mapping for key, or None when it is present neither in memory nor in filename. When read from disk, the mapping contains
+        only the stored attributes, and it is not yet added to the memory cache (this should be done with self.put when the remaining attributes
+        have been calculated).
+        """
+        mapping = self._entries.get(key, None)
+        if not mapping is None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return mapping
+        if filename and os.path.exists(filename):
+            mapping = self.read(filename)
+            if not mapping is None:
+                self.disk_hits += 1
+                return mapping
+        self.misses += 1
+        return None
+
+    def put(self, key, mapping, filename=None, persisted_attributes=()):
+        """Adds mapping to the memory cache, and writes the attributes in persisted_attributes to filename when given."""
+        self._entries[key] = mapping
+        self._entries.move_to_end(key)
+        self.evict()
+        if filename and persisted_attributes:
+            self.write(filename, {j:mapping[j] for j in persisted_attributes})
+
+    def evict(self):
+        nbytes = {i:get_nbytes(j) for i,j in self._entries.items()}
+        total = sum(nbytes.values())
+        while total > self.max_bytes and len(self):
+            key, _ = self._entries.popitem(last=False)
+            total -= nbytes[key]
+            self.evictions += 1
+
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def clear(self):
+        self._entries.clear()
+
+    def read(self, filename):
+        """Attributes that are a dictionary with for each scan a list of arrays (one per duplicate scan) are stored in groups
+        attribute/scan/index, and other attributes as a single dataset.
+        """
+        try:
+            mapping = {}
+            with h5py.File(filename, 'r') as f:
+                if f.attrs['version'] != file_content_version:
+                    return None
+                for attr in f:
+                    if isinstance(f[attr], h5py.Group):
+                        # Groups are iterated in alphabetical order, while the scans should be in numerical order
+                        mapping[attr] = {int(j):[f[attr][j][str(i)][:] for i in range(len(f[attr][j]))] for j in sorted(f[attr], key=int)}
+                    else:
+                        mapping[attr] = f[attr][:]
+            # The modification time is used to determine which files have been used least recently
+            os.utime(filename)
+            return mapping
+        except Exception as e:
+            print(e, 'BinMappingCache.read')
+            return None
+
+    def write(self, filename, mapping):
+        try:
+            directory = os.path.dirname(filename)
+            os.makedirs(directory, exist_ok=True)
+            files = [directory+'/'+j for j in os.listdir(directory) if j.endswith('.h5') and directory+'/'+j != filename]
+            if len(files) >= max_files_per_radar:
+                files.sort(key=os.path.getmtime)
+                for file in files[:len(files)-max_files_per_radar+1]:
+                    os.remove(file)
+
+            with h5py.File(filename, 'w') as f:
+                f.attrs['version'] = file_content_version
+                for attr, value in mapping.items():
+                    if isinstance(value, dict):
+                        for j in value:
+                            for i, arr in enumerate(value[j]):
+                                f.create_dataset(f'{attr}/{j}/{i}', data=arr, track_times=False)
+                    else:
+                        f.create_dataset(attr, data=value, track_times=False)
+            self.disk_writes += 1
+        except Exception as e:
+            print(e, 'BinMappingCache.write')
+
+    def stats(self):
+        n_requests = self.hits+self.disk_hits+self.misses
+        return {'hits':self.hits, 'disk_hits':self.disk_hits, 'misses':self.misses,
+                'hit_rate':(self.hits+self.disk_hits)/n_requests if n_requests else 0., 'evictions':self.evictions,
+                'disk_writes':self.disk_writes, 'n_entries':len(self), 'nbytes':self.nbytes, 'max_bytes':self.max_bytes}
@@ -6,9 +6,15 @@ import time as pytime
 
 import nlr_functions as ft
 import nlr_globalvars as gv
+from derived import nlr_mappingcache as mc
 
 
 class Polar():
+    # Attributes that are determined in self.get_parameters_data_mapping, and that are kept in the bin mapping cache (see nlr_mappingcache.py).
+    # The mapping is not stored on disk, since it is calculated from 1D arrays of ranges and heights in about the time that it takes to read it.
+    mapping_attributes = ('productbins_unique_all_flat', 'radarbins_unique_all_flat', 'groundranges', 'heights_3D_all', 'product_heights')
+    persisted_attributes = ()
+    
     def __init__(self, dp_class, parent = None):
         self.dp = dp_class
         self.dsg = self.dp.dsg
@@ -117,19 +123,37 @@ class Polar():
                                  self.scannumbers_all_before == self.dsg.scannumbers_all[self.i_p])
         if perform_remapping:         
             #Is only done when the structure of the radar volume has changed, or when the function has not yet been called before for self.product,
-            #for the given radar volume structure.
-            self.assign_radarbins_to_productbins()
-            self.assign_productbins_to_radarbins()
-            self.get_heights_3D()
-            
-            # Make sure that product heights are recalculated for every product, by emptying self.product_heights
-            self.product_heights = {}
+            #for the given radar volume structure. In that case the mapping is taken from the cache when it has been calculated before for
+            #this structure.
+            key = self.get_mapping_key()
+            mapping = self.dp.mapping_cache.get(key)
+            if mapping is None:
+                # New dictionaries, since the ones that are currently assigned might be present in the cache
+                self.productbins_unique_all_flat, self.radarbins_unique_all_flat = {}, {}
+                self.assign_radarbins_to_productbins()
+                self.assign_productbins_to_radarbins()
+                self.get_heights_3D()
+                
+                # Make sure that product heights are recalculated for every product, by emptying self.product_heights
+                self.product_heights = {}
+                self.dp.mapping_cache.put(key, {j:self.__dict__[j] for j in self.mapping_attributes})
+            else:
+                for j in self.mapping_attributes:
+                    self.__dict__[j] = mapping[j]
             
             self.radial_bins_all_before = self.radial_bins_all.copy()
             self.azimuthal_bins_all_before = azimuthal_bins_all.copy()
             self.maxheights_all_before = maxheights_all.copy()
             self.scannumbers_all_before = self.dsg.scannumbers_all[self.i_p].copy()
             
+    def get_mapping_key(self):
+        # Hash of everything that determines the mapping. Floats are rounded, such that negligible changes in e.g. scanangles don't lead to
+        # a new mapping
+        scans_params = tuple((j, self.radial_bins_all[j], round(self.radial_res_all[j], 4), round(self.radius_offsets_all[j], 4), 
+                              round(self.scanangles_all[j], 3), round(self.radial_range_all[j], 3), tuple(arr.shape[0] for arr in self.data_all[j]))
+                             for j in self.scans_all)
+        return mc.get_key(('pol', round(self.product_radial_res, 4), self.product_radial_bins_all, self.product_azimuthal_bins, scans_params))
+            
 
 
     def get_data_specs(self):
@@ -146,15 +170,11 @@ class Polar():
         in self.data_all[scan] can be mapped onto a particular bin in self.product_data, and this function determines the maximum reflectivity of
         the bins in self.data_all[scan] that get mapped onto that particular bin in self.product_data. 
         
-        For each scan, the function updates all bins in self.Zmax_3D_all[scan] for which the new reflectivities are higher than the old ones. Because 
-        multiple bins in the reflectivity data can be mapped onto the same bin in self.Zmax_3D_all[scan], this process must be repeated for all bins
-        in the reflectivity data. This is done by masking the bins in the reflectivity data that have already been handled, and then repeating the 
-        process for the non-masked part of the remaining array. The while loop that handles this stops when there are no remaining non-masked bins.
+        The maximum is obtained for all bins in self.Zmax_3D_all[scan] at once with np.maximum.at, using the mapping in self.productbins_unique_all_flat.
         Finally, the flat array self.Zmax_3D_all[scan] is reshaped such that it has the correct dimensions.
         
-        For self.Zavg_3D_all[scan] the calculation is done in a way comparable to that of Zmax, but with as difference that the algorithm now sums all reflectivities 
-        that are mapped onto a particular bin in self.Zavg_3D_all[scan], and finally divides them by the number of reflectivities that is mapped onto 
-        the particular bin, to arrive at the average reflectivity.
+        For self.Zavg_3D_all[scan] all reflectivities that are mapped onto a particular bin in self.Zavg_3D_all[scan] are summed with np.bincount, 
+        and divided by the number of reflectivities that is mapped onto the particular bin, to arrive at the average reflectivity.
         The average reflectivity is here given by Zavg = 10*log10(Zavg_linear), i.e., the average linear reflectivity is calculcated, and from this the 
         logarithm is taken.
         """
@@ -167,7 +187,6 @@ class Polar():
         n = sum([len(self.data_all[j]) for j in self.scans_all])
         self.Zmax_3D_all = np.full((n, length), Z_empty, dtype='float32')
         self.Zavg_3D_all = np.full((n, length), Z_empty, dtype='float32')
-        indices_occurrences = np.ones(length, dtype=self.get_int_dtype())
                                                             
         for j in self.scans_all:
             for i in range(len(self.data_all[j])):
@@ -186,48 +205,11 @@ class Polar():
                     data_array[np.isnan(data_array)] = Z_empty
                     self.Zmax_3D_all[index] = self.Zavg_3D_all[index] = data_array.reshape(length)
                 else:
-                    retain = ~np.isnan(flattened)
-                    flattened = flattened[retain]
-                    indices = self.productbins_unique_all_flat[j][i][retain]
-                    #The linear reflectivity is only calculated for a bin in self.Zavg_3D_all[j] if more than one bin in self.data_all[j][i] is mapped onto that bin
-                    #in self.Zavg_3D_all[j], because calculating the logartihm to arrive back at the logarithmic reflectivity is an expensive operation.
-                    
-                    """indices_occurrences gives the number of occurrences for each index in indices. When the while loop is finished and each bin in 
-                    self.Zavg_3D_all[j] contains the sum of all reflectivities that are mapped onto that bin, then self.Zavg_3D_all[j] is divided by
-                    indices_occurrences, to get the average reflectivity.
-                    """
-                    indices_occurrences[:] = 1
-                    indices_bincount = np.bincount(indices)
-                    indices_occurrences[:len(indices_bincount)] = indices_bincount
-                    
-                    sort_indices = np.argsort(indices)
-                    indices = indices[sort_indices]
-                    flattened = flattened[sort_indices]
-                    
-                    indices_unique_orig, flattened_indices_orig, counts = np.unique(indices, return_index=True, return_counts=True)
-                    count_max = counts.max()
-    
-                    k = 0
-                    while k < count_max:
-                        if k == 0:
-                            self.Zavg_3D_all[index, indices_unique_orig] = self.Zmax_3D_all[index, indices_unique_orig] =\
-                                flattened[flattened_indices_orig]
-                        else:   
-                            select = counts > k
-                            indices_unique = indices_unique_orig[select]
-                            flattened_indices = flattened_indices_orig[select] + k                                
-
-                            if k == 1:
-                                # Perform this operation only once, because it is quite expensive
-                                self.Zavg_3D_all[index, indices_unique] = np.power(10., 0.1*self.Zavg_3D_all[index, indices_unique])
-                                
-                            self.Zavg_3D_all[index, indices_unique] += np.power(10., 0.1*flattened[flattened_indices])
-                            update = self.Zmax_3D_all[index, indices_unique]<flattened[flattened_indices]
-                            self.Zmax_3D_all[index, indices_unique[update]] = flattened[flattened_indices[update]]
-                        k += 1
-                        
-                    Zavg_islinear = indices_occurrences > 1
-                    self.Zavg_3D_all[index, Zavg_islinear] = 10.*np.log10(self.Zavg_3D_all[index, Zavg_islinear]/indices_occurrences[Zavg_islinear])
+                    # Maximum and average of all reflectivities that get mapped onto a particular bin, see ft.get_grid_max_and_mean_dBZ
+                    Zmax, Zavg, _ = ft.get_grid_max_and_mean_dBZ(flattened, self.productbins_unique_all_flat[j][i], length)
+                    empty = np.isnan(Zmax)
+                    Zmax[empty] = Zavg[empty] = Z_empty
+                    self.Zmax_3D_all[index], self.Zavg_3D_all[index] = Zmax, Zavg
                     
                 if n_azi != self.product_azimuthal_bins:
                     # Repeat the mapping results as described at the start of the loop-iteration.
@@ -33,7 +33,9 @@ from nlr_changedata import Change_RadarData
 from nlr_currentdata import AutomaticDownload, DownloadOlderData, CurrentData
 from VWP.nlr_vwp import GUI_VWP
 import nlr_background as bg
+import nlr_directoryindex as di
 import nlr_functions as ft
+import nlr_importdata as ird
 import nlr_globalvars as gv
 
 
@@ -2877,23 +2879,11 @@ class GUI(QWidget):
         else:
             selected_radars = [self.crd.selected_radar]
 
-        for i in selected_radars:
-            for j in ('Z', 'V'):
-                key = i+('_'+j)*(i in gv.radars_with_datasets)
-                for sub in self.dsg.attributes_IDs[key].copy():
-                    for date in self.dsg.attributes_IDs[key][sub].copy():
-                        if int(startdate) <= int(date) <= int(enddate):
-                            for time in self.dsg.attributes_IDs[key][sub][date].copy():
-                                if int(startdatetime) <= int(date+time) <= int(enddatetime):
-                                    del self.dsg.attributes_IDs[key][sub][date][time]
-                        if len(self.dsg.attributes_IDs[key][sub][date]) == 0:
-                            del self.dsg.attributes_IDs[key][sub][date]
-        
-        #Also update the file that contains attributes_IDs
-        with open(self.dsg.attributes_IDs_filename,'wb') as f:
-            pickle.dump(self.dsg.attributes_IDs,f)
+        radar_datasets = [i+('_'+j)*(i in gv.radars_with_datasets) for i in selected_radars for j in ('Z', 'V')]
+        self.dsg.volume_attributes.remove(set(radar_datasets), startdatetime, enddatetime)
         
         self.time_last_removal_volumeattributes = pytime.time()
+        self.dsg.stored_data.invalidate()
         self.update_removeattributes_infow('Done','green')
                                 
     def update_removeattributes_infow(self,text,color):
@@ -3041,6 +3031,8 @@ class GUI(QWidget):
             #Always remove files from the Archived folder when undoing the movement of files.
             removefiles_initialfolder=True
             
+        # Files that are kept open for reading can't be moved or removed on Windows
+        ird.hdf5_files.close_all()
         old_directories=[]; new_directories=[]
         for i in selected_radars:
             if self.stop_movingfiles: return
@@ -3948,6 +3940,7 @@ class GUI(QWidget):
             hbox.addStretch(1)
         
         self.max_radardata_in_memory_GBsw=QLineEdit(); self.max_radardata_in_memory_GBsw.setText(str(ft.rifdot0(self.max_radardata_in_memory_GBs)))
+        self.update_max_radardata_in_memory_GBs_tooltip()
         hbox_max_radardata_in_memory_GBs.addWidget(self.max_radardata_in_memory_GBsw)
         self.sleeptime_after_plottingw=QLineEdit(); self.sleeptime_after_plottingw.setText(str(ft.rifdot0(self.sleeptime_after_plotting)))
         hbox_sleeptime_after_plotting.addWidget(self.sleeptime_after_plottingw)
@@ -3974,7 +3967,14 @@ class GUI(QWidget):
         number=ft.to_number(input_max_radardata_in_memory_GBs)
         if not number is None and number>=0:
             self.max_radardata_in_memory_GBs=float(number)
+            self.dsg.set_memory_limits()
+            self.update_max_radardata_in_memory_GBs_tooltip()
         else: self.max_radardata_in_memory_GBsw.setText(str(ft.rifdot0(self.max_radardata_in_memory_GBs)))
+    def update_max_radardata_in_memory_GBs_tooltip(self):
+        # Usage statistics, that can help with choosing the maximum size
+        stats = self.dsg.stored_data.stats()
+        self.max_radardata_in_memory_GBsw.setToolTip(f"In use: {stats['nbytes']/1e6:.0f} of {stats['max_bytes']/1e6:.0f} MB, {stats['n_entries']} entries "
+            f"({stats['n_entries_compressed']} compressed), hit rate {100*stats['hit_rate']:.0f}%, {stats['evictions']} evictions")
     def change_sleeptime_after_plotting(self):
         input_sleeptime_after_plotting=self.sleeptime_after_plottingw.text()
         number=ft.to_number(input_sleeptime_after_plotting)
@@ -4266,13 +4266,9 @@ class GUI(QWidget):
             pickle.dump(settings,f)
             
             
-        #Dump info over the volume attributes into pickle files, which will be loaded during the next startup of the program in nlr_datasourcegeneral.py
-        with open(self.dsg.attributes_descriptions_filename,'wb') as f:
-            pickle.dump(self.dsg.attributes_descriptions,f)
-        with open(self.dsg.attributes_IDs_filename,'wb') as f:
-            pickle.dump(self.dsg.attributes_IDs,f)
-        with open(self.dsg.attributes_variable_filename,'wb') as f:
-            pickle.dump(self.dsg.attributes_variable,f)
+        #Volume attributes and directory listings are stored in databases directly after determining them, so only the connections need to be closed
+        self.dsg.volume_attributes.close()
+        di.directory_index.close()
              
 
 
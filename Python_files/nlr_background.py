@@ -5,6 +5,7 @@ import numpy as np
 import os
 opa=os.path.abspath
 import re
+import bisect
 import time as pytime
 try:
     from pyshp import shapefile
@@ -14,6 +15,7 @@ from PIL import ImageFont
 import warnings
 warnings.simplefilter("ignore", ResourceWarning) #Prevent ResourceWarnings for unclosed files and sockets from showing up
 
+import nlr_directoryindex as di
 import nlr_functions as ft
 import nlr_globalvars as gv
 
@@ -595,7 +597,7 @@ def get_direntries(abs_path,compare_substring):
         # Earlier os.path.isdir was called to make sure that all dir entries are actually directories. But calling os.path.isdir appeared to
         # be quite slow on the first call, so it's now left out and hoped/assumed that the call of check_correspondence_real_dir_to_dir_string
         # filters out any non-directory entries.
-        direntries = [j for j in os.listdir(abs_path) if check_correspondence_real_dir_to_dir_string(j, compare_substring)]
+        direntries = [j for j in di.listdir(abs_path) if check_correspondence_real_dir_to_dir_string(j, compare_substring)]
     return np.sort(direntries)
     
 def replace_basedir_and_radar_variables(dir_string, basedir, radar):
@@ -903,10 +905,12 @@ def get_nearest_directory(dir_string,basedir,radar,date,time,function_get_filena
         desired_dir_substring1=substrings2[substrings_indices[0]]
         direntries1=get_direntries(opa(abs_paths[0]), substring1)
         #Check existence path_end1, to prevent that subdirectories are chosen that certainly do not contain data for the radar.
-        direntries1 = [j for j in direntries1 if os.path.exists(opa(abs_paths[0]+'/'+j+path_end1))]
-        direntries1_plus_desired_dir=np.sort(direntries1+[desired_dir_substring1])
+        #When path_end1 is empty the directory entries exist already, which saves a call of os.path.exists per entry.
+        direntries1 = [j for j in direntries1 if not path_end1 or os.path.exists(opa(abs_paths[0]+'/'+j+path_end1))]
+        #direntries1 is sorted, so the position of the desired directory can be found with a binary search
+        index=bisect.bisect_left(direntries1,desired_dir_substring1)
+        direntries1_plus_desired_dir=np.array(direntries1[:index]+[desired_dir_substring1]+direntries1[index:])
         n_direntries=len(direntries1_plus_desired_dir)
-        index=np.where(direntries1_plus_desired_dir==desired_dir_substring1)[0][0]
             
         if len(abs_paths)==1:
             if index==0:
@@ -940,10 +944,10 @@ def get_nearest_directory(dir_string,basedir,radar,date,time,function_get_filena
                         desired_dir_substring2=substrings2[substrings_indices[-1]]
                         direntries2=get_direntries(opa(abs_paths[-1]), substring2)
                         #Check existence path_end2, to prevent that subdirectories are chosen that certainly do not contain data for the radar.
-                        direntries2 = [j for j in direntries2 if os.path.exists(opa(abs_paths[-1]+'/'+j+path_end2))]
-                        direntries2_plus_desired_dir=np.sort(direntries2+[desired_dir_substring2])
+                        direntries2 = [j for j in direntries2 if not path_end2 or os.path.exists(opa(abs_paths[-1]+'/'+j+path_end2))]
+                        index=bisect.bisect_left(direntries2,desired_dir_substring2)
+                        direntries2_plus_desired_dir=np.array(direntries2[:index]+[desired_dir_substring2]+direntries2[index:])
                         n_direntries=len(direntries2_plus_desired_dir)
-                        index=np.where(direntries2_plus_desired_dir==desired_dir_substring2)[0][0]
                         
                         if index==0:
                             nearest_dir=abs_paths[-1]+'/'+direntries2_plus_desired_dir[1]+path_end2
@@ -255,6 +255,8 @@ class Change_RadarData(QObject):
             self.plot_current()
         else:
             self.process_datetimeinput(set_data=set_data)
+        # Cancels prefetching for the previous radar
+        self.dsg.prefetcher.update()
             
         self.end_time=pytime.time()
         self.change_radar_running = False
@@ -581,9 +583,11 @@ class Change_RadarData(QObject):
             raise Exception
         
         if time != 'c':
-            timediffs = self.filedatetimes[1]-ft.get_absolutetimes_from_datetimes(date+time)
-            index = np.argmin(np.abs(timediffs))
-            mintimediff = timediffs[index]
+            # self.filedatetimes is sorted, so the closest datetime can be found with a binary search
+            abstime = ft.get_absolutetimes_from_datetimes(date+time)
+            index = ft.closest_index_sorted(self.filedatetimes[1], abstime)
+            mintimediff = self.filedatetimes[1][index]-abstime
+            n_datetimes = len(self.filedatetimes[1])
             if self.ani.continue_type == 'ani' and lr_step == 0:
                 # When determining start and end datetime at the start of an animation iteration, it is not allowed that the end datetime is (much)
                 # later than the inputted value. Similarly, it is not allowed that the start datetime is (much) earlier than the inputted value.
@@ -592,12 +596,12 @@ class Change_RadarData(QObject):
                 # case mintimediff will be 0 since it's already been checked that this datetime is present). 
                 sign = 1 if date+time == self.ani.animation_enddate+self.ani.animation_endtime else -1
                 if sign*mintimediff > 1800:
-                    if sign == 1 and index > 0 or sign == -1 and index < len(timediffs)-1:
+                    if sign == 1 and index > 0 or sign == -1 and index < n_datetimes-1:
                         index -= sign
                     else: 
                         lr_step = -sign                        
             
-            update_directory = lr_step < 0 and index == 0 and mintimediff > 0 or lr_step > 0 and index == len(timediffs)-1 and mintimediff < 0
+            update_directory = lr_step < 0 and index == 0 and mintimediff > 0 or lr_step > 0 and index == n_datetimes-1 and mintimediff < 0
             # If this is the case, then the first or last file in self.filedatetimes is reached.
             if update_directory:
                 desired_newdate, desired_newtime = date, time
@@ -611,9 +615,8 @@ class Change_RadarData(QObject):
                 self.determine_list_filedatetimes()
 
                 #If not files_available, then the 'old' list with datetimes is still used.
-                timediffs = np.abs(self.filedatetimes[1]-ft.get_absolutetimes_from_datetimes(date+time))
                 #Determine the index of the datetime that is closest to date and time.
-                index = np.argmin(timediffs)
+                index = ft.closest_index_sorted(self.filedatetimes[1], abstime)
                 
             # Check whether the timestep is at least nonzero. If not, then if possible go one volume backward/forward.
             datetime, current_datetime = int(self.filedatetimes[0][index]), int(self.date+self.time)
@@ -1072,6 +1075,8 @@ class Change_RadarData(QObject):
             
             if panellist_change:
                 self.pb.set_newdata(panellist_change, delta_time, self.process_keyboardinput, apply_storm_centering=True)
+            # Start decoding the next volumes in the direction of travel, and cancel stale prefetching after a change of product/scan
+            self.dsg.prefetcher.update(int(np.sign(leftright_step)))
                 
 
             if new_scan!=0 or abs(downup_step)==1.1: self.time_last_individualscanchange=pytime.time()
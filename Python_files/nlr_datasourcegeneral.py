@@ -1,20 +1,31 @@
 # Copyright (C) 2016-2024 Bram van 't Veen, bramvtveen94@hotmail.com
 # Distributed under the GNU General Public License version 3, see <https://www.gnu.org/licenses/>.
 
-import sys
 import os
 opa = os.path.abspath
 import numpy as np
 import time as pytime
-import pickle
 import copy
 import traceback
+import zlib
+from collections import OrderedDict
+try:
+    # Faster than zlib, but optional
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
 
 from derived.nlr_derived_plain import DerivedPlain
 from derived import nlr_derived_tilts as dt
+from nlr_prefetch import Prefetcher
 import nlr_datasourcespecific as dss
 import nlr_importdata as ird
+from nlr_volumeattributes import VolumeAttributesStore
+from nlr_dealiasingcache import DealiasedVelocityCache
+from decoders import nexrad_l2
+from dealiasing import nlr_dealiasing
 import nlr_background as bg
+import nlr_directoryindex as di
 import nlr_functions as ft
 import nlr_globalvars as gv
 
@@ -27,11 +38,166 @@ def init_VDA():
     vda(np.zeros((360, 100)), 30, np.arange(0, 360, 1), 1)
     VDA = vda
     print('Unet VDA imported')
+def get_VDA_model_id():
+    from dealiasing.unet_vda.unet_vda import get_model_id
+    return get_model_id()
 import threading
 threading.Thread(target=init_VDA).start()
 
 
 
+# Fractions of the maximum amount of radar data in memory that are used for the cache of decompressed NEXRAD level II blocks
+# (nexrad_l2.bzip2_block_cache) and for the cache of bin mappings for derived products (DerivedPlain.mapping_cache), see
+# DataSource_General.set_memory_limits
+bzip2_block_cache_fraction = 0.25
+mapping_cache_fraction = 0.25
+
+class StoredDataCache():
+    """LRU cache for the data arrays (plus accompanying attributes) that are kept in memory by DataSource_General.store_data_in_memory, with
+    dataspecs strings as keys. 
+    Besides keys for data dictionaries, there can be alias keys that map onto the key of another entry. Each entry keeps track of its aliases,
+    such that they are removed together with the entry. The total size of the data arrays is updated when entries are added or removed, and when
+    it exceeds max_bytes the least recently used entries are evicted.
+    
+    The cache has 2 tiers. When the uncompressed entries take more than hot_fraction of max_bytes, the least recently used ones are moved to
+    a tier with compressed data arrays (see _CompressedArray). Panel data arrays largely consist of the mask value, so in this way many more
+    entries fit within max_bytes. Entries in the compressed tier are decompressed when requested with self.get. Entries are evicted from
+    the compressed tier first.
+    """
+    # Set to False to disable the compressed tier
+    use_compressed_tier = True
+    hot_fraction = 0.25
+    
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        # Both in order of last use
+        self._entries = OrderedDict()
+        self._compressed_entries = OrderedDict()
+        self._products = {}
+        self._aliases = {} # alias -> key
+        self._alias_keys = {} # key -> set of aliases
+        self.nbytes_uncompressed = self.nbytes_compressed = 0
+        self.hits = self.misses = self.evictions = self.n_compressed = self.n_decompressed = 0
+        
+    @property
+    def nbytes(self):
+        return self.nbytes_uncompressed+self.nbytes_compressed
+        
+    def __contains__(self, key):
+        return key in self._entries or key in self._compressed_entries or key in self._aliases
+    
+    def __len__(self):
+        return len(self._entries)+len(self._compressed_entries)
+        
+    def get(self, key):
+        """Returns the data dictionary for key (which can be an alias), or None when absent. The entry becomes the most recently used one."""
+        key = self._aliases.get(key, key)
+        if key in self._compressed_entries:
+            data_dict = self._compressed_entries.pop(key)
+            self.nbytes_compressed -= data_dict['data'].nbytes
+            if isinstance(data_dict['data'], _CompressedArray):
+                data_dict['data'] = data_dict['data'].decompress()
+                self.n_decompressed += 1
+            self._entries[key] = data_dict
+            self.nbytes_uncompressed += data_dict['data'].nbytes
+            self.evict()
+        data_dict = self._entries.get(key, None)
+        if data_dict is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return data_dict
+    
+    def put(self, key, data_dict, product):
+        if key in self._aliases:
+            self._remove_alias(key)
+        # Aliases of key remain valid
+        self._pop(key)
+        self._entries[key] = data_dict
+        self._products[key] = product
+        self.nbytes_uncompressed += data_dict['data'].nbytes
+        self.evict()
+        
+    def put_alias(self, alias, key):
+        if not (key in self._entries or key in self._compressed_entries):
+            return
+        if alias in self._entries or alias in self._compressed_entries:
+            self.remove(alias)
+        elif alias in self._aliases:
+            self._remove_alias(alias)
+        self._aliases[alias] = key
+        self._alias_keys.setdefault(key, set()).add(alias)
+        
+    def _remove_alias(self, alias):
+        self._alias_keys[self._aliases.pop(alias)].discard(alias)
+        
+    def _pop(self, key):
+        data_dict = self._entries.pop(key, None)
+        if not data_dict is None:
+            self.nbytes_uncompressed -= data_dict['data'].nbytes
+        else:
+            data_dict = self._compressed_entries.pop(key, None)
+            if not data_dict is None:
+                self.nbytes_compressed -= data_dict['data'].nbytes
+        return data_dict
+        
+    def remove(self, key):
+        # Removes the entry for key together with its aliases
+        if not self._pop(key) is None:
+            del self._products[key]
+        for alias in self._alias_keys.pop(key, ()):
+            del self._aliases[alias]
+            
+    def invalidate(self, product=None):
+        """Removes all entries for product, or all entries when product is None. Should be called when stored data has become outdated."""
+        for key in [i for i,j in self._products.items() if product is None or j == product]:
+            self.remove(key)
+        
+    def evict(self):
+        if self.use_compressed_tier:
+            # The most recently used entry always remains uncompressed
+            while self.nbytes_uncompressed > self.hot_fraction*self.max_bytes and len(self._entries) > 1:
+                key, data_dict = self._entries.popitem(last=False)
+                self.nbytes_uncompressed -= data_dict['data'].nbytes
+                if data_dict['data'].nbytes >= _CompressedArray.min_nbytes:
+                    data_dict['data'] = _CompressedArray(data_dict['data'])
+                    self.n_compressed += 1
+                self._compressed_entries[key] = data_dict
+                self.nbytes_compressed += data_dict['data'].nbytes
+        while self.nbytes > self.max_bytes and len(self):
+            self.remove(next(iter(self._compressed_entries or self._entries)))
+            self.evictions += 1
+            
+    def resize(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.evict()
+            
+    def stats(self):
+        n_requests = self.hits+self.misses
+        return {'hits':self.hits, 'misses':self.misses, 'hit_rate':self.hits/n_requests if n_requests else 0., 'evictions':self.evictions, 
+                'n_entries':len(self), 'n_entries_compressed':len(self._compressed_entries), 'n_aliases':len(self._aliases), 
+                'n_compressed':self.n_compressed, 'n_decompressed':self.n_decompressed, 'nbytes':self.nbytes, 
+                'nbytes_compressed':self.nbytes_compressed, 'max_bytes':self.max_bytes}
+    
+class _CompressedArray():
+    """Compressed data array in the compressed tier of StoredDataCache. Uses LZ4 when available, and zlib otherwise."""
+    # Smaller arrays (like the empty arrays that are stored when no data could be imported) are not compressed
+    min_nbytes = 4096
+    
+    def __init__(self, array):
+        self.dtype, self.shape = array.dtype, array.shape
+        buf = np.ascontiguousarray(array).data
+        self.buf = lz4_frame.compress(buf) if lz4_frame else zlib.compress(buf, 1)
+        self.nbytes = len(self.buf)
+        
+    def decompress(self):
+        buf = lz4_frame.decompress(self.buf) if lz4_frame else zlib.decompress(self.buf)
+        # bytearray makes the array writeable, like the original array
+        return np.frombuffer(bytearray(buf), self.dtype).reshape(self.shape)
+    
+    
+    
 """DataSource_General contains functions that are related to the import of data, and contains functions that can in general be used for
 different data sources (by forwarding calls to functions in the classes in nlr_datasourcespecific.py).
 """
@@ -105,13 +271,18 @@ class DataSource_General():
         self.data_azimuth_offset = {j:0. for j in range(10)}
         # Similarly as for the azimuth, with radius offsets between -1 and +1 km supported
         self.data_radius_offset = {j:0. for j in range(10)}
-        self.stored_data = {}
+        self.stored_data = StoredDataCache()
+        self.set_memory_limits()
+        # Dealiased velocity fields are also stored on disk, since dealiasing can take a significant amount of time
+        self.dealiasing_cache = DealiasedVelocityCache()
         # For data sources listed here, any change in product/scan availability/content should be reflected in a corresponding change in scannumbers_all.
         # For these sources scannumbers_all is used to determine whether a product/scan in memory needs to be updated, in contrast to self.total_files_size.
         # Has as advantage that product/scan is updated only when actually needed (and not when some other part of the radar volume is updated/expanded). 
         # Disadvantage is that it can be cumbersome to get product/scan availability/content reflected in scannumbers_all, especially when there's a
         # difference in availability for filtered/unfiltered products.
         self.stored_data_sources_with_scannumbers_as_content_marker = ('DWD', 'NWS')
+        # Decodes upcoming volumes in the background, see nlr_prefetch.py
+        self.prefetcher = Prefetcher(dsg_class = self)
         
         self.range_nyquistvelocity_scanpairs_indices = {j:0 for j in range(10)}
         self.scans_radars = {} #Gets updated in self.pb.set_newdata!
@@ -126,13 +297,6 @@ class DataSource_General():
         self.time_last_choosenearestheight = 0
         self.time_last_choosenearestscanangle = 0
         
-        # These objects store results of listing filenames and determines corresponding datetimes, in order to reduce the need
-        # to re-determine them.
-        self.directories_lastupdate_times = {}
-        self.filenames_directory = {}
-        self.nfiles_directory = {}
-        self.datetimes_directory = {}
-
         self.files_datetimesdict = {}
         self.files_datetime = None # Files for the current datetime
         # It could be the case that multiple versions of a product are available for a single radar volume (and that these can't be considered
@@ -151,39 +315,26 @@ class DataSource_General():
                     
         self.scanangles = {}
         
-        self.attributes_descriptions_filename = os.path.join(opa(gv.programdir+'/Generated_files'),'attributes_descriptions.pkl')
-        self.attributes_IDs_filename = os.path.join(opa(gv.programdir+'/Generated_files'),'attributes_IDs.pkl')
-        self.attributes_variable_filename = os.path.join(opa(gv.programdir+'/Generated_files'),'attributes_variable.pkl')
+        # Volume attributes were stored in pickle files by previous versions, which are migrated to the database once
+        generated_files_dir = opa(gv.programdir+'/Generated_files')
+        self.volume_attributes = VolumeAttributesStore(os.path.join(generated_files_dir, 'volume_attributes.sqlite'))
+        # Directory listings and file stats are stored next to the volume attributes, such that they can be used in a next session
+        di.directory_index.open_db(os.path.join(generated_files_dir, 'directory_index.sqlite'))
         try:
-            if self.gui.reset_volume_attributes: raise Exception
-
-            with open(self.attributes_descriptions_filename,'rb') as f:
-                self.attributes_descriptions = pickle.load(f)
-
-            with open(self.attributes_IDs_filename,'rb') as f:
-                self.attributes_IDs = pickle.load(f)
+            if self.gui.reset_volume_attributes:
+                self.volume_attributes.clear()
+            else:
+                self.volume_attributes.migrate_from_pickles(*[os.path.join(generated_files_dir, 'attributes_'+j+'.pkl') for j in
+                                                              ('descriptions', 'IDs', 'variable')])
             
-            with open(self.attributes_variable_filename,'rb') as f:
-                self.attributes_variable = pickle.load(f)
-        except Exception:
-            self.attributes_descriptions, self.attributes_IDs, self.attributes_variable = {}, {}, {}
+            outdated_sources = self.volume_attributes.check_version(self.attributes_version, self.attributes_version_sources)
+            if outdated_sources:
+                radars = [j for j in gv.radars_all if gv.data_sources[j] in outdated_sources]
+                self.volume_attributes.clear([j+i for j in radars for i in ('_V','_Z','')])
+        except Exception as e:
+            print(e, 'DataSource_General.__init__')
             
         self.gui.reset_volume_attributes = False
-            
-        if not 'version' in self.attributes_descriptions or self.attributes_descriptions['version'] != self.attributes_version:
-            self.attributes_descriptions = {'version':self.attributes_version}
-            self.attributes_IDs, self.attributes_variable = {}, {}
-        ft.init_dict_entries_if_absent(self.attributes_descriptions, 'version_sources', dict)
-            
-        for j in gv.radars_all:
-            key_extensions = ('_V','_Z') if j in gv.radars_with_datasets else ('',)
-            source = gv.data_sources[j]
-            reset_attrs_radar = self.attributes_descriptions['version_sources'].get(source, 0) != self.attributes_version_sources.get(source, 0)
-            for i in key_extensions:
-                if reset_attrs_radar or j+i not in self.attributes_descriptions: self.attributes_descriptions[j+i] = {}
-                if reset_attrs_radar or j+i not in self.attributes_IDs: self.attributes_IDs[j+i] = {}
-                if reset_attrs_radar or j+i not in self.attributes_variable: self.attributes_variable[j+i] = {}
-        self.attributes_descriptions['version_sources'] = self.attributes_version_sources
                 
         
     def get_scans_information(self, set_data, delta_time=0):
@@ -208,30 +359,28 @@ class DataSource_General():
         that are available.
         self.scannumbers_all etc. therefore have the form {'z':{1:...,2:...}} etc.
         
-        To prevent that attributes are obtained more than once for a particular file, information about it is stored in a file. Each particular series
-        of attributes gets assigned a unique ID, and this ID in stored in self.attributes_IDs[radar_dataset][dir_string]. 
+        To prevent that attributes are obtained more than once for a particular file, information about it is stored in a database (see 
+        nlr_volumeattributes.py). Each particular series of attributes gets assigned a unique ID, and this ID in stored per radar_dataset, dir_string
+        and datetime. 
         Here, dir_string is the directory string that is present in self.gui.radardata_dirs, for the
         index given in self.gui.radardata_dirs_indices. dir_string is used as key in addition to radar_dataset, because multiple directories can be
         selected for one radar_dataset, and if these directories contain different files for the same date and time, this would lead to problems.
         A disadvantage of the use of dir_string is that the attributes must be determined again when the data is moved to another directory.
         
-        self.attributes_descriptions[radar_dataset] contains the series of attributes that corresponds to a particular ID. 
+        The attribute descriptions for a radar_dataset contain the series of attributes that corresponds to a particular ID. 
         When calling this function, it is first checked whether an attribute ID is available for a particular radar, date and time, and if so, the 
-        corresponding attributes are obtained from self.attributes_descriptions[radar_dataset].
-        If no attribute ID is available, then the attributes will be obtained, and the ID corresponding to it is stored in 
-        self.attributes_IDs[radar_dataset][dir_string].
+        corresponding attributes are obtained from the attribute descriptions.
+        If no attribute ID is available, then the attributes will be obtained, and the ID corresponding to it is stored.
         For radars for which the data for one volume is stored in multiple files, it is however possible that the attributes get stored at a moment
         at which not all files were available yet, such that the saved attributes should be updated when more files come available. In order to
-        handle this, the number of files that was present when saving the attributes is also stored, which is done in
-        self.attributes_IDs[radar_dataset][dir_string]. The values stored in this dictionary are therefore lists of the form 
-        [attributes_ID,saved_total_files_size].
+        handle this, the number of files that was present when saving the attributes is also stored, which is done together
+        with the attributes ID, in the form [attributes_ID,saved_total_files_size,saved_data_selected_startazimuth].
         
-        Sometimes attributes can be expected to vary from volume to volume, in which case it's not wise to add them to self.attributes_descriptions,
+        Sometimes attributes can be expected to vary from volume to volume, in which case it's not wise to add them to the attribute descriptions,
         since that would mean that also the other less variable attributes are stored again and again. In this case they are stored separately
-        in self.attributes_variable, and the corresponding entries in self.attributes_descriptions are replaced by the string 'variable'.
+        as variable attributes, and the corresponding entries in the attribute descriptions are replaced by the string 'variable'.
         
-        self.attributes_descriptions, self.attributes_IDs and self.attributes_variable are dumped into a pickle file when exiting the program,
-        which occurs in the function closeEvent in nlr.py.
+        All these are stored in self.volume_attributes directly after determining them, and are only looked up for the volume that is requested.
         """
 
         # (deep) copy of attributes is not needed, since any change of the current volume attributes will come either with a deep copy
@@ -256,7 +405,7 @@ class DataSource_General():
                         self.__dict__[attr][j] = {}
                     
                 self.scans_doublevolume = [] #scans_doublevolume is used for the new radars of the KNMI, where the volume can be divided into 2 parts.
-                #It is also saved to self.attributes_descriptions[radar_dataset]. It gets defined in the functions get_scans_information in
+                #It is also saved in the volume attributes. It gets defined in the functions get_scans_information in
                 #nlr_importdata.py, if a double volume is present.
                 self.variable_attributes = [] #variable_attributes is used for volume attributes that are expected to be different for (almost)
                 # each volume. These attributes are then stored separately
@@ -442,43 +591,35 @@ class DataSource_General():
                 variable_attrs.append(current_attrs[i])
                 current_attrs[i] = 'variable'
                         
-        current_attrs_ID = None; ID = 0
-        for ID in self.attributes_descriptions[self.radar_dataset]:
-            attrs = self.attributes_descriptions[self.radar_dataset][ID]
-            if attrs == current_attrs:
-                #The series of attributes is the same as one of the series that is already stored, and the corresponding ID is used.
-                current_attrs_ID = ID; break
-        if not current_attrs_ID:
-            #The series of attributes is new, and a new ID is used, that is 1 higher than the largest existing one.
-            current_attrs_ID = ID+1
-            self.attributes_descriptions[self.radar_dataset][current_attrs_ID] = current_attrs
-                                
         # if self.product_versions_in1file=True, then volume attributes for all product versions have been determined at once, hence no need
         # to use a different subdataset for different product versions.
         subdataset = self.get_subdataset(pv='' if self.product_versions_in1file else None)
-        #Insert the attributes ID in self.attributes_IDs
-        ft.create_subdicts_if_absent(self.attributes_IDs[self.radar_dataset], [subdataset, self.crd.date])
         data_selected_startazimuth = self.gui.data_selected_startazimuth if self.crd.radar in gv.radars_with_adjustable_startazimuth else 0
-        self.attributes_IDs[self.radar_dataset][subdataset][self.crd.date][self.crd.time] = [current_attrs_ID,self.total_files_size,data_selected_startazimuth]
-        
-        if variable_attrs:
-            ft.create_subdicts_if_absent(self.attributes_variable[self.radar_dataset], [subdataset, self.crd.date])
-            self.attributes_variable[self.radar_dataset][subdataset][self.crd.date][self.crd.time] = variable_attrs
+        try:
+            self.volume_attributes.put(self.radar_dataset, subdataset, self.crd.date+self.crd.time, current_attrs, self.total_files_size,
+                                       data_selected_startazimuth, variable_attrs)
+        except Exception as e:
+            print(e, 'store_volume_attributes')
             
         self.process_products_with_pvs_in_keys('restore')
                         
     def restore_volume_attributes(self):
         subdataset = self.get_subdataset(pv='' if self.product_versions_in1file else None)
         try:
-            attrs_ID,saved_total_files_size,saved_data_selected_startazimuth = self.attributes_IDs[self.radar_dataset][subdataset][self.crd.date][self.crd.time]
+            datetime = self.crd.date+self.crd.time
+            saved_ID = self.volume_attributes.get_ID(self.radar_dataset, subdataset, datetime)
+            if saved_ID is None:
+                return False
+            attrs_ID,saved_total_files_size,saved_data_selected_startazimuth = saved_ID
             data_selected_startazimuth = self.gui.data_selected_startazimuth if self.crd.radar in gv.radars_with_adjustable_startazimuth else 0
             if saved_total_files_size!=self.total_files_size or saved_data_selected_startazimuth!=data_selected_startazimuth:
                 return False
 
-            attrs = copy.deepcopy(self.attributes_descriptions[self.radar_dataset][attrs_ID])
+            attrs = copy.deepcopy(self.volume_attributes.get_descriptions(self.radar_dataset)[attrs_ID])
             i_variable_attrs = [i for i,attr in enumerate(attrs) if attr == 'variable']
             if i_variable_attrs:
-                variable_attrs = copy.deepcopy(self.attributes_variable[self.radar_dataset][subdataset][self.crd.date][self.crd.time])
+                # Unpickled from the database, so no deep copy needed
+                variable_attrs = self.volume_attributes.get_variable(self.radar_dataset, subdataset, datetime)
                 for i,j in enumerate(i_variable_attrs):
                     attrs[j] = variable_attrs[i]
             self.decompress_volume_attributes(attrs)
@@ -639,7 +780,16 @@ class DataSource_General():
             return dataspecs_string, productunfiltered, polarization, apply_dealiasing, proj
         else:
             return dataspecs_string
-        
+
+    def set_memory_limits(self):
+        """The maximum amount of radar data in memory (set by the user) is divided between the stored data arrays, the cache of decompressed
+        NEXRAD level II blocks and the cache of bin mappings for derived products, such that their total size remains within this maximum.
+        """
+        max_bytes = 1e9*self.gui.max_radardata_in_memory_GBs
+        nexrad_l2.bzip2_block_cache.resize(int(bzip2_block_cache_fraction*max_bytes))
+        self.dp.mapping_cache.resize(mapping_cache_fraction*max_bytes)
+        self.stored_data.resize((1.-bzip2_block_cache_fraction-mapping_cache_fraction)*max_bytes)
+
     def store_data_in_memory(self, j): #j is the panel
         product = self.crd.products[j]
         if product in gv.products_with_tilts_derived_nosave:
@@ -649,32 +799,21 @@ class DataSource_General():
         dataspecs_string, productunfiltered, polarization, apply_dealiasing, proj = self.get_dataspecs_string_panel(j, product, True)
         # if not data changed we can still use self.crd.using_verticalpolarization[j] etc due to dataspecs_string_requested below
         if self.data_changed[j]:  
-            self.stored_data[dataspecs_string] = {'last_use_time':pytime.time(),'data':self.data[j].copy(),'data_azimuth_offset':self.data_azimuth_offset[j],'data_radius_offset':self.data_radius_offset[j],'scantime':self.scantimes[j],'using_unfilteredproduct':self.crd.using_unfilteredproduct[j],'using_verticalpolarization':self.crd.using_verticalpolarization[j]}
+            data_dict = {'data':self.data[j].copy(),'data_azimuth_offset':self.data_azimuth_offset[j],'data_radius_offset':self.data_radius_offset[j],'scantime':self.scantimes[j],'using_unfilteredproduct':self.crd.using_unfilteredproduct[j],'using_verticalpolarization':self.crd.using_verticalpolarization[j]}
         else:
-            self.stored_data[dataspecs_string] = {'last_use_time':pytime.time(),'data':np.zeros((1,1))}
+            data_dict = {'data':np.zeros((1,1))}
             
         if product in gv.plain_products:
-            self.stored_data[dataspecs_string]['meta_PP'] = self.dp.meta_PP[product].copy()
+            data_dict['meta_PP'] = self.dp.meta_PP[product].copy()
+        # The maximum size might have been changed by the user
+        self.set_memory_limits()
+        self.stored_data.put(dataspecs_string, data_dict, product)
                 
         if productunfiltered != self.crd.productunfiltered[j] or polarization != self.crd.polarization[j]:
             # In this case the new data array is both stored for the actual and the requested combination of productunfiltered and 
-            # polarization, but for the requested combination only the key for the actual combination is given as value.
-            # This key can then be used to obtain the desired dictionary with data
+            # polarization, but for the requested combination only an alias for the actual combination is stored.
             dataspecs_string_requested = self.generate_dataspecs_string(product,self.crd.productunfiltered[j],self.crd.polarization[j],apply_dealiasing,j,proj)
-            self.stored_data[dataspecs_string_requested] = dataspecs_string    
-            
-        stored_data_size = np.sum([float(sys.getsizeof(j['data'])) for j in self.stored_data.values() if not isinstance(j, str)])
-        #Convert to float, since the number might exceed the maximum value for 32-bit ints.
-        while stored_data_size>1e9*self.gui.max_radardata_in_memory_GBs:
-            #Remove the dataset with the most outdated last_use_time
-            index = np.argmax([pytime.time()-j['last_use_time'] for j in self.stored_data.values() if not isinstance(j, str)])
-            most_outdated_last_use_time_key = list(self.stored_data)[index]
-            # Also remove possible other keys that map onto the key that will be removed
-            keys_remove = [most_outdated_last_use_time_key]+\
-                [j for j in self.stored_data if type(self.stored_data[j]) == str and self.stored_data[j] == most_outdated_last_use_time_key]
-            for key in keys_remove:
-                del self.stored_data[key]
-            stored_data_size = np.sum([float(sys.getsizeof(j['data'])) for j in self.stored_data.values() if not isinstance(j, str)])
+            self.stored_data.put_alias(dataspecs_string_requested, dataspecs_string)
         
     def check_presence_data_in_memory(self,product,productunfiltered,polarization,apply_dealiasing,panel):
         if self.gui.max_radardata_in_memory_GBs <= 0:
@@ -693,16 +832,10 @@ class DataSource_General():
             # Can happen when requested scan or duplicate is unavailable
             return
         
-        if dataspecs_string in self.stored_data:
-            data_dict = self.stored_data[dataspecs_string]
-            if isinstance(data_dict, str): # In this case data_dict actually is a key that maps onto another data_dict
-                data_dict = self.stored_data[data_dict]
-            last_use_time = data_dict['last_use_time']
-            if last_use_time<self.pb.cmap_lastmodification_time[product] or last_use_time<self.gui.time_last_removal_volumeattributes:
-                return False #In this case the color map has been modified in the mean time, implying that
-                #self.pb.mask_values_int[product] could have been changed. If this is the case then the number of masked elements
-                #will likely change, which requires an update of the data.
-                
+        # Entries that have become outdated due to a change of color map or removal of volume attributes are removed from self.stored_data
+        # (see self.stored_data.invalidate), and will therefore not be found here.
+        data_dict = self.stored_data.get(dataspecs_string)
+        if not data_dict is None:
             # An empty array has been saved to memory when attempts to import data were unsuccessful. In this case don't update the data
             # array and attributes, but also don't re-import data, which requires that self.import_data[panel] is still set to False.
             if data_dict['data'].size > 1:
@@ -720,7 +853,6 @@ class DataSource_General():
                 
                 self.data_changed[panel] = True
             self.import_data[panel] = False
-            data_dict['last_use_time'] = pytime.time()
             
             
     def convert_dtype_float_to_uint(self,data,product,inverse=False):
@@ -798,6 +930,8 @@ class DataSource_General():
         # half-finished scans.
         # self.total_files_size should also be used elsewhere where information about total files size is needed.
         self.total_files_size = self.get_total_volume_files_size()
+        # The files of the volume that is read here, used for the dealiased velocity cache when mono PRF dealiasing is performed below
+        volume_filepaths = [opa(os.path.join(self.crd.directory, j)) for j in self.files_datetime]
         
         self.radar_dataset = self.get_radar_dataset()
         
@@ -895,7 +1029,7 @@ class DataSource_General():
                     not self.mono_prf_dealiasing_performed:
                         # A Nyquist velocity of 999. indicates that it could not be determined, while it is at least high enough to include
                         # the scan in operations that require a sufficiently high Nyquist velocity.
-                        self.data[j] = self.perform_mono_prf_dealiasing(j, self.data[j])
+                        self.data[j] = self.perform_mono_prf_dealiasing(volume_filepaths, self.crd.scans[j], j, self.data[j])
                 except Exception as e:
                     print(e, 'get_data, panel '+str(j))
                     traceback.print_exception(type(e), e, e.__traceback__)
@@ -947,16 +1081,61 @@ class DataSource_General():
         # stats.print_stats(20)  
         return self.data_changed, self.total_files_size
     
-    def perform_mono_prf_dealiasing(self, j, data, vn=None, azis=None, da=None): # j is the panel
+    def perform_mono_prf_dealiasing(self, filepaths, scan, j, data, vn=None, azis=None, da=None): # j is the panel
+        """filepaths are the path(s) of the radar file(s) from which the scan is read, which are used for the dealiased velocity cache
+        (see self.get_dealiasing_cache_source).
+        """
+        vn = self.nyquist_velocities_all_mps[scan] if vn is None else vn
+        _data = np.where(data == self.pb.mask_values['v'], np.nan, data)
+        try:
+            filename, files_size, filepaths = self.get_dealiasing_cache_source(filepaths)
+            # The key is determined before calling VDA, since the dealiased velocity might already be in the cache while the model is still
+            # being loaded
+            model_id = VDA.model_id if VDA else get_VDA_model_id()
+            params = ['Unet VDA', filepaths, model_id, vn, da, self.gui.dealiasing_setting, self.gui.dealiasing_max_nyquist_vel]
+            key = self.dealiasing_cache.get_key(scan, [_data, azis], params)
+        except Exception as e:
+            print(e, 'perform_mono_prf_dealiasing')
+            key = None
+            
         if VDA is None:
-            self.dont_store_in_memory[j] = True
-            return data
-        data[data == self.pb.mask_values['v']] = np.nan
-        vn = self.nyquist_velocities_all_mps[self.crd.scans[j]] if vn is None else vn
-        data = VDA(data, vn, azis, da, extra_dealias='extra' in self.gui.dealiasing_setting)
+            cached_data = None if key is None else self.dealiasing_cache.get(filename, key, files_size)
+            if cached_data is None:
+                self.dont_store_in_memory[j] = True
+                return data
+            data = cached_data
+        else:
+            function = lambda: VDA(_data, vn, azis, da, extra_dealias='extra' in self.gui.dealiasing_setting)
+            data = function() if key is None else self.dealiasing_cache(filename, function, key, files_size)
         self.mono_prf_dealiasing_performed = True
         return data
     
+    def apply_dual_prf_dealiasing(self, filepaths, scan, v_array, data_mask, *args, **kwargs):
+        """Calls nlr_dealiasing.apply_dual_prf_dealiasing with the remaining arguments, and takes the result from the dealiased velocity cache
+        when available. filepaths are the path(s) of the radar file(s) from which scan is read.
+        """
+        function = lambda: nlr_dealiasing.apply_dual_prf_dealiasing(v_array, data_mask, *args, **kwargs)
+        try:
+            filename, files_size, filepaths = self.get_dealiasing_cache_source(filepaths)
+            arrays = [v_array, data_mask, kwargs.get('z_array', None), kwargs.get('c_array', None)]
+            params = ['dual PRF', filepaths]+list(args)+[(i, kwargs[i]) for i in sorted(kwargs) if not i in ('z_array', 'c_array')]
+            # The key is determined before dealiasing, since that modifies v_array in place
+            key = self.dealiasing_cache.get_key(scan, arrays, params)
+        except Exception as e:
+            print(e, 'apply_dual_prf_dealiasing')
+            return function()
+        return self.dealiasing_cache(filename, function, key, files_size)
+    
+    def get_dealiasing_cache_source(self, filepaths):
+        """Returns the name of the dealiased velocity cache file and the total size of the radar file(s) in filepaths (a path or list of
+        paths), together with the list of absolute paths. These are taken from the files from which the scan is read, and not from
+        self.crd, since scans can be dealiased for another volume than the one that is displayed, and self.crd can change while scans are
+        read concurrently.
+        """
+        filepaths = [opa(j) for j in ([filepaths] if isinstance(filepaths, str) else filepaths)]
+        filename = self.dealiasing_cache.get_filename(self.gui.derivedproducts_dir, filepaths)
+        return filename, self.dealiasing_cache.get_files_size(filepaths), filepaths
+    
     def calculate_derived_with_tilts(self, j): # j is the panel
         """Currently only calculates SRV.
         Also, SRV is calculated from uint velocity data (which is dtype in which velocity is available at this point), 
@@ -1450,7 +1629,13 @@ class DataSource_General():
         """Returns the filenames in a list with directory entries (which could also include directories, and which get removed from the list here).
         """
         if directory is None: return [] #Calling os.listdir with argument None lists the current working directory, which is not desired.
-        return self.source_classes[self.data_source(radar)].get_filenames_directory(radar,directory)
+        # Filenames are only determined again when the content of the directory has changed, see nlr_directoryindex.py
+        function = lambda: self.source_classes[self.data_source(radar)].get_filenames_directory(radar,directory)
+        try:
+            return di.directory_index.get_derived(directory, ('filenames', radar), function)
+        except OSError:
+            # The directory doesn't exist (anymore), in which case the source classes return no filenames 
+            return function()
                
     def get_datetimes_from_files(self,radar,filenames,directory=None,dtype = str,return_unique_datetimes = True, mode='simple'):
         # directory is in most cases not needed to determine datetimes from filenames, but Meteo-France archived files are an exception, since
@@ -1474,22 +1659,17 @@ class DataSource_General():
     
     def update_directories_lastupdate_times(self, directory):
         # This function gets called from a signal in nlr_currentdata.py
-        self.directories_lastupdate_times[directory] = pytime.time()
+        di.directory_index.invalidate(directory)
     
     def get_datetimes_directory(self,radar,directory,dtype = str,return_unique_datetimes = True):
-        lastupdate_time = self.filenames_directory.get(directory, {}).get('time', 0)
-        if pytime.time() - lastupdate_time < 60 and lastupdate_time > self.directories_lastupdate_times.get(directory, 0):
-            filenames = self.filenames_directory[directory]['fnames']
-        else:
-            filenames = self.get_filenames_directory(radar,directory)
-            self.filenames_directory[directory] = {'time':pytime.time(), 'fnames':filenames}
         # This function gets regularly called from within self.crd.switch_to_nearby_radar, so it's important to cache results.
-        # Earlier this was done using the modification time (mtime) of the directory that would also remove the need for always determining filenames.
-        # But this method appeared to be not trustworthy, as some filesystems don't update it when the number of files in the directory changes.
-        if not directory in self.nfiles_directory or self.nfiles_directory[directory] != len(filenames):
-            self.datetimes_directory[directory] = self.get_datetimes_from_files(radar,filenames,directory,dtype,return_unique_datetimes, mode='simple')
-            self.nfiles_directory[directory] = len(filenames)
-        return self.datetimes_directory[directory]
+        # This is done in the directory index, that determines datetimes again only when the content of the directory has changed.
+        filenames = self.get_filenames_directory(radar,directory)
+        function = lambda: self.get_datetimes_from_files(radar,filenames,directory,dtype,return_unique_datetimes, mode='simple')
+        try:
+            return di.directory_index.get_derived(directory, ('datetimes', radar, dtype, return_unique_datetimes), function)
+        except OSError:
+            return function()
     
     def get_product_versions(self, radar, filenames, datetimes):
         self.product_versions_datetimesdict = self.product_versions_directory = self.products_version_dependent =\
@@ -1506,7 +1686,6 @@ class DataSource_General():
     
     def get_files(self,radar,directory,return_datetimes = False):
         filenames = self.get_filenames_directory(radar,directory)
-        self.filenames_directory[directory] = {'time':pytime.time(), 'fnames':filenames}
             
         if radar in gv.radars_with_onefileperdate:
             #Here there is one file per date, and therefore multiple radar volumes per file. datetimes contains datetimes of all the radar volumes
@@ -1537,7 +1716,8 @@ class DataSource_General():
     
     def get_total_volume_files_size(self, datetime=None):
         files_datetime = self.files_datetimesdict[datetime] if datetime else self.files_datetime
-        return sum([os.path.getsize(self.crd.directory+'/'+j) for j in files_datetime])
+        # Sizes are taken from the stat cache of the directory index, see nlr_directoryindex.py
+        return sum(di.directory_index.get_file_sizes(self.crd.directory, files_datetime))
     
     def get_filenames_and_datetimes_in_datetime_range(self,radar,dataset = None,dir_string = None,startdatetime = None,enddatetime = None,return_abspaths = False,return_completely_selected_directories = False):
         #Either dir_string or dataset should be given as input
@@ -1553,7 +1733,7 @@ class DataSource_General():
         dirs_abspaths = bg.get_abspaths_directories_in_datetime_range(dir_string,self.gui.radar_basedir,radar,startdatetime,enddatetime)[0]
         
         completely_selected_directories = []
-        requested_filenames = np.array([],dtype = 'int64'); requested_datetimes = np.array([],dtype = 'int64')
+        requested_filenames = []; requested_datetimes = []
         for i in dirs_abspaths:
             try:
                 filenames = self.get_filenames_directory(radar,i)
@@ -1570,13 +1750,16 @@ class DataSource_General():
                 else:
                     requested = np.ones(len(datetimes),dtype = 'bool')
                     
-                requested_filenames = np.append(requested_filenames,filenames[requested])
-                requested_datetimes = np.append(requested_datetimes,datetimes[requested])
+                requested_filenames.append(filenames[requested])
+                requested_datetimes.append(datetimes[requested])
             
                 if return_completely_selected_directories and np.count_nonzero(requested)==len(datetimes):
                     completely_selected_directories.append(i)
             except Exception as e:
                 print(i, e)
+        # Concatenating once at the end is much faster than appending per directory
+        requested_filenames = np.concatenate(requested_filenames) if requested_filenames else np.array([],dtype = 'int64')
+        requested_datetimes = np.concatenate(requested_datetimes) if requested_datetimes else np.array([],dtype = 'int64')
             
         if return_completely_selected_directories:
             return completely_selected_directories,requested_filenames,requested_datetimes
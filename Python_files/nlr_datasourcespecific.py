@@ -9,6 +9,7 @@ import time as pytime
 
 import nlr_globalvars as gv
 import nlr_background as bg
+import nlr_directoryindex as di
 import nlr_functions as ft
 
 
@@ -43,7 +44,7 @@ class Source_KNMI():
                     
     def get_filenames_directory(self,radar,directory):
         try:
-            entries=os.listdir(directory)
+            entries=di.listdir(directory)
         except Exception: entries=[]
         filenames=np.sort(np.array([j for j in entries if j[-2:]=='h5' and j[:15]=='RAD_NL'+gv.radar_ids[radar]+'_VOL_NA']))
         return filenames
@@ -149,7 +150,7 @@ class Source_KMI():
     
     def get_filenames_directory(self,radar,directory):
         try:
-            entries=os.listdir(directory)
+            entries=di.listdir(directory)
         except Exception: entries=[]
         filenames=np.sort(np.array([j for j in entries if os.path.splitext(j)[1][1:] in ('hdf','h5','vol')]))
         return filenames
@@ -212,7 +213,7 @@ class Source_skeyes():
 
     def get_filenames_directory(self,radar,directory):        
         try:
-            entries=os.listdir(directory)
+            entries=di.listdir(directory)
         except Exception: entries=[]
         if any(any(j in i for j in ('.vol', 'scan_abc.hdf')) for i in entries):
             return self.dsg.source_classes['KMI'].get_filenames_directory(radar, directory)
@@ -460,7 +461,7 @@ class Source_DWD():
  
     def get_filenames_directory(self,radar,directory):
         try:
-            entries=os.listdir(directory)
+            entries=di.listdir(directory)
         except Exception: entries=[]
         return np.sort([j for j in entries if any(j.endswith(i) for i in self.import_classes)])
     
@@ -500,7 +501,7 @@ class Source_TUDelft():
                 
     def get_filenames_directory(self, radar, directory):
         try:
-            entries=os.listdir(directory)
+            entries=di.listdir(directory)
         except Exception: entries=[]
         filenames=np.sort(np.array([j for j in entries if j[-3:]=='.nc']))
         return filenames
@@ -601,7 +602,7 @@ class Source_Leonardo():
         
     def get_filenames_directory(self, radar, directory):
         try:
-            entries=os.listdir(directory)
+            entries=di.listdir(directory)
         except Exception: entries=[]
         filenames=np.sort(np.array([j for j in entries if j[-4:]=='.vol']))
         return filenames
@@ -639,7 +640,7 @@ class Source_DMI():
                     
     def get_filenames_directory(self,radar,directory):
         try:
-            entries=os.listdir(directory)
+            entries=di.listdir(directory)
         except Exception: entries=[]
         filenames=np.sort([j for j in entries if j.split('.')[-1] in ('h5', 'hdf') and gv.radar_ids[radar] in j])
         return filenames
@@ -691,7 +692,7 @@ class Source_AustroControl():
                     
     def get_filenames_directory(self,radar,directory):
         try:
-            entries=os.listdir(directory)
+            entries=di.listdir(directory)
         except Exception: entries=[]
         filenames = np.sort([j for j in entries if j[-3:]=='hdf'])
         return filenames
@@ -736,7 +737,7 @@ class Source_CHMI():
                     
     def get_filenames_directory(self,radar,directory):
         try:
-            entries=os.listdir(directory)
+            entries=di.listdir(directory)
         except Exception: entries=[]
         filenames = np.sort(np.array([j for j in entries if '.h' in j[-5:]]))
         return filenames
@@ -815,7 +816,7 @@ class Source_MeteoFrance():
                     
     def get_filenames_directory(self, radar, directory):
         try:
-            entries = os.listdir(directory)
+            entries = di.listdir(directory)
         except Exception: entries = []
         filenames = np.sort([j for j in entries if any(i in j for i in ('PAM', 'PAG'))])
         return filenames
@@ -865,7 +866,7 @@ class Source_UKMO():
         
     def get_filenames_directory(self, radar, directory):
         try:
-            entries = os.listdir(directory)
+            entries = di.listdir(directory)
         except Exception: entries = []
         filenames = np.sort([j for j in entries if j[-7:] == '.dat.gz'])
         return filenames
@@ -926,6 +927,14 @@ class Source_NWS():
     def import_class(self):
         level = self.get_level()
         return self.dsg.NEXRAD_L2 if level == 2 else self.dsg.NEXRAD_L3
+    
+    def prefetch_file(self, filepath, scanangles=None):
+        # Is called by nlr_prefetch.Prefetcher in a worker thread. Level 3 files are small, and are just read.
+        if self.get_level(os.path.basename(filepath)) == 2:
+            self.dsg.NEXRAD_L2.prefetch_file(filepath, scanangles)
+        else:
+            with open(filepath, 'rb') as f:
+                f.read()
         
     def filepaths(self, product=None, scan=None, duplicate=None):
         level = self.get_level()
@@ -991,7 +1000,7 @@ class Source_NWS():
     
     def get_filenames_directory(self, radar, directory):
         try:
-            entries = os.listdir(directory)
+            entries = di.listdir(directory)
             level = self.get_level(entries[0])
             if level == 3:
                 # There are many kinds of L3 files. Here only those that contain the desired products are kept
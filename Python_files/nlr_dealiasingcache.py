@@ -0,0 +1,130 @@
+# Copyright (C) 2016-2024 Bram van 't Veen, bramvtveen94@hotmail.com
+# Distributed under the GNU General Public License version 3, see <https://www.gnu.org/licenses/>.
+
+import os
+import hashlib
+import threading
+import time as pytime
+import numpy as np
+import h5py
+
+
+"""On-disk cache of dealiased velocity fields, in the derived products directory. Dealiasing (and the Unet VDA model in particular)
+can take a significant amount of time, and without cache it is repeated each time that a scan is removed from memory or viewed in a
+new session.
+
+Fields are stored in one HDF5 file per radar file from which the velocity scan is read (see get_filename), with one dataset per
+dealiased field. Files are thus identified by the radar file and not by the displayed volume, since scans are also dealiased for other
+volumes than the one that is displayed (e.g. for the VWP). A file is rewritten when the size of the radar file(s) changes. The dataset
+name consists of the scan number and a hash of everything that determines the result: the input arrays (velocity, data mask and any
+other arrays used by the algorithm), the Nyquist velocities, and the algorithm and its settings. A change in the input data or settings
+therefore automatically results in a new entry. As for derived products (see DerivedPlain.write_file), the number of datasets per file is
+limited, and when this limit is reached the dataset that has been used the least number of times is removed (the oldest one when several
+datasets have been used equally often).
+"""
+
+# Should be updated when a dealiasing algorithm changes, such that previously stored fields are no longer used
+file_content_version = 2
+max_datasets_per_file = 40
+
+
+class DealiasedVelocityCache():
+    def __init__(self):
+        # h5py doesn't support concurrent access to a file from multiple threads, and scans can be dealiased concurrently
+        # (see nlr_importdata.read_scans_concurrently)
+        self.lock = threading.Lock()
+        self.n_hits = self.n_misses = 0
+
+    def get_filename(self, derivedproducts_dir, filepaths):
+        """Returns the name of the cache file for the radar file(s) in filepaths, that contain the scan that is dealiased. When a scan is
+        read from more than one file, the cache file is named after the first one. The directory name contains a hash of the directory of
+        the radar file, such that radar files with equal names in different directories don't share a cache file.
+        """
+        directory, filename = os.path.split(os.path.abspath(filepaths[0]))
+        subdirectory = os.path.basename(directory)+'_'+hashlib.blake2b(directory.encode(), digest_size=8).hexdigest()
+        return derivedproducts_dir+'/dealiased_velocity/'+subdirectory+'/'+filename+'.h5'
+
+    def get_files_size(self, filepaths):
+        # Determined when dealiasing, such that it describes the file(s) from which the scan has just been read
+        return sum(os.path.getsize(j) for j in filepaths)
+
+    def get_key(self, scan, arrays, params):
+        """Returns the scan number followed by a hash of the list of arrays and the list params, with parameter values that are converted to
+        strings. Arrays can be None, and params can contain arrays.
+        """
+        h = hashlib.blake2b(digest_size=16)
+        for arr in arrays:
+            if arr is None:
+                h.update(b'None')
+            else:
+                arr = np.ascontiguousarray(arr)
+                h.update(f'{arr.dtype.str}{arr.shape}'.encode())
+                h.update(arr.view('uint8').ravel())
+        for p in params:
+            if isinstance(p, np.ndarray):
+                p = (p.dtype.str, p.shape, p.tobytes())
+            h.update(repr(p).encode())
+        return f'{scan}_{h.hexdigest()}'
+
+    def check_need_update(self, f, source_files_size):
+        return f.attrs['version'] != file_content_version or f.attrs['source_files_size'] != source_files_size
+
+    def get(self, filename, key, source_files_size):
+        # Returns the stored field, or None when it is not present in the cache
+        data = None
+        with self.lock:
+            try:
+                if os.path.exists(filename):
+                    with h5py.File(filename, 'r+') as f:
+                        if not self.check_need_update(f, source_files_size) and key in f:
+                            dataset = f[key]
+                            data = dataset[:]
+                            dataset.attrs['n_displayed'] += 1
+                            dataset.attrs['last_view_time'] = pytime.time()
+            except Exception as e:
+                print(e, 'DealiasedVelocityCache.get')
+            if data is None:
+                self.n_misses += 1
+            else:
+                self.n_hits += 1
+        return data
+
+    def put(self, filename, key, data, source_files_size):
+        with self.lock:
+            try:
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                try:
+                    with h5py.File(filename, 'r') as f:
+                        action = 'w' if self.check_need_update(f, source_files_size) else 'a'
+                except Exception:
+                    action = 'w'
+
+                with h5py.File(filename, action) as f:
+                    f.attrs['version'] = file_content_version
+                    f.attrs['source_files_size'] = source_files_size
+                    if key in f:
+                        del f[key]
+                    datasets = list(f)
+                    if len(datasets) >= max_datasets_per_file:
+                        n_displayed = np.array([f[j].attrs['n_displayed'] for j in datasets])
+                        last_view_times = np.array([f[j].attrs['last_view_time'] for j in datasets])
+                        # Remove the least used dataset, and the oldest of these when several datasets have been used equally often
+                        candidates = np.nonzero(n_displayed == n_displayed.min())[0]
+                        del f[datasets[candidates[np.argmin(last_view_times[candidates])]]]
+                    # Velocities are stored lossless, since dealiased fields can be input for further processing (e.g. Unet VDA after
+                    # dual-PRF dealiasing)
+                    dataset = f.create_dataset(key, data=data, compression='gzip', compression_opts=1, shuffle=True, track_times=False)
+                    dataset.attrs['n_displayed'] = 1
+                    dataset.attrs['last_view_time'] = pytime.time()
+            except Exception as e:
+                print(e, 'DealiasedVelocityCache.put')
+
+    def __call__(self, filename, function, key, source_files_size):
+        """Returns function(), which should return the dealiased velocity field that is identified by key (see self.get_key). When present
+        the field is taken from the cache, and otherwise it is calculated and stored.
+        """
+        data = self.get(filename, key, source_files_size)
+        if data is None:
+            data = function()
+            self.put(filename, key, data, source_files_size)
+        return data
@@ -0,0 +1,328 @@
+# Copyright (C) 2016-2024 Bram van 't Veen, bramvtveen94@hotmail.com
+# Distributed under the GNU General Public License version 3, see <https://www.gnu.org/licenses/>.
+
+import os
+opa = os.path.abspath
+import bisect
+import json
+import sqlite3
+import threading
+import time as pytime
+from collections import OrderedDict
+try:
+    # Optional, without it changes in directories are detected by polling
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+"""Index of the content of radar data directories. Listing a directory with thousands of files can take a long time, especially on
+network mounts, and directories are listed many times when browsing through the archive or switching between radars. The index keeps
+a sorted list of entry names for recently used directories, together with results that are derived from it (like the filenames and
+datetimes for a radar, see DataSource_General.get_filenames_directory). Derived results are only determined again when the content of
+the directory has changed.
+
+Changes are detected in two ways:
+- When the watchdog package is available, recently used directories are watched for changes (with inotify on Linux). Created, deleted
+  and moved files are then added to or removed from the index, without listing the directory again.
+- Otherwise, or when the watch fails, the directory is listed again when its modification time has changed, and at least every
+  poll_interval seconds. The latter is needed since some filesystems (like network mounts) don't update the modification time reliably.
+  For the same reason watched directories are also listed again every poll_interval seconds, since events for changes made by other
+  machines aren't received for network mounts.
+
+The index also contains a cache with sizes and modification times of files, that is filled for the whole directory at once with os.scandir
+(on Windows and for many network filesystems this requires no extra request per file). It is cleared when the directory content or its
+modification time changes (the latter also happens when a file is replaced by renaming another one), and for watched directories the
+entries for modified files are removed.
+
+When a database file is set with open_db, entry names and the stat cache are also stored in an SQLite database, such that directories
+don't need to be listed again in a new session. A stored listing is only used when the modification time of the directory is unchanged,
+and like a new listing it is used for at most poll_interval seconds. Derived results are not stored.
+"""
+
+poll_interval = 60
+# The modification time of a directory is checked at most once per mtime_check_interval seconds
+mtime_check_interval = 2
+max_directories = 256
+max_watched_directories = 32
+# Files that have been modified less than recent_file_age seconds ago might still be being written, and their sizes are therefore
+# not taken from the stat cache
+recent_file_age = 300
+# Maximum number of directories in the database, of which the least recently listed ones are removed
+max_stored_directories = 4096
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, index):
+        self.index = index
+
+    def on_any_event(self, event):
+        try:
+            self.index.process_event(event)
+        except Exception as e:
+            print(e, '_EventHandler.on_any_event')
+
+
+class DirectoryIndex():
+    def __init__(self, db_filename=None):
+        # For each directory a dictionary with its sorted entry names, the time of listing, the modification time, a version number
+        # that is increased with each change of the content, and the results derived from the content.
+        self.directories = OrderedDict()
+        self.lock = threading.RLock()
+        self.observer = None
+        self.watches = OrderedDict()
+        self.db_filename = db_filename
+        self.connection = None
+        # Separate lock for the database, such that it doesn't block access to the index in memory
+        self.db_lock = threading.Lock()
+
+    def open_db(self, db_filename):
+        with self.db_lock:
+            self.close_db()
+            self.db_filename = db_filename
+
+    def connect(self):
+        # Should be called with self.db_lock acquired
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.db_filename), exist_ok=True)
+            self.connection = sqlite3.connect(self.db_filename, check_same_thread=False)
+            # The database is a cache, for which losing the last transactions at a crash is harmless
+            self.connection.execute("PRAGMA synchronous=OFF")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime_ns INTEGER, time REAL, names TEXT, "
+                                    "stats TEXT)")
+            with self.connection:
+                self.connection.execute("DELETE FROM directories WHERE path NOT IN (SELECT path FROM directories ORDER BY time DESC LIMIT ?)",
+                                        (max_stored_directories,))
+        return self.connection
+
+    def close_db(self):
+        # Should be called with self.db_lock acquired
+        if not self.connection is None:
+            self.connection.close()
+            self.connection = None
+
+    def read_stored(self, directory, mtime_ns):
+        # Returns the stored names and stats for directory, or None when not present or when the modification time has changed
+        if self.db_filename is None:
+            return None
+        try:
+            with self.db_lock:
+                row = self.connect().execute("SELECT names, stats FROM directories WHERE path=? AND mtime_ns=?", (directory, mtime_ns)).fetchone()
+            if row is None:
+                return None
+            stats = json.loads(row[1])
+            return {'names':json.loads(row[0]), 'stats':None if stats is None else {i:tuple(j) for i,j in stats.items()}}
+        except (sqlite3.Error, ValueError) as e:
+            print(e, 'DirectoryIndex.read_stored')
+            return None
+
+    def store(self, entry):
+        if self.db_filename is None:
+            return
+        # Stats of files that might still be being written are not stored, since they would be regarded as final in a later session
+        min_mtime_ns = (pytime.time()-recent_file_age)*1e9
+        with self.lock:
+            stats = None if entry['stats'] is None else {i:j for i,j in entry['stats'].items() if j[1] <= min_mtime_ns}
+            values = (entry['path'], entry['mtime_ns'], entry['time'], json.dumps(entry['names']), json.dumps(stats))
+        try:
+            with self.db_lock:
+                with self.connect() as connection: # Commits the transaction
+                    connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)", values)
+        except sqlite3.Error as e:
+            print(e, 'DirectoryIndex.store')
+
+    def remove_stored(self, directory=None):
+        if self.db_filename is None:
+            return
+        try:
+            with self.db_lock:
+                with self.connect() as connection:
+                    if directory:
+                        connection.execute("DELETE FROM directories WHERE path=?", (directory,))
+                    else:
+                        connection.execute("DELETE FROM directories")
+        except sqlite3.Error as e:
+            print(e, 'DirectoryIndex.remove_stored')
+
+    def listdir(self, directory):
+        """Returns the names of the entries in directory, in sorted order. Like os.listdir, an OSError is raised when directory can't be
+        listed.
+        """
+        entry = self.get_entry(directory)
+        with self.lock:
+            return list(entry['names'])
+
+    def get_derived(self, directory, key, function):
+        """Returns the result of function(), which should depend only on the content of directory. The result is stored under key,
+        and function is only called again when the content of directory has changed. An OSError is raised when directory can't be listed.
+        """
+        entry = self.get_entry(directory)
+        with self.lock:
+            version = entry['version']
+            if key in entry['derived'] and entry['derived'][key][0] == version:
+                return entry['derived'][key][1]
+        result = function()
+        with self.lock:
+            entry['derived'][key] = (version, result)
+        return result
+
+    def get_file_sizes(self, directory, filenames):
+        """Returns the sizes of the files in filenames, that should be located in directory. Like os.path.getsize, an OSError is raised
+        when a file doesn't exist.
+        """
+        entry = self.get_entry(directory)
+        with self.lock:
+            stats = entry['stats']
+        if stats is None:
+            stats = {}
+            with os.scandir(entry['path']) as iterator:
+                for j in iterator:
+                    try:
+                        stat = j.stat()
+                        stats[j.name] = (stat.st_size, stat.st_mtime_ns)
+                    except OSError:
+                        pass
+            with self.lock:
+                # Also when another thread has scanned the directory in the meantime, the results of this scan replace the cached ones,
+                # since they are at least as recent
+                entry['stats'] = stats
+                store = self.directories.get(entry['path'], None) is entry
+            if store:
+                self.store(entry)
+                    
+        sizes = []
+        min_mtime_ns = (pytime.time()-recent_file_age)*1e9
+        for name in filenames:
+            stat = stats.get(name, None)
+            if stat is None or stat[1] > min_mtime_ns:
+                stat = os.stat(os.path.join(entry['path'], name))
+                stat = stats[name] = (stat.st_size, stat.st_mtime_ns)
+            sizes.append(stat[0])
+        return sizes
+
+    def invalidate(self, directory=None):
+        # Causes the directory (or all directories when None) to be listed again at the next request
+        with self.lock:
+            for j in ([opa(directory)] if directory else list(self.directories)):
+                if j in self.directories:
+                    self.directories[j]['time'] = 0
+        self.remove_stored(opa(directory) if directory else None)
+
+    def get_entry(self, directory):
+        directory = opa(directory)
+        now = pytime.time()
+        with self.lock:
+            entry = self.directories.get(directory, None)
+            if entry:
+                self.directories.move_to_end(directory)
+                valid = now-entry['time'] < poll_interval
+                if valid and now-entry['mtime_check_time'] > mtime_check_interval:
+                    entry['mtime_check_time'] = now
+                    try:
+                        valid = os.stat(directory).st_mtime_ns == entry['mtime_ns'] or directory in self.watches
+                    except OSError:
+                        valid = False
+                if valid:
+                    return entry
+
+        # Listing takes place outside the lock, since it can take a long time. A stored listing is only used when the directory is not yet
+        # present in memory, since otherwise the directory is listed again because it might have changed.
+        mtime_ns = os.stat(directory).st_mtime_ns
+        stored = self.read_stored(directory, mtime_ns) if entry is None else None
+        names = stored['names'] if stored else sorted(os.listdir(directory))
+        with self.lock:
+            previous = self.directories.get(directory, None)
+            unchanged = previous and previous['names'] == names
+            if unchanged:
+                # The content has not changed, so derived results remain valid. A changed modification time can however also mean that
+                # files have been replaced (e.g. with os.replace when downloading again), in which case their stats are outdated.
+                mtime_changed = mtime_ns != previous['mtime_ns']
+                if mtime_changed:
+                    previous['stats'] = None
+                previous.update({'time':now, 'mtime_check_time':now, 'mtime_ns':mtime_ns})
+            else:
+                entry = {'path':directory, 'names':names, 'time':now, 'mtime_check_time':now, 'mtime_ns':mtime_ns, 'derived':{},
+                         'stats':stored['stats'] if stored else None, 'version':previous['version']+1 if previous else 0}
+                self.directories[directory] = entry
+                self.directories.move_to_end(directory)
+                while len(self.directories) > max_directories:
+                    self.unwatch(self.directories.popitem(last=False)[0])
+                self.watch(directory)
+        if unchanged:
+            if mtime_changed:
+                self.store(previous)
+            return previous
+        if not stored:
+            self.store(entry)
+        return entry
+
+    def watch(self, directory):
+        if Observer is None:
+            return
+        try:
+            if directory in self.watches:
+                self.watches.move_to_end(directory)
+                return
+            if self.observer is None:
+                self.observer = Observer()
+                self.observer.daemon = True
+                self.observer.start()
+            self.watches[directory] = self.observer.schedule(_EventHandler(self), directory, recursive=False)
+            while len(self.watches) > max_watched_directories:
+                self.unwatch(next(iter(self.watches)))
+        except Exception as e:
+            # E.g. when the maximum number of inotify watches has been reached. Polling is then used for this directory.
+            print(e, 'DirectoryIndex.watch')
+
+    def unwatch(self, directory):
+        watch = self.watches.pop(directory, None)
+        if watch:
+            try:
+                self.observer.unschedule(watch)
+            except Exception as e:
+                print(e, 'DirectoryIndex.unwatch')
+
+    def process_event(self, event):
+        paths = [opa(event.src_path)]
+        if event.event_type == 'moved':
+            paths.append(opa(event.dest_path))
+        with self.lock:
+            for i, path in enumerate(paths):
+                directory, name = os.path.split(path)
+                entry = self.directories.get(directory, None)
+                if path in self.directories and event.event_type in ('deleted', 'moved') and i == 0:
+                    # A watched directory itself has been removed or moved
+                    self.directories[path]['time'] = 0
+                if entry is None or not directory in self.watches:
+                    continue
+                index = bisect.bisect_left(entry['names'], name)
+                present = index < len(entry['names']) and entry['names'][index] == name
+                if event.event_type in ('deleted', 'moved') and i == 0:
+                    if present:
+                        entry['names'].pop(index)
+                elif event.event_type in ('created', 'moved'):
+                    if not present:
+                        entry['names'].insert(index, name)
+                elif not event.event_type in ('modified', 'closed'):
+                    # Other events (like opening a file) don't change the content
+                    continue
+                # Also a modification of a file changes the version, since derived results might depend on file sizes
+                entry['version'] += 1
+                entry['derived'] = {}
+                if entry['stats']:
+                    entry['stats'].pop(name, None)
+
+    def close(self):
+        with self.lock:
+            if self.observer:
+                self.observer.stop()
+                self.observer = None
+            self.watches = OrderedDict()
+        with self.db_lock:
+            self.close_db()
+
+
+directory_index = DirectoryIndex()
+listdir = directory_index.listdir
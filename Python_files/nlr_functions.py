@@ -521,6 +521,15 @@ def closest_value(array,value, return_index=False):
     index=np.argmin(np.abs(array-value))
     return array[index] if not return_index else (array[index], index)
 
+def closest_index_sorted(array,value):
+    """Returns the index of the element in the sorted array (without duplicates) that is closest to value. Gives the same result as
+    np.argmin(np.abs(array-value)), including the choice for the first index when two elements are equally close, but uses a binary search.
+    """
+    index=int(np.searchsorted(array,value))
+    if index==0 or index==len(array):
+        return max(index-1,0)
+    return index-1 if value-array[index-1]<=array[index]-value else index
+
 def point_inside_rectangle(point,corners):
     rectangle_center=np.sum(corners,axis=0)/4;
     rectangle_xdim=corners[:,0].max()-rectangle_center[0];
@@ -894,10 +903,28 @@ def get_window_sum(arr, window = [2, 2, 2, 2, 2]):
     and the elements in 'window' specify for each radial (centered around the central radial in which the radar bin is located) the number of radial bins in the window. 
     For each radial do 2*x+1 radial bins belong to the window, where x is the element in 'window'. The elements in window thus specify the number of radial bins above and below
     the central radius of the window. 
+    The azimuthal dimension (axis 0) is periodic, while bins beyond the first or last radial bin are not included in the sum.
+    
+    The sum is calculated either by adding shifted copies of arr (get_window_sum_shifted), or with a summed-area table (get_window_sum_sat).
+    The cost of the first method increases with the size of the window, while that of the second method is independent of it. But for the 
+    small windows that are most commonly used, the first method is faster. window_sum_sat_threshold determines when the second method is used,
+    based on the number of array additions that the first method requires, multiplied by the size of the elements in arr (since the summed-area
+    table always uses 4 or 8 bytes per element), and divided by the number of different window widths (each requiring a pass for the 
+    summed-area table).
     """
     if len(window) % 2 == 0: 
         raise Exception("The length of 'window' should be an odd number")
     
+    n_additions = 3*(len(window)//2)+2*max(window)+1
+    if n_additions*arr.dtype.itemsize > window_sum_sat_threshold*len(set(window)) and (arr.dtype.kind != 'f' or np.isfinite(arr).all()):
+        return get_window_sum_sat(arr, window)
+    return get_window_sum_shifted(arr, window)
+
+window_sum_sat_threshold = 128
+
+def get_window_sum_shifted(arr, window = [2, 2, 2, 2, 2]):
+    # Calculates the window sum by adding shifted copies of arr. Requires a window that is symmetric around the central azimuth, and
+    # that has the largest elements at the center.
     window = np.array(window)
     azi_sums = {1:arr.copy()}
     n_azi = int((len(window) - 1)/2)
@@ -914,6 +941,128 @@ def get_window_sum(arr, window = [2, 2, 2, 2, 2]):
     
     return window_sum
 
+def get_window_sum_sat(arr, window = [2, 2, 2, 2, 2]):
+    """Calculates the window sum with a summed-area table, for windows of arbitrary shape. The cost is independent of the size of the window,
+    and only increases with the number of different window widths. 
+    First cumulative sums along the radial dimension are used to obtain for each window width the sum over the radial bins within the window.
+    For each width this is done for the 'ring' of bins that is not yet included in the next smaller width. For each ring the sum over the radials
+    is then obtained from cumulative sums along the azimuthal dimension (with periodic boundaries), over the radials for which the window has at
+    least this width.
+    Sums are accumulated in float64 or (for integer/boolean arrays) int32/int64, and then converted back to the dtype of arr. For boolean arrays
+    the result is therefore True when at least one element in the window is True, as for get_window_sum_shifted. Arrays with non-finite values
+    should not be used, since these would affect the sums for all bins further along the radial.
+    """
+    window = np.asarray(window)
+    n_azi, n_rad = arr.shape
+    n_half = len(window)//2
+    w_max = int(window.max())
+    acc_dtype = 'float64' if arr.dtype.kind == 'f' else ('int32' if arr.dtype.itemsize == 1 else 'int64')
+    
+    # Cumulative sums along the radial dimension, padded such that windows extending beyond the first or last radial bin get clipped
+    c_rad = np.zeros((n_azi, n_rad+2*w_max+1), acc_dtype)
+    np.cumsum(arr, axis=1, dtype=acc_dtype, out=c_rad[:, w_max+1:w_max+1+n_rad])
+    c_rad[:, w_max+1+n_rad:] = c_rad[:, w_max+n_rad:w_max+n_rad+1]
+    radial_sum = lambda w: c_rad[:, w_max+w+1:w_max+w+1+n_rad] - c_rad[:, w_max-w:w_max-w+n_rad]
+    
+    window_sum = np.zeros(arr.shape, acc_dtype)
+    w_prev = None
+    for w in np.unique(window):
+        ring = radial_sum(w)
+        if not w_prev is None:
+            ring -= radial_sum(w_prev)
+        w_prev = w
+        
+        # Azimuthal offsets for which the window has at least width w, divided into runs of consecutive offsets
+        offsets = np.nonzero(window >= w)[0]-n_half
+        for run in np.split(offsets, np.nonzero(np.diff(offsets) != 1)[0]+1):
+            d1, d2 = int(run[0]), int(run[-1])
+            if d2-d1 < 2:
+                for d in range(d1, d2+1):
+                    if d == 0:
+                        window_sum += ring
+                    else:
+                        add_rolled_arr(window_sum, ring, 0, -d)
+            else:
+                c_azi = np.zeros((n_azi+d2-d1+1, n_rad), acc_dtype)
+                np.cumsum(ring[np.arange(d1, n_azi+d2) % n_azi], axis=0, out=c_azi[1:])
+                window_sum += c_azi[d2-d1+1:] - c_azi[:n_azi]
+    return window_sum.astype(arr.dtype, copy=False)
+
+def get_window_offsets(window):
+    # Returns the azimuthal and radial offsets of all bins in the window, relative to its central bin
+    n_half = len(window)//2
+    azi_offsets = np.concatenate([np.full(2*w+1, i-n_half) for i, w in enumerate(window)])
+    rad_offsets = np.concatenate([np.arange(-w, w+1) for w in window])
+    return azi_offsets, rad_offsets
+
+def get_window_blocks(rows, cols, n_azi, band_rows=16):
+    """Divides the radials into bands of band_rows radials, and returns for each run of consecutive bands that contain any of the bins with
+    row and column indices rows and cols a block (start row, end row, start column, end column). The column range is limited to the range
+    that contains the bins in the run. rows should be sorted. Used by get_window_sums_at.
+    """
+    bands = rows//band_rows
+    if len(bands) == 0:
+        return []
+    run_starts = np.concatenate([[0], np.nonzero(np.diff(bands) > 1)[0]+1, [len(rows)]])
+    blocks = []
+    for i, j in zip(run_starts[:-1], run_starts[1:]):
+        c = cols[i:j]
+        blocks.append((bands[i]*band_rows, min((bands[j-1]+1)*band_rows, n_azi), int(c.min()), int(c.max())+1))
+    return blocks
+
+def get_window_sums_at(arrays, window, indices):
+    """Returns for each array in arrays the window sums (as calculated by get_window_sum) for only the radar bins with (sorted) flattened
+    indices 'indices'. All arrays should have the same 2D shape.
+    When the number of bins is small, the elements in the window of each bin are summed directly. Otherwise get_window_sum is applied to
+    the blocks of radials that contain the bins (see get_window_blocks), or to the whole arrays when these blocks comprise most of them.
+    The method is chosen based on the number of elements that needs to be processed.
+    """
+    n_azi, n_rad = arrays[0].shape
+    n_half, w_max = len(window)//2, max(window)
+    rows, cols = np.divmod(indices, n_rad)
+    blocks = get_window_blocks(rows, cols, n_azi)
+    n_block_elements = sum((r1-r0+2*n_half)*(min(c1+w_max, n_rad)-max(c0-w_max, 0)) for r0, r1, c0, c1 in blocks)
+    window_size = sum(2*j+1 for j in window)
+
+    if len(indices)*window_size < n_block_elements:
+        azi_offsets, rad_offsets = get_window_offsets(window)
+        window_cols = cols+rad_offsets[:, None]
+        valid = (window_cols >= 0) & (window_cols < n_rad)
+        window_indices = ((rows+azi_offsets[:, None]) % n_azi)*n_rad + np.clip(window_cols, 0, n_rad-1)
+        sums = []
+        for arr in arrays:
+            values = arr.ravel()[window_indices]
+            values[~valid] = 0
+            sums.append(values.sum(axis=0, dtype=arr.dtype))
+        return sums
+    elif n_block_elements > 0.5*arrays[0].size:
+        return [get_window_sum(arr, window).ravel()[indices] for arr in arrays]
+
+    sums = [np.empty(len(indices), arr.dtype) for arr in arrays]
+    for r0, r1, c0, c1 in blocks:
+        i, j = np.searchsorted(rows, [r0, r1])
+        c0, c1 = max(c0-w_max, 0), min(c1+w_max, n_rad)
+        block_rows = np.s_[r0-n_half:r1+n_half] if r0 >= n_half and r1+n_half <= n_azi else np.arange(r0-n_half, r1+n_half) % n_azi
+        for arr, s in zip(arrays, sums):
+            # Azimuthal periodicity in get_window_sum affects only the first and last n_half radials of the block, which are not used
+            s[i:j] = get_window_sum(arr[block_rows, c0:c1], window)[rows[i:j]-r0+n_half, cols[i:j]-c0]
+    return sums
+
+def get_window_neighbours(indices, window, shape):
+    # Returns the (sorted) flattened indices of all radar bins that have any of the bins with flattened indices 'indices' in their window.
+    # The window should be symmetric around the central azimuth.
+    n_azi, n_rad = shape
+    window_size = sum(2*j+1 for j in window)
+    if len(indices)*window_size < 0.1*n_azi*n_rad:
+        rows, cols = np.divmod(indices, n_rad)
+        azi_offsets, rad_offsets = get_window_offsets(window)
+        window_cols = cols+rad_offsets[:, None]
+        valid = (window_cols >= 0) & (window_cols < n_rad)
+        return np.unique((((rows+azi_offsets[:, None]) % n_azi)*n_rad + window_cols)[valid])
+    selected = np.zeros(shape, 'bool')
+    selected.ravel()[indices] = True
+    return np.flatnonzero(get_window_sum(selected, window))
+
 def get_window_mean(arr, data_mask, window, copy=False):
     arr = arr.copy() if copy else arr
     arr[data_mask] = 0
@@ -957,29 +1106,64 @@ def calculate_ref_phase(sin_phi, cos_phi, window):
     sin_phi_sum, cos_phi_sum = get_window_sum(sin_phi, window), get_window_sum(cos_phi, window)
     return np.arctan2(sin_phi_sum, cos_phi_sum)
 
-def get_window_phase_stdev(phi, data_mask, window):
-    # Calculates stdev in phase space, taking into account the circular nature of the phase
+def get_window_circular_stats(phi, data_mask, window, dtype='float64'):
+    """Returns for each radar bin the circular mean phase and the mean resultant length of the unmasked phases phi in the window, together with
+    the number of unmasked bins in the window. These follow from window sums of sin(phi) and cos(phi), which are obtained with get_window_sum
+    (periodic in azimuth, and using a summed-area table for larger windows). The mean resultant length ranges from 0 (uniformly spread phases)
+    to 1 (equal phases), and is 0 when all bins in the window are masked. dtype determines the precision of the calculation, with float32
+    being faster and requiring less memory.
+    """
     if len(window) % 2 == 0: 
         raise Exception("The length of 'window' should be an odd number")
         
+    phi = phi.astype(dtype, copy=False)
     sin_phi = np.sin(phi); sin_phi[data_mask] = 0.
     cos_phi = np.cos(phi); cos_phi[data_mask] = 0.
-    phi_ref = calculate_ref_phase(sin_phi, cos_phi, window)
-                
-    n_azi = int((len(window) - 1)/2)
-    n_rad = max(window)
+    sin_phi_sum, cos_phi_sum = get_window_sum(sin_phi, window), get_window_sum(cos_phi, window)
+    n_unmasked = get_window_sum((~data_mask).astype('uint8'), window)
+    phi_mean = np.arctan2(sin_phi_sum, cos_phi_sum)
+    resultant_length = np.hypot(sin_phi_sum, cos_phi_sum)/np.maximum(n_unmasked, 1)
+    return phi_mean, np.minimum(resultant_length, 1, out=resultant_length), n_unmasked
+
+def get_window_circular_stdev(phi, data_mask, window, dtype='float64'):
+    # Circular standard deviation sqrt(-2*ln(R)), with R the mean resultant length in the window. Unlike get_window_phase_stdev it requires
+    # only window sums, but it gives larger values for strongly spread phases, and is infinite when all bins in the window are masked.
+    resultant_length = get_window_circular_stats(phi, data_mask, window, dtype)[1]
+    with np.errstate(divide='ignore'):
+        return np.sqrt(-2*np.log(resultant_length))
+
+def get_window_phase_stdev(phi, data_mask, window, dtype='float64'):
+    """Calculates for each radar bin the root-mean-square difference between the unmasked phases in the window and their circular mean phase
+    (see get_window_circular_stats), taking into account the circular nature of the phase. 
+    The squared differences are summed per window offset, for which a view on a padded copy of phi is used. As in get_window_sum, the 
+    azimuthal dimension is periodic, and bins beyond the first or last radial bin are not included. dtype determines the precision of 
+    the calculation, with float32 being faster and requiring less memory.
+    """
+    window = np.asarray(window)
+    phi_ref, _, n_unmasked = get_window_circular_stats(phi, data_mask, window, dtype)
+    n_azi, n_rad = phi.shape
+    n_half = len(window)//2
+    w_max = int(window.max())
     
-    diff = np.zeros_like(phi)
-    for i in range(-n_azi, n_azi+1):
-        for j in range(-n_rad, n_rad+1):
-            if abs(j) > window[n_azi+i]:
-                continue
-            _diff = np.abs(phi_ref - get_translated_arr(phi, (i, j)))
-            _diff = np.minimum(_diff, 2*np.pi-_diff)
-            _diff[get_translated_arr(data_mask, (i, j))] = 0.
-            diff += _diff**2
-    n_unmasked = np.maximum(get_window_sum((~data_mask).astype('uint8'), window), 1)
-    return np.sqrt(diff/n_unmasked)
+    # Azimuthal padding is periodic. Padded bins in the radial dimension are treated as masked.
+    azi_indices = np.arange(-n_half, n_azi+n_half) % n_azi
+    phi_padded = np.zeros((n_azi+2*n_half, n_rad+2*w_max), dtype)
+    phi_padded[:, w_max:w_max+n_rad] = phi[azi_indices]
+    unmasked_padded = np.zeros(phi_padded.shape, 'bool')
+    unmasked_padded[:, w_max:w_max+n_rad] = ~data_mask[azi_indices]
+    
+    diff, _diff, _diff2 = np.zeros_like(phi_ref), np.empty_like(phi_ref), np.empty_like(phi_ref)
+    for i in range(-n_half, n_half+1):
+        for j in range(-window[n_half+i], window[n_half+i]+1):
+            s = np.s_[n_half+i:n_half+i+n_azi, w_max+j:w_max+j+n_rad]
+            np.subtract(phi_ref, phi_padded[s], out=_diff)
+            np.abs(_diff, out=_diff)
+            np.subtract(2*np.pi, _diff, out=_diff2)
+            np.minimum(_diff, _diff2, out=_diff)
+            np.square(_diff, out=_diff)
+            np.add(diff, _diff, out=diff, where=unmasked_padded[s])
+    diff /= np.maximum(n_unmasked, 1)
+    return np.sqrt(diff, out=diff)
   
 def get_speckle_mask(data_mask):
     # Returns True when a non-masked radar bin is completely surrounded by masked radar bins (in all 8 neighbouring bins)
@@ -1030,4 +1214,43 @@ def get_window_indices(i, window, shape, periodic = 'rows'):
         cols_window[cols_window >= shape[1]] = shape[1]-1
     if periodic in (None, 'cols'):
         rows_window[rows_window >= shape[0]] = shape[0]-1
-    return rows_window, cols_window
\ No newline at end of file
+    return rows_window, cols_window
+
+# Maximum number of radar bins that get_grid_max_and_mean_dBZ processes at once, to limit the memory that is used for intermediate arrays.
+# Use None for no limit.
+grid_mapping_chunk_size = 2**22
+
+def get_grid_max_and_mean_dBZ(Z, indices, length, calculate_max=True, chunk_size=None):
+    """For flat arrays Z (reflectivity in dBZ) and indices (for each element of Z the index of the grid cell onto which it is mapped, in a 
+    flat grid with length grid cells), returns for each grid cell the maximum reflectivity, the average reflectivity and the number of 
+    elements that are mapped onto it. The average is calculated from linear reflectivities, i.e. Zavg = 10*log10(mean(10**(0.1*Z))).
+    Elements with a NaN reflectivity or with an index >= length are not included. Zmax and Zavg are NaN for grid cells onto which no
+    elements are mapped, and Zmax is None when not calculate_max.
+    
+    Sums and counts are obtained with np.bincount and maxima with np.maximum.at, in chunks of chunk_size elements (default
+    grid_mapping_chunk_size). For grid cells with a single element, Zavg is set equal to that element, without conversion to linear
+    reflectivity and back.
+    """
+    chunk_size = chunk_size or grid_mapping_chunk_size or len(Z)
+    counts = np.zeros(length, dtype='int64')
+    Zsum = np.zeros(length, dtype='float64')
+    # Contains the maximum when calculate_max, and otherwise the last element that is mapped onto a grid cell. Either is equal to 
+    # the only element for grid cells with a single element.
+    Zmax = np.full(length, -np.inf if calculate_max else np.nan, dtype='float32')
+    for k in range(0, len(Z), chunk_size):
+        z, i = Z[k:k+chunk_size], indices[k:k+chunk_size]
+        retain = (i < length) & ~np.isnan(z)
+        z, i = z[retain].astype('float32', copy=False), i[retain].astype(np.intp, copy=False)
+        counts += np.bincount(i, minlength=length)
+        Zsum += np.bincount(i, np.power(np.float32(10.), np.float32(0.1)*z), minlength=length)
+        if calculate_max:
+            np.maximum.at(Zmax, i, z)
+        else:
+            Zmax[i] = z
+    empty = counts == 0
+    Zmax[empty] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Zavg = (10.*np.log10(Zsum/counts)).astype('float32')
+    single = counts == 1
+    Zavg[single] = Zmax[single]
+    return (Zmax if calculate_max else None), Zavg, counts
@@ -4,6 +4,9 @@
 import os
 opa=os.path.abspath
 import re
+import io
+import json
+import sqlite3
 import h5py
 import xmltodict
 import zlib
@@ -11,9 +14,11 @@ import numpy as np
 from collections import OrderedDict
 import copy #Important: Is used with exec, and therefore listed as unused!
 import time as pytime
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import datetime as dtime
 import netCDF4 as nc
-from scipy.interpolate import interp1d
 import warnings
 
 from numpy_bufr import decode_bufr
@@ -21,9 +26,8 @@ from numpy_bufr import decode_bufr
 import nlr_background as bg
 import nlr_functions as ft
 import nlr_globalvars as gv
-from dealiasing import nlr_dealiasing as da
 from derived import nlr_derived_tilts as dt
-from decoders.nexrad_l2 import NEXRADLevel2File
+from decoders.nexrad_l2 import NEXRADLevel2File, NEXRADLevel2MetaIndex, decompress_into_cache
 from decoders.nexrad_l3 import NEXRADLevel3File
 from decoders.dorade import DORADEFile
 from decoders.ukmo_polar import UKMOPolarFile
@@ -68,17 +72,13 @@ def process_azis_array(azis, da, calc_azi_offset, azi_pos='center'):
         azi_offset = np.mean([ft.angle_diff(0.5*da, (azis[i]+offset) % da) for i in range(n_azi)])
     return azis, n_azi, da, azi_offset, diffs
 
-ij_map = ref_azi_offset = None
-input_before = {j:None for j in ('n_azi', 'azis', 'diffs', 'da', 'azi_offset', 'azi_pos')}
+# Index maps calculated by get_regular_grid_map, with keys as given in map_onto_regular_grid. Several maps are kept, since panels with
+# different scans (that usually have different azimuths) are imported alternately.
+regular_grid_maps = OrderedDict()
+regular_grid_maps_max_size = 32
+# map_onto_regular_grid can be called from several threads by read_scans_concurrently
+regular_grid_maps_lock = threading.Lock()
 def map_onto_regular_grid(data, n_azi, azis, diffs, da, azi_offset, azi_pos='center'):
-    global ij_map, ref_azi_offset, input_before
-    args = locals()
-    _input = {k:(args[k].tolist() if type(args[k]) is np.ndarray else args[k]) for k in input_before}
-    if _input == input_before:
-        data = data[ij_map]
-        data[ij_map == -1] = np.nan
-        return data, ref_azi_offset
-    
     # azi_pos ('center'/'left') specifies whether the azimuth values are given for the center of a radial, or for the left edge
     """Map the data onto a regular grid with constant azimuthal spacing. The azimuthal resolution of the grid is set such that
     the positional error (defined as the difference in actual position of an edge of a radial, and the position of that edge on 
@@ -89,12 +89,41 @@ def map_onto_regular_grid(data, n_azi, azis, diffs, da, azi_offset, azi_pos='cen
     (proportional to its width) in the remapped array. These width variations are reduced by removing them if that doesn't
     increase the positional error by too much.
     """
+    # Rounding to 1e-4 degrees has no noticeable effect on the index map (see max_error in get_regular_grid_map)
+    key = (n_azi, np.round(azis, 4).tobytes(), np.round(diffs, 4).tobytes(), round(float(da), 6), round(float(azi_offset), 6), azi_pos)
+    with regular_grid_maps_lock:
+        grid_map = regular_grid_maps.get(key, None)
+        if grid_map:
+            regular_grid_maps.move_to_end(key)
+    if grid_map:
+        ij_map, missing, ref_azi_offset = grid_map
+    else:
+        ij_map, ref_azi_offset = get_regular_grid_map(n_azi, azis, diffs, da, azi_offset, azi_pos)
+        missing = ij_map == -1
+        # None when there are no missing radials
+        missing = missing if missing.any() else None
+        with regular_grid_maps_lock:
+            regular_grid_maps[key] = (ij_map, missing, ref_azi_offset)
+            if len(regular_grid_maps) > regular_grid_maps_max_size:
+                regular_grid_maps.popitem(last=False)
+            
+    data = data[ij_map]
+    if not missing is None:
+        data[missing] = np.nan
+    return data, ref_azi_offset
+    
+def get_regular_grid_map(n_azi, azis, diffs, da, azi_offset, azi_pos):
+    # Returns the index map ij_map for map_onto_regular_grid, where ij_map[i] is the index of the radial in data that is mapped onto
+    # radial i of the regular grid, and -1 for missing radials.
     azis %= 360 # It can apparently happen for old NEXRAD L3 data that values above 360 exist
     
     i_min, i_max = azis.argmin(), azis.argmax()
     x = np.append(azis, [azis[i_min]+360, azis[i_max]-360])
-    y = np.append(np.arange(n_azi, dtype='float64'), [i_min, i_max])
-    f = interp1d(x, y, kind='nearest')
+    y = np.append(np.arange(n_azi), [i_min, i_max]).astype('int16')
+    # Nearest neighbour interpolation with x_bounds halfway between the sorted x values. In case of a tie the lower neighbour is chosen.
+    i_sort = np.argsort(x, kind='mergesort')
+    x, y = x[i_sort], y[i_sort]
+    x_bounds = x[1:]/2 + x[:-1]/2
     max_error = 0.05
     max_error_width_correction = 4/3*max_error
     
@@ -109,7 +138,7 @@ def map_onto_regular_grid(data, n_azi, azis, diffs, da, azi_offset, azi_pos='cen
         
         diff_offset_fac = 1. if azi_pos == 'left' else 0.5
 
-        ij_map = np.array([int(j) for j in f(ref_azis)], dtype='int16')
+        ij_map = y[np.searchsorted(x_bounds, ref_azis).clip(0, len(x)-1)]
         ref_diffs = ft.angle_diff(azis[ij_map], ref_azis)
         if azi_pos == 'left':
             # For azi_pos == 'left' the nearest neighbor interpolation above results in an average azimuth offset of -0.5*da. 
@@ -139,39 +168,139 @@ def map_onto_regular_grid(data, n_azi, azis, diffs, da, azi_offset, azi_pos='cen
     
     if k > 1:
         j_repeats = np.bincount(ij_map[ij_map != -1])
-        j_repeats_notk = {j:n for j,n in enumerate(j_repeats) if n not in (k, 0)} # Also not 0, otherwise calling np.where below doesn't give a hit
-        keys, vals = list(j_repeats_notk), list(j_repeats_notk.values())
+        # Also not 0, since these radials are absent in ij_map
+        keys = np.nonzero((j_repeats != k) & (j_repeats != 0))[0]
+        vals = j_repeats[keys]
         """These are pairs of indices for radials that are not repeated the expected # of k times in the remapped array. The radials contained
         within the azimuthal range spanned by each pair of radials will be checked for whether their positional error won't increase by too much
         in case that the width variation is removed (smoothed away). 
-        Also couple the first and last radial, hence loop over the full range of len(keys).
+        Also couple the first and last radial, hence np.roll.
         Only include radial pairs with different # of repetitions, since in the case of an equal number the width variation can't be smoothed away.
         """
-        pairs = {keys[i-1]:keys[i] for i in range(len(keys)) if vals[i-1] != vals[i]}
-        
-        angle_diff_left = ft.angle_diff(azis_left, ref_azis-0.5*ref_da)
-        angle_diff_right = ft.angle_diff(azis_right, ref_azis+0.5*ref_da)
-        remove = []
-        for j1,j2 in (_ for _ in pairs.items() if not _[0] in remove):
-            sign = np.sign(j_repeats_notk[j2]-j_repeats_notk[j1])
-            r = np.arange(j1, j2+(j2 < j1)*n_azi) % n_azi
-            if sign == -1:
-                max_error_exceeded = np.min(angle_diff_left[r] - ref_da) < -max_error_width_correction
-            else:
-                max_error_exceeded = np.max(angle_diff_right[r] + ref_da) > max_error_width_correction
-            if not max_error_exceeded:
-                i1 = np.where(ij_map == j1)[0][-1]
-                i2 = np.where(ij_map == j2)[0][0]
-                idx1 = np.arange(i1, i2+(i2 < i1)*ref_n_azi) + (sign == 1)
-                idx2 = idx1-sign
-                ij_map[idx1 % ref_n_azi] = ij_map[idx2 % ref_n_azi]
-                remove.append(j2)
-    
-    data = data[ij_map]
-    data[ij_map == -1] = np.nan
-    input_before = _input
-    return data, ref_azi_offset
+        select = vals != np.roll(vals, 1)
+        j1, j2 = np.roll(keys, 1)[select], keys[select]
+        sign = np.sign(vals[select]-np.roll(vals, 1)[select])
+        if len(j1):
+            angle_diff_left = ft.angle_diff(azis_left, ref_azis-0.5*ref_da)[:n_azi]
+            angle_diff_right = ft.angle_diff(azis_right, ref_azis+0.5*ref_da)[:n_azi]
+            # Minimum/maximum over the range of radials from j1 to j2, which can wrap around. Arrays are therefore repeated, and the range
+            # ends are included in the indices for reduceat. The appended element ensures that the last index is within bounds.
+            r = np.column_stack([j1, j2+(j2 < j1)*n_azi]).ravel()
+            min_left = np.minimum.reduceat(np.concatenate([angle_diff_left]*2+[[0]]), r)[::2]
+            max_right = np.maximum.reduceat(np.concatenate([angle_diff_right]*2+[[0]]), r)[::2]
+            max_error_exceeded = np.where(sign == -1, min_left-ref_da < -max_error_width_correction, 
+                                          max_right+ref_da > max_error_width_correction)
+            
+            # Width variations are not removed for a pair when they have been removed for the preceding pair that ends with its first radial
+            remove = set()
+            apply = []
+            for i in range(len(j1)):
+                apply.append(not max_error_exceeded[i] and not j1[i] in remove)
+                if apply[-1]:
+                    remove.add(j2[i])
+            j1, j2, sign = j1[apply], j2[apply], sign[apply]
+            
+            # Index of the last occurrence of j1 and the first occurrence of j2 in ij_map
+            i_map = np.arange(ref_n_azi)
+            valid = ij_map != -1
+            i_last, i_first = np.full(len(j_repeats), -1), np.full(len(j_repeats), ref_n_azi)
+            np.maximum.at(i_last, ij_map[valid], i_map[valid])
+            np.minimum.at(i_first, ij_map[valid], i_map[valid])
+            i1, i2 = i_last[j1], i_first[j2]
+            # The ranges from i1 to i2 don't overlap, so shifts can be applied for all pairs at once
+            n = i2+(i2 < i1)*ref_n_azi-i1
+            idx1 = np.arange(n.sum())-np.repeat(np.cumsum(n)-n, n)+np.repeat(i1+(sign == 1), n)
+            idx2 = idx1-np.repeat(sign, n)
+            ij_map[idx1 % ref_n_azi] = ij_map[idx2 % ref_n_azi]
+    return ij_map, ref_azi_offset
+
+
+
+# Number of threads that read_scans_concurrently uses. Scans are read sequentially when set to 1.
+multiple_scans_workers = min(4, os.cpu_count() or 1)
+multiple_scans_executor = None
+def read_scans_concurrently(function, scans):
+    """Calls function(j) for each scan j in scans, and returns a dictionary with the results. Is used in the get_data_multiple_scans
+    functions of the classes below, where function reads, scales and possibly dealiases the data for scan j (including its duplicates).
+    Calls are distributed over a pool of threads. This is sufficient since most time is spent in numpy operations, decompression 
+    and h5py reading, that release the GIL. A process pool can't be used, since function operates on the volume attributes of 
+    DataSource_General. This means that function should not modify shared state, other than the volume attributes for scan j.
+    Any exception is raised in the calling thread, just as when reading sequentially.
+    """
+    global multiple_scans_executor
+    # Calls from a worker thread of the pool are handled sequentially, since waiting for results from the same pool in a worker
+    # thread could lead to a deadlock.
+    nested = threading.current_thread().name.startswith('nlr_multiple_scans')
+    if multiple_scans_workers <= 1 or len(scans) <= 1 or nested:
+        return {j:function(j) for j in scans}
+    
+    if multiple_scans_executor is None:
+        multiple_scans_executor = ThreadPoolExecutor(max_workers=multiple_scans_workers, thread_name_prefix='nlr_multiple_scans')
+    futures = {j:multiple_scans_executor.submit(function, j) for j in scans}
+    return {j:future.result() for j,future in futures.items()}
+
+
+
+class HDF5FilePool():
+    """Bounded pool of opened HDF5 files, to prevent that a file gets opened (and its metadata parsed) again for each panel, scan and
+    product that is read from it. Files are keyed by path, modification time and size, such that a file that gets rewritten is opened 
+    again. When more than max_files files are open, the least recently used file is closed, unless it's still in use (in which case 
+    it gets closed when released).
+    For each file also an index is kept, that can be used for storing information that is obtained from the file structure (like the
+    dataset path for each product), such that this needs to be determined only once per file.
+    """
+    def __init__(self, max_files=8):
+        self.max_files = max_files
+        # Values are dictionaries with keys 'file', 'index' and 'n_users'
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+        
+    def key(self, filepath):
+        stat = os.stat(filepath)
+        return (opa(filepath), stat.st_mtime_ns, stat.st_size)
+    
+    @contextmanager
+    def open(self, filepath):
+        """Use as 'with hdf5_files.open(filepath) as hf:'. The file is not closed at the end of the with statement, but remains open
+        in the pool."""
+        key = self.key(filepath)
+        with self.lock:
+            entry = self.files.get(key, None)
+            if entry is None:
+                entry = self.files[key] = {'file':h5py.File(filepath, 'r'), 'index':{}, 'n_users':0}
+            self.files.move_to_end(key)
+            entry['n_users'] += 1
+            self.close_unused()
+        try:
+            yield entry['file']
+        finally:
+            with self.lock:
+                entry['n_users'] -= 1
+                self.close_unused()
+                
+    def index(self, hf):
+        # Returns the index for file hf, or an empty dictionary when hf is not in the pool
+        with self.lock:
+            for entry in self.files.values():
+                if entry['file'] is hf:
+                    return entry['index']
+        return {}
+                    
+    def close_unused(self, n_keep=None):
+        # Should be called with self.lock acquired
+        n_close = len(self.files)-(self.max_files if n_keep is None else n_keep)
+        for key in [k for k,entry in self.files.items() if entry['n_users'] == 0][:max(n_close, 0)]:
+            try:
+                self.files.pop(key)['file'].close()
+            except Exception as e:
+                print(e, 'HDF5FilePool.close_unused')
+                
+    def close_all(self):
+        # Closes all files that are not in use
+        with self.lock:
+            self.close_unused(n_keep=0)
 
+hdf5_files = HDF5FilePool()
 
 
 
@@ -250,12 +379,12 @@ class Leonardo_vol_rainbow3():
         data_mask = self.dsg.data[j]<=self.dsg.data[j].min()
         if i_p == 'v':
             if self.crd.apply_dealiasing[j] and not self.dsg.low_nyquist_velocities_all_mps[self.crd.scans[j]] is None:
-                self.dsg.data[j] = self.dealias_velocity(self.dsg.data[j], data_mask, self.crd.scans[j])
+                self.dsg.data[j] = self.dealias_velocity(filepath, self.dsg.data[j], data_mask, self.crd.scans[j])
                 
         self.dsg.data[j][data_mask]=self.pb.mask_values[product]
             
             
-    def dealias_velocity(self, data, data_mask, scan):
+    def dealias_velocity(self, filepath, data, data_mask, scan):
         """Important: The KMI seems to use two PRFs per radial, seems to correct velocities using the lower Nyquist velocity. Both vn_l and vn_h in apply_dual_prf_dealiasing are therefore set to vn_l.
         Further, for Jabbeke the dual PRF errors can be all multiples of the low Nyquist velocity, and not only even multiples. Hence multiplication of vn_l by 0.5.
         """
@@ -263,7 +392,7 @@ class Leonardo_vol_rainbow3():
         radial_res = self.dsg.radial_res_all['v'][scan]
         window_size = [2, 2, 2]
         n_it = 1 if self.gui.vwp.updating_vwp else self.gui.dealiasing_dualprf_n_it
-        return da.apply_dual_prf_dealiasing(data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan],\
+        return self.dsg.apply_dual_prf_dealiasing(filepath, scan, data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan],\
         vn_l, vn_l, None, window_detection = window_size, window_correction = window_size, n_it = n_it) 
         #The first azimuth is scanned with a high PRF
 
@@ -296,7 +425,7 @@ class Leonardo_vol_rainbow3():
                 data_mask = data[j]<=data[j].min()
                 if i_p == 'v':
                     if apply_dealiasing[j] and not self.dsg.low_nyquist_velocities_all_mps[j] is None:
-                        data[j] = self.dealias_velocity(data[j], data_mask, j)
+                        data[j] = self.dealias_velocity(filepath, data[j], data_mask, j)
                 data[j][data_mask]=np.nan
                 data[j] = [data[j]]
         
@@ -318,6 +447,104 @@ class Leonardo_vol_rainbow3():
 
 
 
+class Rainbow5FileIndex():
+    """Index of the content of Rainbow5 .vol files, that contains the parsed XML header (with the parameter dictionaries for all slices)
+    and for each blob its byte offset, size and compression. With it only the blobs that are needed get read from the file, instead of 
+    searching through the complete file content and parsing the XML header each time that a scan is requested.
+    Indices are kept in memory for the max_files most recently used files, and are also stored in an SQLite database. Entries are keyed
+    by directory and filename, and are only used when the size and modification time of the file are unchanged.
+    """
+    def __init__(self, db_filename, max_files=32):
+        self.db_filename = db_filename
+        self.max_files = max_files
+        self.indices = OrderedDict()
+        self.connection = None
+        self.lock = threading.Lock()
+        
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.db_filename), exist_ok=True)
+            self.connection = sqlite3.connect(self.db_filename, check_same_thread=False)
+            self.connection.execute("CREATE TABLE IF NOT EXISTS file_index (directory TEXT, filename TEXT, size INTEGER, "
+                                    "mtime_ns INTEGER, file_index TEXT, PRIMARY KEY (directory, filename))")
+        return self.connection
+    
+    def key(self, filepath):
+        stat = os.stat(filepath)
+        filepath = opa(filepath)
+        return (os.path.dirname(filepath), os.path.basename(filepath), stat.st_size, stat.st_mtime_ns)
+        
+    def get(self, filepath):
+        key = self.key(filepath)
+        with self.lock:
+            file_index = self.indices.get(key, None)
+            if file_index:
+                self.indices.move_to_end(key)
+                return file_index
+            try:
+                row = self.connect().execute("SELECT file_index FROM file_index WHERE directory=? AND filename=? AND size=? "
+                                             "AND mtime_ns=?", key).fetchone()
+                file_index = None if row is None else json.loads(row[0])
+            except (sqlite3.Error, ValueError) as e:
+                print(e, 'Rainbow5FileIndex.get')
+                
+        if file_index is None:
+            file_index = self.create_index(filepath)
+            try:
+                with self.lock:
+                    with self.connect() as connection: # Commits the transaction
+                        connection.execute("INSERT OR REPLACE INTO file_index VALUES (?, ?, ?, ?, ?)", key+(json.dumps(file_index),))
+            except sqlite3.Error as e:
+                print(e, 'Rainbow5FileIndex.put')
+                
+        with self.lock:
+            self.indices[key] = file_index
+            while len(self.indices) > self.max_files:
+                self.indices.popitem(last=False)
+        return file_index
+        
+    def create_index(self, filepath):
+        with open(filepath, 'rb') as vol:
+            content = vol.read()
+        
+        vol = io.BytesIO(content)
+        endXMLmarker = b"<!-- END XML -->"
+        header = b""
+        line = b""
+        while not line.startswith(endXMLmarker):
+            header += line[:-1]
+            line = vol.readline()
+            if len(line) == 0:
+                break
+        xml_dict = xmltodict.parse(header,dict_constructor=dict)
+        # Older versions of the vol format don't provide the 'multitripprfmode' attribute, is e.g. the case for the Wideumont radar. 
+        # In that case assume a default value of 'single', which at least works for Wideumont.
+        file_index = {'slices':xml_dict['volume']['scan']['slice'],
+                      'multitripprfmode':xml_dict['volume']['scan'].get('pargroup', {}).get('multitripprfmode', 'single'),
+                      'blobs':{}}
+        
+        # The blobs follow each other, and the data of a blob is skipped when searching for the next one, since the (compressed) data
+        # could contain the search string
+        pos = vol.tell()
+        while True:
+            start = content.find(b'<BLOB ', pos)
+            end = content.find(b'>', start)
+            if start == -1 or end == -1:
+                break
+            attrs = dict(re.findall(rb'(\w+)="([^"]*)"', content[start:end]))
+            if not b'blobid' in attrs or not b'size' in attrs:
+                break
+            size = int(attrs[b'size'])
+            # The blob data starts after the '>' and a newline character
+            file_index['blobs'][attrs[b'blobid'].decode()] = [end+2, size, attrs.get(b'compression', b'').decode()]
+            pos = end+2+size
+        return file_index
+
+rainbow5_file_index = Rainbow5FileIndex(opa(gv.programdir+'/Generated_files/rainbow5_file_index.sqlite'))
+    
+    
+    
+
 class Leonardo_vol_rainbow5():
     def __init__(self, gui_class, dsg_class, parent = None):  
         self.gui=gui_class
@@ -325,83 +552,54 @@ class Leonardo_vol_rainbow5():
         self.crd=self.dsg.crd
         self.pb = self.gui.pb
         
-        self.filepath = None #Is only used in self.get_parameter_dicts to determine whether the parameter dicts need to be updated
-        self.parameter_dicts={}
+        self.filepath = None #Is used in self.dealias_velocity
         
         
 
-    def get_parameter_dicts(self,vol,product,productunfiltered):
-        """Returns a dictionary with the relevant parameters like productdate, blobid, datadepth, product minimum, product maximum, the number of azimuths
-        and some information required for obtaining the starting azimuth.
+    def get_parameter_dicts(self,filepath):
+        """Returns a list with for each slice (scan) a dictionary with the relevant parameters like productdate, blobid, datadepth, product minimum, 
+        product maximum, the number of azimuths and some information required for obtaining the starting azimuth.
+        Separate files are used for filtered and unfiltered product variants, and some of the important parameters can vary between them (for 
+        example the data depth for phidp for Helchteren). Parameter dicts are therefore obtained per file.
         """        
-        #Determine different parameter dicts for filtered and unfiltered product variants, because I've observed that some of the 
-        #important parameters can vary between the filtered and unfiltered product, for example the data depth for phidp for Helchteren.
-        if productunfiltered:
-            product = 'u'+product
-            
-        if product in self.parameter_dicts and self.parameter_dicts[product]['filepath']==self.filepath:
-            parameter_dicts=self.parameter_dicts[product]['dict']
-        else:  
-            endXMLmarker = b"<!-- END XML -->"
-            header = b""
-            line = b""
-            while not line.startswith(endXMLmarker):
-                header += line[:-1]
-                line = vol.readline()
-                if len(line) == 0:
-                    break
-            xml_dict=xmltodict.parse(header,dict_constructor=dict)
-            parameter_dicts=xml_dict['volume']['scan']['slice']
-            self.parameter_dicts[product]={}
-            self.parameter_dicts[product]['dict']=parameter_dicts
-            self.parameter_dicts[product]['filepath']=self.filepath
-            if product == 'v':
-                # This parameter is used in dealias_velocity. Older versions of the vol format don't provide the 'multitripprfmode' attribute,
-                # is e.g. the case for the Wideumont radar. In that case assume a default value of 'single', which at least works for Wideumont.         
-                self.parameter_dicts[product]['multitripprfmode'] = xml_dict['volume']['scan'].get('pargroup', {}).get('multitripprfmode', 'single')               
-
-        return parameter_dicts
+        return rainbow5_file_index.get(filepath)['slices']
 
 
     def get_scans_information(self,filepath,product):
-        i_p = gv.i_p[product]
-        self.filepath = filepath
-        
-        with open(filepath,'rb') as vol:
-            parameter_dicts=self.get_parameter_dicts(vol,i_p,productunfiltered=False)
-            n_dicts=len(parameter_dicts)
-            
-            #There is no need to check whether it is necessary to update the attributes, because for these .vol files obtaining them takes only
-            #a very small amount of time.
-            for j in range(1,n_dicts+1):
-                subdict=parameter_dicts[j-1]
-                self.dsg.scanangles_all['z'][j]=float(subdict['posangle'])
-                try:
-                    self.dsg.nyquist_velocities_all_mps[j]=float(subdict['dynv']['@max']) #Is available for all products
-                except Exception:
-                    self.dsg.nyquist_velocities_all_mps[j] = None
-                    if product == 'v':
-                        #For data from Wideumont for some older days before 2015 the Nyquist velocities are located under the key 
-                        #'rawdata' instead of 'dynv'.
-                        self.dsg.nyquist_velocities_all_mps[j]=float(subdict['slicedata']['rawdata']['@max']) #Is available for all products
-                for i in range(j - 1, -1, -1):
-                    try:
-                        prf_l = float(parameter_dicts[i]['lowprf'])
-                        break
-                    except Exception:
-                        continue
-                radar_wavelength = 5.3 * 1e-2
-                self.dsg.low_nyquist_velocities_all_mps[j] = self.dsg.high_nyquist_velocities_all_mps[j] = None if prf_l == 0.0 else radar_wavelength*prf_l/4.
-                    
-                self.dsg.radial_bins_all['z'][j]=int(subdict['slicedata']['rawdata']['@bins'])
+        parameter_dicts=self.get_parameter_dicts(filepath)
+        n_dicts=len(parameter_dicts)
+        
+        #There is no need to check whether it is necessary to update the attributes, because for these .vol files obtaining them takes only
+        #a very small amount of time.
+        for j in range(1,n_dicts+1):
+            subdict=parameter_dicts[j-1]
+            self.dsg.scanangles_all['z'][j]=float(subdict['posangle'])
+            try:
+                self.dsg.nyquist_velocities_all_mps[j]=float(subdict['dynv']['@max']) #Is available for all products
+            except Exception:
+                self.dsg.nyquist_velocities_all_mps[j] = None
+                if product == 'v':
+                    #For data from Wideumont for some older days before 2015 the Nyquist velocities are located under the key 
+                    #'rawdata' instead of 'dynv'.
+                    self.dsg.nyquist_velocities_all_mps[j]=float(subdict['slicedata']['rawdata']['@max']) #Is available for all products
+            for i in range(j - 1, -1, -1):
                 try:
-                    self.dsg.radial_res_all['z'][j]=float(subdict['rangestep'])
+                    prf_l = float(parameter_dicts[i]['lowprf'])
+                    break
                 except Exception:
-                    #Also because of a change in the data format for data from Wideumont. The range step is only listed for the 
-                    #first scan.
-                    self.dsg.radial_res_all['z'][j]=self.dsg.radial_res_all['z'][j-1]
-                self.dsg.scannumbers_all['z'][j]=[j]
+                    continue
+            radar_wavelength = 5.3 * 1e-2
+            self.dsg.low_nyquist_velocities_all_mps[j] = self.dsg.high_nyquist_velocities_all_mps[j] = None if prf_l == 0.0 else radar_wavelength*prf_l/4.
                 
+            self.dsg.radial_bins_all['z'][j]=int(subdict['slicedata']['rawdata']['@bins'])
+            try:
+                self.dsg.radial_res_all['z'][j]=float(subdict['rangestep'])
+            except Exception:
+                #Also because of a change in the data format for data from Wideumont. The range step is only listed for the 
+                #first scan.
+                self.dsg.radial_res_all['z'][j]=self.dsg.radial_res_all['z'][j-1]
+            self.dsg.scannumbers_all['z'][j]=[j]
+            
         if self.crd.radar == 'Zaventem':
             # See ODIM_hdf5.get_scans_information for explanation
             self.dsg.scanangles_all['z'] = {j:0.5 if a <= 0.6 else a for j,a in self.dsg.scanangles_all['z'].items()}
@@ -418,39 +616,36 @@ class Leonardo_vol_rainbow5():
         self.filepath = filepath
         product, i_p = self.crd.products[j], gv.i_p[self.crd.products[j]]
         scan=self.dsg.scannumbers_all[i_p][self.crd.scans[j]][self.dsg.scannumbers_forduplicates[self.crd.scans[j]]]
-        with open(filepath,'rb') as vol:
-            volreader=vol.read()
-            vol.seek(0)
-            parameter_dicts=self.get_parameter_dicts(vol,i_p,productunfiltered=self.crd.using_unfilteredproduct[j])
-            subdict=parameter_dicts[scan-1]
-            self.dsg.scantimes[j] = self.get_scan_timerange(parameter_dicts,scan)
-    
-            blobid=int(subdict['slicedata']['rawdata']['@blobid'])
-            datadepth=int(subdict['slicedata']['rawdata']['@depth'])
-            data_min=float(subdict['slicedata']['rawdata']['@min'])
-            data_max=float(subdict['slicedata']['rawdata']['@max'])
-            blobid_startangle=int(ft.from_list_or_nolist(subdict['slicedata']['rayinfo'])['@blobid'])
-            datadepth_startangle=int(ft.from_list_or_nolist(subdict['slicedata']['rayinfo'])['@depth'])
-            start_azimuth=self.extract_data(volreader,blobid_startangle,datadepth_startangle)[0]*(360/(2**datadepth_startangle-1)) 
-            #The azimuth at which the radars starts the scan. The data is shifted by int(np.floor(start_azimuth)), to put it at the correct position
-            #with a maximum deviation of 0.5 degrees.
-            dims = (int(subdict['slicedata']['rawdata']['@rays']),self.dsg.radial_bins_all['z'][scan])
+        parameter_dicts=self.get_parameter_dicts(filepath)
+        subdict=parameter_dicts[scan-1]
+        self.dsg.scantimes[j] = self.get_scan_timerange(parameter_dicts,scan)
+    
+        blobid=int(subdict['slicedata']['rawdata']['@blobid'])
+        datadepth=int(subdict['slicedata']['rawdata']['@depth'])
+        data_min=float(subdict['slicedata']['rawdata']['@min'])
+        data_max=float(subdict['slicedata']['rawdata']['@max'])
+        blobid_startangle=int(ft.from_list_or_nolist(subdict['slicedata']['rayinfo'])['@blobid'])
+        datadepth_startangle=int(ft.from_list_or_nolist(subdict['slicedata']['rayinfo'])['@depth'])
+        start_azimuth=self.extract_data(filepath,blobid_startangle,datadepth_startangle)[0]*(360/(2**datadepth_startangle-1)) 
+        #The azimuth at which the radars starts the scan. The data is shifted by int(np.floor(start_azimuth)), to put it at the correct position
+        #with a maximum deviation of 0.5 degrees.
+        dims = (int(subdict['slicedata']['rawdata']['@rays']),self.dsg.radial_bins_all['z'][scan])
+        
+        self.dsg.data[j]=(np.reshape(self.extract_data(filepath,blobid,datadepth),dims)*((data_max-data_min)/(2**datadepth-1))+data_min)
+        if product == 'c': self.dsg.data[j] *= 100.
+        self.dsg.data[j] = np.roll(self.dsg.data[j][:360],int(np.round(start_azimuth)),axis=0)
             
-            self.dsg.data[j]=(np.reshape(self.extract_data(volreader,blobid,datadepth),dims)*((data_max-data_min)/(2**datadepth-1))+data_min)
-            if product == 'c': self.dsg.data[j] *= 100.
-            self.dsg.data[j] = np.roll(self.dsg.data[j][:360],int(np.round(start_azimuth)),axis=0)
+        data_mask = self.dsg.data[j]<=self.dsg.data[j].min()
+        if i_p == 'v':
+            if self.crd.apply_dealiasing[j] and not self.dsg.low_nyquist_velocities_all_mps[self.crd.scans[j]] is None:
+                productunfiltered = self.crd.using_unfilteredproduct[j]
+                polarization = 'V' if self.crd.using_verticalpolarization[j] == 'V' else 'H'
+                self.dsg.data[j] = self.dealias_velocity(filepath, self.dsg.data[j], data_mask, productunfiltered, polarization, self.crd.scans[j])
                 
-            data_mask = self.dsg.data[j]<=self.dsg.data[j].min()
-            if i_p == 'v':
-                if self.crd.apply_dealiasing[j] and not self.dsg.low_nyquist_velocities_all_mps[self.crd.scans[j]] is None:
-                    productunfiltered = self.crd.using_unfilteredproduct[j]
-                    polarization = 'V' if self.crd.using_verticalpolarization[j] == 'V' else 'H'
-                    self.dsg.data[j] = self.dealias_velocity(self.dsg.data[j], data_mask, productunfiltered, polarization, self.crd.scans[j])
-                    
-            self.dsg.data[j][data_mask]=self.pb.mask_values[product]
-            
-            
-    def dealias_velocity(self, data, data_mask, productunfiltered, polarization, scan, max_range = None):
+        self.dsg.data[j][data_mask]=self.pb.mask_values[product]
+        
+        
+    def dealias_velocity(self, filepath, data, data_mask, productunfiltered, polarization, scan, max_range = None):
         vn_l = self.dsg.low_nyquist_velocities_all_mps[scan]
         """Important: The KMI seems to use two PRFs per radial, seems to correct velocities using the lower Nyquist velocity. Both vn_l and vn_h in apply_dual_prf_dealiasing are therefore set to vn_l.        
         Further, for Jabbeke the dual PRF errors can be all multiples of the low Nyquist velocity, and not only even multiples. Hence multiplication of vn_l by 0.5.
@@ -458,44 +653,41 @@ class Leonardo_vol_rainbow5():
         (and yes, the inconsistency in capitalisation of the 1st letter is correct)
         """
         deviation_factor = 1.
-        if self.parameter_dicts['v']['multitripprfmode'] == 'Off':
+        if rainbow5_file_index.get(filepath)['multitripprfmode'] == 'Off':
             vn_l *= 0.5
             deviation_factor = 1.33 #The maximum allowed velocity deviation is increased slightly, to reduce the smoothing of the velocity field a little.
         radial_res = self.dsg.radial_res_all['v'][scan]
         
         source = self.dsg.source_Leonardo
         # Specify source function, because in that case the product for which the filepath is valid is returned.
-        self.filepath, p = source.filepath('c', productunfiltered, polarization, source_function = source.get_scans_information)
+        filepath_c, p = source.filepath('c', productunfiltered, polarization, source_function = source.get_scans_information)
         
         if p != 'c':
             c_array = None
         else:
             #Import the correlation coefficients
-            with open(self.filepath,'rb') as vol:
-                volreader=vol.read()
-                vol.seek(0)
-                parameter_dicts=self.get_parameter_dicts(vol,'v',productunfiltered=False)
-                import_scan = self.dsg.scannumbers_all['v'][scan][self.dsg.scannumbers_forduplicates[scan]]
-                subdict=parameter_dicts[import_scan-1]
-    
-                blobid=int(subdict['slicedata']['rawdata']['@blobid'])
-                datadepth=int(subdict['slicedata']['rawdata']['@depth'])
-                data_min=float(subdict['slicedata']['rawdata']['@min'])
-                data_max=float(subdict['slicedata']['rawdata']['@max'])
-                blobid_startangle=int(ft.from_list_or_nolist(subdict['slicedata']['rayinfo'])['@blobid'])
-                datadepth_startangle=int(ft.from_list_or_nolist(subdict['slicedata']['rayinfo'])['@depth'])
-                                
-                start_azimuth=self.extract_data(volreader,blobid_startangle,datadepth_startangle)[0]*(360/(2**datadepth_startangle-1)) 
-                #The azimuth at which the radars starts the scan. The data is shifted by int(np.floor(start_azimuth)), to put it at the correct position
-                #with a maximum deviation of 0.5 degrees.
-                dims = (int(subdict['slicedata']['rawdata']['@rays']),self.dsg.radial_bins_all['z'][scan])
-                c_array = 100. * (np.reshape(self.extract_data(volreader,blobid,datadepth),dims)*((data_max-data_min)/(2**datadepth-1))+data_min)
-                s = np.s_[:] if max_range is None else np.s_[:, :int(np.ceil(ft.var1_to_var2(max_range, self.dsg.scanangles_all['v'][scan], 'gr+theta->sr') / self.dsg.radial_res_all['v'][scan]))]
-                c_array = np.roll(c_array[:360][s],int(np.round(start_azimuth)),axis=0)
+            parameter_dicts=self.get_parameter_dicts(filepath_c)
+            import_scan = self.dsg.scannumbers_all['v'][scan][self.dsg.scannumbers_forduplicates[scan]]
+            subdict=parameter_dicts[import_scan-1]
+    
+            blobid=int(subdict['slicedata']['rawdata']['@blobid'])
+            datadepth=int(subdict['slicedata']['rawdata']['@depth'])
+            data_min=float(subdict['slicedata']['rawdata']['@min'])
+            data_max=float(subdict['slicedata']['rawdata']['@max'])
+            blobid_startangle=int(ft.from_list_or_nolist(subdict['slicedata']['rayinfo'])['@blobid'])
+            datadepth_startangle=int(ft.from_list_or_nolist(subdict['slicedata']['rayinfo'])['@depth'])
+                            
+            start_azimuth=self.extract_data(filepath_c,blobid_startangle,datadepth_startangle)[0]*(360/(2**datadepth_startangle-1)) 
+            #The azimuth at which the radars starts the scan. The data is shifted by int(np.floor(start_azimuth)), to put it at the correct position
+            #with a maximum deviation of 0.5 degrees.
+            dims = (int(subdict['slicedata']['rawdata']['@rays']),self.dsg.radial_bins_all['z'][scan])
+            c_array = 100. * (np.reshape(self.extract_data(filepath_c,blobid,datadepth),dims)*((data_max-data_min)/(2**datadepth-1))+data_min)
+            s = np.s_[:] if max_range is None else np.s_[:, :int(np.ceil(ft.var1_to_var2(max_range, self.dsg.scanangles_all['v'][scan], 'gr+theta->sr') / self.dsg.radial_res_all['v'][scan]))]
+            c_array = np.roll(c_array[:360][s],int(np.round(start_azimuth)),axis=0)
         
         window_size = [2, 2, 2] if self.crd.radar != 'Zaventem' else None
         n_it = 1 if self.gui.vwp.updating_vwp else self.gui.dealiasing_dualprf_n_it
-        return da.apply_dual_prf_dealiasing(data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan],\
+        return self.dsg.apply_dual_prf_dealiasing(filepath, scan, data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan],\
         vn_l, vn_l, None, window_detection = window_size, window_correction = window_size, deviation_factor = deviation_factor, n_it = n_it,\
         c_array = c_array) #The first azimuth is scanned with a high PRF
                 
@@ -536,36 +728,37 @@ class Leonardo_vol_rainbow5():
         if isinstance(apply_dealiasing, bool):
             apply_dealiasing = {j: apply_dealiasing for j in scans}
         
-        data={}; scantimes={}       
-        with open(filepath,'rb') as vol:
-            volreader=vol.read()                                                                                
-            vol.seek(0)
-            parameter_dicts=self.get_parameter_dicts(vol,i_p,productunfiltered)
-            for j in scans: 
-                subdict=parameter_dicts[j-1]
-                scantimes[j] = [self.get_scan_timerange(parameter_dicts,j)]
-
-                blobid=int(subdict['slicedata']['rawdata']['@blobid'])
-                datawidth=int(subdict['slicedata']['rawdata']['@depth'])
-                data_min=float(subdict['slicedata']['rawdata']['@min'])
-                data_max=float(subdict['slicedata']['rawdata']['@max'])
-                blobid_startangle=int(ft.from_list_or_nolist(subdict['slicedata']['rayinfo'])['@blobid'])
-                datadepth_startangle=int(ft.from_list_or_nolist(subdict['slicedata']['rayinfo'])['@depth'])
-                n_radialbins=int(ft.from_list_or_nolist(subdict['slicedata']['rawdata'])['@bins'])
-                                
-                extracted_data=self.extract_data(volreader,blobid,datawidth)
-                n_azimuthalbins=int(len(extracted_data)/n_radialbins)
-                start_azimuth=self.extract_data(volreader,blobid_startangle,datadepth_startangle)[0]*(360/(2**datadepth_startangle-1))                
-                data[j]=((np.reshape(extracted_data,(n_azimuthalbins,n_radialbins))*(data_max-data_min)/(2**datawidth-1)+data_min)[:360]).astype('float32')
-                s = np.s_[:] if max_range is None else np.s_[:, :int(np.ceil(ft.var1_to_var2(max_range, self.dsg.scanangles_all[i_p][j], 'gr+theta->sr') / self.dsg.radial_res_all[i_p][j]))]
-                data[j]=np.roll(data[j][s],int(np.floor(start_azimuth)),axis=0)
-                
-                data_mask = data[j] <= data[j].min()
-                if i_p == 'v':
-                    if apply_dealiasing[j] and not self.dsg.low_nyquist_velocities_all_mps[j] is None:
-                        data[j] = self.dealias_velocity(data[j], data_mask, productunfiltered, polarization, j, max_range)
-                data[j][data_mask]=np.nan
-                data[j] = [data[j]]
+        parameter_dicts=self.get_parameter_dicts(filepath)
+        
+        def read_scan(j):
+            subdict=parameter_dicts[j-1]
+            scantime = self.get_scan_timerange(parameter_dicts,j)
+
+            blobid=int(subdict['slicedata']['rawdata']['@blobid'])
+            datawidth=int(subdict['slicedata']['rawdata']['@depth'])
+            data_min=float(subdict['slicedata']['rawdata']['@min'])
+            data_max=float(subdict['slicedata']['rawdata']['@max'])
+            blobid_startangle=int(ft.from_list_or_nolist(subdict['slicedata']['rayinfo'])['@blobid'])
+            datadepth_startangle=int(ft.from_list_or_nolist(subdict['slicedata']['rayinfo'])['@depth'])
+            n_radialbins=int(ft.from_list_or_nolist(subdict['slicedata']['rawdata'])['@bins'])
+                            
+            extracted_data=self.extract_data(filepath,blobid,datawidth)
+            n_azimuthalbins=int(len(extracted_data)/n_radialbins)
+            start_azimuth=self.extract_data(filepath,blobid_startangle,datadepth_startangle)[0]*(360/(2**datadepth_startangle-1))                
+            data_j=((np.reshape(extracted_data,(n_azimuthalbins,n_radialbins))*(data_max-data_min)/(2**datawidth-1)+data_min)[:360]).astype('float32')
+            s = np.s_[:] if max_range is None else np.s_[:, :int(np.ceil(ft.var1_to_var2(max_range, self.dsg.scanangles_all[i_p][j], 'gr+theta->sr') / self.dsg.radial_res_all[i_p][j]))]
+            data_j=np.roll(data_j[s],int(np.floor(start_azimuth)),axis=0)
+            
+            data_mask = data_j <= data_j.min()
+            if i_p == 'v':
+                if apply_dealiasing[j] and not self.dsg.low_nyquist_velocities_all_mps[j] is None:
+                    data_j = self.dealias_velocity(filepath, data_j, data_mask, productunfiltered, polarization, j, max_range)
+            data_j[data_mask]=np.nan
+            return [data_j], [scantime]
+        
+        results = read_scans_concurrently(read_scan, scans)
+        data = {j:results[j][0] for j in scans}
+        scantimes = {j:results[j][1] for j in scans}
 
         volume_starttime, volume_endtime = ft.get_start_and_end_volumetime_from_scantimes([i[0] for i in scantimes.values()])
         # No meta information with using_unfilteredproduct and using_verticalpolarization is returned here, because these should be determined 
@@ -573,22 +766,15 @@ class Leonardo_vol_rainbow5():
         return data, scantimes, volume_starttime, volume_endtime
                 
     
-    def extract_data(self,volreader,blobid,datadepth):
-        start=0
-        searchString = '<BLOB blobid="{0}"'.format(blobid)
-        start = volreader.find(searchString.encode(), start)
-        if start == -1:
+    def extract_data(self,filepath,blobid,datadepth):
+        # Only the blob itself is read from the file, at the position given by the file index
+        blobs = rainbow5_file_index.get(filepath)['blobs']
+        if not str(blobid) in blobs:
             raise EOFError('Blob ID {0} not found!'.format(blobid))
-        end = volreader.find(b'>', start)
-        xmlstring = volreader[start:end + 1]
-    
-        # cheat the xml parser by making xml well-known
-        xmldict = xmltodict.parse(xmlstring.decode() + '</BLOB>',dict_constructor=dict)
-        cmpr = xmldict['BLOB']['@compression']
-        size = int(xmldict['BLOB']['@size'])
-        data = volreader[end + 2:end + 2 + size] # read blob data to string
-        # if b'\\n' in data:
-        #     data = data[:data.index(b'\\n')]
+        start, size, cmpr = blobs[str(blobid)]
+        with open(filepath, 'rb') as vol:
+            vol.seek(start)
+            data = vol.read(size)
     
         # decompress if necessary
         # the first 4 bytes are neglected for an unknown reason
@@ -856,7 +1042,7 @@ class KNMI_hdf5():
         
         radial_res = self.dsg.radial_res_all['v'][scan]
         n_it = 1 if self.gui.vwp.updating_vwp else self.gui.dealiasing_dualprf_n_it
-        return da.apply_dual_prf_dealiasing(data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan],\
+        return self.dsg.apply_dual_prf_dealiasing(hf.filename, scan, data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan],\
         vn_l, vn_h, 'h', window_detection, window_correction, deviation_factor = deviation_factor, n_it = n_it,\
         c_array = c_array, mask_all_nearzero_velocities = mask_all_nearzero_velocities) #The first azimuth is scanned with a high PRF
 
@@ -877,15 +1063,15 @@ class KNMI_hdf5():
         if isinstance(apply_dealiasing, bool):
             apply_dealiasing = {j: apply_dealiasing for j in (scans[0] if isinstance(scans[0], list) else scans)}
         
-        data={}; scantimes={}; meta={}
+        meta={}
         with h5py.File(filepath,'r') as hf:
-            for j in scans: 
-                data[j]=[]; scantimes[j]=[]
+            def read_scan(j):
+                data_j=[]; scantimes_j=[]; meta_j={}
                 for scan in self.dsg.scannumbers_all[i_p][j]:
                     scangroup=hf['scan'+str(scan)]
-                    scantimes[j] += [self.get_scan_timerange(scangroup)]
+                    scantimes_j += [self.get_scan_timerange(scangroup)]
                     
-                    productname, dataset, success, meta['using_unfilteredproduct'], meta['using_verticalpolarization'] =\
+                    productname, dataset, success, meta_j['using_unfilteredproduct'], meta_j['using_verticalpolarization'] =\
                         self.try_various_combis_of_filter_and_polarization(i_p,scangroup,productunfiltered,polarization)
                                         
                     calibrationgroup=scangroup['calibration']
@@ -899,12 +1085,12 @@ class KNMI_hdf5():
                         data_Zh=np.array(scangroup['scan_'+productname[:-1]+'_data'][s],dtype='float32')*gain+offset
                         data_maskvalue=data_Zh.min()
                         data_mask = (data_Zh == data_maskvalue) | (data_Zv == data_maskvalue)
-                        data[j]+=[dt.calculate_zdr_array(data_Zh,data_Zv)]
+                        data_j+=[dt.calculate_zdr_array(data_Zh,data_Zv)]
                     else:
-                        data[j]+=[np.array(scangroup[dataset][s],dtype='float32')*gain+offset]
-                        if product == 'c': data[j][-1] *= 100.
-                        data_mask = data[j][-1] <= data[j][-1].min()
-                        # data[j][-1] += 3.
+                        data_j+=[np.array(scangroup[dataset][s],dtype='float32')*gain+offset]
+                        if product == 'c': data_j[-1] *= 100.
+                        data_mask = data_j[-1] <= data_j[-1].min()
+                        # data_j[-1] += 3.
                         if i_p == 'v':
                             if self.crd.radar == 'Herwijnen' and self.crd.date[:4] == '2019' and polarization == 'H' and 'scan_Vv_data' in scangroup:
                                 """IMPORTANT: Under these conditions empty velocity bins for the horizontally polarized channel are filled with velocity bins
@@ -912,12 +1098,20 @@ class KNMI_hdf5():
                                 of Herwijnen in 2019, that reduces data availability for the VVP retrieval.
                                 """
                                 data_Vv = np.array(scangroup['scan_Vv_data'][s],dtype='float32')*gain+offset
-                                data[j][-1][data_mask] = data_Vv[data_mask]
-                                data_mask = data[j][-1] <= data[j][-1].min()
+                                data_j[-1][data_mask] = data_Vv[data_mask]
+                                data_mask = data_j[-1] <= data_j[-1].min()
                             
                             if apply_dealiasing[j] and not self.dsg.low_nyquist_velocities_all_mps[j] is None:
-                                data[j][-1] = self.dealias_velocity(hf, data[j][-1], data_mask, j, max_range)    
-                    data[j][-1][data_mask] = np.nan
+                                data_j[-1] = self.dealias_velocity(hf, data_j[-1], data_mask, j, max_range)    
+                    data_j[-1][data_mask] = np.nan
+                return data_j, scantimes_j, meta_j
+            
+            results = read_scans_concurrently(read_scan, scans)
+        data = {j:results[j][0] for j in scans}
+        scantimes = {j:results[j][1] for j in scans}
+        # As before, the meta information for the last scan is returned
+        for j in scans:
+            meta.update(results[j][2])
         
         scantimes_list = []
         for i in scantimes:
@@ -940,22 +1134,37 @@ class ODIM_hdf5():
                               'ZDR':'d','AttCorrZDRCorr':'d','RHOHV':'c','URHOHV':'c','PHIDP':'p','UPHIDP':'p',
                               'KDPCorr':'k','KDP':'k','SQI':'q','SQIH':'q','SNR':'i','STAT2':'STAT2'}
         
+        # Extra masks for clutter filtering that are calculated in self.read_data, with keys as given there. Several masks are kept, 
+        # since different panels can show different scans.
+        self.extra_masks = OrderedDict()
+        self.extra_masks_max_size = 10
+        
     
-    def find_product_dataset(self, scangroup, product):
-        datasets = [key for key in scangroup if key.startswith('data')]
-        for d in datasets:
-            dataset = scangroup[d]
-            p_name = dataset['what'].attrs['quantity'].decode('utf-8')
-            if self.product_names.get(p_name, '') == product:
-                return dataset
-            elif not p_name in self.product_names:
-                if p_name == 'SCAN' and len(datasets) == 1:
+    def find_product_dataset(self, scangroup, product, index=None):
+        """index can be the index of the file in hdf5_files, in which case the datasets for all products in scangroup are determined only 
+        once, instead of checking the quantity attribute of each dataset for each call.
+        """
+        if index is None:
+            index = {}
+        key = ('datasets', scangroup.name)
+        if not key in index:
+            datasets = [key for key in scangroup if key.startswith('data')]
+            product_datasets = {}
+            for d in datasets:
+                p_name = scangroup[d]['what'].attrs['quantity'].decode('utf-8')
+                if p_name in self.product_names:
+                    product_datasets.setdefault(self.product_names[p_name], d)
+                elif p_name == 'SCAN' and len(datasets) == 1:
                     # In this case the product name is not correctly specified, and with only 1 dataset present it is assumed
                     # that it contains the requested product
-                    return dataset
+                    product_datasets[None] = d
+            index[key] = product_datasets
+        d = index[key].get(product, index[key].get(None, None))
+        return scangroup[d] if d else None
             
     def get_scans_information(self,filepath,product='z'):
-        with h5py.File(filepath,'r') as hf: 
+        with hdf5_files.open(filepath) as hf: 
+            index = hdf5_files.index(hf)
             scans = [int(j[7:]) for j in hf if j.startswith('dataset')]
             for j in scans:
                 try:
@@ -974,7 +1183,7 @@ class ODIM_hdf5():
                     try:
                         self.dsg.nyquist_velocities_all_mps[j] = abs(float(scangroup['how'].attrs['NI']))
                     except Exception:
-                        dataset = self.find_product_dataset(scangroup, product)
+                        dataset = self.find_product_dataset(scangroup, product, index)
                         self.dsg.nyquist_velocities_all_mps[j] = abs(float(dataset['what'].attrs['offset']))
                 
                 try:
@@ -1049,7 +1258,7 @@ class ODIM_hdf5():
             for p in products:
                 try:
                     filepath_p = self.crd.directory+'/'+self.crd.date+self.crd.time+'00.rad.'+gv.radar_ids[self.crd.radar]+'.pvol.'+p+'rad.scan_abc.hdf'
-                    with h5py.File(filepath_p, 'r') as hf:
+                    with hdf5_files.open(filepath_p) as hf:
                         # Sorting is necessary, because otherwise the scans are sorted in order of increasing first digit.                        
                         scans_p = sorted([int(j[7:]) for j in list(hf) if j[:7]=='dataset'])                        
                         scanangles_p = {j:ft.rndec(float(hf['dataset'+str(j)]['where'].attrs['elangle']), 2) for j in scans_p}
@@ -1101,17 +1310,20 @@ class ODIM_hdf5():
         # When a product is not included in gv.i_p, one can provide a productname instead.
         # This requires adding the map productname:productname to self.product_names
         i_p = gv.i_p.get(product, product) # In case of productname
-        with h5py.File(filepath,'r') as hf:
+        # The file remains open in hdf5_files, such that the calls of self.read_data below for obtaining other products don't open
+        # it again.
+        with hdf5_files.open(filepath) as hf:
+            index = hdf5_files.index(hf)
             _i_p = i_p if i_p in self.dsg.scannumbers_all else 'z' # In case of productname
             dataset_n = self.dsg.scannumbers_all[_i_p][scan][self.dsg.scannumbers_forduplicates[scan]]
             scangroup = hf[f'dataset{dataset_n}']
                 
             unfiltered = productunfiltered or gv.data_sources[self.crd.radar] == 'ARPAV'
             p = 'u'*unfiltered+i_p
-            dataset = self.find_product_dataset(scangroup, p)
+            dataset = self.find_product_dataset(scangroup, p, index)
             if not dataset:
                 p = i_p
-                dataset = self.find_product_dataset(scangroup, p)
+                dataset = self.find_product_dataset(scangroup, p, index)
                 if not dataset:
                     raise Exception(p+' not present in file')
             elif panel != None:
@@ -1167,9 +1379,15 @@ class ODIM_hdf5():
                 
             elif gv.data_sources[self.crd.radar] in ('ARPA FVG', 'ARPAV'):
                 if not productunfiltered:
-                    key = filepath+str(scan)
-                    if hasattr(self, 'extra_mask') and self.extra_mask['key'] == key:
-                        extra_mask = self.extra_mask['mask']
+                    key = (hdf5_files.key(filepath), dataset_n)
+                    # get instead of checking for presence of key, since another thread can remove it (see read_scans_concurrently)
+                    extra_mask = self.extra_masks.get(key, None)
+                    if not extra_mask is None:
+                        # Least recently used masks are evicted first
+                        try:
+                            self.extra_masks.move_to_end(key)
+                        except KeyError:
+                            pass
                     else:
                         kwargs = {'apply_dealiasing':False, 'productunfiltered':True, 'panel':None, 'check_azis':False}
                         # copy is used for storing in self.p_data, since without copy the arrays would be altered in subsequent
@@ -1192,7 +1410,12 @@ class ODIM_hdf5():
                             ground_clutter_mask = ((np.abs(V_data) < 0.5) & (W_data < 0.75))
                             extra_mask = np.isnan(SNR_data) | (SNR_data < 3.) | ground_clutter_mask# | (SQI_data < 0.1)                            
                         
-                        self.extra_mask = {'mask':extra_mask, 'key':key}
+                        self.extra_masks[key] = extra_mask
+                        while len(self.extra_masks) > self.extra_masks_max_size:
+                            try:
+                                self.extra_masks.popitem(last=False)
+                            except KeyError:
+                                break
                     data_mask |= extra_mask
                     
                     if i_p == 'v' and gv.data_sources[self.crd.radar] == 'ARPA FVG':
@@ -1211,11 +1434,11 @@ class ODIM_hdf5():
             data[data_mask] = np.nan
             if i_p == 'v':
                 if apply_dealiasing and self.dsg.low_nyquist_velocities_all_mps[scan] != None:
-                    data = self.dealias_velocity(data, data_mask, scan)
+                    data = self.dealias_velocity(filepath, data, data_mask, scan)
                     
                 if panel != None and apply_dealiasing and 'Unet VDA' in self.gui.dealiasing_setting:
                     # Performing mono PRF dealiasing must be done before the regridding that's done below
-                    data = self.dsg.perform_mono_prf_dealiasing(panel, data)
+                    data = self.dsg.perform_mono_prf_dealiasing(filepath, scan, panel, data)
             
             if check_azis and 'how' in scangroup and 'startazA' in scangroup['how'].attrs:
                 da = int(round(360/ft.from_list_or_nolist(scangroup['where'].attrs['nrays'])))
@@ -1238,7 +1461,7 @@ class ODIM_hdf5():
             
         return data, data_mask, scantime
         
-    def dealias_velocity(self, data, data_mask, scan):
+    def dealias_velocity(self, filepath, data, data_mask, scan):
         vn_l = self.dsg.low_nyquist_velocities_all_mps[scan]
         vn_h = self.dsg.high_nyquist_velocities_all_mps[scan]
         dr = self.dsg.radial_res_all['v'][scan]
@@ -1256,7 +1479,7 @@ class ODIM_hdf5():
             window_detection = [0,3,6,9,3,6,0] if dr == 0.25 else [1,2,3,4,3,2,1]
             window_correction = [0,3,6,3,0] if dr == 0.25 else [0,1,2,3,2,1,0]
         n_it = 1 if self.gui.vwp.updating_vwp else self.gui.dealiasing_dualprf_n_it
-        return da.apply_dual_prf_dealiasing(data, data_mask, dr, self.dsg.nyquist_velocities_all_mps[scan],\
+        return self.dsg.apply_dual_prf_dealiasing(filepath, scan, data, data_mask, dr, self.dsg.nyquist_velocities_all_mps[scan],\
         vn_l, vn_h, None, window_detection = window_detection, window_correction = window_correction, deviation_factor = deviation_factor,\
         n_it = n_it, mask_all_nearzero_velocities = self.crd.radar == 'Wideumont') #The first azimuth is scanned with a high PRF
 
@@ -1288,10 +1511,9 @@ class ODIM_hdf5():
         if isinstance(apply_dealiasing, bool):
             apply_dealiasing = {j: apply_dealiasing for j in scans}
         
-        data, scantimes = {}, {}
         meta = {'using_unfilteredproduct':False, 'using_verticalpolarization':False}
-        for j in scans: 
-            data[j], scantimes[j] = [], []
+        def read_scan(j):
+            data_j, scantimes_j = [], []
             for scan in self.dsg.scannumbers_all[i_p][j]:
                 data_mask = False
                 if i_p == 'v' and self.crd.radar == 'Zaventem':
@@ -1305,9 +1527,13 @@ class ODIM_hdf5():
                 _data, data_mask, _scantime = self.read_data(filepath, product, j, apply_dealiasing, productunfiltered, data_mask=data_mask)
                 _data[data_mask] = np.nan
                 
-                data[j].append(_data)
-                scantimes[j].append(_scantime)
+                data_j.append(_data)
+                scantimes_j.append(_scantime)
+            return data_j, scantimes_j
                 
+        results = read_scans_concurrently(read_scan, scans)
+        data = {j:results[j][0] for j in scans}
+        scantimes = {j:results[j][1] for j in scans}
         volume_starttime, volume_endtime = ft.get_start_and_end_volumetime_from_scantimes([i[0] for i in scantimes.values()])                
         return data, scantimes, volume_starttime, volume_endtime, meta
     
@@ -1447,19 +1673,19 @@ class skeyes_hdf5():
             data_mask = (self.dsg.data[j]<=data_maskvalue) | (self.dsg.data[j]==int255_datavalue)
             if i_p == 'v':
                 if self.crd.apply_dealiasing[j] and not self.dsg.low_nyquist_velocities_all_mps[self.crd.scans[j]] is None:
-                    self.dsg.data[j] = self.dealias_velocity(self.dsg.data[j], data_mask, self.crd.scans[j])
+                    self.dsg.data[j] = self.dealias_velocity(filepath, self.dsg.data[j], data_mask, self.crd.scans[j])
                     
             self.dsg.data[j][data_mask]=self.pb.mask_values[product]
                     
                     
-    def dealias_velocity(self, data, data_mask, scan):
+    def dealias_velocity(self, filepath, data, data_mask, scan):
         vn_l = self.dsg.low_nyquist_velocities_all_mps[scan]
         vn_h = self.dsg.high_nyquist_velocities_all_mps[scan]
         radial_res = self.dsg.radial_res_all['v'][scan]
         #The window is chosen to be slightly larger than the default window in nlr_dealiasing.py, because the low and high Nyquist velocities are larger
         #than the 30/40 kts on which the window sizes in nlr_dealiasing.py are based.
         n_it = 1 if self.gui.vwp.updating_vwp else self.gui.dealiasing_dualprf_n_it
-        return da.apply_dual_prf_dealiasing(data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan],\
+        return self.dsg.apply_dual_prf_dealiasing(filepath, scan, data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan],\
         vn_l, vn_h, None, n_it = n_it, window_detection = [3,5,7,5,3], window_correction = [5,7,5]) #The first azimuth is scanned with a high PRF
                     
         
@@ -1474,24 +1700,23 @@ class skeyes_hdf5():
         if isinstance(apply_dealiasing, bool):
             apply_dealiasing = {j: apply_dealiasing for j in scans}
         
-        data={}; scantimes={}
-        for j in scans: 
-            data[j] = []; scantimes[j] = []
+        def read_scan(j):
+            data_j = []; scantimes_j = []
             for i in range(len(self.dsg.scannumbers_all[i_p][j])):
                 scan=self.dsg.scannumbers_all[i_p][j][i][1]
                 file_index=self.dsg.scannumbers_all[i_p][j][i][0]
                 with h5py.File(filepaths[file_index],'r') as hf:
                     scangroup = hf['scan'+str(scan)]
-                    scantimes[j] += [ft.format_time(scangroup['what'].attrs['starttime'].decode('utf-8'))+\
+                    scantimes_j += [ft.format_time(scangroup['what'].attrs['starttime'].decode('utf-8'))+\
                                        '-'+ft.format_time(scangroup['what'].attrs['endtime'].decode('utf-8'))]
                         
                     calibrationgroup=scangroup['what']
                     gain=float(calibrationgroup.attrs['gain'])
                     offset=float(calibrationgroup.attrs['offset'])
                     s = np.s_[:] if max_range is None else np.s_[:, :int(np.ceil(ft.var1_to_var2(max_range, self.dsg.scanangles_all[i_p][j], 'gr+theta->sr') / self.dsg.radial_res_all[i_p][j]))]
-                    data[j] += [np.array(scangroup['data'][s],dtype='float32')*gain+offset]
+                    data_j += [np.array(scangroup['data'][s],dtype='float32')*gain+offset]
     
-                    data_mask = (data[j][-1] <= data[j][-1].min()) | (data[j][-1] == data[j][-1].max())
+                    data_mask = (data_j[-1] <= data_j[-1].min()) | (data_j[-1] == data_j[-1].max())
                     if i_p == 'v':
                         if int(self.crd.date[:4]) > 2014 and z_data[j][i].shape == data_mask.shape:
                             # Last check is included because it sometimes happens that no Z scan is available for the lowest dual-PRF scan, 
@@ -1504,9 +1729,13 @@ class skeyes_hdf5():
                             data_mask |= ((z_data[j][i] < -17.) & (data_range >= 3) & (data_range <= 7))
                         
                         if apply_dealiasing[j] and not self.dsg.low_nyquist_velocities_all_mps[j] is None:
-                            data[j][-1] = self.dealias_velocity(data[j][-1], data_mask, j)
-                    data[j][-1][data_mask] = np.nan
+                            data_j[-1] = self.dealias_velocity(filepaths[file_index], data_j[-1], data_mask, j)
+                    data_j[-1][data_mask] = np.nan
+            return data_j, scantimes_j
                 
+        results = read_scans_concurrently(read_scan, scans)
+        data = {j:results[j][0] for j in scans}
+        scantimes = {j:results[j][1] for j in scans}
         volume_starttime, volume_endtime = ft.get_start_and_end_volumetime_from_scantimes([i[0] for i in scantimes.values()])                
         meta = {'using_unfilteredproduct': False, 'using_verticalpolarization': False}
         return data, scantimes, volume_starttime, volume_endtime, meta
@@ -1634,18 +1863,18 @@ class DWD_odimh5():
             data %= 360.
         elif i_p == 'v':
             if apply_dealiasing and not self.dsg.low_nyquist_velocities_all_mps[scan] is None:
-                data = self.dealias_velocity(data, data_mask, scan, vn_first_azimuth, combi=len(filepaths) > 0)
+                data = self.dealias_velocity(filepaths, data, data_mask, scan, vn_first_azimuth, combi=len(filepaths) > 0)
         
         return data, data_mask, scantime
     
-    def dealias_velocity(self, data, data_mask, scan, vn_first_azimuth, combi=False):
+    def dealias_velocity(self, filepaths, data, data_mask, scan, vn_first_azimuth, combi=False):
         vn_l = self.dsg.low_nyquist_velocities_all_mps[scan]
         vn_h = self.dsg.high_nyquist_velocities_all_mps[scan]
         radial_res = self.dsg.radial_res_all['v'][scan]
         n_it = 1 if self.gui.vwp.updating_vwp else self.gui.dealiasing_dualprf_n_it
         window_detection = [1,4,7,4,1] if combi else None
         window_correction = [2,4,2] if combi else None
-        return da.apply_dual_prf_dealiasing(data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan],\
+        return self.dsg.apply_dual_prf_dealiasing(filepaths, scan, data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan],\
         vn_l, vn_h, vn_first_azimuth, window_detection, window_correction, n_it = n_it)
             
 
@@ -1664,14 +1893,16 @@ class DWD_odimh5():
         if isinstance(apply_dealiasing, bool):
             apply_dealiasing = {j: apply_dealiasing for j in scans}
         
-        data = {}; scantimes = {}
-        for j in scans: 
+        def read_scan(j):
             fileid = self.dsg.scannumbers_all[i_p][j][0]
             filepaths_j = filepaths[fileid]
-            data[j], data_mask, scantimes[j] = self.read_data(filepaths_j, product, j, apply_dealiasing[j])
-            scantimes[j] = [scantimes[j]]
-            data[j][data_mask] = np.nan
-            data[j] = [data[j]]
+            data_j, data_mask, scantime = self.read_data(filepaths_j, product, j, apply_dealiasing[j])
+            data_j[data_mask] = np.nan
+            return [data_j], [scantime]
+        
+        results = read_scans_concurrently(read_scan, scans)
+        data = {j:results[j][0] for j in scans}
+        scantimes = {j:results[j][1] for j in scans}
                                             
         volume_starttime, volume_endtime = ft.get_start_and_end_volumetime_from_scantimes([i[0] for i in scantimes.values()])                
         meta = {'using_unfilteredproduct': False, 'using_verticalpolarization': False}
@@ -1787,7 +2018,7 @@ class DWD_BUFR():
                  
         if i_p == 'v':
             if self.crd.apply_dealiasing[j] and not self.dsg.low_nyquist_velocities_all_mps[self.crd.scans[j]] is None:
-                self.dsg.data[j] = self.dealias_velocity(self.dsg.data[j], data_mask, self.crd.scans[j])
+                self.dsg.data[j] = self.dealias_velocity(filepath, self.dsg.data[j], data_mask, self.crd.scans[j])
                 
         self.dsg.data[j][data_mask] = self.pb.mask_values[product]
             
@@ -1801,12 +2032,12 @@ class DWD_BUFR():
         self.dsg.scantimes[j] = starttime+('-'+endtime if not endtime == starttime else '')
             
             
-    def dealias_velocity(self, data, data_mask, scan):
+    def dealias_velocity(self, filepath, data, data_mask, scan):
         vn_l = self.dsg.low_nyquist_velocities_all_mps[scan]
         vn_h = self.dsg.high_nyquist_velocities_all_mps[scan]
         radial_res = self.dsg.radial_res_all['v'][scan]
         n_it = 1 if self.gui.vwp.updating_vwp else self.gui.dealiasing_dualprf_n_it
-        return da.apply_dual_prf_dealiasing(data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan],\
+        return self.dsg.apply_dual_prf_dealiasing(filepath, scan, data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan],\
         vn_l, vn_h, None, n_it = n_it) #The prf of the first azimuth is unknown, hence vn_first_azimuth = None
 
 
@@ -1861,7 +2092,7 @@ class DWD_BUFR():
             
             if i_p == 'v':
                 if apply_dealiasing[j] and not self.dsg.low_nyquist_velocities_all_mps[j] is None:
-                    data[j] = self.dealias_velocity(data[j], data_mask, j)
+                    data[j] = self.dealias_velocity(filepaths[fileid], data[j], data_mask, j)
             data[j][data_mask] = np.nan
             data[j] = [data[j]]
         
@@ -2263,7 +2494,7 @@ class MeteoFrance_BUFR():
                 # data_mask[~low_thres & (v_std > 30)] = True
             
             if apply_dealiasing and not self.dsg.low_nyquist_velocities_all_mps[scan] is None:
-                data = self.dealias_velocity(data, data_mask, scan, z_data, c_data)
+                data = self.dealias_velocity(filepath, data, data_mask, scan, z_data, c_data)
                 
         #The end datetime is given here
         datetime = ''.join([format(int(float(data_info['00400'+str(j)][0])), '02') for j in range(1, 7)])
@@ -2286,14 +2517,14 @@ class MeteoFrance_BUFR():
         self.crd.using_unfilteredproduct[j] = self.crd.productunfiltered[j]
         
         
-    def dealias_velocity(self, data, data_mask, scan, z_array=None, c_array=None):
+    def dealias_velocity(self, filepath, data, data_mask, scan, z_array=None, c_array=None):
         vn_l = self.dsg.low_nyquist_velocities_all_mps[scan]
         vn_h = self.dsg.high_nyquist_velocities_all_mps[scan]
         radial_res = self.dsg.radial_res_all['v'][scan]
         n_it = 1 if self.gui.vwp.updating_vwp else self.gui.dealiasing_dualprf_n_it
-        return da.apply_dual_prf_dealiasing(data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan], vn_l, vn_h, None, 
-                                            window_detection = [1,2,1], window_correction = [1,2,1], deviation_factor = 1., n_it = n_it,
-                                            z_array=z_array, c_array=c_array)
+        return self.dsg.apply_dual_prf_dealiasing(filepath, scan, data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan], vn_l, vn_h, None, 
+                                                  window_detection = [1,2,1], window_correction = [1,2,1], deviation_factor = 1., n_it = n_it,
+                                                  z_array=z_array, c_array=c_array)
             
             
     def get_data_multiple_scans(self,filepaths,product,scans,productunfiltered=False,polarization='H',apply_dealiasing=True,max_range=None):
@@ -2450,7 +2681,7 @@ class UKMO_Polar():
                 data_mask |= (data_products['SQI'] < 0.25) & (data_products['REF'] < 15.)
         
         if apply_dealiasing:
-            data = self.dealias_velocity(data, data_mask, scan, c_array=data_products.get('RHO', None))
+            data = self.dealias_velocity(filepath, data, data_mask, scan, c_array=data_products.get('RHO', None))
         
         start_time = ''.join([format(j, '02d') for j in volume_header['volume start time and date'][3:]])
         end_time = ''.join([format(j, '02d') for j in volume_header['volume stop time and date'][3:]])
@@ -2465,7 +2696,7 @@ class UKMO_Polar():
         
         self.crd.using_unfilteredproduct[j] = self.crd.productunfiltered[j]
 
-    def dealias_velocity(self, data, data_mask, scan, z_array=None, c_array=None):
+    def dealias_velocity(self, filepath, data, data_mask, scan, z_array=None, c_array=None):
         vn_l = self.dsg.low_nyquist_velocities_all_mps[scan]
         vn_h = self.dsg.high_nyquist_velocities_all_mps[scan]
         # The staggered-PRF aliasing errors can be any linear combination of the form n1*vn_l+n2*vn_h, with n1 and n2 integers.
@@ -2474,9 +2705,9 @@ class UKMO_Polar():
         vn_l = vn_h = (vn_l+vn_h)/2.
         radial_res = self.dsg.radial_res_all['v'][scan]
         n_it = 1 if self.gui.vwp.updating_vwp else self.gui.dealiasing_dualprf_n_it
-        return da.apply_dual_prf_dealiasing(data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan], vn_l, vn_h, None, 
-                                            window_detection = [1,2,1], window_correction = [1,2,1], deviation_factor = 1.0, n_it = n_it,
-                                            z_array=z_array, c_array=c_array)
+        return self.dsg.apply_dual_prf_dealiasing(filepath, scan, data, data_mask, radial_res, self.dsg.nyquist_velocities_all_mps[scan], vn_l, vn_h, None, 
+                                                  window_detection = [1,2,1], window_correction = [1,2,1], deviation_factor = 1.0, n_it = n_it,
+                                                  z_array=z_array, c_array=c_array)
 
     def get_data_multiple_scans(self,filepaths,product,scans,productunfiltered=False,polarization='H',apply_dealiasing=True,max_range=None):
         """apply_dealiasing can be either a bool or a dictionary that specifies per scan whether dealiasing should be applied.
@@ -2512,17 +2743,42 @@ class NEXRAD_L2():
         self.filepath = None
         self.read_mode = None
         self.moments = None
+        # Stores the scan metadata obtained below in get_scans_information, such that it needs to be obtained only once per file
+        self.meta_index = NEXRADLevel2MetaIndex(opa(gv.programdir+'/Generated_files/nexrad_l2_meta_index.sqlite'))
     
     
-    def get_scans_information(self, filepath):    
-        self.read_file(filepath, 'min-meta')
-        n_scans = self.file.nscans
-        scans_record_indices = self.file.scan_msgs
-        scans_startend_pos = self.file.scan_startend_pos
-        radial_records = self.file.radial_records
+    def prefetch_file(self, filepath, scanangles=None):
+        """Is called by nlr_prefetch.Prefetcher in a worker thread, so it should not modify any attributes of this class or of self.dsg.
+        Stores the scan metadata of the file in self.meta_index, and for bzip2-compressed files decompresses the scans with a scanangle
+        in scanangles (all scans when None) into nexrad_l2.bzip2_block_cache. The subsequent import of the file then requires no 
+        decompression.
+        """
+        scans_meta = self.meta_index.get(filepath)
+        if scans_meta is None:
+            file = NEXRADLevel2File(filepath, 'min-meta')
+            scans_meta = file.get_scans_meta()
+            file.close()
+            self.meta_index.put(filepath, scans_meta)
+        if scans_meta['bzip2_compression']:
+            startend_pos = [j['startend_pos'] for j in scans_meta['scans'] if scanangles is None or 
+                            min(abs(j['target_angle']-a) for a in scanangles) < 0.25]
+            if startend_pos:
+                decompress_into_cache(filepath, startend_pos)
+    
+    def get_scans_information(self, filepath):
+        scans_meta = self.meta_index.get(filepath)
+        if scans_meta is None:
+            self.read_file(filepath, 'min-meta')
+            scans_meta = self.file.get_scans_meta()
+            self.meta_index.put(filepath, scans_meta)
+            if self.file._bzip2_compression:
+                self.file.close()
+        scans_meta, bzip2_compression = scans_meta['scans'], scans_meta['bzip2_compression']
+        n_scans = len(scans_meta)
+        scans_startend_pos = [j['startend_pos'] for j in scans_meta]
         
-        scanangles = self.file.get_target_angles()
-        actual_scanangles = [self.file.get_elevation_angles()[indices].mean() for indices in scans_record_indices]
+        scanangles = np.array([j['target_angle'] for j in scans_meta], dtype='float32')
+        actual_scanangles = [j['elevation_angle'] for j in scans_meta]
         max_diff = np.abs(actual_scanangles-scanangles).max()
         for i in range(len(scanangles)):
             diff = np.abs(actual_scanangles[i]-scanangles[:i]) if i else np.array([0])
@@ -2540,7 +2796,7 @@ class NEXRAD_L2():
                 # only 1 radial for 'min-meta', which might well not give a good sample of the azimuthal mean scanangle. 
                 scanangles[i] = actual_scanangles[i]
         
-        unambig_ranges = [self.file.get_unambigous_range()[indices].mean() for indices in scans_record_indices]
+        unambig_ranges = [j['unambig_range'] for j in scans_meta]
         i_scans_z = []
         i_scans_exclude = [0] if gv.radar_bands[self.crd.radar] == 'C' else []
         if gv.radar_bands[self.crd.radar] == 'S':
@@ -2574,9 +2830,8 @@ class NEXRAD_L2():
             ft.init_dict_entries_if_absent(self.dsg.__dict__[j], products_all, dict)
         for i in i_scans_include:
             j = i+1
-            scan_record_indices = scans_record_indices[i]
-            rcs = [radial_records[k] for k in scan_record_indices]
-            rc = rcs[0]
+            # Gate information for the moments that are available in the first radial of the scan
+            rc = scans_meta[i]['moments']
                  
             products = (products_z if i in i_scans_z else products_v) if i in i_scans_z+i_scans_v else products_all
             for p in products:
@@ -2594,7 +2849,7 @@ class NEXRAD_L2():
                     # have different values. Also, its value can even be azimuth-dependent for certain scans. Here I set its value
                     # equal to that of the first azimuth of a scan. And in the case of duplicates, the value for the first duplicate
                     # gets selected (in bg.sort_volume_attributes). Keep this in mind for certain operations!
-                    vn = self.file.get_nyquist_vel(scans=[i])[0]
+                    vn = scans_meta[i]['nyquist_vel']
                     if vn == 0.:
                         # This is the case for TDWR radars where no Nyquist velocity is given. In this case it is set to 999, to prevent 
                         # issues in VWP creation where scans with low Nyquist velocity are excluded, while indicating that it is not a real
@@ -2654,10 +2909,7 @@ class NEXRAD_L2():
                     self.dsg.radial_bins_all[p][i] = min(self.dsg.radial_bins_all[p][i], n_rad_max)
                                     
         # For bzip2-compressed files the start and end positions of the data for each scan are expected to vary from volume to volume
-        self.dsg.variable_attributes = ['scanangles_all']+['scannumbers_all']*self.file._bzip2_compression
-        
-        if self.file._bzip2_compression:
-            self.file.close()
+        self.dsg.variable_attributes = ['scanangles_all']+['scannumbers_all']*bzip2_compression
                 
         
     def read_data(self, product, scan, scan_index=0, n_rad=None, panel=None):
@@ -2694,7 +2946,7 @@ class NEXRAD_L2():
         vn_azis = self.file.get_nyquist_vel(scans=[scan_index])[-n_azi:]
         # Exclude Nyquist velocities of 0 as is the case for TDWR radars
         if i_p == 'v' and vn_azis[0] != 0. and panel != None and self.crd.apply_dealiasing[panel] and 'Unet VDA' in self.gui.dealiasing_setting:
-            data = self.dsg.perform_mono_prf_dealiasing(panel, data, vn_azis, azis, da)
+            data = self.dsg.perform_mono_prf_dealiasing(self.filepath, scan, panel, data, vn_azis, azis, da)
         
         data, azi_offset = map_onto_regular_grid(data, n_azi, azis, diffs, da, azi_offset)
         if panel != None:
@@ -2796,18 +3048,26 @@ class NEXRAD_L2():
         sort_indices_inverse = [j[0] for j in sorted(enumerate(sort_indices), key=lambda x: x[1])]
         scan_indices = [scan_indices[i] for i in sort_indices_inverse]
         
-        data, scantimes, radius_offsets = {}, {}, {}
-        i = 0
+        # The duplicates are read in the same task, since read_data updates the scanangles for all duplicates of a scan
+        tasks, i = {}, 0
         for j in scans:
-            data[j], scantimes[j] = [], []
             n_duplicates_scan = len(self.dsg.scannumbers_all[i_p][j])
-            for k in list(range(n_duplicates_scan))[duplicates_select]:
+            tasks[j] = [(k, scan_indices[i+n]) for n,k in enumerate(list(range(n_duplicates_scan))[duplicates_select])]
+            i += len(tasks[j])
+            
+        def read_scan(j):
+            data_j, scantimes_j, rad_offset = [], [], None
+            for k, scan_index in tasks[j]:
                 n_rad = None if max_range is None else int(np.ceil(ft.var1_to_var2(max_range, self.dsg.scanangle(i_p, j, k), 'gr+theta->sr') / self.dsg.radial_res_all[i_p][j]))
-                scan_data, _, scan_scantime, rad_offset = self.read_data(product, j, scan_indices[i], n_rad)
-                data[j].append(scan_data)
-                scantimes[j].append(scan_scantime)
-                radius_offsets[j] = rad_offset
-                i += 1
+                scan_data, _, scan_scantime, rad_offset = self.read_data(product, j, scan_index, n_rad)
+                data_j.append(scan_data)
+                scantimes_j.append(scan_scantime)
+            return data_j, scantimes_j, rad_offset
+        
+        results = read_scans_concurrently(read_scan, scans)
+        data = {j:results[j][0] for j in scans}
+        scantimes = {j:results[j][1] for j in scans}
+        radius_offsets = {j:results[j][2] for j in scans if not results[j][2] is None}
         
         scantimes_all = sum(list(scantimes.values()), [])
         volume_starttime, volume_endtime = ft.get_start_and_end_volumetime_from_scantimes(scantimes_all)
@@ -3015,7 +3275,7 @@ class CFRadial():
                 # vmax = np.abs(data).max()
                 # if vmax > vn:
                 #     vn = 26.2
-                data = self.dsg.perform_mono_prf_dealiasing(j, data, vn, azis, da)
+                data = self.dsg.perform_mono_prf_dealiasing(filepath, scan, j, data, vn, azis, da)
             
             self.dsg.data[j], azi_offset = map_onto_regular_grid(data, n_azi, azis, diffs, da, azi_offset, azi_pos='left')
             if not j is None:
@@ -3114,7 +3374,7 @@ class DORADE():
             vmax = np.abs(data).max()
             if vmax > vn:
                 vn = vmax
-            data = self.dsg.perform_mono_prf_dealiasing(j, data, vn, azis, da)
+            data = self.dsg.perform_mono_prf_dealiasing(filepath, scan, j, data, vn, azis, da)
         
         self.dsg.data[j], azi_offset = map_onto_regular_grid(data, n_azi, azis, diffs, da, azi_offset, azi_pos='center')
         if not j is None:
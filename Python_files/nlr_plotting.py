@@ -1797,6 +1797,9 @@ class Plotting(QObject,app.Canvas):
                 self.data_values_ticks[product] = np.unique(self.data_values_ticks[product])
                 
                 self.cmap_lastmodification_time[product]=pytime.time()
+                # A modified color map might imply a change of self.mask_values_int[product], in which case the number of masked elements
+                # will likely change, which requires an update of the data.
+                self.dsg.stored_data.invalidate(product)
 
         self.cmaps_minvalues_before=self.gui.cmaps_minvalues.copy(); self.cmaps_maxvalues_before=self.gui.cmaps_maxvalues.copy()
         return changed_colortables
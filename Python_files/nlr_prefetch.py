@@ -0,0 +1,132 @@
+# Copyright (C) 2016-2024 Bram van 't Veen, bramvtveen94@hotmail.com
+# Distributed under the GNU General Public License version 3, see <https://www.gnu.org/licenses/>.
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import nlr_globalvars as gv
+import nlr_functions as ft
+
+
+"""Prefetcher decodes radar volumes that will likely be requested next, while the current volume is being displayed. It is updated
+in nlr_changedata.py after each change of the displayed data, with the direction of travel for left/right steps (which includes the
+steps during an animation). During an animation the volumes are taken from the animation window, which wraps around from its end
+to its start.
+
+Importing data for a panel involves a lot of state of DataSource_General (volume attributes, self.data etc.) that can't be modified
+from a worker thread. Prefetching therefore takes place at the level of the file decoders: when the data source class has a method
+prefetch_file(filepath, scanangles), then this method decodes the file into the (thread-safe) caches of the decoder, which are used
+when the volume is subsequently imported in DataSource_General.get_data. Otherwise the file is only read, such that it is at least
+present in the file cache of the OS.
+"""
+
+# Number of volumes that are prefetched in the direction of travel. Prefetching is disabled when set to 0.
+n_volumes = 3
+n_workers = 2
+
+
+class Prefetcher():
+    def __init__(self, dsg_class):
+        self.dsg = dsg_class
+        self.crd = self.dsg.crd
+        self.gui = self.dsg.gui
+        self.pb = self.gui.pb
+
+        self.executor = None
+        # Futures for scheduled files, with filepaths as keys
+        self.futures = {}
+        # Is increased when scheduled work becomes stale, in which case workers skip it
+        self.generation = 0
+        self.panel_specs = None
+
+    def get_panel_specs(self):
+        # These determine which data gets imported for the panels, and a change in them makes scheduled work stale.
+        # Dataspecs strings (see DataSource_General.generate_dataspecs_string) can't be used for this, since they also change from
+        # volume to volume.
+        panels = tuple((self.crd.products[j], self.crd.scans[j], self.crd.productunfiltered[j], self.crd.polarization[j],
+                        self.crd.apply_dealiasing[j]) for j in self.pb.panellist)
+        return (self.crd.radar, self.crd.dataset, self.crd.directory, panels)
+
+    def cancel(self):
+        self.generation += 1
+        for future in self.futures.values():
+            future.cancel()
+        self.futures = {}
+
+    def update(self, direction=0):
+        """Should be called after each change of the displayed data. direction is -1/+1 after a step backward/forward in time, and 0 otherwise.
+        Scheduled work is cancelled when radar, dataset, products or scans have changed, and new work is scheduled when direction != 0.
+        """
+        if n_volumes <= 0:
+            return
+        try:
+            panel_specs = self.get_panel_specs()
+            if panel_specs != self.panel_specs:
+                self.cancel()
+                self.panel_specs = panel_specs
+            if direction == 0 or self.crd.radar in gv.radars_with_onefileperdate:
+                # In the latter case a file contains many volumes, that are all decoded at once anyway
+                return
+
+            source = self.dsg.source_classes[self.dsg.data_source()]
+            prefetch_file = getattr(source, 'prefetch_file', None)
+            scanangles = self.get_scanangles()
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix='nlr_prefetch')
+
+            filepaths = [self.crd.directory+'/'+filename for datetime in self.get_next_datetimes(direction) for
+                         filename in self.dsg.files_datetimesdict.get(datetime, [])]
+            # Finished work is remembered for files that are still upcoming, to prevent prefetching them again
+            self.futures = {i:j for i,j in self.futures.items() if not j.done() or i in filepaths}
+            for filepath in filepaths:
+                if not filepath in self.futures:
+                    self.futures[filepath] = self.executor.submit(self.prefetch, self.generation, prefetch_file, filepath, scanangles)
+        except Exception as e:
+            print(e, 'Prefetcher.update')
+
+    def get_scanangles(self):
+        # Returns the scanangles of the scans that are shown in the panels, or None when all scans are needed (for plain products)
+        if any(self.crd.products[j] in gv.plain_products for j in self.pb.panellist):
+            return None
+        scanangles = [self.dsg.scanangles_all_m[gv.i_p[self.crd.products[j]]].get(self.crd.scans[j]) for j in self.pb.panellist]
+        return None if None in scanangles else scanangles
+
+    def get_next_datetimes(self, direction):
+        datetimes, abstimes = self.crd.filedatetimes
+        if len(datetimes) == 0:
+            return []
+        current_datetime = self.crd.date+self.crd.time
+        abstime = ft.get_absolutetimes_from_datetimes(current_datetime)
+        timestep = 60*max(self.crd.desired_timestep_minutes(), self.crd.volume_timestep_m)
+
+        animating = self.crd.ani.continue_type in ('ani', 'ani_case')
+        if animating:
+            window = ft.get_absolutetimes_from_datetimes([str(self.crd.ani.startdatetime), str(self.crd.ani.enddatetime)])
+        next_datetimes = []
+        for i in range(n_volumes):
+            abstime += direction*timestep
+            if animating and not window[0] <= abstime <= window[1]:
+                # The animation continues at the other end of its window
+                abstime = window[0] if direction > 0 else window[1]
+            index = np.abs(abstimes-abstime).argmin()
+            if abs(abstimes[index]-abstime) > timestep:
+                # The end of the directory has been reached, or there is a large gap in the data
+                break
+            datetime = datetimes[index]
+            if datetime != current_datetime and not datetime in next_datetimes:
+                next_datetimes.append(datetime)
+        return next_datetimes
+
+    def prefetch(self, generation, prefetch_file, filepath, scanangles):
+        if generation != self.generation:
+            # Stale work, that could not be cancelled anymore
+            return
+        try:
+            if prefetch_file:
+                prefetch_file(filepath, scanangles)
+            else:
+                with open(filepath, 'rb') as f:
+                    while f.read(4*1024**2):
+                        pass
+        except Exception as e:
+            print(e, 'Prefetcher.prefetch', filepath)
@@ -0,0 +1,185 @@
+# Copyright (C) 2016-2024 Bram van 't Veen, bramvtveen94@hotmail.com
+# Distributed under the GNU General Public License version 3, see <https://www.gnu.org/licenses/>.
+
+import os
+import pickle
+import json
+import sqlite3
+import threading
+
+
+"""Storage of volume attributes (see DataSource_General.get_scans_information for a description of them) in an SQLite database.
+Previously attributes_descriptions, attributes_IDs and attributes_variable were kept in memory as nested dictionaries, which were loaded
+from pickle files at startup and completely rewritten when exiting the program. With years of archived data these files become large,
+which makes startup slow. In the database the attributes IDs and variable attributes are stored per radar_dataset, subdataset and
+datetime, and are only looked up when needed. New entries are inserted directly when they are determined.
+
+Attribute descriptions (the series of attributes that corresponds to a particular ID) are few in number, and are kept in memory per
+radar_dataset after their first use, since storing new attributes requires comparing them with all existing descriptions.
+Attributes are stored as pickled objects, since they contain dictionaries with integer keys and numpy values.
+"""
+
+
+class VolumeAttributesStore():
+    def __init__(self, db_filename):
+        self.db_filename = db_filename
+        self.connection = None
+        self.lock = threading.RLock()
+        # Attribute descriptions per radar_dataset, with IDs as keys
+        self.descriptions = {}
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.db_filename), exist_ok=True)
+            self.connection = sqlite3.connect(self.db_filename, check_same_thread=False)
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS descriptions (radar_dataset TEXT, id INTEGER, attrs BLOB, PRIMARY KEY (radar_dataset, id));
+                CREATE TABLE IF NOT EXISTS ids (radar_dataset TEXT, subdataset TEXT, datetime TEXT, attrs_id INTEGER, total_files_size INTEGER,
+                                                data_selected_startazimuth REAL, PRIMARY KEY (radar_dataset, subdataset, datetime));
+                CREATE TABLE IF NOT EXISTS variable (radar_dataset TEXT, subdataset TEXT, datetime TEXT, attrs BLOB,
+                                                     PRIMARY KEY (radar_dataset, subdataset, datetime));
+                CREATE INDEX IF NOT EXISTS ids_datetime ON ids (radar_dataset, datetime);
+                CREATE INDEX IF NOT EXISTS variable_datetime ON variable (radar_dataset, datetime);
+                """)
+        return self.connection
+
+    def close(self):
+        with self.lock:
+            if not self.connection is None:
+                self.connection.close()
+                self.connection = None
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.connect().execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_meta(self, key, value):
+        with self.lock:
+            with self.connect() as connection: # Commits the transaction
+                connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, json.dumps(value)))
+
+    def check_version(self, version, version_sources):
+        """Returns the data sources for which the stored attributes are outdated, because their version in version_sources differs from
+        the stored one. All attributes are removed when version differs from the stored version, in which case None is returned.
+        """
+        if self.get_meta('version') != version:
+            self.clear()
+            self.set_meta('version', version)
+            self.set_meta('version_sources', version_sources)
+            return None
+        stored_version_sources = self.get_meta('version_sources') or {}
+        self.set_meta('version_sources', version_sources)
+        return [i for i in set(stored_version_sources) | set(version_sources) if
+                stored_version_sources.get(i, 0) != version_sources.get(i, 0)]
+
+    def clear(self, radar_datasets=None):
+        # Removes all attributes for the radar_datasets in radar_datasets, or for all radar_datasets when it is None
+        with self.lock:
+            with self.connect() as connection:
+                for table in ('descriptions', 'ids', 'variable'):
+                    if radar_datasets is None:
+                        connection.execute("DELETE FROM "+table)
+                    else:
+                        connection.executemany("DELETE FROM "+table+" WHERE radar_dataset=?", [(j,) for j in radar_datasets])
+            if radar_datasets is None:
+                self.descriptions = {}
+            else:
+                for j in radar_datasets:
+                    self.descriptions.pop(j, None)
+
+    def get_descriptions(self, radar_dataset):
+        with self.lock:
+            if not radar_dataset in self.descriptions:
+                rows = self.connect().execute("SELECT id, attrs FROM descriptions WHERE radar_dataset=? ORDER BY id", (radar_dataset,))
+                self.descriptions[radar_dataset] = {i:pickle.loads(j) for i,j in rows}
+            return self.descriptions[radar_dataset]
+
+    def get_ID(self, radar_dataset, subdataset, datetime):
+        # Returns [attributes_ID, saved_total_files_size, saved_data_selected_startazimuth], or None when not available
+        with self.lock:
+            row = self.connect().execute("SELECT attrs_id, total_files_size, data_selected_startazimuth FROM ids WHERE radar_dataset=? AND "
+                                         "subdataset=? AND datetime=?", (radar_dataset, subdataset, datetime)).fetchone()
+        return None if row is None else list(row)
+
+    def get_variable(self, radar_dataset, subdataset, datetime):
+        with self.lock:
+            row = self.connect().execute("SELECT attrs FROM variable WHERE radar_dataset=? AND subdataset=? AND datetime=?",
+                                         (radar_dataset, subdataset, datetime)).fetchone()
+        return None if row is None else pickle.loads(row[0])
+
+    def put(self, radar_dataset, subdataset, datetime, attrs, total_files_size, data_selected_startazimuth, variable_attrs=None):
+        """Stores the attributes for a volume. When the series attrs equals one that is already stored, then its ID is reused.
+        Otherwise a new ID is used, that is 1 higher than the largest existing one.
+        """
+        with self.lock:
+            descriptions = self.get_descriptions(radar_dataset)
+            attrs_ID = next((ID for ID, j in descriptions.items() if j == attrs), None)
+            with self.connect() as connection:
+                if attrs_ID is None:
+                    attrs_ID = max(descriptions, default=0)+1
+                    connection.execute("INSERT OR REPLACE INTO descriptions VALUES (?, ?, ?)", (radar_dataset, attrs_ID, pickle.dumps(attrs)))
+                    descriptions[attrs_ID] = attrs
+                connection.execute("INSERT OR REPLACE INTO ids VALUES (?, ?, ?, ?, ?, ?)",
+                                   (radar_dataset, subdataset, datetime, attrs_ID, total_files_size, data_selected_startazimuth))
+                if variable_attrs:
+                    connection.execute("INSERT OR REPLACE INTO variable VALUES (?, ?, ?, ?)",
+                                       (radar_dataset, subdataset, datetime, pickle.dumps(variable_attrs)))
+        return attrs_ID
+
+    def remove(self, radar_datasets, startdatetime, enddatetime):
+        # Removes attributes IDs and variable attributes for datetimes in the range from startdatetime to enddatetime (inclusive).
+        # Returns the number of removed volumes.
+        n_removed = 0
+        with self.lock:
+            with self.connect() as connection:
+                for radar_dataset in radar_datasets:
+                    n_removed += connection.execute("DELETE FROM ids WHERE radar_dataset=? AND datetime BETWEEN ? AND ?",
+                                                    (radar_dataset, startdatetime, enddatetime)).rowcount
+                    connection.execute("DELETE FROM variable WHERE radar_dataset=? AND datetime BETWEEN ? AND ?",
+                                       (radar_dataset, startdatetime, enddatetime))
+        return n_removed
+
+    def migrate_from_pickles(self, descriptions_filename, IDs_filename, variable_filename):
+        """Imports the pickled attributes_descriptions, attributes_IDs and attributes_variable dictionaries that were used by previous
+        versions. This is done only once, when the database has no version yet. The version of the pickled attributes is stored
+        in the database, such that they get removed in check_version when outdated. The pickle files are removed afterwards.
+        """
+        if not self.get_meta('version') is None or not os.path.exists(descriptions_filename):
+            return
+        try:
+            attributes = []
+            for filename in (descriptions_filename, IDs_filename, variable_filename):
+                with open(filename, 'rb') as f:
+                    attributes.append(pickle.load(f))
+            descriptions, IDs, variable = attributes
+
+            with self.lock:
+                with self.connect() as connection:
+                    for radar_dataset, subdict in descriptions.items():
+                        if not isinstance(subdict, dict) or radar_dataset == 'version_sources':
+                            continue
+                        connection.executemany("INSERT OR REPLACE INTO descriptions VALUES (?, ?, ?)",
+                                               ((radar_dataset, i, pickle.dumps(j)) for i,j in subdict.items()))
+                    for radar_dataset in IDs:
+                        connection.executemany("INSERT OR REPLACE INTO ids VALUES (?, ?, ?, ?, ?, ?)",
+                                               ((radar_dataset, subdataset, date+time)+tuple(l) for subdataset, i in IDs[radar_dataset].items()
+                                                for date, j in i.items() for time, l in j.items()))
+                    for radar_dataset in variable:
+                        connection.executemany("INSERT OR REPLACE INTO variable VALUES (?, ?, ?, ?)",
+                                               ((radar_dataset, subdataset, date+time, pickle.dumps(l)) for subdataset, i in variable[radar_dataset].items()
+                                                for date, j in i.items() for time, l in j.items()))
+                    connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", ('version', json.dumps(descriptions.get('version', None))))
+                    connection.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", ('version_sources', json.dumps(descriptions.get('version_sources', {}))))
+                self.descriptions = {}
+        except Exception as e:
+            print(e, 'VolumeAttributesStore.migrate_from_pickles')
+            self.clear()
+            return
+
+        for filename in (descriptions_filename, IDs_filename, variable_filename):
+            try:
+                os.remove(filename)
+            except Exception as e:
+                print(e, 'VolumeAttributesStore.migrate_from_pickles')
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the calculation of echo tops, PCAPPI, VIL and Zmax products for 4-panel layouts with one function call per product (as before, with
+DerivedPlain.calculate_echotops etc.) with the calculation in a single pass over the scans for products that use the same scans
+(DerivedPlain.calculate_column_products). Products are calculated from a synthetic volume with 15 scans, on polar grids and on Cartesian grids
+with a resolution of 0.5 km (as when correcting for storm motion, in which case PCAPPIs remain polar). Volumes are used for which the bottom
+scan is used by all products, and for which it is removed for echo tops and VIL (see DerivedPlain.get_info_per_product).
+The time to obtain the mappings and the (height-sorted) data is not included. Results should be equal.
+Usage: python benchmark_column_products.py (from the Python_files directory)
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import tempfile
+import time as pytime
+from types import SimpleNamespace
+import numpy as np
+
+import nlr_functions as ft
+import nlr_globalvars as gv
+from derived.nlr_derived_plain import DerivedPlain
+from derived.nlr_mappingcache import BinMappingCache
+
+
+layouts = [['e_18.5', 'a_1.5', 'l_[True, 0]', 'm_0.5'],
+           ['e_18.5', 'e_30.0', 'e_40.0', 'e_50.0'],
+           ['a_0.3', 'a_0.5', 'a_1.5', 'a_3.0'],
+           ['l_[True, 0]', 'h_[True, 1]', 'h_[True, 3]', 'm_1.5']]
+scanangles = {'bottom scan kept': [0.3, 0.5, 0.8, 1.1, 1.5, 2., 2.5, 3., 4., 5., 6., 8., 10., 12., 15.],
+              'bottom scan removed': [0.3, 0.4, 0.8, 1.1, 1.5, 2., 2.5, 3., 4., 5., 6., 8., 10., 12., 15.]}
+n_azi, radial_res, n_rad = 360, 0.25, 1000
+n_repeat = 3
+
+def synthetic_volume(rng, scanangles):
+    # Cells of which the reflectivity decreases with height
+    data = {}
+    azi = np.deg2rad(np.arange(0.5, n_azi)*360/n_azi)[:, None]
+    r = radial_res*np.arange(0.5, n_rad)[None]
+    Z0 = 35+20*np.sin(3*azi+r/20)*np.cos(r/35)
+    for j, scanangle in enumerate(scanangles, 1):
+        h = ft.var1_to_var2(r, scanangle, 'sr+theta->h')
+        Z = Z0-4*h+rng.normal(0, 3, (n_azi, n_rad))
+        Z[(Z < 0) | (rng.random(Z.shape) < 0.05)] = np.nan
+        data[j] = [Z.astype('float32')]
+    return data
+
+def setup(data, scanangles, stormmotion, derivedproducts_dir):
+    scans = list(data)
+    dsg = SimpleNamespace(scannumbers_all={'z': {**{j: [j] for j in scans}, 'a': [1], 'm': [1]}}, get_radar_dataset=lambda no_special_char=False: 'Radar')
+    gui = SimpleNamespace(cartesian_product_res=0.5, cartesian_product_maxrange=200., stormmotion=stormmotion, derivedproducts_dir=derivedproducts_dir)
+    dp = DerivedPlain.__new__(DerivedPlain)
+    dp.dsg, dp.gui, dp.crd = dsg, gui, SimpleNamespace(radar='Radar')
+    dp.pb = SimpleNamespace(mask_values={j: -1e6 for j in gv.plain_products})
+    dp.products_requiring_heightsorted_data = ['e','a','l']
+    dp.plain_products_functions = {'independent':{'e':dp.calculate_echotops,'a':dp.calculate_PCAPPI,'m':dp.calculate_Zmax,'l':dp.calculate_VIL}}
+    dp.mapping_parameters = ['Zmax_3D','Zavg_3D','heights_3D','hdiffs']
+    dp.mapping_cache = BinMappingCache()
+    dp.import_data_specs, dp.double_volume_index, dp.i_p = 'volume', 0, 'z'
+    dp.get_import_data_specs = lambda: 'volume'
+    from derived.polar import Polar
+    from derived.cartesian import Cartesian
+    dp.mapping_classes = {'pol': Polar(dp), 'car': Cartesian(dp)}
+
+    dp.scans_all = scans
+    dp.data_all = data
+    dp.scanangles_all = {j: scanangles[j-1] for j in scans}
+    dp.radial_bins_all = {j: n_rad for j in scans}
+    dp.radial_res_all = {j: radial_res for j in scans}
+    dp.radial_range_all = {j: n_rad*radial_res for j in scans}
+    dp.radius_offsets_all = {j: 0. for j in scans}
+    dp.scantimes_all = {j: ['12:00:00'] for j in scans}
+    dp.get_info_per_product()
+    return dp
+
+def get_p_params_functions(dp, panels):
+    # As in DerivedPlain._calculate_plain_products
+    p_params_functions, p_params_projs = {}, {}
+    dp.base_p_params = panels.copy()
+    for p_param in panels:
+        p_param_function = 'l_[True, 0]' if p_param.startswith('h_') else p_param
+        p_params_functions[p_param_function] = p_params_functions.get(p_param_function, [])+[p_param]
+        p_params_projs[p_param_function] = 'car' if dp.gui.stormmotion[1] != 0. and p_param[0] in gv.plain_products_correct_for_SM else 'pol'
+    return p_params_functions, p_params_projs
+
+def prepare(dp, p_param, proj):
+    # As in the loop over p_params in DerivedPlain._calculate_plain_products
+    dp.product, param = dp.get_product_and_param(p_param)
+    for attr in ('bottom_scan_removed', 'scans'):
+        dp.__dict__[attr] = dp.__dict__[attr+'_products'][dp.product]
+    mapping = dp.mapping_classes[proj]
+    for attr in ('i_p', 'scans', 'scans_all', 'data_all', 'scanangles_all', 'radial_bins_all', 'radial_res_all',
+                 'radial_range_all', 'scantimes_all', 'radius_offsets_all'):
+        mapping.__dict__[attr] = dp.__dict__[attr]
+    mapping.get_product_dimensions()
+    dp.product_shape = mapping.get_product_shape()
+    dp.product_slice = mapping.get_product_slice()
+    mapping.get_parameters_data_mapping()
+    mapping.calculate_Zmax_and_Zavg_3D()
+    mapping.sort_data_and_get_hdiffs_if_necessary()
+    for parameter in dp.mapping_parameters:
+        if hasattr(mapping, parameter):
+            dp.__dict__[parameter] = mapping.__dict__[parameter]
+    return param
+
+def run(dp, panels, column_engine):
+    p_params_functions, p_params_projs = get_p_params_functions(dp, panels)
+    column_groups = dp.get_column_groups(p_params_functions, p_params_projs) if column_engine else {}
+    t_total = 0.
+    for k in range(n_repeat):
+        dp.product_arrays, column_arrays = {}, {}
+        for p_param in sorted(p_params_functions, key=lambda j: j in column_groups and column_groups[j][0] != j):
+            param = prepare(dp, p_param, p_params_projs[p_param])
+            t = pytime.perf_counter()
+            if p_param in column_groups:
+                if not p_param in column_arrays:
+                    column_arrays.update(dp.calculate_column_products(column_groups[p_param]))
+                dp.product_array = column_arrays.pop(p_param)
+            else:
+                dp.plain_products_functions['independent'][dp.product](param)
+            t_total += pytime.perf_counter()-t
+            dp.product_arrays[p_param] = dp.product_array
+    return t_total/n_repeat, dp.product_arrays, len(set(map(tuple, column_groups.values())))
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    directory = tempfile.TemporaryDirectory()
+    for volume in scanangles:
+        data = synthetic_volume(rng, scanangles[volume])
+        for stormmotion in ((0., 0.), (270., 15.)):
+            dp = setup(data, scanangles[volume], stormmotion, directory.name)
+            grid = 'polar' if stormmotion[1] == 0. else 'Cartesian'
+            for panels in layouts:
+                t_before, reference, _ = run(dp, panels, False)
+                t_column, result, n_groups = run(dp, panels, True)
+                equal = reference.keys() == result.keys() and all(np.array_equal(reference[j], result[j], equal_nan=True) for j in reference)
+                print(f'{volume}, {grid}, {panels}: per product {t_before:.3f} s, single pass {t_column:.3f} s ({n_groups} groups), '
+                      f'equal results: {equal}')
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Compares dual PRF dealiasing of a synthetic scan (720 radials and 1832 radial bins) with obtaining the dealiased velocities from the
+dealiased velocity cache (nlr_dealiasingcache.py), in the way in which DataSource_General.apply_dual_prf_dealiasing uses it. Dealiased
+velocities obtained from the cache should be equal to those of the dealiasing algorithm. Also the removal of the least used datasets
+when the maximum number of datasets per file is reached, the use of a separate cache file per radar file, invalidation when the size of the
+radar file changes, and concurrent use from multiple threads are checked.
+Usage: python benchmark_dealiasing_cache.py
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import tempfile
+import time as pytime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import h5py
+
+import nlr_dealiasingcache as dc
+from dealiasing.nlr_dealiasing import apply_dual_prf_dealiasing
+
+
+vn_l, vn_h = 16., 20.
+vn_e = vn_l*vn_h/(vn_h-vn_l)
+
+def synthetic_scan(rng, n_azi=720, n_rad=1832):
+    azi = np.deg2rad(np.arange(n_azi)*360/n_azi)[:, None]
+    v = 25*np.sin(azi)*np.linspace(0.3, 1, n_rad)+rng.normal(0, 1, (n_azi, n_rad))
+    vn = np.where(np.arange(n_azi) % 2 == 0, vn_l, vn_h)[:, None]
+    v = (v+vn) % (2*vn)-vn
+    # Dual PRF errors
+    errors = rng.random(v.shape) < 0.01
+    v[errors] += np.where(rng.random(np.count_nonzero(errors)) < 0.5, -2, 2)*np.broadcast_to(vn, v.shape)[errors]
+    data_mask = rng.random(v.shape) < 0.2
+    return v.astype('float32'), data_mask
+
+def create_radar_file(filepath, size=1000):
+    with open(filepath, 'wb') as f:
+        f.write(bytes(size))
+
+def dealias_cached(cache, directory, filepath, scan, data, data_mask, *args, **kwargs):
+    # As in DataSource_General.apply_dual_prf_dealiasing
+    filename, files_size = cache.get_filename(directory, [filepath]), cache.get_files_size([filepath])
+    arrays = [data, data_mask, kwargs.get('z_array', None), kwargs.get('c_array', None)]
+    params = ['dual PRF', [filepath]]+list(args)+[(i, kwargs[i]) for i in sorted(kwargs) if not i in ('z_array', 'c_array')]
+    key = cache.get_key(scan, arrays, params)
+    return cache(filename, lambda: apply_dual_prf_dealiasing(data, data_mask, *args, **kwargs), key, files_size)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    data, data_mask = synthetic_scan(rng)
+    args = (0.25, vn_e, vn_l, vn_h, None)
+
+    with tempfile.TemporaryDirectory() as directory:
+        radar_file = directory+'/radar/volume1.h5'
+        os.makedirs(directory+'/radar')
+        create_radar_file(radar_file)
+        cache = dc.DealiasedVelocityCache()
+        filename = cache.get_filename(directory, [radar_file])
+
+        t = pytime.perf_counter()
+        reference = apply_dual_prf_dealiasing(data.copy(), data_mask, *args, n_it=50)
+        t_dealias = pytime.perf_counter()-t
+        t = pytime.perf_counter()
+        first = dealias_cached(cache, directory, radar_file, 1, data.copy(), data_mask, *args, n_it=50)
+        t_first = pytime.perf_counter()-t
+        t = pytime.perf_counter()
+        second = dealias_cached(cache, directory, radar_file, 1, data.copy(), data_mask, *args, n_it=50)
+        t_second = pytime.perf_counter()-t
+        print(f'dealiasing {t_dealias:.3f} s, first call with cache {t_first:.3f} s, second call {t_second:.3f} s, '
+              f'file size {os.path.getsize(filename)/1e6:.1f} MB')
+        print('Equal results:', np.array_equal(reference, first) and np.array_equal(reference, second))
+        # A different setting should result in a new entry
+        other = dealias_cached(cache, directory, radar_file, 1, data.copy(), data_mask, *args, n_it=1)
+        print('Different setting gives a new entry:', cache.n_misses == 2 and cache.n_hits == 1)
+        # The same scan from another radar file should be stored in another cache file
+        other_radar_file = directory+'/radar/volume2.h5'
+        create_radar_file(other_radar_file)
+        dealias_cached(cache, directory, other_radar_file, 1, data.copy(), data_mask, *args, n_it=50)
+        other_filename = cache.get_filename(directory, [other_radar_file])
+        print('Other radar file uses another cache file:', cache.n_misses == 3 and os.path.exists(other_filename) and other_filename != filename)
+
+        # Fill the file beyond its maximum number of datasets. The first (most used) dataset should remain present.
+        files_size = cache.get_files_size([radar_file])
+        small = rng.random((10, 10)).astype('float32')
+        for i in range(dc.max_datasets_per_file+5):
+            cache.put(filename, f'{i}_key', small, files_size)
+        with h5py.File(filename, 'r') as f:
+            n_datasets = len(f)
+        key = cache.get_key(1, [data, data_mask, None, None], ['dual PRF', [radar_file]]+list(args)+[('n_it', 50)])
+        print(f'Datasets in file: {n_datasets}, most used dataset kept: {not cache.get(filename, key, files_size) is None}')
+        # A changed radar file (different size) should invalidate the cache file
+        create_radar_file(radar_file, 2000)
+        print('Changed radar file invalidates cache file:', cache.get(filename, key, cache.get_files_size([radar_file])) is None)
+
+        # Concurrent use from multiple threads, as in nlr_importdata.read_scans_concurrently
+        scans = [rng.normal(0, 10, (360, 200)).astype('float32') for i in range(8)]
+        cached = lambda j: dealias_cached(cache, directory, other_radar_file, j, scans[j].copy(), np.zeros(scans[j].shape, bool), *args, n_it=50)
+        with ThreadPoolExecutor(4) as executor:
+            results1 = list(executor.map(cached, range(len(scans))))
+        with ThreadPoolExecutor(4) as executor:
+            results2 = list(executor.map(cached, range(len(scans))))
+        print('Equal results with threads:', all(np.array_equal(i, j) for i, j in zip(results1, results2)))
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Compares determining the total file size of radar volumes with os.path.getsize per file (as previously done in
+DataSource_General.get_total_volume_files_size) with using the stat cache of the directory index (nlr_directoryindex.py).
+A synthetic directory is created with a given number of files, that are grouped into volumes with one file per scan, as is the
+case for e.g. DWD and Météo-France. The total size is determined for each volume, and this is repeated n_passes times, to mimic
+browsing through the directory.
+This is also done with a new index instance that uses the database of the first one (as in a new session), in which case the directory
+doesn't need to be listed and scanned again.
+Finally it is checked that the size of a file is updated when the file is replaced by a renamed one (as when downloading it again).
+Usage: python benchmark_directory_stat_cache.py [<number of files> [<files per volume> [<directory>]]]
+By default 10000 files are created in a temporary directory, with 10 files per volume. A directory on a network mount can be
+given to include the latency of the filesystem.
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import tempfile
+import time as pytime
+
+import nlr_directoryindex as di
+
+
+n_passes = 3
+
+def create_files(directory, n_files, n_per_volume):
+    volumes = []
+    for i in range(n_files//n_per_volume):
+        volume = [f'{i:06d}_scan{j:02d}.h5' for j in range(n_per_volume)]
+        for j, filename in enumerate(volume):
+            with open(os.path.join(directory, filename), 'wb') as f:
+                f.write(b'\0'*(100+i+j))
+        volumes.append(volume)
+    # Make the files older than di.recent_file_age, as for archived data
+    mtime = pytime.time()-2*di.recent_file_age
+    for volume in volumes:
+        for filename in volume:
+            os.utime(os.path.join(directory, filename), (mtime, mtime))
+    return volumes
+
+def total_sizes_getsize(directory, volumes):
+    return [sum([os.path.getsize(directory+'/'+j) for j in volume]) for volume in volumes]
+
+def total_sizes_index(directory, volumes, index):
+    return [sum(index.get_file_sizes(directory, volume)) for volume in volumes]
+
+def write_file(filename, size):
+    with open(filename, 'wb') as f:
+        f.write(b'\0'*size)
+    # Older than di.recent_file_age, such that the size is taken from the stat cache
+    mtime = pytime.time()-3600
+    os.utime(filename, (mtime, mtime))
+
+def check_replace_by_rename(directory):
+    index = di.DirectoryIndex()
+    write_file(directory+'/replaced.h5', 100)
+    sizes_before = index.get_file_sizes(directory, ['replaced.h5'])
+    write_file(directory+'/replaced.h5.tmp', 5000)
+    os.replace(directory+'/replaced.h5.tmp', directory+'/replaced.h5')
+    # The modification time of the directory is checked at most once per di.mtime_check_interval seconds
+    pytime.sleep(di.mtime_check_interval+0.1)
+    sizes_after = index.get_file_sizes(directory, ['replaced.h5'])
+    return sizes_before == [100] and sizes_after == [5000]
+
+
+if __name__ == '__main__':
+    n_files = int(float(sys.argv[1])) if len(sys.argv) > 1 else 10000
+    n_per_volume = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    with tempfile.TemporaryDirectory(dir=sys.argv[3] if len(sys.argv) > 3 else None) as directory, tempfile.TemporaryDirectory() as db_directory:
+        volumes = create_files(directory, n_files, n_per_volume)
+        print(f'{len(volumes)} volumes with {n_per_volume} files each, {n_passes} passes')
+
+        db_filename = db_directory+'/directory_index.sqlite'
+        results = {}
+        for name in ('os.path.getsize', 'stat cache', 'stat cache, new session'):
+            # Each index instance uses the database of the previous one
+            index = di.DirectoryIndex(db_filename)
+            function = total_sizes_getsize if name == 'os.path.getsize' else lambda i, j: total_sizes_index(i, j, index)
+            t = pytime.perf_counter()
+            sizes = function(directory, volumes)
+            t_first = pytime.perf_counter()-t
+            t = pytime.perf_counter()
+            for i in range(n_passes-1):
+                function(directory, volumes)
+            t_next = (pytime.perf_counter()-t)/(n_passes-1)
+            results[name] = sizes
+            print(f'{name}: first pass {t_first:.4f} s, next passes {t_next:.4f} s, {1e6*t_next/len(volumes):.2f} us per volume')
+        print('Equal results:', results['os.path.getsize'] == results['stat cache'] == results['stat cache, new session'])
+        print('Size updated after replacing a file by renaming:', check_replace_by_rename(directory))
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the dual PRF dealiasing in dealiasing/nlr_dealiasing.py with the previous version of its iteration (PreviousDualPRFDealiasing below),
+in which every iteration checked all radar bins that had an outlier in their window, and calculated window sums for the whole scan once more
+than a few thousand bins were involved. The dealiased velocities should be equal. 
+Synthetic scans are used with a smooth velocity field, to which dual PRF errors of 2 times the low or high Nyquist velocity are added,
+either at randomly scattered radar bins, or in clusters. For each case the number of iterations, timings and per-iteration statistics of the 
+new version are shown.
+Usage: python benchmark_dualprf_dealiasing.py
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import time as pytime
+import numpy as np
+
+from nlr_functions import get_window_sum, get_window_indices
+from dealiasing.nlr_dealiasing import DualPRFDealiasing
+
+
+vn_l, vn_h = 16., 20.
+vn_e = vn_l*vn_h/(vn_h-vn_l)
+window_detection, window_correction = [1,2,3,2,1], [2,3,2]
+
+class PreviousDualPRFDealiasing(DualPRFDealiasing):
+    def dealias(self):
+        self.n_azi, self.n_rad = self.data.shape
+        self.data_indices = np.array(np.meshgrid(np.arange(self.n_azi, dtype = 'int16'), np.arange(self.n_rad, dtype = 'int16'))).T
+        if self.vn_first_azimuth:
+            vn_order = [self.vn_h, self.vn_l] if self.vn_first_azimuth == 'h' else [self.vn_l, self.vn_h]
+            self.vn_radials = np.tile(vn_order, (self.n_azi+1)//2)[:self.n_azi].astype(self.data.dtype)
+            self.vn_array = np.transpose(np.tile(self.vn_radials, (self.n_rad, 1))).astype(self.data.dtype)
+            
+        self.n_outliers_before = 1e8; self.n_outliers = 1e6
+        for self.n in range(self.n_it):
+            if self.n == 0:                 
+                self.phi = np.pi * self.data / self.vn_e
+                self.sin_phi = np.sin(self.phi); self.cos_phi = np.cos(self.phi)
+                self.sin_phi[self.data_mask] = self.cos_phi[self.data_mask] = 0.
+            else:                
+                self.phi[self.outliers] = np.pi * self.data[self.outliers] / self.vn_e
+                phi_outliers = self.phi[self.outliers]
+                self.sin_phi[self.outliers] = np.sin(phi_outliers); self.cos_phi[self.outliers] = np.cos(phi_outliers)
+                              
+            self.detect_outliers()
+            if self.n_outliers_before <= self.n_outliers:
+                break
+            self.correct_outliers()
+
+    def detect_outliers(self):
+        if self.n == 0:
+            self.update = self.data_nonmask
+        else:
+            # Keep in mind that the window sum cannot become larger than 1 for a boolean array. But that is not a problem here.
+            self.update = self.data_nonmask & get_window_sum(self.outliers, self.window_detection)
+        self.n_update = np.count_nonzero(self.update)
+        
+        phi_ref = self.calculate_reference_phase(self.update, self.n_update, self.window_detection)
+        
+        phi_diff = np.abs(self.phi[self.update] - phi_ref)
+        corr = phi_diff > np.pi
+        phi_diff[corr] = 2*np.pi - phi_diff[corr]
+        v_diff = phi_diff * self.vn_e/np.pi
+                    
+        if self.vn_first_azimuth is None:
+            self.v_diff_detection = np.zeros((self.n_azi, self.n_rad), dtype = self.data.dtype)
+            self.v_diff_detection[self.update] = v_diff
+            
+            self.determine_vn_even_and_odd_radials()
+            self.vn_array = np.tile(self.vn_radials, (self.n_rad, 1)).T
+        
+        if self.n > 0: 
+            self.outliers[:] = 0
+        else:
+            self.outliers = np.zeros((self.n_azi, self.n_rad), dtype = 'bool')
+        outliers = (np.abs(v_diff) > self.deviation_factor * self.vn_array[self.update])
+        self.outliers[self.update] = outliers 
+        
+        self.n_outliers_before = self.n_outliers
+        self.n_outliers = np.count_nonzero(self.outliers)
+        
+    def correct_outliers(self):
+        self.sin_phi[self.outliers] = self.cos_phi[self.outliers] = 0.
+        
+        if self.min_gates_correct > 0:
+            n_nonoutliers = get_window_sum(np.logical_or(self.data_nonmask, ~self.outliers).astype('uint8'), self.window_correction)
+            self.outliers[n_nonoutliers < self.min_gates_correct] = False
+        
+        #Calculate again the mean phase, but exclude the outliers from the averaging        
+        phi_ref = self.calculate_reference_phase(self.outliers, self.n_outliers, self.window_correction)
+        
+        v_diff = (self.phi[self.outliers] - phi_ref)*self.vn_e/np.pi
+        select = np.abs(v_diff) > self.vn_e
+        v_diff[select] -= np.sign(v_diff[select])*2*self.vn_e
+        
+        vn_outliers = self.vn_array[self.outliers]
+        correction_ints = np.round(v_diff/(2*vn_outliers))
+        data_outliers = self.data[self.outliers] - 2*correction_ints*vn_outliers
+        outside_extended_nyquist_interval = np.abs(data_outliers) > self.vn_e
+        data_outliers_outside_nyq_int = data_outliers[outside_extended_nyquist_interval]
+        data_outliers[outside_extended_nyquist_interval] = -np.sign(data_outliers_outside_nyq_int)*2*self.vn_e\
+        + data_outliers_outside_nyq_int
+        self.data[self.outliers] = data_outliers
+        
+    def calculate_reference_phase(self, select, n_select, window):
+        if n_select < 12000 * (self.n_rad * self.n_azi) / (838 * 360):
+            #Around this value of n_select becomes this method faster
+            rows, cols = get_window_indices(self.data_indices[select], window, self.data.shape, periodic = 'rows')
+            window_size = sum([j*2+1 for j in window])
+            sin_phi_sum_update = np.sum(self.sin_phi[rows, cols].reshape((window_size, n_select)), axis = 0)
+            cos_phi_sum_update = np.sum(self.cos_phi[rows, cols].reshape((window_size, n_select)), axis = 0)
+            return np.arctan2(sin_phi_sum_update, cos_phi_sum_update)
+        else:
+            sin_phi_sum_detection, cos_phi_sum_detection = get_window_sum(self.sin_phi, window), get_window_sum(self.cos_phi, window)
+            return np.arctan2(sin_phi_sum_detection[select], cos_phi_sum_detection[select])
+
+
+def create_scan(rng, shape, error_fraction, clustered):
+    azi = np.linspace(0, 2*np.pi, shape[0], endpoint=False)[:, None]
+    rad = np.linspace(0, 1, shape[1])[None]
+    v_true = (10+40*rad)*np.cos(azi-1) + 5*np.sin(3*azi+5*rad) + rng.normal(0, 1, shape)
+    vn_radials = np.where(np.arange(shape[0]) % 2 == 0, vn_l, vn_h)[:, None]
+    if clustered:
+        # Errors in patches of a few radials and radial bins, as occur in areas with strong shear
+        errors = get_window_sum(rng.random(shape) < error_fraction/25, [2,2,2,2,2]) & (rng.random(shape) < 0.5)
+    else:
+        errors = rng.random(shape) < error_fraction
+    v = v_true + 2*errors*rng.choice([-1, 1], shape)*vn_radials
+    v = ((v+vn_e) % (2*vn_e) - vn_e).astype('float32')
+    data_mask = rng.random(shape) < 0.2
+    data_mask[:, :20] = True
+    return v, data_mask
+
+def run(dealiasing, v, data_mask, vn_first_azimuth, n_it):
+    t = pytime.perf_counter()
+    result = dealiasing(v.copy(), data_mask.copy(), 360/v.shape[0], 0.25, vn_e, vn_l, vn_h, vn_first_azimuth, window_detection, 
+                        window_correction, 1.0, n_it)
+    return result, pytime.perf_counter()-t
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    all_equal = True
+    for shape in ((360, 900), (720, 1832)):
+        for error_fraction, clustered in ((0.01, False), (0.1, False), (0.05, True), (0.2, True)):
+            v, data_mask = create_scan(rng, shape, error_fraction, clustered)
+            for vn_first_azimuth, n_it in (('l', 50), (None, 50), ('l', 1)):
+                previous, t_previous = run(PreviousDualPRFDealiasing(), v, data_mask, vn_first_azimuth, n_it)
+                dealiasing = DualPRFDealiasing()
+                result, t = run(dealiasing, v, data_mask, vn_first_azimuth, n_it)
+                equal = np.array_equal(previous, result)
+                all_equal &= equal
+                print(f'{shape[0]}x{shape[1]}, {100*error_fraction:.0f}% {"clustered" if clustered else "scattered"} errors, '
+                      f'vn_first_azimuth {vn_first_azimuth}, n_it {n_it}: previous {1e3*t_previous:.0f} ms, new {1e3*t:.0f} ms, equal {equal}')
+                for i, j in enumerate(dealiasing.iterations):
+                    print(f'  iteration {i}: {j["n_update"]} bins checked, {j["n_outliers"]} outliers, {j["n_changed"]} changed, '
+                          f'{1e3*j["time"]:.1f} ms')
+    print('All results equal:', all_equal)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the time needed to obtain the mappings between radar bins and product bins (Polar.get_parameters_data_mapping and
+Cartesian.get_parameters_data_mapping, followed by determining the (sorted) product heights) when alternating between 2 synthetic volume
+structures, as happens when switching between radars or when a radar alternates between volume coverage patterns. This is done
+- without cache, in which case the mapping is recalculated at each switch
+- with the bin mapping cache (nlr_mappingcache.py), in which case mappings are taken from memory after the first visit of a structure
+- with a new cache instance (as in a new session), in which case Cartesian mappings are read from disk at the first visit of a structure
+Mappings obtained from the cache should be equal to the recalculated ones. Cartesian products have a resolution of 0.5 km.
+Usage: python benchmark_mappingcache.py
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import tempfile
+import time as pytime
+from types import SimpleNamespace
+import numpy as np
+
+from derived.polar import Polar
+from derived.cartesian import Cartesian
+from derived.nlr_mappingcache import BinMappingCache
+
+
+# Radar, number of azimuths, radial resolution, number of radial bins and scanangles of the 2 volume structures
+structures = {'A': ('Radar A', 360, 0.25, 1000, [0.3, 0.5, 0.8, 1.1, 1.5, 2., 2.5, 3., 4., 5., 6., 8., 10., 12., 15.]),
+              'B': ('Radar B', 720, 0.5, 480, [0.5, 0.9, 1.3, 1.8, 2.4, 3.1, 4., 5.1, 6.4, 8., 10., 12.5, 15.6, 19.5])}
+n_switches = 8
+
+class NoCache():
+    def get_filename(self, *args):
+        return None
+    def get(self, key, filename=None):
+        return None
+    def put(self, *args):
+        pass
+
+def setup(cls, cache, derivedproducts_dir):
+    dsg = SimpleNamespace(scannumbers_all={'z': {}})
+    gui = SimpleNamespace(cartesian_product_res=0.5, cartesian_product_maxrange=200., stormmotion=(0., 0.), derivedproducts_dir=derivedproducts_dir)
+    dp = SimpleNamespace(dsg=dsg, gui=gui, mapping_cache=cache, bottom_scan_removed=True, products_requiring_heightsorted_data=['e'])
+    mapping = cls(dp)
+    mapping.i_p = 'z'
+    return mapping
+
+def set_structure(mapping, structure):
+    radar, n_azi, radial_res, n_rad, scanangles = structures[structure]
+    scans = list(range(1, len(scanangles)+1))
+    dsg, dp = mapping.dsg, mapping.dp
+    dsg.scannumbers_all['z'] = {j: [j] for j in scans}
+    dsg.get_radar_dataset = lambda no_special_char=False: radar
+    dp.index_all = lambda scan, sub_scan=0: scans.index(scan)+sub_scan
+    dp.get_indices_scans = lambda: np.array(scans)-1
+    dp.products_per_indices = {str(dp.get_indices_scans()): ['e']}
+    # Only the shape of the data arrays is used for the mapping
+    mapping.data_all = {j: [np.zeros((n_azi, n_rad), dtype='float32')] for j in scans}
+    mapping.scans, mapping.scans_all = scans, scans
+    mapping.scanangles_all = {j: scanangles[j-1] for j in scans}
+    mapping.radial_bins_all = {j: n_rad for j in scans}
+    mapping.radial_res_all = {j: radial_res for j in scans}
+    mapping.radial_range_all = {j: n_rad*radial_res for j in scans}
+    mapping.radius_offsets_all = {j: 0. for j in scans}
+    mapping.scantimes_all = {j: ['12:00:00'] for j in scans}
+
+def get_mapping(mapping):
+    mapping.get_product_dimensions()
+    mapping.get_product_shape()
+    mapping.get_product_slice()
+    mapping.get_parameters_data_mapping()
+    # As in sort_data_and_get_hdiffs_if_necessary
+    key = str(mapping.dp.get_indices_scans())
+    if isinstance(mapping, Polar):
+        if not key in mapping.product_heights:
+            mapping.get_product_heights()
+        return mapping.product_heights[key]
+    else:
+        if not key in mapping.sorted_heights:
+            mapping.get_sorted_heights()
+        return mapping.sorted_heights[key]
+
+def get_arrays(mapping, heights):
+    # The last row of hdiffs is not assigned
+    return [heights['heights_3D'], heights['hdiffs'][:-1], mapping.heights_3D_all]+\
+           [j for attr in ('productbins_unique_all_flat', 'radarbins_unique_all_flat') for i in mapping.__dict__[attr].values() for j in i]
+
+def equal(arrays, reference):
+    return len(arrays) == len(reference) and all(np.array_equal(i, j) for i, j in zip(arrays, reference))
+
+def run(cls, cache, derivedproducts_dir, references=None):
+    mapping = setup(cls, cache, derivedproducts_dir)
+    times, results = [], {}
+    for i in range(n_switches):
+        structure = 'AB'[i % 2]
+        set_structure(mapping, structure)
+        t = pytime.perf_counter()
+        heights = get_mapping(mapping)
+        times.append(pytime.perf_counter()-t)
+        if references is None:
+            results[structure] = get_arrays(mapping, heights)
+        else:
+            results[structure] = results.get(structure, True) and equal(get_arrays(mapping, heights), references[structure])
+    # Times for the first visit of both structures, and the mean time for the later visits
+    return f'{times[0]:.3f}/{times[1]:.3f} s, then {np.mean(times[2:]):.3f} s', results
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        for cls in (Polar, Cartesian):
+            t_nocache, references = run(cls, NoCache(), directory)
+            cache = BinMappingCache()
+            t_cache, equal_cache = run(cls, cache, directory, references)
+            cache_new = BinMappingCache()
+            t_new, equal_new = run(cls, cache_new, directory, references)
+            print(f'{cls.__name__}, time per switch (first visits of structures A/B, then mean of later visits):')
+            print(f'without cache {t_nocache}, with cache {t_cache}, new session {t_new}')
+            print('Equal results:', all(equal_cache.values()) and all(equal_new.values()))
+            print('Cache:', {i: j for i, j in cache.stats().items() if i != 'max_bytes'})
+            print('Cache in new session:', {i: j for i, j in cache_new.stats().items() if i != 'max_bytes'})
+
+        # Mappings with storm motion correction should not be stored on disk
+        mapping = setup(Cartesian, BinMappingCache(), directory+'/SM')
+        mapping.gui.stormmotion = (270., 15.)
+        set_structure(mapping, 'A')
+        mapping.scantimes_all = {j: [f'12:0{j//4}:{10*(j%4)}0'] for j in mapping.scans_all}
+        get_mapping(mapping)
+        print('Storm motion corrected mapping not on disk:', mapping.dp.mapping_cache.disk_writes == 0 and not os.path.exists(directory+'/SM'))
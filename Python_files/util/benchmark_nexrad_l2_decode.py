@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the columnar (bulk) decoding of MSG31 records in decoders/nexrad_l2.py with the dictionary-based decoding.
+Usage: python benchmark_nexrad_l2_decode.py <NEXRAD L2 file> [n_repeats]
+A super-res VCP 212 volume is most representative for animations.
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import time as pytime
+import numpy as np
+
+from decoders import nexrad_l2
+
+
+filename = sys.argv[1]
+n_repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+moments = ["REF", "VEL", "SW", "ZDR", "PHI", "RHO", "CFP"]
+
+meta = nexrad_l2.NEXRADLevel2File(filename, read_mode='all-meta')
+scans_startend_pos = meta.scan_startend_pos
+meta.close()
+
+def decode_volume():
+    # Mimics NEXRAD_L2.get_data_multiple_scans, with for each scan also the azimuths, times and Nyquist velocities
+    file = nexrad_l2.NEXRADLevel2File(filename, read_mode=scans_startend_pos)
+    for scan in range(file.nscans):
+        for moment in moments:
+            file.get_data(moment, 1840, scans=[scan], raw_data=True)
+        file.get_azimuth_angles([scan])
+        file.get_times([scan])
+        file.get_nyquist_vel([scan])
+    file.close()
+    return file
+
+timings = {}
+for bulk_decoding in (False, True):
+    nexrad_l2.bulk_decoding = bulk_decoding
+    decode_volume() # Warm-up, such that file system caching affects both modes equally
+    t = pytime.time()
+    for i in range(n_repeats):
+        file = decode_volume()
+    timings[bulk_decoding] = (pytime.time()-t)/n_repeats
+    print(f'bulk_decoding={bulk_decoding}: {timings[bulk_decoding]:.3f} s per volume ({len(file.radial_records)} radials, {file.nscans} scans)')
+print(f'Speedup: {timings[False]/timings[True]:.2f}x')
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the peak memory usage (max RSS) of loading several NEXRAD L2 volumes with and without zero-copy reading
+(nexrad_l2.zero_copy_reading), for uncompressed or gzipped files. Each mode is run in a separate process, since the
+max RSS of a process can only increase.
+Usage: python benchmark_nexrad_l2_memory.py <NEXRAD L2 file> [<NEXRAD L2 file> ...]
+The resource module is used for obtaining the max RSS, which is not available on Windows.
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import subprocess
+import resource
+import time as pytime
+
+from decoders import nexrad_l2
+
+
+def load_volumes(filenames):
+    # Mimics the use for derived products, for which all scans of several volumes are requested, and where the file
+    # objects are kept open (as with NEXRAD_L2.read_file for gzipped and uncompressed files).
+    files, data = [], []
+    for filename in filenames:
+        meta = nexrad_l2.NEXRADLevel2File(filename, read_mode='all-meta')
+        file = nexrad_l2.NEXRADLevel2File(filename, read_mode=meta.scan_startend_pos)
+        for scan in range(file.nscans):
+            data.append(file.get_data('REF', 1840, scans=[scan], raw_data=True))
+        files.append(file)
+    return files, data
+
+def max_rss_MB():
+    # ru_maxrss is given in kilobytes on Linux, and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss/1024**2 if sys.platform == 'darwin' else max_rss/1024
+
+
+if len(sys.argv) > 2 and sys.argv[1] == '--child':
+    nexrad_l2.zero_copy_reading = sys.argv[2] == 'True'
+    rss_start = max_rss_MB()
+    t = pytime.time()
+    load_volumes(sys.argv[3:])
+    print(f'{max_rss_MB()-rss_start:.1f} {pytime.time()-t:.3f}')
+else:
+    filenames = sys.argv[1:]
+    results = {}
+    for zero_copy_reading in (False, True):
+        output = subprocess.run([sys.executable, __file__, '--child', str(zero_copy_reading)]+filenames,
+                                capture_output=True, text=True, check=True).stdout
+        results[zero_copy_reading] = [float(j) for j in output.split()[-2:]]
+        rss, t = results[zero_copy_reading]
+        print(f'zero_copy_reading={zero_copy_reading}: max RSS increase {rss:.1f} MB, {t:.3f} s for {len(filenames)} volumes')
+    print(f'Reduction of max RSS increase: {results[False][0]-results[True][0]:.1f} MB')
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Checks and timings for the Unet VDA dealiaser (dealiasing/unet_vda/unet_vda.py):
+- The vectorized Unet_VDA.expand_data_to_360deg is compared with the previous loop-based implementation, for random scans with data gaps.
+- When TensorFlow is available, the correction of velocities for the categories predicted by the network in NumpyBackend.dealias_vel is
+  compared with VelocityDealiaser.dealias_vel in src/dealias.py, for random network outputs.
+- When TensorFlow is available, the model is exported for the NumPy backend (when not done before), and the dealiased velocities from
+  the NumPy and TensorFlow backends are compared for synthetic aliased scans. Also dealiasing all scans at once with
+  Unet_VDA.dealias_scans is compared with dealiasing them one by one.
+- Timings are given for each available backend.
+Usage: python benchmark_unet_vda.py
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import time as pytime
+from types import SimpleNamespace
+import numpy as np
+
+from nlr_functions import angle_diff
+from dealiasing.unet_vda import unet_vda as uv
+
+
+n_repeat = 3
+
+def expand_data_to_360deg_loop(data, vn, azis, da):
+    n_azi, n_rad = data.shape
+
+    _data, indices = [], []
+    j = 0
+    for i,a in enumerate(azis):
+        n = angle_diff(a, azis[(i+1)%n_azi], between_0_360=True)/da
+        if n > 3:
+            k = sum(map(len, _data))
+            _data += [data[j:i+1], np.full((round(n)-1, n_rad), np.nan, data.dtype)]
+            indices += list(range(k, k+i+1-j))
+            j = i+1
+    k = sum(map(len, _data))
+    n_expected = round(360/da)
+    n_extra = max(0, k-n_expected)
+    _data += [data[j:], np.full((n_extra, n_rad), np.nan, data.dtype)]
+    indices += list(range(k, k+n_azi-j))
+    _data = np.concatenate([j for j in _data if len(j)])
+
+    shift = round(azis[0]/da)
+    _data = np.roll(_data, shift, axis=0)
+    indices = (np.array(indices)+shift) % len(_data)
+
+    _vn = np.full(len(_data), np.nan, data.dtype)
+    _vn[indices] = vn
+    return _data, _vn, indices
+
+def random_scan_with_gaps(rng):
+    da = rng.choice([0.5, 1., 1.2])
+    n = int(round(360/da))
+    azis = (rng.uniform(0, 360)+da*np.arange(n)+rng.normal(0, 0.05, n)) % 360
+    keep = np.ones(n, bool)
+    for i in range(rng.integers(0, 4)):
+        start = rng.integers(0, n)
+        keep[start:start+rng.integers(1, 60)] = False
+    azis = azis[keep]
+    return rng.random((len(azis), 20)).astype('float32'), rng.random(len(azis)).astype('float32'), azis, da
+
+def check_expand_data(vda, rng):
+    t_loop = t_vectorized = 0.
+    for i in range(300):
+        data, vn, azis, da = random_scan_with_gaps(rng)
+        t = pytime.perf_counter()
+        result1 = expand_data_to_360deg_loop(data, vn, azis, da)
+        t_loop += pytime.perf_counter()-t
+        t = pytime.perf_counter()
+        result2 = vda.expand_data_to_360deg(data, vn, azis, da)
+        t_vectorized += pytime.perf_counter()-t
+        if not all(np.array_equal(j, k, equal_nan=True) for j, k in zip(result1, result2)):
+            return False, t_loop, t_vectorized
+    return True, t_loop, t_vectorized
+
+def check_dealias_vel(rng):
+    # dealias_vel only uses apply_correction, such that the model doesn't need to be built
+    from dealiasing.unet_vda.src.dealias import VelocityDealiaser
+    vda = SimpleNamespace(apply_correction=lambda *args: VelocityDealiaser.apply_correction(None, *args))
+    vel = rng.uniform(-20, 20, (2, 360, 128)).astype('float32')
+    vel[rng.random(vel.shape) < 0.1] = np.nan
+    nyq = rng.uniform(8, 25, (2, 360, 1)).astype('float32')
+    out = rng.normal(0, 1, (2, 360, 128, 6)).astype('float32')
+    reference = VelocityDealiaser.dealias_vel(vda, vel[..., None], out, nyq[..., None]).numpy()[..., 0]
+    result = uv.NumpyBackend.dealias_vel(None, vel, out, nyq)
+    return np.array_equal(reference, result, equal_nan=True)
+
+def synthetic_scans(rng):
+    # Aliased velocities for a uniform wind field plus noise, for typical scan dimensions
+    scans = []
+    for n_azi, n_rad, vn in ((360, 400, 8.), (360, 1000, 12.), (720, 1832, 16.), (361, 600, 25.)):
+        azi = np.deg2rad(np.arange(0.5, n_azi)*360/n_azi)[:, None]
+        v = 30*np.sin(azi)*np.linspace(0.3, 1, n_rad)+rng.normal(0, 1, (n_azi, n_rad))
+        v = ((v+vn) % (2*vn)-vn).astype('float32')
+        v[rng.random(v.shape) < 0.1] = np.nan
+        scans.append((v, vn))
+    return scans
+
+def timing(vda, scans):
+    t = pytime.perf_counter()
+    for i in range(n_repeat):
+        for data, vn in scans:
+            vda(data, vn)
+    t_single = (pytime.perf_counter()-t)/n_repeat
+    t = pytime.perf_counter()
+    for i in range(n_repeat):
+        vda.dealias_scans([j[0] for j in scans], [j[1] for j in scans])
+    return t_single, (pytime.perf_counter()-t)/n_repeat
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    vda = uv.Unet_VDA()
+    equal, t_loop, t_vectorized = check_expand_data(vda, rng)
+    print(f'expand_data_to_360deg equal results: {equal}, loop {t_loop:.3f} s, vectorized {t_vectorized:.3f} s')
+
+    try:
+        print('NumpyBackend.dealias_vel equal to VelocityDealiaser.dealias_vel:', check_dealias_vel(rng))
+    except ImportError as e:
+        print(e, 'check_dealias_vel')
+
+    scans = synthetic_scans(rng)
+    results = {}
+    for name in ('tensorflow', 'numpy'):
+        try:
+            vda = uv.Unet_VDA(name)
+            vda.load_model()
+        except Exception as e:
+            print(e, name)
+            continue
+        if name == 'tensorflow' and not os.path.exists(uv.numpy_model_filename):
+            vda.backend.export_numpy_model()
+            print('Exported model to', uv.numpy_model_filename)
+
+        results[name] = [vda(data, vn) for data, vn in scans]
+        batch = vda.dealias_scans([j[0] for j in scans], [j[1] for j in scans])
+        print(f'{name}: batch equal to single scans:', all(np.array_equal(j, k, equal_nan=True) for j, k in zip(batch, results[name])))
+        t_single, t_batch = timing(vda, scans)
+        print(f'{name}: {len(scans)} scans one by one {t_single:.2f} s, all at once {t_batch:.2f} s')
+
+    if len(results) == 2:
+        for (data, vn), v_tf, v_np in zip(scans, results['tensorflow'], results['numpy']):
+            unmasked = ~np.isnan(data)
+            fraction = np.count_nonzero(v_tf[unmasked] != v_np[unmasked])/np.count_nonzero(unmasked)
+            print(f'{data.shape} vn={vn}: max abs difference {np.nanmax(np.abs(v_tf-v_np)):.2e}, fraction of different bins {fraction:.2e}')
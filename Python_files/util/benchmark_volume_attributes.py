@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the startup and lookup time of the pickled volume attributes dictionaries (attributes_descriptions, attributes_IDs and
+attributes_variable, as used by previous versions) with those of the SQLite store in nlr_volumeattributes.py, for a synthetic archive
+with a given number of volumes. The SQLite database is created by migrating the pickle files, as happens at the first startup.
+Usage: python benchmark_volume_attributes.py [<number of volumes> ...]
+The default numbers of volumes are 100000 and 1000000.
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import tempfile
+import pickle
+import time as pytime
+import numpy as np
+
+from nlr_volumeattributes import VolumeAttributesStore
+
+
+radar_datasets = ['KTLX', 'KFWS', 'Den Helder_Z', 'Den Helder_V', 'Herwijnen_Z', 'Herwijnen_V']
+n_descriptions = 20 # Number of distinct attribute series per radar_dataset
+
+def create_attributes(n_volumes, rng):
+    descriptions = {'version':16, 'version_sources':{}}
+    IDs, variable = {}, {}
+    n_per_dataset = n_volumes//len(radar_datasets)
+    for rd in radar_datasets:
+        descriptions[rd] = {}
+        for ID in range(1, n_descriptions+1):
+            scanangles = {p:{j:float(0.5*j+0.01*ID) for j in range(1, 16)} for p in ('z', 'v', 'w')}
+            descriptions[rd][ID] = [scanangles, {'z':{'1-15':0.25}, 'v':'z', 'w':'z'}, {'z':{'1-15':1840}}, 'variable', [1, 2]]
+        IDs[rd] = {'': {}}
+        variable[rd] = {'': {}}
+        # 5-minute volumes
+        for abstime in range(0, 300*n_per_dataset, 300):
+            datetime = pytime.strftime('%Y%m%d%H%M', pytime.gmtime(1.5e9+abstime))
+            date, time = datetime[:8], datetime[8:]
+            IDs[rd][''].setdefault(date, {})[time] = [int(rng.integers(1, n_descriptions+1)), int(rng.integers(1e6, 1e8)), 0]
+            variable[rd][''].setdefault(date, {})[time] = [{j:float(rng.random()) for j in range(1, 16)}]
+    return descriptions, IDs, variable
+
+def lookup_pickled(descriptions, IDs, variable, rd, date, time):
+    attrs_ID, size, startazimuth = IDs[rd][''][date][time]
+    return descriptions[rd][attrs_ID], variable[rd][''][date][time]
+
+def lookup_sqlite(store, rd, datetime):
+    attrs_ID, size, startazimuth = store.get_ID(rd, '', datetime)
+    return store.get_descriptions(rd)[attrs_ID], store.get_variable(rd, '', datetime)
+
+
+def benchmark(n_volumes, tempdir, n_lookups=1000):
+    rng = np.random.default_rng(0)
+    attributes = create_attributes(n_volumes, rng)
+    filenames = [os.path.join(tempdir, f'attributes_{j}.pkl') for j in ('descriptions', 'IDs', 'variable')]
+    for filename, attrs in zip(filenames, attributes):
+        with open(filename, 'wb') as f:
+            pickle.dump(attrs, f)
+    pickles_size = sum(os.path.getsize(j) for j in filenames)
+    lookups = [(rd, date, time) for rd in radar_datasets for date in attributes[1][rd][''] for time in attributes[1][rd][''][date]]
+    lookups = [lookups[j] for j in rng.integers(0, len(lookups), n_lookups)]
+    del attributes
+
+    t = pytime.perf_counter()
+    loaded = []
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            loaded.append(pickle.load(f))
+    t_startup_pickle = pytime.perf_counter()-t
+    t = pytime.perf_counter()
+    for j in lookups:
+        lookup_pickled(*loaded, *j)
+    t_lookup_pickle = (pytime.perf_counter()-t)/n_lookups
+    t = pytime.perf_counter()
+    for filename, attrs in zip(filenames, loaded):
+        with open(filename, 'wb') as f:
+            pickle.dump(attrs, f)
+    t_save_pickle = pytime.perf_counter()-t
+    del loaded
+
+    db_filename = os.path.join(tempdir, 'volume_attributes.sqlite')
+    t = pytime.perf_counter()
+    store = VolumeAttributesStore(db_filename)
+    store.migrate_from_pickles(*filenames)
+    store.close()
+    t_migrate = pytime.perf_counter()-t
+    db_size = os.path.getsize(db_filename)
+
+    t = pytime.perf_counter()
+    store = VolumeAttributesStore(db_filename)
+    store.check_version(16, {})
+    t_startup_sqlite = pytime.perf_counter()-t
+    t = pytime.perf_counter()
+    for rd, date, time in lookups:
+        lookup_sqlite(store, rd, date+time)
+    t_lookup_sqlite = (pytime.perf_counter()-t)/n_lookups
+    t = pytime.perf_counter()
+    descriptions = store.get_descriptions(radar_datasets[0])
+    for j in range(100):
+        store.put(radar_datasets[0], '', f'2099010100{j:02d}', descriptions[1+j%n_descriptions], 10**7, 0, [{1:0.5}])
+    t_put_sqlite = (pytime.perf_counter()-t)/100
+    store.close()
+    os.remove(db_filename)
+
+    print(f'{n_volumes} volumes:')
+    print(f'  pickle: startup {t_startup_pickle:.3f} s, lookup {1e6*t_lookup_pickle:.1f} us, save on exit {t_save_pickle:.3f} s, '
+          f'size {pickles_size/1024**2:.1f} MB')
+    print(f'  sqlite: startup {t_startup_sqlite:.3f} s, lookup {1e6*t_lookup_sqlite:.1f} us, store {1e3*t_put_sqlite:.2f} ms per volume, '
+          f'size {db_size/1024**2:.1f} MB, one-time migration {t_migrate:.1f} s')
+
+
+if __name__ == '__main__':
+    numbers = [int(float(j)) for j in sys.argv[1:]] or [100000, 1000000]
+    with tempfile.TemporaryDirectory() as tempdir:
+        for n_volumes in numbers:
+            benchmark(n_volumes, tempdir)
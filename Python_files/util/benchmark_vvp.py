@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the VVP retrieval in VWP/vvp.py with the previous version (PreviousVVP below), which assembled the velocities per height layer and
+per scan in lists, tested data availability per sector pair, and called scipy.optimize.lsq_linear for each height layer. Synthetic volumes
+are used with a wind profile that varies with height, noise, data gaps and aliased velocities. Retrieved profiles should be equal up to the
+tolerance of the least-squares solvers.
+Usage: python benchmark_vvp.py
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import time as pytime
+from types import SimpleNamespace
+import numpy as np
+from scipy.optimize import lsq_linear
+
+import nlr_functions as ft
+from VWP.vvp import VVP
+
+
+scanangles = [0.3, 0.8, 1.5, 2.5, 3.5, 4.5, 6., 8., 10., 12., 15., 20., 25.]
+n_repeat = 3
+
+class PreviousVVP(VVP):
+    def get_V_height_layers(self):
+        """Divides the vertical dimension into height layers with a thickness of self.dh km, from self.height_limits[0] to self.height_limits[1] km.
+        Next, all available velocities in these layers are listed, as a function of the azimuth phi and the scanangle theta.        
+        At last the total number of radar bins available within the height layer is determined (which also includes radar bins for
+        which no velocity is available).
+        """
+        hlayer_centers = np.arange(self.height_limits[0], self.height_limits[1]+1e-3, self.dh)
+        if self.h0 > 0:
+            hlayer_centers += self.h0
+            
+        attrs = ('h_layers', 'v_layers', 'vn_layers', 'azi_layers', 'theta_layers')
+        for attr in attrs:
+            self.__dict__[attr] = {h:[] for h in hlayer_centers}
+        self.totalbins_layers_scans = {h: {j:0 for j in self.data} for h in hlayer_centers}
+        h_before = None
+        for h in hlayer_centers:
+            for j in self.data:
+                height_range = np.array([np.max([0, h-self.dh/2.-self.antenna_height]), h+self.dh/2.-self.antenna_height])
+                ground_range = ft.var1_to_var2(height_range, self.scanangles[j], 'h+theta->gr')  
+                ground_range[0] = max([ground_range[0], self.range_limits[0]])
+                ground_range[1] = min([ground_range[1], self.range_limits[1]])
+                if ground_range[1] <= ground_range[0]:
+                    continue #This can occur when both ground_range[0] and ground_range[1] lie outside self.range_limits,
+                    #and is caused by the fact that only one of the values gets corrected.
+                
+                slant_range = ft.var1_to_var2(ground_range, self.scanangles[j], 'gr+theta->sr')
+                #Bins are included when at least half of a bin is inside the height range.
+                bins_range = np.round(slant_range/self.radial_res[j]-np.array([0, 1])).astype('int')
+                bins_range[1] = min([bins_range[1], self.radial_bins[j]-1])
+                if bins_range[0] > bins_range[1]:
+                    continue #This can occur when np.round(slant_range/self.radial_res[j]) gives
+                    #the same result for both elements in slant_range, such that subtracting 1 of the latter leads to this problem.
+                
+                data_bins_range = self.data[j][:,bins_range[0]:bins_range[1]+1]
+                unmasked = ~np.isnan(data_bins_range)
+                #Remove velocities below self.v_min m/s, to reduce contamination by ground clutter.
+                unmasked[unmasked] = (np.abs(data_bins_range[unmasked]) >= self.v_min)
+                data_unmasked = data_bins_range[unmasked]
+
+                if data_unmasked.shape[0]>0:
+                    na, nr = self.data[j].shape
+                    data_heights = self.antenna_height+np.tile(ft.var1_to_var2(self.radial_res[j]*np.arange(0.5+bins_range[0], bins_range[1]+1), self.scanangles[j], 'sr+theta->h'), (na, 1))
+                    self.h_layers[h].append(data_heights[unmasked])
+                    self.v_layers[h].append(data_unmasked)
+                    self.vn_layers[h].append(np.full(data_unmasked.shape[0], self.dsg.nyquist_velocities_all_mps[j], dtype='float32'))
+                    data_azimuths = np.tile(np.arange(0.5, na, 1), (nr, 1)).T*(2*np.pi/na)
+                    self.azi_layers[h].append(data_azimuths[:, bins_range[0]:bins_range[1]+1][unmasked])
+                    self.theta_layers[h].append(np.full(data_unmasked.shape[0], self.scanangles[j]*np.pi/180., dtype='float32'))
+                    self.totalbins_layers_scans[h][j] += np.size(data_bins_range)
+                
+            if len(self.h_layers[h]) == 0:
+                del self.h_layers[h]
+                continue
+            
+            for attr in attrs:
+                self.__dict__[attr][h] = np.concatenate(self.__dict__[attr][h])
+            self.h_layers[h] = self.h_layers[h].mean()-self.h0
+            
+            if h_before and self.h_layers[h]-self.h_layers[h_before] < 0.1:
+                n1, n2 = len(self.v_layers[h_before]), len(self.v_layers[h])
+                self.h_layers[h] = (n1*self.h_layers[h_before]+n2*self.h_layers[h])/(n1+n2)
+                for attr in attrs:
+                    if not attr == 'h_layers':
+                        self.__dict__[attr][h] = np.concatenate([self.__dict__[attr][h], self.__dict__[attr][h_before]])
+                    del self.__dict__[attr][h_before]
+            h_before = h
+            
+    def test_data_availability_height_layers(self, count_filled_sectors = False): 
+        """Divide the azimuthal dimension into self.n_sectors sectors, that each span 360/self.n_sectors degrees. 
+        Sectors are grouped into pairs of two, with the members being located opposite to each other. This implies that when sector 1 spans
+        the azimuthal range of 0 to 45 degrees, that sector 2 spans the range of 180 to 225 degrees. 
+        
+        A condition on data availibility is now that for at least one of these two sectors within a pair, the radar bins with velocities available
+        must at least cover an area of self.min_area_sector. This condition is posed in order to reduce the number of incorrect retrievals
+        due to a low amount of data.
+        The reason for grouping sectors into these pairs is that for a sine or cosine the function values in opposite sectors of the 
+        the azimuthal domain should have only a flipped sign. This implies that the availability of data in both these sectors does not provide much more
+        information than when it is available for only one sector. That is the reason that it is considered sufficient when only one sector within a pair
+        contains enough data to satisfy the above areal condition.     
+        
+        There is an issue with the above condition however, and that is that the vertical resolution of data is radar-dependent. This means that for some radars
+        there will be multiple scans that cover a particular height range, while for others there might be only one. In the latter case it is much more
+        difficult to satisfy the areal condition. For this reason data availability within a certain sector is also considered to be sufficient when for at least
+        one scan velocity is available for at least 33% of the total number of radar bins within that sector for that scan.
+        
+        The conditions on data availability used here is different from and probably less strict than the one used by Iwan Holleman, who divides the azimuthal domain in 8
+        sectors of 45 degrees, and requires for all sectors (<- especially this is quite a criterion) that at least 5 data points are available.
+        """
+        sector_width = 2*np.pi/(self.n_sectors)
+        self.filled_sectors = []
+        for h in self.h_layers.copy():
+            theta_layers_scans = {k: self.theta_layers[h] == self.scanangles[k]*np.pi/180. for k in self.data}
+            self.filled_sectors += [0]
+            for j in range(self.n_sectors//2):
+                azirange_sector1 = sector_width*np.array([j, j+1])
+                azirange_sector2 = np.pi + sector_width*np.array([j, j+1])
+                
+                select1 = (self.azi_layers[h]>=azirange_sector1[0]) & (self.azi_layers[h]<azirange_sector1[1])
+                select2 = (self.azi_layers[h]>=azirange_sector2[0]) & (self.azi_layers[h]<azirange_sector2[1])
+                
+                max_fractional_nbins_sector1 = max([np.count_nonzero(select1 & theta_layers_scans[k]) / (self.totalbins_layers_scans[h][k]/self.n_sectors) for k in self.data if not self.totalbins_layers_scans[h][k] == 0])
+                """IMPORTANT: With the current condition on max_fractional_bins_sector (>= 0.33) it seems like the areal condition (>= 7) has no effect anymore,
+                since every sector that satisfies the areal condition also seems to satisfy the fractional condition. It should therefore be considered to remove
+                the areal condition.
+                """
+                if max_fractional_nbins_sector1 >= 0.33:
+                    self.filled_sectors[-1] += 1
+                if not max_fractional_nbins_sector1 >= 0.33 or count_filled_sectors:
+                    max_fractional_nbins_sector2 = max([np.count_nonzero(select2 & theta_layers_scans[k]) / (self.totalbins_layers_scans[h][k]/self.n_sectors) for k in self.data if not self.totalbins_layers_scans[h][k] == 0])
+                    if max_fractional_nbins_sector2 >= 0.33:
+                        self.filled_sectors[-1] += 1
+                        
+                availability_condition_satisfied = self.filled_sectors[-1] >= self.min_sector_pairs_filled
+                if not count_filled_sectors and (availability_condition_satisfied or
+                self.min_sector_pairs_filled-self.filled_sectors[-1] > self.n_sectors//2-(j+1)):
+                    #In the latter case it is impossible to get self.min_sector_pairs_filled sectors filled, despite the remaining iterations.
+                    break
+            
+            if self.filled_sectors[-1] < self.min_sector_pairs_filled:
+                self.filled_sectors.pop()
+                del self.h_layers[h]
+        self.filled_sectors = np.array(self.filled_sectors)
+                        
+    def retrieve_velocities_through_fit(self, determine_uncertainty=True):      
+        """Fit the formula "Vr = w*sin(theta)+u_0*cos(theta)*sin(phi)+v_0*cos(theta)*cos(phi)" to the self.data, 
+        where w = w_0 + W_f, the sum of the vertical velocity and the terminal velocity of hydrometeors.
+        """    
+        self.V = []; self.w = []; self.sigma = []
+        for i, h in enumerate(self.h_layers):
+            if not determine_uncertainty and i < len(self.h_layers):
+                # Attempt extended dealiasing of the velocity for the next height using the retrieved velocity for the current height
+                V_below = self.V0 if i == 0 else self.V[i-1]
+                if not V_below is None:
+                    V, a = np.linalg.norm(V_below), np.arctan2(V_below[0], V_below[1])
+                    V_diff = self.v_layers[h]-V*np.cos(self.azi_layers[h]-a)
+                    select = np.abs(V_diff) > self.vn_layers[h]
+                    self.v_layers[h][select] += -np.sign(V_diff[select])*2*self.vn_layers[h][select]
+                
+            A = np.transpose([np.cos(self.theta_layers[h])*np.sin(self.azi_layers[h]),np.cos(self.theta_layers[h])*np.cos(self.azi_layers[h]), np.sin(self.theta_layers[h])])
+            #x = [u_0,v_0,w]
+            b = self.v_layers[h]
+            #Require that -10<=w<=0 m/s, otherwise unrealistic estimates for w might be obtained
+            output = lsq_linear(A, b, bounds = ([-np.inf, -np.inf, -10.], [np.inf, np.inf, 0.]))
+            params = output.x
+            self.V += [params[:2]]
+            self.w += [params[2]]
+            
+            if determine_uncertainty:
+                Vr_fit = np.linalg.norm(self.V[i])*np.cos(self.theta_layers[h])*np.cos(self.azi_layers[h]-np.arctan2(self.V[i][0],self.V[i][1]))+self.w[i]*np.sin(self.theta_layers[h])
+                self.sigma += [np.sqrt(np.sum(np.power(self.v_layers[h]-Vr_fit,2.))/(self.v_layers[h].shape[0]-3))]
+                #Formula (3.21) from Iwan Holleman is used to calculate the standard deviation self.sigma of the radial velocity
+            
+        self.V, self.w, self.sigma = np.array(self.V), np.array(self.w), np.array(self.sigma)
+                
+    def remove_outliers_and_repeat_fit(self):
+        """Remove outliers, by requiring that the radial velocities deviate by less than self.dv_outliers from the value that follows
+        from the determined velocities. After removal of outliers, repeat the fit.
+        """
+        for i, h in enumerate(self.h_layers):
+            Vr_fit = np.linalg.norm(self.V[i])*np.cos(self.theta_layers[h])*np.cos(self.azi_layers[h]-np.arctan2(self.V[i][0],self.V[i][1]))+self.w[i]*np.sin(self.theta_layers[h])
+            non_outliers = np.abs(self.v_layers[h]-Vr_fit)<self.dv_outliers
+            self.v_layers[h] = self.v_layers[h][non_outliers]
+            self.theta_layers[h] = self.theta_layers[h][non_outliers]
+            self.azi_layers[h] = self.azi_layers[h][non_outliers]
+            
+        self.test_data_availability_height_layers(count_filled_sectors = True)
+        self.retrieve_velocities_through_fit()
+
+
+def synthetic_volume(rng, n_azi=360, radial_res=0.125, max_range=25., vn=16.):
+    data, radial_res_all, nyquist = {}, {}, {}
+    n_rad = int(max_range/radial_res)
+    azi = np.deg2rad(np.arange(0.5, n_azi)*360/n_azi)[:, None]
+    for j, theta in enumerate(scanangles, 1):
+        sr = radial_res*np.arange(0.5, n_rad)
+        h = ft.var1_to_var2(sr, theta, 'sr+theta->h')
+        u, v = 5+3*h, 10-2*h+np.sin(h)
+        vr = np.cos(np.deg2rad(theta))*(u*np.sin(azi)+v*np.cos(azi))-3*np.sin(np.deg2rad(theta))
+        vr = vr+rng.normal(0, 1.5, vr.shape)
+        # Clutter-like outliers, aliasing and data gaps
+        outliers = rng.random(vr.shape) < 0.01
+        vr[outliers] += rng.normal(0, 30, np.count_nonzero(outliers))
+        vr = (vr+vn) % (2*vn)-vn
+        vr[rng.random(vr.shape) < 0.3] = np.nan
+        vr[rng.integers(0, n_azi-60):][:60] = np.nan
+        data[j], radial_res_all[j], nyquist[j] = vr.astype('float32'), radial_res, vn
+    return data, radial_res_all, nyquist
+
+def run_vvp(cls, data, radial_res, nyquist, V0=None):
+    dsg = SimpleNamespace(nyquist_velocities_all_mps=nyquist)
+    vvp = cls(SimpleNamespace(crd=None, dsg=dsg))
+    vvp.h0, vvp.V0, vvp.antenna_height = 0., V0, 0.03
+    vvp.data, vvp.nyquist_velocities = data, nyquist
+    vvp.scanangles = {j: scanangles[j-1] for j in data}
+    vvp.radial_bins = {j: data[j].shape[1] for j in data}
+    vvp.radial_res = radial_res
+    vvp.get_V_height_layers()
+    vvp.test_data_availability_height_layers()
+    vvp.retrieve_velocities_through_fit(determine_uncertainty=False)
+    vvp.remove_outliers_and_repeat_fit()
+    return np.array(list(vvp.h_layers.values())), vvp.V, vvp.w, vvp.sigma, vvp.filled_sectors
+
+def timing(cls, *args):
+    t = pytime.perf_counter()
+    for i in range(n_repeat):
+        run_vvp(cls, *args)
+    return (pytime.perf_counter()-t)/n_repeat
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    for radial_res, vn, V0 in ((0.125, 16., None), (0.25, 8., None), (0.5, 12., np.array([5., 10.])), (1., 25., None)):
+        args = synthetic_volume(rng, radial_res=radial_res, vn=vn)
+        results_previous = run_vvp(PreviousVVP, *args, V0)
+        results = run_vvp(VVP, *args, V0)
+        equal = all(np.allclose(i, j, rtol=0, atol=1e-6) for i, j in zip(results_previous, results)) and\
+                all(np.shape(i) == np.shape(j) for i, j in zip(results_previous, results))
+        print(f'radial_res={radial_res}, vn={vn}, V0={V0}: {len(results[0])} layers, equal results: {equal}')
+        print(f'  previous version {timing(PreviousVVP, *args, V0):.3f} s, new version {timing(VVP, *args, V0):.3f} s')
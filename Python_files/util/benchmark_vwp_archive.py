@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput of the archive-wide VWP generation in VWP/vwp_archive.py, for synthetic radar volumes (see benchmark_vvp.py). Profiles are
+calculated one by one in this process, and with a process pool as done by VWPArchiveGenerator (with vwp_worker.py as main module of the
+worker processes). The profiles are then written to a
+time-height store in batches, with an interruption halfway, after which generation is resumed for the remaining datetimes. It is checked
+that the profiles read back from the store are equal to the directly calculated ones, and that changed volumes are replaced.
+Finally it is checked that PlottingVWP.get_time_height_data reads the profiles that are written with the keys of VWPArchiveGenerator
+(requires PyQt5 and vispy).
+Usage: python benchmark_vwp_archive.py [n_volumes] [n_workers]
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import tempfile
+import time as pytime
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import h5py
+
+import nlr_functions as ft
+from VWP import vwp_archive as va
+from VWP import vwp_worker as vw
+from VWP.vvp import VVP
+from benchmark_vvp import synthetic_volume, scanangles
+
+
+settings = {'range_limits': [2., 25.], 'height_limits': [0.1, 11.9], 'v_min': 2.}
+heights = np.arange(settings['height_limits'][0], settings['height_limits'][1]+1e-3, 0.2)
+group_name = va.get_group_name(settings['range_limits'], settings['height_limits'], 0.2, settings['v_min'])
+
+def volume_args(seed):
+    data, radial_res, nyquist = synthetic_volume(np.random.default_rng(seed), radial_res=0.25)
+    return (settings, data, {j: scanangles[j-1] for j in data}, radial_res, nyquist, 0.03)
+
+def records(datetimes, profiles, size=1000):
+    return [{'datetime': i, 'producttime': '00:00:00-00:05:00', 'total_volume_files_size': size, 'profile': j} for i, j in zip(datetimes, profiles)]
+
+def profiles_equal(store_data, row, profile):
+    indices, h, V, w, sigma, filled_sectors = profile
+    stored = [store_data[j][row] for j in ('h', 'u', 'v', 'w', 'sigma', 'filled_sectors')]
+    if any(np.count_nonzero(~np.isnan(j)) != len(indices) for j in stored):
+        return False
+    return all(np.allclose(i[indices], j, rtol=1e-6) for i, j in zip(stored, (h, V[:, 0], V[:, 1], w, sigma, filled_sectors)))
+
+def check_time_height_reader(directory, datetimes, profiles):
+    from VWP.nlr_plottingvwp import PlottingVWP
+    dsg = SimpleNamespace(get_radar_dataset=lambda no_special_char=False: 'Radar', get_subdataset=lambda product: 'V', data_source=lambda: 'KNMI')
+    gui = SimpleNamespace(vvp_range_limits=settings['range_limits'], vvp_height_limits=settings['height_limits'], vvp_vmin_mps=settings['v_min'],
+                          derivedproducts_dir=directory, dsg=dsg)
+    # As in VWPArchiveGenerator.__call__
+    store, group_name, vvp_version = va.get_store_and_keys(gui, VVP(None, **va.get_settings(gui)))
+    store.write(group_name, heights, vvp_version, records(datetimes, profiles))
+    pvwp = SimpleNamespace(gui=gui)
+    data = PlottingVWP.get_time_height_data(pvwp, datetimes[1], datetimes[-1])
+    equal = data['datetimes'].tolist() == datetimes[1:] and all(profiles_equal(data, i, j) for i, j in enumerate(profiles[1:]))
+    # Profiles for other VVP settings are not present
+    gui.vvp_vmin_mps += 1
+    return equal and PlottingVWP.get_time_height_data(pvwp) is None
+
+
+if __name__ == '__main__':
+    n_volumes = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else max(1, os.cpu_count()-1)
+    args = [volume_args(j) for j in range(n_volumes)]
+    datetimes = [int(ft.next_datetime('202401010000', 5*j)) for j in range(n_volumes)]
+
+    t = pytime.perf_counter()
+    profiles = [vw.calculate_profile(j) for j in args]
+    t_serial = pytime.perf_counter()-t
+    t = pytime.perf_counter()
+    with ProcessPoolExecutor(n_workers) as executor:
+        with vw.as_main_module():
+            futures = [executor.submit(vw.calculate_profile, j) for j in args]
+        profiles_pool = [j.result() for j in futures]
+    t_pool = pytime.perf_counter()-t
+    print(f'{n_volumes} volumes: one by one {n_volumes/t_serial:.1f} volumes/s, process pool with {n_workers} workers {n_volumes/t_pool:.1f} volumes/s')
+    print('Equal profiles with process pool:', all(all(np.array_equal(i, j) for i, j in zip(p1, p2)) for p1, p2 in zip(profiles, profiles_pool)))
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = va.VWPTimeHeightStore(directory+'/VWP/radar/time_height.h5')
+        n = n_volumes//2
+        # Write the first half in batches, in reversed order to check that reading sorts by datetime
+        t = pytime.perf_counter()
+        for i in range(n, 0, -va.write_interval):
+            s = slice(max(0, i-va.write_interval), i)
+            store.write(group_name, heights, '1_0', records(datetimes[s], profiles[s]))
+        # An interrupted write: datasets are resized and (partially) written, but n_rows is not updated
+        with h5py.File(store.filename, 'a') as f:
+            for name in ('datetimes', 'h'):
+                f[group_name][name].resize(n+3, axis=0)
+            f[group_name]['datetimes'][n:n+3] = datetimes[n:n+3]
+        completed = store.get_completed(group_name, '1_0')
+        print('Completed after interruption:', sorted(completed) == datetimes[:n])
+        remaining = [i for i, j in enumerate(datetimes) if not j in completed]
+        for i in range(0, len(remaining), va.write_interval):
+            s = remaining[i:i+va.write_interval]
+            store.write(group_name, heights, '1_0', records([datetimes[j] for j in s], [profiles[j] for j in s]))
+        t_write = pytime.perf_counter()-t
+
+        t = pytime.perf_counter()
+        data = store.read(group_name)
+        t_read = pytime.perf_counter()-t
+        print(f'Store: writing {1e3*t_write:.1f} ms, reading {1e3*t_read:.1f} ms, file size {os.path.getsize(store.filename)/1e3:.0f} kB')
+        print('Read datetimes sorted and complete:', data['datetimes'].tolist() == datetimes)
+        print('Equal profiles from store:', all(profiles_equal(data, i, j) for i, j in enumerate(profiles)))
+
+        # A changed volume replaces its row, and a failed profile is not returned by read
+        store.write(group_name, heights, '1_0', records(datetimes[:1], [profiles[1]], size=2000)+records(datetimes[1:2], [None]))
+        completed = store.get_completed(group_name, '1_0')
+        data = store.read(group_name, startdatetime=datetimes[0], enddatetime=datetimes[2])
+        print('Changed volumes replaced:', completed[datetimes[0]] == 2000 and len(completed) == n_volumes and 
+              data['datetimes'].tolist() == [datetimes[0], datetimes[2]] and profiles_equal(data, 0, profiles[1]))
+        print('Outdated VVP version resets store:', store.get_completed(group_name, '2_0') == {})
+
+        try:
+            print('Time-height data read by PlottingVWP:', check_time_height_reader(directory+'/reader', datetimes, profiles))
+        except ImportError as e:
+            print(e, 'check_time_height_reader')
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Compares nlr_functions.get_window_phase_stdev with the previous implementation, that translated copies of the phase array for each
+window offset (get_window_phase_stdev_translated below), and compares their timings for a scan with 720 radials and 1832 radial bins.
+The previous implementation replicated the phases at the first and last radial bins for offsets beyond them, and translated incorrectly 
+in azimuth for the first and last radials. Results are therefore compared both with the previous implementation away from these bins, and 
+with a version of it that uses correct translations over the whole scan.
+Also shown is the circular standard deviation that follows from the mean resultant length (get_window_circular_stdev), and how often
+it leads to the same result as get_window_phase_stdev when comparing with a threshold, as done for velocity filtering in nlr_importdata.py.
+Usage: python benchmark_window_phase_stdev.py
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import time as pytime
+import numpy as np
+
+import nlr_functions as ft
+
+
+window = [1,2,3,2,1]
+n_repeat = 3
+
+def get_window_phase_stdev_translated(phi, data_mask, window, translate=ft.get_translated_arr):
+    sin_phi = np.sin(phi); sin_phi[data_mask] = 0.
+    cos_phi = np.cos(phi); cos_phi[data_mask] = 0.
+    phi_ref = ft.calculate_ref_phase(sin_phi, cos_phi, window)
+                
+    n_azi = int((len(window) - 1)/2)
+    n_rad = max(window)
+    
+    diff = np.zeros_like(phi)
+    for i in range(-n_azi, n_azi+1):
+        for j in range(-n_rad, n_rad+1):
+            if abs(j) > window[n_azi+i]:
+                continue
+            _diff = np.abs(phi_ref - translate(phi, (i, j)))
+            _diff = np.minimum(_diff, 2*np.pi-_diff)
+            _diff[translate(data_mask, (i, j))] = 0.
+            diff += _diff**2
+    n_unmasked = np.maximum(ft.get_window_sum((~data_mask).astype('uint8'), window), 1)
+    return np.sqrt(diff/n_unmasked)
+
+def translate_correct(arr, shift):
+    # Periodic in azimuth, and masked (when arr is boolean) or zero beyond the first and last radial bin
+    out = np.roll(arr, shift[0], axis=0)
+    fill = arr.dtype == bool
+    if shift[1] > 0:
+        out[:, :-shift[1]] = out[:, shift[1]:]
+        out[:, -shift[1]:] = fill
+    elif shift[1] < 0:
+        out[:, -shift[1]:] = out[:, :shift[1]]
+        out[:, :-shift[1]] = fill
+    return out
+
+def create_phases(rng, shape, noise, mask_fraction):
+    # Smooth phase field plus noise, wrapped to the interval from -pi to pi
+    azi, rad = np.meshgrid(np.linspace(0, 2*np.pi, shape[0], endpoint=False), np.linspace(0, 1, shape[1]), indexing='ij')
+    phi = 2*np.sin(azi)*rad + rng.normal(0, noise, shape)
+    phi = (phi+np.pi) % (2*np.pi) - np.pi
+    return phi, rng.random(shape) < mask_fraction
+
+def timing(function, *args):
+    t = pytime.perf_counter()
+    for i in range(n_repeat):
+        function(*args)
+    return 1e3*(pytime.perf_counter()-t)/n_repeat
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    n_half, w_max = len(window)//2, max(window)
+    interior = np.s_[2*n_half:-n_half, w_max:-w_max]
+    for noise in (0.2, 0.6, 1.2, 2.):
+        phi, data_mask = create_phases(rng, (360, 500), noise, 0.3)
+        stdev = ft.get_window_phase_stdev(phi, data_mask, window)
+        stdev_float32 = ft.get_window_phase_stdev(phi, data_mask, window, dtype='float32')
+        stdev_previous = get_window_phase_stdev_translated(phi.copy(), data_mask, window)
+        stdev_correct = get_window_phase_stdev_translated(phi.copy(), data_mask, window, translate_correct)
+        print(f'noise {noise} rad: max abs difference with previous (away from edges) '
+              f'{np.abs(stdev-stdev_previous)[interior].max():.1e}, with correct translations {np.abs(stdev-stdev_correct).max():.1e}, '
+              f'float32 {np.abs(stdev-stdev_float32).max():.1e}')
+        
+        circular_stdev = ft.get_window_circular_stdev(phi, data_mask, window)
+        unmasked = ~data_mask
+        for threshold in (0.63, 1.26):
+            agreement = ((stdev > threshold) == (circular_stdev > threshold))[unmasked].mean()
+            print(f'  circular stdev from resultant length: same result for threshold {threshold} rad for {100*agreement:.1f}% of bins')
+        print(f'  medians {np.median(stdev[unmasked]):.3f} and {np.median(circular_stdev[unmasked]):.3f}')
+        
+    phi, data_mask = create_phases(rng, (720, 1832), 0.6, 0.3)
+    print('720x1832 (ms):')
+    print(f'  previous {timing(get_window_phase_stdev_translated, phi.copy(), data_mask, window):.1f}')
+    for dtype in ('float64', 'float32'):
+        print(f'  get_window_phase_stdev {dtype} {timing(ft.get_window_phase_stdev, phi, data_mask, window, dtype):.1f}, '
+              f'get_window_circular_stdev {dtype} {timing(ft.get_window_circular_stdev, phi, data_mask, window, dtype):.1f}')
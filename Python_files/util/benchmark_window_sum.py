@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Checks that the summed-area table implementation of the window sum (nlr_functions.get_window_sum_sat) gives the same results as
+the implementation that adds shifted copies of the array (get_window_sum_shifted), and compares their timings for a scan with
+720 radials and 1832 radial bins. The timing of get_window_sum shows which method gets selected for each window.
+Usage: python benchmark_window_sum.py
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import time as pytime
+import numpy as np
+
+import nlr_functions as ft
+
+
+windows = ([0,1,0], [1,1,1], [2,2,2,2,2], [2,4,6,4,2], [5]*11, [10]*21, [4]*31, [20]*41)
+n_repeat = 3
+
+def timing(function, arr, window):
+    t = pytime.perf_counter()
+    for i in range(n_repeat):
+        function(arr, window)
+    return 1e3*(pytime.perf_counter()-t)/n_repeat
+
+def check_equal(rng):
+    # Random symmetric windows with the largest elements at the center, as required by get_window_sum_shifted
+    for i in range(300):
+        n_azi, n_rad = int(rng.integers(3, 40)), int(rng.integers(1, 60))
+        center = int(rng.integers(0, 8))
+        half = sorted(int(rng.integers(0, center+1)) for j in range(int(rng.integers(0, min(6, n_azi//2)+1))))
+        window = half+[center]+half[::-1]
+        for arr in (rng.random((n_azi, n_rad)).astype('float32'), rng.random((n_azi, n_rad)) > 0.8,
+                    rng.integers(0, 2, (n_azi, n_rad)).astype('uint8'), rng.integers(0, 100, (n_azi, n_rad))):
+            sum1, sum2 = ft.get_window_sum_shifted(arr, window), ft.get_window_sum_sat(arr, window)
+            equal = np.allclose(sum1, sum2, atol=1e-4) if arr.dtype.kind == 'f' else np.array_equal(sum1, sum2)
+            if not equal or sum1.dtype != sum2.dtype:
+                return False
+    return True
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    print('Equal results for random windows:', check_equal(rng))
+
+    arr = rng.random((720, 1832)).astype('float32')
+    for name, arr in (('float32', arr), ('uint8', (arr > 0.5).astype('uint8'))):
+        print(f'720x1832 {name} (ms):')
+        for window in windows:
+            t_shifted = timing(ft.get_window_sum_shifted, arr, window)
+            t_sat = timing(ft.get_window_sum_sat, arr, window)
+            t = timing(ft.get_window_sum, arr, window)
+            print(f'  {str(window) if len(window) < 10 else str(window[:1])+"*"+str(len(window)):<16} shifted {t_shifted:6.1f}  '
+                  f'summed-area table {t_sat:6.1f}  get_window_sum {t:6.1f}')
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the calculation of Zmax and Zavg on the grids of polar and Cartesian derived products (calculate_Zmax_and_Zavg_3D in
+derived/polar.py and derived/cartesian.py) with the previous versions (PreviousPolar and PreviousCartesian below). These sorted the radar
+bins by product bin, and looped over the number of radar bins per product bin. Synthetic volumes are used with 15 scans.
+- Polar: scans with a radial resolution of 0.125 km are mapped onto a product grid with a radial resolution of 0.25 km.
+  Zmax should be equal, and Zavg equal up to float32 rounding of the linear reflectivity sums.
+- Cartesian: grids with a resolution of 1 and 0.5 km. The previous version only averaged the first kmax = ceil(40*product_res**2) radar bins
+  that are mapped onto a product bin, and the current version averages all of them. Zavg is therefore compared for product bins with at most kmax
+  radar bins, and the maximum difference is shown for the other bins.
+Usage: python benchmark_zmax_zavg.py
+
+@author: bramv
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+import time as pytime
+from types import SimpleNamespace
+import numpy as np
+
+import nlr_functions as ft
+from derived.polar import Polar
+from derived.cartesian import Cartesian
+
+
+scanangles = [0.3, 0.5, 0.8, 1.1, 1.5, 2., 2.5, 3., 4., 5., 6., 8., 10., 12., 15.]
+n_repeat = 3
+
+class PreviousPolar(Polar):
+    def calculate_Zmax_and_Zavg_3D(self):
+        t = pytime.time()
+        """Calculates per scan the maximum and average reflectivity on the grid on which self.product_data is defined. 
+        
+        If the radial size (resolution) of a radar bin in self.data_all[scan] is greater than that of self.product_data, then this function simply
+        determines which bin in self.data_all[scan] is closest to a particular bin in self.product_data, and assigns its reflectivity to it.
+
+        If the radial size (resolution) of a radar bin in self.data_all[scan] is less than that of self.product_data, then multiple bins
+        in self.data_all[scan] can be mapped onto a particular bin in self.product_data, and this function determines the maximum reflectivity of
+        the bins in self.data_all[scan] that get mapped onto that particular bin in self.product_data. 
+        
+        For each scan, the function updates all bins in self.Zmax_3D_all[scan] for which the new reflectivities are higher than the old ones. Because 
+        multiple bins in the reflectivity data can be mapped onto the same bin in self.Zmax_3D_all[scan], this process must be repeated for all bins
+        in the reflectivity data. This is done by masking the bins in the reflectivity data that have already been handled, and then repeating the 
+        process for the non-masked part of the remaining array. The while loop that handles this stops when there are no remaining non-masked bins.
+        Finally, the flat array self.Zmax_3D_all[scan] is reshaped such that it has the correct dimensions.
+        
+        For self.Zavg_3D_all[scan] the calculation is done in a way comparable to that of Zmax, but with as difference that the algorithm now sums all reflectivities 
+        that are mapped onto a particular bin in self.Zavg_3D_all[scan], and finally divides them by the number of reflectivities that is mapped onto 
+        the particular bin, to arrive at the average reflectivity.
+        The average reflectivity is here given by Zavg = 10*log10(Zavg_linear), i.e., the average linear reflectivity is calculcated, and from this the 
+        logarithm is taken.
+        """
+        if self.get_data_specs()==self.data_specs:
+            return
+        
+        length = self.product_azimuthal_bins*self.product_radial_bins_all
+        
+        Z_empty = -30.       
+        n = sum([len(self.data_all[j]) for j in self.scans_all])
+        self.Zmax_3D_all = np.full((n, length), Z_empty, dtype='float32')
+        self.Zavg_3D_all = np.full((n, length), Z_empty, dtype='float32')
+        indices_occurrences = np.ones(length, dtype=self.get_int_dtype())
+                                                            
+        for j in self.scans_all:
+            for i in range(len(self.data_all[j])):
+                index = self.dp.index_all(j, i)
+                flattened = self.data_all[j][i].ravel()
+                n_azi = self.data_all[j][i].shape[0]
+                # The number of azimuthal bins for the scan might differ from self.product_azimuthal_bins. If that's the case only
+                # the first n_azi bins of the mapped Z arrays will be filled by the mapping procedure. At the end of this loop-iteration
+                # the results of the mapping procedure are then repeated by a factor self.product_azimuthal_bins/n_azi.
+                
+                if self.product_radial_res<=self.radial_res_all[j]:
+                    indices = self.radarbins_unique_all_flat[j][i]
+                    radial_bins = int(len(indices)/n_azi)
+                    data_array = self.Zmax_3D_all[index].reshape((self.product_azimuthal_bins,self.product_radial_bins_all))
+                    data_array[:n_azi,:radial_bins] = np.reshape(flattened[indices], (n_azi, radial_bins))
+                    data_array[np.isnan(data_array)] = Z_empty
+                    self.Zmax_3D_all[index] = self.Zavg_3D_all[index] = data_array.reshape(length)
+                else:
+                    retain = ~np.isnan(flattened)
+                    flattened = flattened[retain]
+                    indices = self.productbins_unique_all_flat[j][i][retain]
+                    #The linear reflectivity is only calculated for a bin in self.Zavg_3D_all[j] if more than one bin in self.data_all[j][i] is mapped onto that bin
+                    #in self.Zavg_3D_all[j], because calculating the logartihm to arrive back at the logarithmic reflectivity is an expensive operation.
+                    
+                    """indices_occurrences gives the number of occurrences for each index in indices. When the while loop is finished and each bin in 
+                    self.Zavg_3D_all[j] contains the sum of all reflectivities that are mapped onto that bin, then self.Zavg_3D_all[j] is divided by
+                    indices_occurrences, to get the average reflectivity.
+                    """
+                    indices_occurrences[:] = 1
+                    indices_bincount = np.bincount(indices)
+                    indices_occurrences[:len(indices_bincount)] = indices_bincount
+                    
+                    sort_indices = np.argsort(indices)
+                    indices = indices[sort_indices]
+                    flattened = flattened[sort_indices]
+                    
+                    indices_unique_orig, flattened_indices_orig, counts = np.unique(indices, return_index=True, return_counts=True)
+                    count_max = counts.max()
+    
+                    k = 0
+                    while k < count_max:
+                        if k == 0:
+                            self.Zavg_3D_all[index, indices_unique_orig] = self.Zmax_3D_all[index, indices_unique_orig] =\
+                                flattened[flattened_indices_orig]
+                        else:   
+                            select = counts > k
+                            indices_unique = indices_unique_orig[select]
+                            flattened_indices = flattened_indices_orig[select] + k                                
+
+                            if k == 1:
+                                # Perform this operation only once, because it is quite expensive
+                                self.Zavg_3D_all[index, indices_unique] = np.power(10., 0.1*self.Zavg_3D_all[index, indices_unique])
+                                
+                            self.Zavg_3D_all[index, indices_unique] += np.power(10., 0.1*flattened[flattened_indices])
+                            update = self.Zmax_3D_all[index, indices_unique]<flattened[flattened_indices]
+                            self.Zmax_3D_all[index, indices_unique[update]] = flattened[flattened_indices[update]]
+                        k += 1
+                        
+                    Zavg_islinear = indices_occurrences > 1
+                    self.Zavg_3D_all[index, Zavg_islinear] = 10.*np.log10(self.Zavg_3D_all[index, Zavg_islinear]/indices_occurrences[Zavg_islinear])
+                    
+                if n_azi != self.product_azimuthal_bins:
+                    # Repeat the mapping results as described at the start of the loop-iteration.
+                    n_repeat = int(self.product_azimuthal_bins/n_azi)
+                    for Z in (self.Zmax_3D_all, self.Zavg_3D_all):
+                        data = Z[index, :int(length/n_repeat)].reshape((n_azi, self.product_radial_bins_all))
+                        Z[index, :] = np.repeat(data, n_repeat, axis=0).reshape(length)
+                    
+        self.Zmax_3D_all.shape = (n, self.product_azimuthal_bins, self.product_radial_bins_all)                                          
+        self.Zavg_3D_all.shape = (n, self.product_azimuthal_bins, self.product_radial_bins_all)                                          
+                    
+        self.data_specs = self.get_data_specs()
+
+
+
+class PreviousCartesian(Cartesian):
+    def calculate_Zmax_and_Zavg_3D(self):
+        t = pytime.time()
+        """Calculates per scan the maximum and average reflectivity on the grid on which self.product_data is defined. 
+        See the same function in polar.py for more information, here only the difference with that implementation are described:
+        the only difference is that we cannot know beforehand whether
+        """
+        if self.get_data_specs()==self.data_specs:
+            return
+        
+        length = self.product_xy_bins_all**2
+        max_value = np.iinfo(self.get_int_dtype()).max
+        
+        Z_empty = -30.       
+        n = sum([len(self.data_all[j]) for j in self.scans_all])
+        self.Zavg_3D_all = np.full((n, length), Z_empty, dtype='float32')        
+        indices_occurrences = np.ones(length, dtype=self.get_int_dtype())
+                                                            
+        for j in self.scans_all:
+            for i in range(0, len(self.data_all[j])):
+                index = self.dp.index_all(j, i)
+                flattened = self.data_all[j][i].ravel()
+                
+                indices = self.productbins_unique_all_flat[j][i]
+                retain = (indices != max_value) & ~np.isnan(flattened)
+                flattened = flattened[retain]
+                indices = indices[retain]
+                #The linear reflectivity is only calculated for a bin in self.Zavg_3D_all[j] if more than one bin in self.data_all[j][i] is mapped onto that bin
+                #in self.Zavg_3D_all[j], because calculating the logartihm to arrive back at the logarithmic reflectivity is an expensive operation.
+                
+                kmax = max(1, int(np.ceil(40*self.product_res**2)))
+                """indices_occurrences gives the number of occurrences for each index in indices. When the while loop is finished and each bin in 
+                self.Zavg_3D_all[j] contains the sum of all reflectivities that are mapped onto that bin, then self.Zavg_3D_all[j] is divided by
+                indices_occurrences, to get the average reflectivity.
+                """
+                indices_occurrences[:] = 1
+                indices_bincount = np.minimum(np.bincount(indices), kmax)
+                indices_occurrences[:len(indices_bincount)] = indices_bincount
+                
+                sort_indices = np.argsort(indices)
+                indices = indices[sort_indices]
+                flattened = flattened[sort_indices]
+                
+                indices_unique_orig, flattened_indices_orig, counts = np.unique(indices, return_index=True, return_counts=True)
+                count_max = counts.max()
+
+                k = 0
+                while k < min([kmax, count_max]):
+                    if k == 0:
+                        self.Zavg_3D_all[index, indices_unique_orig] = flattened[flattened_indices_orig]
+                    else:                                   
+                        select = counts > k
+                        indices_unique = indices_unique_orig[select]
+                        flattened_indices = flattened_indices_orig[select] + k
+                        
+                        if k == 1:
+                            # Perform this operation only once, because it is quite expensive
+                            self.Zavg_3D_all[index, indices_unique] = np.power(10., 0.1*self.Zavg_3D_all[index, indices_unique])
+                            
+                        self.Zavg_3D_all[index, indices_unique] += np.power(10., 0.1*flattened[flattened_indices])
+                    k += 1
+                
+                Zavg_islinear = indices_occurrences > 1
+                self.Zavg_3D_all[index, Zavg_islinear] = 10.*np.log10(self.Zavg_3D_all[index, Zavg_islinear]/indices_occurrences[Zavg_islinear])
+
+                flattened = self.data_all[j][i].ravel()
+                Zavg_empty = (self.Zavg_3D_all[index] == Z_empty) & (self.radarbins_unique_all_flat[j][i] != max_value)
+                self.Zavg_3D_all[index, Zavg_empty] = flattened[self.radarbins_unique_all_flat[j][i][Zavg_empty]]
+                
+        self.Zavg_3D_all[np.isnan(self.Zavg_3D_all)] = Z_empty  
+        self.Zavg_3D_all.shape = (n, self.product_xy_bins_all, self.product_xy_bins_all)
+        self.Zmax_3D_all = self.Zavg_3D_all
+
+        self.data_specs = self.get_data_specs()
+
+
+
+def synthetic_volume(rng, radial_res, n_azi=360, max_range=250.):
+    data = {}
+    n_rad = int(max_range/radial_res)
+    azi = np.deg2rad(np.arange(0.5, n_azi)*360/n_azi)[:, None]
+    r = radial_res*np.arange(0.5, n_rad)[None]
+    for j in range(1, len(scanangles)+1):
+        Z = 20+25*np.sin(3*azi+r/20)*np.cos(r/35)+rng.normal(0, 3, (n_azi, n_rad))
+        Z[(Z < 10) | (rng.random(Z.shape) < 0.1)] = np.nan
+        data[j] = [Z.astype('float32')]
+    return data
+
+def setup(cls, data, radial_res, product_res=None):
+    scans = list(data)
+    dsg = SimpleNamespace(scannumbers_all={'z': {j: [1] for j in scans}})
+    gui = SimpleNamespace(cartesian_product_res=product_res, cartesian_product_maxrange=200.)
+    dp = SimpleNamespace(dsg=dsg, gui=gui, get_import_data_specs=lambda: str(pytime.perf_counter()))
+    dp.index_all = lambda scan, sub_scan: scans.index(scan)+sub_scan
+    mapping = cls(dp)
+    mapping.data_all, mapping.scans, mapping.scans_all, mapping.i_p = data, scans, scans, 'z'
+    mapping.scanangles_all = {j: scanangles[j-1] for j in scans}
+    mapping.radial_bins_all = {j: data[j][0].shape[1] for j in scans}
+    mapping.radial_res_all = {j: radial_res for j in scans}
+    mapping.radial_range_all = {j: mapping.radial_bins_all[j]*radial_res for j in scans}
+    mapping.radius_offsets_all = {j: 0. for j in scans}
+    if cls is PreviousPolar or cls is Polar:
+        dp.bottom_scan_removed = True
+        mapping.get_product_dimensions()
+        # A coarser product resolution than that of the scans, such that multiple radar bins are mapped onto each product bin
+        mapping.product_radial_res = 2*radial_res
+        mapping.product_radial_bins = mapping.product_radial_bins_all = int(np.ceil(mapping.product_radial_bins/2))
+        mapping.assign_radarbins_to_productbins()
+        mapping.assign_productbins_to_radarbins()
+    else:
+        mapping.translation_vectors = {j: [np.zeros(2)] for j in scans}
+        mapping.get_product_dimensions()
+        mapping.assign_radarbins_to_productbins()
+        mapping.get_product_coords_and_groundranges()
+        mapping.assign_productbins_to_radarbins()
+    return mapping
+
+def run(mapping):
+    t = pytime.perf_counter()
+    for i in range(n_repeat):
+        mapping.data_specs = None
+        mapping.calculate_Zmax_and_Zavg_3D()
+    return (pytime.perf_counter()-t)/n_repeat
+
+def counts_per_productbin(mapping, length):
+    counts = []
+    for j in mapping.scans_all:
+        indices = mapping.productbins_unique_all_flat[j][0]
+        retain = (indices < length) & ~np.isnan(mapping.data_all[j][0].ravel())
+        counts.append(np.bincount(indices[retain], minlength=length))
+    return np.array(counts)
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    data = synthetic_volume(rng, 0.125)
+    previous, current = setup(PreviousPolar, data, 0.125), setup(Polar, data, 0.125)
+    t_previous, t = run(previous), run(current)
+    print(f'Polar {current.product_azimuthal_bins}x{current.product_radial_bins_all}: previous {t_previous:.3f} s, new {t:.3f} s')
+    print('  Zmax equal:', np.array_equal(previous.Zmax_3D_all, current.Zmax_3D_all), 
+          f', Zavg max abs difference: {np.abs(previous.Zavg_3D_all-current.Zavg_3D_all).max():.2e} dBZ')
+
+    data = synthetic_volume(rng, 0.25)
+    for product_res in (1., 0.5):
+        previous, current = setup(PreviousCartesian, data, 0.25, product_res), setup(Cartesian, data, 0.25, product_res)
+        t_previous, t = run(previous), run(current)
+        n = current.product_xy_bins_all
+        print(f'Cartesian {n}x{n} ({product_res} km): previous {t_previous:.3f} s, new {t:.3f} s')
+        kmax = max(1, int(np.ceil(40*product_res**2)))
+        counts = counts_per_productbin(current, n**2).reshape(previous.Zavg_3D_all.shape)
+        diff = np.abs(previous.Zavg_3D_all-current.Zavg_3D_all)
+        print(f'  Zavg max abs difference: {diff[counts <= kmax].max():.2e} dBZ for product bins with at most {kmax} radar bins,',
+              f'{diff[counts > kmax].max() if (counts > kmax).any() else 0:.2f} dBZ for the {100*np.mean(counts > kmax):.2f}% of product bins with more')
+    
+    # Chunking should not change the results
+    chunk_size = ft.grid_mapping_chunk_size
+    ft.grid_mapping_chunk_size = 10000
+    chunked = setup(Cartesian, data, 0.25, 0.5)
+    t = run(chunked)
+    ft.grid_mapping_chunk_size = chunk_size
+    print(f'Cartesian with chunks of 10000 radar bins: {t:.3f} s, equal results: {np.array_equal(chunked.Zavg_3D_all, current.Zavg_3D_all)}')
@@ -12,5 +12,7 @@ setup(name='NLradar',
       description='',
       author="Bram van 't Veen",
       packages=[],
-      install_requires=['numpy','pyproj','pyshp','opencv-python','pillow','imageio','pyqt5','scipy','requests','gpxpy','netcdf4==1.6','pyopengl','matplotlib','numpy-bufr @ git+https://github.com/Bram94/numpy_bufr.git','xmltodict','boto3','pytz','av','tensorflow==2.10','pyperclip','Unidecode']
+      install_requires=['numpy','pyproj','pyshp','opencv-python','pillow','imageio','pyqt5','scipy','requests','gpxpy','netcdf4==1.6','pyopengl','matplotlib','numpy-bufr @ git+https://github.com/Bram94/numpy_bufr.git','xmltodict','boto3','pytz','av','tensorflow==2.10','pyperclip','Unidecode'],
+      # Optional, for detecting changes in radar data directories without polling (see nlr_directoryindex.py)
+      extras_require={'watchdog':['watchdog']}
 	  )